@@ -0,0 +1,80 @@
+"""
+Benchmarking script for the gradient clipping, with a kernel per gradient or with the multi-tensor kernels
+
+Usage:
+```
+python examples/bench_clip_grads.py --n-params 2000 --param-size 1048576
+```
+"""
+
+import argparse
+import time
+
+import torch
+from nanotron import distributed as dist
+from nanotron.optim.clip_grads import clip_grad_norm
+from nanotron.parallel.parameters import NanotronParameter
+from nanotron.utils import find_free_port
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-params", type=int, default=2000, help="Number of parameters")
+    parser.add_argument("--param-size", type=int, default=2**20, help="Number of elements of each parameter")
+    parser.add_argument("--norm-type", type=float, default=2.0)
+    parser.add_argument("--n-iterations", type=int, default=20)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_args()
+
+
+def synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def main(args):
+    device = torch.device(args.device)
+    backend = "nccl" if device.type == "cuda" else "gloo"
+    dist.init_process_group(backend=backend, init_method=f"tcp://localhost:{find_free_port()}", rank=0, world_size=1)
+
+    named_parameters = []
+    for i in range(args.n_params):
+        param = NanotronParameter(torch.empty(args.param_size, device=device))
+        param.grad = torch.randn(args.param_size, device=device)
+        named_parameters.append((f"param_{i}", param))
+
+    for foreach in (False, True):
+        # Warmup
+        clip_grad_norm(
+            mp_pg=dist.group.WORLD,
+            named_parameters=named_parameters,
+            max_norm=1.0,
+            grad_accumulator=None,
+            norm_type=args.norm_type,
+            foreach=foreach,
+        )
+        synchronize(device)
+
+        start_time = time.perf_counter()
+        for _ in range(args.n_iterations):
+            clip_grad_norm(
+                mp_pg=dist.group.WORLD,
+                named_parameters=named_parameters,
+                max_norm=1.0,
+                grad_accumulator=None,
+                norm_type=args.norm_type,
+                foreach=foreach,
+            )
+        synchronize(device)
+        elapsed_time = (time.perf_counter() - start_time) / args.n_iterations
+
+        print(
+            f"[foreach={foreach}] {args.n_params} gradients of {args.param_size} elements on {device}: {elapsed_time * 1000:.2f}ms"
+        )
+
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    _args = get_args()
+    main(_args)
@@ -0,0 +1,56 @@
+"""
+Benchmarking script for the Nanoset index builders
+
+Usage:
+```
+python examples/bench_nanoset_index.py --n-samples 1000000000 --n-datasets 50
+```
+"""
+
+import argparse
+import time
+
+import numpy as np
+from nanotron.data.nanoset import NANOSET_INDEX_BUILDERS
+from nanotron.data.utils import normalize
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-samples", type=int, default=10**9, help="Number of samples of the index")
+    parser.add_argument("--n-datasets", type=int, default=50, help="Number of datasets of the mixture")
+    parser.add_argument(
+        "--index-builders",
+        type=str,
+        nargs="+",
+        default=list(NANOSET_INDEX_BUILDERS.keys()),
+        choices=list(NANOSET_INDEX_BUILDERS.keys()),
+        help="Index builders to benchmark",
+    )
+    parser.add_argument("--seed", type=int, default=1234)
+    return parser.parse_args()
+
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    dataset_weights = normalize(rng.random(args.n_datasets).tolist())
+    dataset_sizes = np.maximum(rng.multinomial(args.n_samples, dataset_weights), 1)
+
+    for index_builder in args.index_builders:
+        build_nanoset_index = NANOSET_INDEX_BUILDERS[index_builder]
+        # Trigger the numba compilation with a small index so it's not included in the measurement
+        build_nanoset_index(n_samples=args.n_datasets, weights=dataset_weights, dataset_sizes=dataset_sizes)
+
+        start_time = time.perf_counter()
+        build_nanoset_index(n_samples=args.n_samples, weights=dataset_weights, dataset_sizes=dataset_sizes)
+        elapsed_time = time.perf_counter() - start_time
+
+        print(
+            f"[{index_builder}] {args.n_samples} samples, {args.n_datasets} datasets: {elapsed_time:.2f}s "
+            f"({args.n_samples / elapsed_time:.2e} samples/s)"
+        )
+
+
+if __name__ == "__main__":
+    _args = get_args()
+    main(_args)
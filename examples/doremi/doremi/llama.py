@@ -9,6 +9,7 @@ from nanotron.models import NanotronModel
 from nanotron.models.llama import LlamaModel
 from nanotron.nn.layer_norm import TritonRMSNorm
 from nanotron.parallel import ParallelContext
+from nanotron.parallel.data_parallel.fully_sharded import iter_materialized_named_parameters
 from nanotron.parallel.parameters import NanotronParameter
 from nanotron.parallel.pipeline_parallel.block import PipelineBlock, TensorPointer
 from nanotron.parallel.tensor_parallel.functional import sharded_cross_entropy
@@ -44,7 +45,8 @@ class BaseLLaMa(NanotronModel):
         sigma = config.model.init_method.std
         num_layers = config.model.model_config.num_hidden_layers
 
-        for param_name, param in model.named_parameters():
+        # The parameters sharded across DP are allocated one block at a time
+        for param_name, param in iter_materialized_named_parameters(model):
             assert isinstance(param, NanotronParameter)
 
             module_name, param_name = param_name.rsplit(".", 1)
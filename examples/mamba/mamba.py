@@ -31,6 +31,7 @@ from nanotron.generation.generate_store import AttachableStore
 from nanotron.logging import log_rank
 from nanotron.models import NanotronModel
 from nanotron.parallel import ParallelContext
+from nanotron.parallel.data_parallel.fully_sharded import iter_materialized_named_parameters
 from nanotron.parallel.parameters import NanotronParameter
 from nanotron.parallel.pipeline_parallel.block import PipelineBlock, TensorPointer
 from nanotron.parallel.pipeline_parallel.p2p import P2P
@@ -834,7 +835,8 @@ class MambaForTraining(NanotronModel):
             dt_rank = config.model.model_config.ssm_cfg["dt_rank"]
             dt_scale = config.model.model_config.ssm_cfg["dt_scale"]
 
-        for param_name, param in model.named_parameters():
+        # The parameters sharded across DP are allocated one block at a time
+        for param_name, param in iter_materialized_named_parameters(model):
             assert isinstance(param, NanotronParameter)
 
             module_name, param_name = param_name.rsplit(".", 1)
@@ -13,6 +13,7 @@ from nanotron.config import ParallelismArgs
 from nanotron.logging import log_rank
 from nanotron.models import NanotronModel
 from nanotron.parallel import ParallelContext
+from nanotron.parallel.data_parallel.fully_sharded import get_param_id_to_shard
 from nanotron.parallel.parameters import NanotronParameter
 from nanotron.parallel.pipeline_parallel.utils import get_pp_rank_of
 from nanotron.parallel.tensor_parallel.nn import (
@@ -51,12 +52,13 @@ class MambaTrainer(DistributedTrainer):
                 (
                     target,
                     (
-                        parallel_context.world_rank_matrix[
-                            dist.get_rank(parallel_context.expert_pg),
-                            get_pp_rank_of(target, module=model),
-                            dist.get_rank(parallel_context.dp_pg),
-                            dist.get_rank(parallel_context.tp_pg),
-                        ],
+                        parallel_context.get_global_rank(
+                            ep_rank=dist.get_rank(parallel_context.expert_pg),
+                            pp_rank=get_pp_rank_of(target, module=model),
+                            dp_rank=dist.get_rank(parallel_context.dp_pg),
+                            tp_rank=dist.get_rank(parallel_context.tp_pg),
+                            cp_rank=dist.get_rank(parallel_context.cp_pg),
+                        ),
                     ),
                 )
                 for target in embeddings_lm_head_tied_names
@@ -136,7 +138,11 @@ class MambaTrainer(DistributedTrainer):
                 unwrapped_model.init_model_randomly(config=self.config)
                 # Synchronize parameters so that the model is consistent
                 # sync all params across dp
+                param_id_to_shard = get_param_id_to_shard(unwrapped_model)
                 for name, param in sorted(model.named_parameters(), key=lambda x: x[0]):
+                    if id(param) in param_id_to_shard:
+                        # Each DP rank keeps its own slices of the parameters sharded across DP
+                        continue
                     dist.all_reduce(param, op=dist.ReduceOp.AVG, group=self.parallel_context.dp_pg)
 
                 # sync tied params across tied groups
@@ -148,7 +154,8 @@ class MambaTrainer(DistributedTrainer):
                     key=lambda x: x[0],
                 ):
                     group = self.parallel_context.world_ranks_to_pg[group_ranks]
-                    dist.all_reduce(param, op=dist.ReduceOp.AVG, group=group)
+                    # The tied ranks of a parameter sharded across DP keep the same slices of it
+                    dist.all_reduce(param_id_to_shard.get(id(param), param), op=dist.ReduceOp.AVG, group=group)
             else:
                 raise ValueError(f"Unsupported {self.config.model.init_method}")
 
@@ -0,0 +1,121 @@
+"""
+Recommends the parallelism of a run from its config, without any GPU
+
+Usage:
+```
+python examples/plan_parallelism.py --config-file examples/config_tiny_llama.yaml --num-gpus 64 --global-batch-size 512
+```
+
+To compare the memory and throughput of the recompute policies with the parallelism of the config:
+```
+python examples/plan_parallelism.py --config-file examples/config_tiny_llama.yaml --compare-recompute-policies
+```
+
+The bandwidths can be measured with `nanotron.helpers.test_all_pair_to_pair`.
+"""
+
+import argparse
+
+from nanotron.config import Config, LlamaConfig, get_config_from_file
+from nanotron.config.utils_config import cast_pipeline_engine_to_str
+from nanotron.parallel.pipeline_parallel.schedule import PIPELINE_SCHEDULES
+from nanotron.parallel.planner import (
+    GiB,
+    HardwareArgs,
+    plan_parallelism,
+    plan_recompute_policies,
+    recommend_parallelism,
+)
+from nanotron.parallel.tensor_parallel.nn import TensorParallelLinearMode
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config-file", type=str, required=True, help="Path to the YAML config file")
+    parser.add_argument("--num-gpus", type=int, default=None, help="Number of GPUs, defaults to the config's")
+    parser.add_argument(
+        "--global-batch-size", type=int, default=None, help="Sequences per step, defaults to the config's"
+    )
+    parser.add_argument("--gpus-per-node", type=int, default=8)
+    parser.add_argument("--peak-tflops", type=float, default=989.0, help="Peak dense bf16 TFLOPs of a GPU")
+    parser.add_argument("--mfu", type=float, default=0.5, help="Fraction of the peak flops the matmuls reach")
+    parser.add_argument("--gpu-memory", type=float, default=80.0, help="Memory of a GPU in GiB")
+    parser.add_argument("--intra-node-bandwidth", type=float, default=150.0, help="Bus bandwidth in GB/s in a node")
+    parser.add_argument("--inter-node-bandwidth", type=float, default=25.0, help="Bus bandwidth in GB/s across nodes")
+    parser.add_argument(
+        "--pp-engines",
+        type=str,
+        nargs="+",
+        default=["afab", "1f1b"],
+        choices=list(PIPELINE_SCHEDULES.keys()),
+        help="Pipeline engines to consider",
+    )
+    parser.add_argument("--top-k", type=int, default=10, help="Number of parallelisms to recommend")
+    parser.add_argument(
+        "--compare-recompute-policies",
+        action="store_true",
+        help="Report the step time and memory of each recompute policy with the parallelism of the config",
+    )
+    return parser.parse_args()
+
+
+def main(args):
+    config = get_config_from_file(args.config_file, config_class=Config, model_config_class=LlamaConfig)
+    model_config = config.model.model_config
+    hardware = HardwareArgs(
+        gpus_per_node=args.gpus_per_node,
+        peak_flops=args.peak_tflops * 1e12,
+        mfu=args.mfu,
+        gpu_memory=args.gpu_memory * GiB,
+        intra_node_bandwidth=args.intra_node_bandwidth * 1e9,
+        inter_node_bandwidth=args.inter_node_bandwidth * 1e9,
+    )
+    parallelism = config.parallelism
+    num_gpus = args.num_gpus or parallelism.dp * parallelism.tp * parallelism.pp
+    global_batch_size = args.global_batch_size or config.global_batch_size
+
+    pp_engine = cast_pipeline_engine_to_str(parallelism.pp_engine)
+    if args.num_gpus is None and args.global_batch_size is None and pp_engine in PIPELINE_SCHEDULES:
+        current_parallelism = {
+            "dp": parallelism.dp,
+            "tp": parallelism.tp,
+            "pp": parallelism.pp,
+            "sequence_length": config.tokens.sequence_length,
+            "micro_batch_size": config.tokens.micro_batch_size,
+            "batch_accumulation_per_replica": config.tokens.batch_accumulation_per_replica,
+            "pp_engine": pp_engine,
+            "sequence_parallel": parallelism.tp_mode is TensorParallelLinearMode.REDUCE_SCATTER,
+            "zero_stage": config.optimizer.zero_stage,
+        }
+        current_plan = plan_parallelism(
+            model_config,
+            hardware,
+            recompute_policy=parallelism.recompute_policy,
+            recompute_layer_interval=parallelism.recompute_layer_interval,
+            **current_parallelism,
+        )
+        print(f"Current config: {current_plan}")
+
+        if args.compare_recompute_policies:
+            print("Recompute policies, from the fastest (* if it fits in memory):")
+            for plan in plan_recompute_policies(model_config, hardware, **current_parallelism):
+                print(f"{'*' if plan.fits_in_memory(hardware) else ' '} {plan}")
+
+    plans = recommend_parallelism(
+        model_config,
+        hardware,
+        num_gpus=num_gpus,
+        sequence_length=config.tokens.sequence_length,
+        global_batch_size=global_batch_size,
+        pp_engines=tuple(args.pp_engines),
+        zero_stage=config.optimizer.zero_stage,
+        top_k=args.top_k,
+    )
+    if len(plans) == 0:
+        print(f"No parallelism fits in memory with {num_gpus} GPUs")
+    for plan in plans:
+        print(plan)
+
+
+if __name__ == "__main__":
+    main(get_args())
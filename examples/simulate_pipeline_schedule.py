@@ -0,0 +1,52 @@
+"""
+Predicts the pipeline bubble of each pipeline engine, without any GPU
+
+Usage:
+```
+python examples/simulate_pipeline_schedule.py --pp 4 --nb-microbatches 8
+```
+"""
+
+import argparse
+
+from nanotron.parallel.pipeline_parallel.schedule import PIPELINE_SCHEDULES, simulate_pipeline_schedule
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pp", type=int, required=True, help="Number of PP stages")
+    parser.add_argument("--nb-microbatches", type=int, required=True, help="Number of micro batches per batch")
+    parser.add_argument("--forward-time", type=float, default=1.0, help="Time of the forward of a stage")
+    parser.add_argument(
+        "--backward-input-time", type=float, default=1.0, help="Time of the input gradient computation of a stage"
+    )
+    parser.add_argument(
+        "--backward-weight-time", type=float, default=1.0, help="Time of the weight gradient computation of a stage"
+    )
+    parser.add_argument("--p2p-time", type=float, default=0.0, help="Time to send activations to the next stage")
+    parser.add_argument(
+        "--pp-engines",
+        type=str,
+        nargs="+",
+        default=list(PIPELINE_SCHEDULES.keys()),
+        choices=list(PIPELINE_SCHEDULES.keys()),
+        help="Pipeline engines to simulate",
+    )
+    return parser.parse_args()
+
+
+def main(args):
+    for pp_engine in args.pp_engines:
+        get_schedule = PIPELINE_SCHEDULES[pp_engine]
+        simulation = simulate_pipeline_schedule(
+            [get_schedule(args.pp, pp_rank, args.nb_microbatches) for pp_rank in range(args.pp)],
+            forward_time=args.forward_time,
+            backward_input_time=args.backward_input_time,
+            backward_weight_time=args.backward_weight_time,
+            p2p_time=args.p2p_time,
+        )
+        print(f"{pp_engine:>12}: step time {simulation.step_time:.2f} | bubble ratio {simulation.bubble_ratio:.1%}")
+
+
+if __name__ == "__main__":
+    main(get_args())
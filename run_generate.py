@@ -21,6 +21,7 @@ from nanotron.config import (
     ParallelismArgs,
     get_config_from_file,
 )
+from nanotron.generation.continuous_batching import ContinuousBatchingDecoder
 from nanotron.generation.decode import (
     GenerationInput,
     TokenizerConfig,
@@ -60,6 +61,14 @@ def get_args():
     parser.add_argument("--pp", type=int, default=0)
     parser.add_argument("--tp", type=int, default=0)
     parser.add_argument("--max-new-tokens", type=int, default=128, help="Maximum number of new tokens to generate")
+    parser.add_argument(
+        "--paged-kv-cache-num-blocks", type=int, default=None, help="Number of blocks of the paged KV cache per layer"
+    )
+    parser.add_argument(
+        "--continuous-batching",
+        action="store_true",
+        help="Replace the finished sequences by new ones at each step (requires --paged-kv-cache-num-blocks)",
+    )
     return parser.parse_args()
 
 
@@ -70,6 +79,9 @@ def main():
 
     config = get_config_from_file((args.ckpt_path / "config.yaml").as_posix())
     model_config = config.model.model_config
+    if getattr(model_config, "doc_masking", False):
+        # Documents are only packed at training time
+        model_config.doc_masking = False
     tokenizer_path = config.tokenizer.tokenizer_name_or_path
 
     parallel_config = ParallelismArgs(
@@ -172,18 +184,33 @@ def main():
             # "Tomorrow's world is shaped by",
         ]
 
-        outputs = decode_text(
-            input_iter=(GenerationInput(text=text) for text in dummy_inputs),
-            tokenizer=tokenizer,
-            # TODO @thomasw21: From ModelWithLoss extract the model.
-            model=model.model,
-            parallel_context=parallel_context,
-            max_new_tokens=args.max_new_tokens,
-            max_micro_batch_size=2,
-            generation_config=GenerationArgs(sampler="greedy", use_cache=True),
-            tokenizer_config=TokenizerConfig(max_input_length=None),
-            is_bench=os.environ.get("USE_BENCH", "0") == "1",
+        generation_config = GenerationArgs(
+            sampler="greedy", use_cache=True, paged_kv_cache_num_blocks=args.paged_kv_cache_num_blocks
         )
+        if args.continuous_batching:
+            outputs = ContinuousBatchingDecoder(
+                # TODO @thomasw21: From ModelWithLoss extract the model.
+                model=model.model,
+                tokenizer=tokenizer,
+                parallel_context=parallel_context,
+                generation_config=generation_config,
+                tokenizer_config=TokenizerConfig(max_input_length=None),
+                max_batch_size=2,
+                max_new_tokens=args.max_new_tokens,
+            ).generate(input_iter=(GenerationInput(text=text) for text in dummy_inputs))
+        else:
+            outputs = decode_text(
+                input_iter=(GenerationInput(text=text) for text in dummy_inputs),
+                tokenizer=tokenizer,
+                # TODO @thomasw21: From ModelWithLoss extract the model.
+                model=model.model,
+                parallel_context=parallel_context,
+                max_new_tokens=args.max_new_tokens,
+                max_micro_batch_size=2,
+                generation_config=generation_config,
+                tokenizer_config=TokenizerConfig(max_input_length=None),
+                is_bench=os.environ.get("USE_BENCH", "0") == "1",
+            )
         for output in outputs:
             input_ids = output.input_ids
             generated_ids = output.generation_ids
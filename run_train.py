@@ -144,6 +144,7 @@ def get_dataloader_from_data_stage(
         # Get tokenizer cardinality
         tokenizer = AutoTokenizer.from_pretrained(trainer.config.tokenizer.tokenizer_name_or_path)
         token_size = 4 if len(tokenizer) > np.iinfo(np.uint16).max + 1 else 2
+        eos_token_id = tokenizer.eos_token_id if data.dataset.pack_documents else None
         del tokenizer
         # Create Nanoset
         from nanotron.data.nanoset import Nanoset
@@ -156,6 +157,8 @@ def get_dataloader_from_data_stage(
                 token_size=token_size,
                 train_split_num_samples=trainer.config.tokens.train_steps * trainer.global_batch_size,
                 random_seed=data.seed,
+                index_builder=data.dataset.index_builder,
+                cache_index=data.dataset.cache_index,
             )
 
         # Prepare dataloader
@@ -169,6 +172,7 @@ def get_dataloader_from_data_stage(
             consumed_train_samples=consumed_train_samples,
             dataloader_num_workers=data.num_loading_workers,
             dataloader_drop_last=True,
+            eos_token_id=eos_token_id,
         )
 
         return train_dataloader
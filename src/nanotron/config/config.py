@@ -12,7 +12,13 @@ from datasets.download.streaming_download_manager import xPath
 from yaml.loader import SafeLoader
 
 from nanotron.config.lighteval_config import LightEvalConfig
-from nanotron.config.models_config import ExistingCheckpointInit, NanotronConfigs, RandomInit, SpectralMupInit
+from nanotron.config.models_config import (
+    ExistingCheckpointInit,
+    LlamaConfig,
+    NanotronConfigs,
+    RandomInit,
+    SpectralMupInit,
+)
 from nanotron.config.parallelism_config import ParallelismArgs
 from nanotron.config.utils_config import (
     RecomputeGranularity,
@@ -113,11 +119,21 @@ class S3UploadArgs:
 class NanosetDatasetsArgs:
     dataset_folder: Union[str, List[str]]
     dataset_weights: Optional[List[float]] = None
+    index_builder: str = "argmax"
+    cache_index: bool = True
+    pack_documents: bool = False
 
     def __post_init__(self):
         if isinstance(self.dataset_folder, str):  # Case 1: 1 Dataset folder
             self.dataset_folder = [self.dataset_folder]
             self.dataset_weights = [1]
+        from nanotron.data.nanoset import NANOSET_INDEX_BUILDERS
+
+        if self.index_builder not in NANOSET_INDEX_BUILDERS:
+            raise ValueError(
+                f"index_builder should be a string selected in {list(NANOSET_INDEX_BUILDERS.keys())} "
+                f"and not {self.index_builder}"
+            )
 
 
 @dataclass
@@ -127,10 +143,13 @@ class DataArgs:
     dataset: Optional[Union[PretrainDatasetsArgs, NanosetDatasetsArgs]]
     seed: Optional[int]
     num_loading_workers: Optional[int] = 1
+    num_prefetch_micro_batches: int = 0  # Micro-batches copied to the GPU ahead of the training loop, 0 to disable
 
     def __post_init__(self):
         if self.seed is None:
             self.seed = DEFAULT_SEED
+        if self.num_prefetch_micro_batches < 0:
+            raise ValueError(f"num_prefetch_micro_batches should be >= 0 and not {self.num_prefetch_micro_batches}")
 
 
 @dataclass
@@ -152,6 +171,10 @@ class CheckpointsArgs:
     checkpoints_path: where to save the checkpoints
     checkpoint_interval: how often to save the checkpoints
     resume_checkpoint_path: if you want to load from a specific checkpoint path
+    async_save: snapshot the states in pinned CPU memory and write them to disk in the background
+    max_weights_shard_size: if set, pack the weights of each rank in safetensors shards of at most this many bytes
+        instead of saving one file per parameter
+    load_weights_num_workers: number of threads reading the weights files when loading a checkpoint
     """
 
     checkpoints_path: Path
@@ -162,8 +185,13 @@ class CheckpointsArgs:
     load_lr_scheduler: Optional[bool] = True
     load_optimizer: Optional[bool] = True
     checkpoints_path_is_shared_file_system: Optional[bool] = False
+    async_save: Optional[bool] = False
+    max_weights_shard_size: Optional[int] = None
+    load_weights_num_workers: Optional[int] = 8
 
     def __post_init__(self):
+        if self.load_weights_num_workers is not None and self.load_weights_num_workers < 1:
+            raise ValueError(f"load_weights_num_workers should be >= 1 and not {self.load_weights_num_workers}")
         if isinstance(self.checkpoints_path, str):
             self.checkpoints_path = xPath(self.checkpoints_path)
         if isinstance(self.resume_checkpoint_path, str):
@@ -317,6 +345,21 @@ class OptimizerArgs:
     clip_grad: Optional[float]
     accumulate_grad_in_fp32: bool
     learning_rate_scheduler: LRSchedulerArgs
+    # ZeRO stage 2 reduce-scatters the gradients across DP in buckets of this size
+    # (ZeRO stage 3 reduce-scatters the gradients of each `PipelineBlock` as soon as its backward is done)
+    zero_bucket_cap_mb: int = 25
+    # Keep the fp32 weights and the optimizer states in pinned CPU memory, and run the optimizer step on CPU
+    cpu_offload: bool = False
+
+    def __post_init__(self):
+        if self.zero_stage not in (0, 1, 2, 3):
+            raise ValueError(f"zero_stage should be 0, 1, 2 or 3, got {self.zero_stage}")
+        if self.zero_stage >= 2 and not self.accumulate_grad_in_fp32:
+            raise ValueError(
+                f"zero_stage {self.zero_stage} shards the fp32 gradients, it requires accumulate_grad_in_fp32"
+            )
+        if self.cpu_offload and not self.accumulate_grad_in_fp32:
+            raise ValueError("cpu_offload offloads the fp32 weights, it requires accumulate_grad_in_fp32")
 
 
 @dataclass
@@ -327,12 +370,20 @@ class GenerationArgs:
     top_p: Optional[float] = None
     n_samples: Optional[int] = None
     eos: Optional[str] = None
+    # A sequence is done once it generates `eos` (or the tokenizer's EOS token) or one of the `stop_strings`
+    stop_strings: Optional[List[str]] = None
     seed: Optional[int] = None
     use_cache: Optional[bool] = False
+    # If set, the KV cache is paged: each attention layer gets `paged_kv_cache_num_blocks` blocks of
+    # `paged_kv_cache_block_size` tokens shared by all the sequences (flash-attn requires a multiple of 256)
+    paged_kv_cache_num_blocks: Optional[int] = None
+    paged_kv_cache_block_size: int = 256
 
     def __post_init__(self):
         if isinstance(self.sampler, str):
             self.sampler = SamplerType[self.sampler.upper()]
+        if self.paged_kv_cache_num_blocks is not None and not self.use_cache:
+            raise ValueError("paged_kv_cache_num_blocks requires use_cache")
         if self.seed is None:
             self.seed = DEFAULT_SEED
 
@@ -373,6 +424,35 @@ class Config:
                 self.tokens.train_steps - self.optimizer.learning_rate_scheduler.lr_warmup_steps
             )
 
+        if self.parallelism is not None and self.tokens is not None:
+            # Context parallelism splits the sequences in contiguous chunks, one per CP rank
+            if self.tokens.sequence_length % self.parallelism.cp != 0:
+                raise ValueError(
+                    f"sequence_length ({self.tokens.sequence_length}) should be divisible by cp ({self.parallelism.cp})"
+                )
+            local_sequence_length = self.tokens.sequence_length // self.parallelism.cp
+            if (
+                self.parallelism.tp_mode is TensorParallelLinearMode.REDUCE_SCATTER
+                and local_sequence_length % self.parallelism.tp != 0
+            ):
+                # Sequence parallelism splits the activations between the TP linears along the sequence
+                raise ValueError(
+                    f"sequence_length / cp ({local_sequence_length}) should be divisible by tp ({self.parallelism.tp}) "
+                    "with tp_mode REDUCE_SCATTER"
+                )
+
+        if self.parallelism is not None and self.parallelism.cp > 1:
+            if self.optimizer is not None and self.optimizer.zero_stage >= 3:
+                raise ValueError("zero_stage 3 isn't supported with context parallelism")
+            # Only the Llama attention runs ring attention over the sequence chunks
+            if self.model is not None and not isinstance(self.model.model_config, LlamaConfig):
+                raise ValueError(
+                    "Context parallelism is only supported by Llama models, "
+                    f"got {type(self.model.model_config).__name__}"
+                )
+            if self.model is not None and getattr(self.model.model_config, "doc_masking", False):
+                raise ValueError("doc_masking isn't supported with context parallelism")
+
         if self.data_stages is not None:
             self.data_stages = sorted(self.data_stages, key=lambda stage: stage.start_training_step)
             names = [stage.name for stage in self.data_stages]
@@ -390,6 +470,18 @@ class Config:
                         f"Each stage should have unique starting training step, please change the starting training step for stage {stage.name}"
                     )
 
+            doc_masking = getattr(self.model.model_config, "doc_masking", False)
+            for stage in self.data_stages:
+                pack_documents = (
+                    isinstance(stage.data.dataset, NanosetDatasetsArgs) and stage.data.dataset.pack_documents
+                )
+                if pack_documents != doc_masking:
+                    raise ValueError(
+                        f"Stage {stage.name} has pack_documents={pack_documents} but the model has "
+                        f"doc_masking={doc_masking}. "
+                        "Packing documents requires a Nanoset dataset and the model doc masking, and vice versa"
+                    )
+
             # NOTE: must order the stages by start_training_step from lowest to highest
             assert all(
                 self.data_stages[i].start_training_step < self.data_stages[i + 1].start_training_step
@@ -1,15 +1,23 @@
 from dataclasses import dataclass
-from typing import Optional
+from typing import List, Optional
 
 from nanotron.config.utils_config import (
     cast_str_to_pipeline_engine,
 )
 from nanotron.parallel.pipeline_parallel.engine import (
     AllForwardAllBackwardPipelineEngine,
+    InterleavedOneForwardOneBackwardPipelineEngine,
+    OneForwardOneBackwardPipelineEngine,
     PipelineEngine,
+    ZeroBubblePipelineEngine,
 )
 from nanotron.parallel.tensor_parallel.nn import TensorParallelLinearMode
 
+# Parts of a decoder layer that can be recomputed in the backward instead of keeping their activations. The core
+# attention isn't one of them: flash_attn already recomputes the attention scores, and the output projection keeps the
+# attention output, so recomputing it would only drop its softmax statistics
+RECOMPUTE_POLICIES = ("full", "mlp")
+
 
 @dataclass
 class ParallelismArgs:
@@ -19,20 +27,52 @@ class ParallelismArgs:
         dp: Number of DP replicas
         pp: Number of PP stages
         tp: Number of TP replicas
+        cp: Number of CP ranks, splitting the sequences in contiguous chunks attended with ring attention
         expert_parallel_size: Number of expert parallel replicas (used only for MoEs)
-        pp_engine: Pipeline engine to use between "1f1b" and "afab"
+        pp_engine: Pipeline engine to use between "1f1b", "afab", "interleaved_1f1b" and "zero_bubble"
+        pp_num_model_chunks: Number of model chunks (virtual stages) per PP rank with the "interleaved_1f1b" engine
+        pp_partition: How to split the model in PP stages between "compute" and "min_max": compute balances the compute
+            costs greedily, min_max minimizes the compute of the slowest stage under `pp_max_memory_per_rank`
+        pp_max_memory_per_rank: Memory in GiB the estimated parameters, optimizer states and activations of a PP rank
+            can use with the "min_max" partition, None for no limit
+        pp_cache_p2p_metadata: Whether PP send/recv cache the metadata of the tensors and batch them in a single
+            message, instead of sending the metadata of each tensor before its data
+        pp_offload_activations: Whether PP ranks move the activations of their micro batches waiting for a backward
+            to pinned host memory, and prefetch them before it, with the "afab" and "1f1b" engines
+        pp_offload_activations_ranks: PP ranks offloading their activations with `pp_offload_activations`. None for
+            all of them with "afab", and all but the last one with "1f1b", which runs each backward right after its
+            forward
+        dp_overlap_grad_reduce: Whether to reduce the gradients across DP and tied ranks during the last backward of
+            each parameter when the model isn't wrapped in DDP, instead of after the pipeline
         tp_mode: TP mode to use between "all_reduce" and "reduce_scatter": all_reduce is normal, reduce_scatter activate sequence parallelism
         tp_linear_async_communication: Whether to use async communication in TP linear layers
-        recompute_layer: Whether to recompute each Transformer layer to save memory.
+        tp_cross_entropy_chunk_size: Number of tokens the lm_head logits and their cross entropy are computed on at
+            once, without keeping the logits for the backward, None to compute all the logits at once
+        recompute_layer: Whether to recompute each Transformer layer to save memory, same as `recompute_policy="full"`
+        recompute_policy: What to recompute in the backward to save memory, None for nothing, "full" for the whole
+            decoder layers or "mlp" for their MLP. See
+            `nanotron.parallel.planner.plan_recompute_policies` for the memory and throughput of each one
+        recompute_layer_interval: Recompute one decoder layer every `recompute_layer_interval` layers
     """
 
     dp: int
     pp: int
     tp: int
+    cp: int = 1
     pp_engine: Optional[PipelineEngine] = None
+    pp_num_model_chunks: Optional[int] = None
+    pp_partition: str = "compute"
+    pp_max_memory_per_rank: Optional[float] = None
+    pp_cache_p2p_metadata: bool = False
+    pp_offload_activations: bool = False
+    pp_offload_activations_ranks: Optional[List[int]] = None
+    dp_overlap_grad_reduce: bool = False
     tp_mode: Optional[TensorParallelLinearMode] = None
     tp_linear_async_communication: Optional[bool] = None
+    tp_cross_entropy_chunk_size: Optional[int] = None
     recompute_layer: bool = False
+    recompute_policy: Optional[str] = None
+    recompute_layer_interval: int = 1
 
     tp_recompute_allgather: bool = True
 
@@ -47,7 +87,63 @@ class ParallelismArgs:
         if self.tp_linear_async_communication is None:
             self.tp_linear_async_communication = False
 
+        if self.cp < 1:
+            raise ValueError(f"cp should be >= 1, got {self.cp}")
+
         if isinstance(self.pp_engine, str):
             self.pp_engine = cast_str_to_pipeline_engine(self.pp_engine)
+        if isinstance(self.pp_engine, InterleavedOneForwardOneBackwardPipelineEngine):
+            if self.pp_num_model_chunks is not None:
+                self.pp_engine.num_model_chunks = self.pp_num_model_chunks
+            self.pp_num_model_chunks = self.pp_engine.num_model_chunks
+        elif self.pp_num_model_chunks not in (None, 1):
+            raise ValueError(
+                f"pp_num_model_chunks={self.pp_num_model_chunks} requires the 'interleaved_1f1b' pipeline engine"
+            )
+        if self.pp_partition not in ("compute", "min_max"):
+            raise ValueError(f"pp_partition should be 'compute' or 'min_max', got {self.pp_partition}")
+        if self.pp_max_memory_per_rank is not None and self.pp_partition != "min_max":
+            raise ValueError("pp_max_memory_per_rank requires pp_partition='min_max'")
+        if self.pp_offload_activations:
+            if not isinstance(
+                self.pp_engine, (AllForwardAllBackwardPipelineEngine, OneForwardOneBackwardPipelineEngine)
+            ):
+                raise ValueError("pp_offload_activations requires the 'afab' or '1f1b' pipeline engine")
+            if self.pp_offload_activations_ranks is None:
+                is_afab = isinstance(self.pp_engine, AllForwardAllBackwardPipelineEngine)
+                self.pp_offload_activations_ranks = list(range(self.pp if is_afab else self.pp - 1))
+            if any(not 0 <= pp_rank < self.pp for pp_rank in self.pp_offload_activations_ranks):
+                raise ValueError(
+                    f"pp_offload_activations_ranks should be PP ranks in [0, {self.pp}), got {self.pp_offload_activations_ranks}"
+                )
+            self.pp_engine.offload_activations_pp_ranks = self.pp_offload_activations_ranks
+        elif self.pp_offload_activations_ranks is not None:
+            raise ValueError("pp_offload_activations_ranks requires pp_offload_activations")
+        if self.tp_cross_entropy_chunk_size is not None and self.tp_cross_entropy_chunk_size <= 0:
+            raise ValueError(f"tp_cross_entropy_chunk_size should be positive, got {self.tp_cross_entropy_chunk_size}")
         if isinstance(self.tp_mode, str):
             self.tp_mode = TensorParallelLinearMode[self.tp_mode.upper()]
+
+        if self.recompute_layer:
+            if self.recompute_policy not in (None, "full"):
+                raise ValueError(f"recompute_layer conflicts with recompute_policy={self.recompute_policy}")
+            self.recompute_policy = "full"
+        if self.recompute_policy is not None and self.recompute_policy not in RECOMPUTE_POLICIES:
+            raise ValueError(f"recompute_policy should be one of {RECOMPUTE_POLICIES}, got {self.recompute_policy}")
+        if self.recompute_layer_interval < 1:
+            raise ValueError(f"recompute_layer_interval should be >= 1, got {self.recompute_layer_interval}")
+        self.recompute_layer = self.recompute_policy == "full"
+        if isinstance(self.pp_engine, ZeroBubblePipelineEngine):
+            # The input gradient pass of the engine can't backpropagate through the reentrant checkpoints
+            if self.recompute_policy is not None:
+                raise ValueError("The 'zero_bubble' pipeline engine doesn't support recompute_policy")
+            # The custom autograd functions of these linears compute the weight gradients in both backward passes
+            if self.tp_mode is TensorParallelLinearMode.REDUCE_SCATTER or self.tp_linear_async_communication:
+                raise ValueError(
+                    "The 'zero_bubble' pipeline engine requires tp_mode=ALL_REDUCE "
+                    "without tp_linear_async_communication"
+                )
+
+    def should_recompute(self, policy: str, layer_idx: int) -> bool:
+        """Whether the `policy` part of the decoder layer `layer_idx` is recomputed in the backward"""
+        return self.recompute_policy == policy and layer_idx % self.recompute_layer_interval == 0
@@ -7,8 +7,10 @@ import torch
 from nanotron.generation.sampler import SamplerType
 from nanotron.parallel.pipeline_parallel.engine import (
     AllForwardAllBackwardPipelineEngine,
+    InterleavedOneForwardOneBackwardPipelineEngine,
     OneForwardOneBackwardPipelineEngine,
     PipelineEngine,
+    ZeroBubblePipelineEngine,
 )
 from nanotron.parallel.tensor_parallel.nn import TensorParallelLinearMode
 
@@ -96,8 +98,14 @@ def cast_str_to_pipeline_engine(str_pp_engine: str) -> PipelineEngine:
         return AllForwardAllBackwardPipelineEngine()
     elif str_pp_engine == "1f1b":
         return OneForwardOneBackwardPipelineEngine()
+    elif str_pp_engine == "interleaved_1f1b":
+        return InterleavedOneForwardOneBackwardPipelineEngine()
+    elif str_pp_engine == "zero_bubble":
+        return ZeroBubblePipelineEngine()
     else:
-        raise ValueError(f"pp_engine should be a string selected in ['afab', '1f1b'] and not {str_pp_engine}")
+        raise ValueError(
+            f"pp_engine should be a string selected in ['afab', '1f1b', 'interleaved_1f1b', 'zero_bubble'] and not {str_pp_engine}"
+        )
 
 
 def cast_pipeline_engine_to_str(pp_engine: PipelineEngine) -> str:
@@ -105,7 +113,11 @@ def cast_pipeline_engine_to_str(pp_engine: PipelineEngine) -> str:
         return "afab"
     elif isinstance(pp_engine, OneForwardOneBackwardPipelineEngine):
         return "1f1b"
+    elif isinstance(pp_engine, InterleavedOneForwardOneBackwardPipelineEngine):
+        return "interleaved_1f1b"
+    elif isinstance(pp_engine, ZeroBubblePipelineEngine):
+        return "zero_bubble"
     else:
         raise ValueError(
-            f"pp_engine should be aan instance of AllForwardAllBackwardPipelineEngine or OneForwardOneBackwardPipelineEngine, not {type(pp_engine)}"
+            f"pp_engine should be an instance of AllForwardAllBackwardPipelineEngine, OneForwardOneBackwardPipelineEngine, InterleavedOneForwardOneBackwardPipelineEngine or ZeroBubblePipelineEngine, not {type(pp_engine)}"
         )
@@ -1,5 +1,5 @@
 import dataclasses
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Union
 
 import numpy as np
 import torch
@@ -16,12 +16,16 @@ class NanosetDataCollatorForCLM:
     - input_pp_rank: Discards last input id token
     - output_pp_rank: Discards first label id token
     - other pp ranks: Don't have data. Instead, we use `TensorPointer` to point to the rank having the data.
+
+    If `eos_token_id` is set, the input_pp_rank also emits the `position_ids` of the documents packed in each sample,
+    starting again from 0 after every EOS token, so the model can restrict the attention to each document.
     """
 
     sequence_length: int
     input_pp_rank: int
     output_pp_rank: int
     parallel_context: ParallelContext
+    eos_token_id: Optional[int] = None
 
     def __call__(self, examples: List[Dict[str, List[np.ndarray]]]) -> Dict[str, Union[torch.Tensor, TensorPointer]]:
         # Process the case when current rank doesn't require data. We return `TensorPointer` that points to ranks having the data.
@@ -31,12 +35,15 @@ class NanosetDataCollatorForCLM:
             self.output_pp_rank,
         ]:
             assert all(len(example) == 0 for example in examples)
-            return {
+            result = {
                 "input_ids": TensorPointer(group_rank=self.input_pp_rank),
                 "input_mask": TensorPointer(group_rank=self.input_pp_rank),
                 "label_ids": TensorPointer(group_rank=self.output_pp_rank),
                 "label_mask": TensorPointer(group_rank=self.output_pp_rank),
             }
+            if self.eos_token_id is not None:
+                result["position_ids"] = TensorPointer(group_rank=self.input_pp_rank)
+            return result
 
         # Make sure we load only what's necessary, ie we only load a `input_ids` column.
         assert all(list(example.keys()) == ["input_ids"] for example in examples)
@@ -51,6 +58,8 @@ class NanosetDataCollatorForCLM:
         result["input_mask"] = TensorPointer(group_rank=self.input_pp_rank)
         result["label_ids"] = TensorPointer(group_rank=self.output_pp_rank)
         result["label_mask"] = TensorPointer(group_rank=self.output_pp_rank)
+        if self.eos_token_id is not None:
+            result["position_ids"] = TensorPointer(group_rank=self.input_pp_rank)
 
         assert (
             expanded_input_length == self.sequence_length + 1
@@ -60,6 +69,8 @@ class NanosetDataCollatorForCLM:
         if current_pp_rank == self.input_pp_rank:
             result["input_ids"] = input_ids[:, :-1]
             result["input_mask"] = torch.ones((batch_size, self.sequence_length), dtype=torch.bool)
+            if self.eos_token_id is not None:
+                result["position_ids"] = get_document_position_ids(result["input_ids"], self.eos_token_id)
 
         # Process labels: shift them to the left
         if current_pp_rank == self.output_pp_rank:
@@ -78,3 +89,24 @@ class NanosetDataCollatorForCLM:
             )
 
         return result
+
+
+def get_document_position_ids(input_ids: torch.Tensor, eos_token_id: int) -> torch.Tensor:
+    """
+    Build the position ids of the documents packed in each sample. Positions start again from 0 on the token
+    following an EOS token.
+
+    Args:
+        input_ids (torch.Tensor): [batch_size, seq_length] The packed samples
+        eos_token_id (int): The EOS token id closing each document
+
+    Returns:
+        torch.Tensor: [batch_size, seq_length] The position ids, as torch.int32
+    """
+    batch_size, seq_length = input_ids.shape
+    positions = torch.arange(seq_length, dtype=torch.int32).expand(batch_size, seq_length)
+    # Position of the first token of the document of each token
+    document_starts = torch.zeros((batch_size, seq_length), dtype=torch.int32)
+    document_starts[:, 1:] = torch.where(input_ids[:, :-1] == eos_token_id, positions[:, 1:], 0)
+    document_starts = torch.cummax(document_starts, dim=-1).values
+    return positions - document_starts
@@ -1,3 +1,5 @@
+from typing import Optional
+
 import nanotron.distributed as dist
 from nanotron import logging
 from nanotron.data.collator import NanosetDataCollatorForCLM
@@ -23,6 +25,7 @@ def build_nanoset_dataloader(
     consumed_train_samples: int = 0,
     dataloader_drop_last: bool = True,
     dataloader_pin_memory: bool = True,
+    eos_token_id: Optional[int] = None,
 ) -> DataLoader:
 
     # Case of ranks not requiring data. We give them a dummy dataset, then the collator will do his job
@@ -37,6 +40,7 @@ def build_nanoset_dataloader(
         input_pp_rank=input_pp_rank,
         output_pp_rank=output_pp_rank,
         parallel_context=parallel_context,
+        eos_token_id=eos_token_id,
     )
 
     # Compute size and rank of dataloader workers
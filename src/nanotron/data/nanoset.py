@@ -1,4 +1,8 @@
+import glob
+import hashlib
+import json
 import os
+import uuid
 import warnings
 from typing import Dict, List, Tuple, Union
 
@@ -23,6 +27,12 @@ class Nanoset(torch.utils.data.Dataset):
         sequence_length (int): Sequence length of the built samples
         token_size (int): Number of bytes for the tokens stored in the processed dataset files. 2 for vocab sizes < 65535, 4 otherwise
         train_split_num_samples (int): Number of samples the dataset needs. It's the training steps * global batch size
+        random_seed (int): Seed used to shuffle the dataset index and dataset sample index
+        index_builder (str): Function used to build the Nanoset index between "argmax" (`build_nanoset_index_helper`)
+            and "quota" (`build_nanoset_index_quota_helper`), which is faster, especially with many datasets
+        cache_index (bool): Whether to store the Nanoset index in a `.npy` cache next to the `.ds` files of the first
+            dataset folder. Subsequent builds with the same fingerprint load it with `mmap_mode="r"` instead of
+            recomputing it
     """
 
     def __init__(
@@ -33,12 +43,19 @@ class Nanoset(torch.utils.data.Dataset):
         train_split_num_samples: int,
         dataset_weights: Union[List[float], None] = None,
         random_seed: int = 1234,
+        index_builder: str = "argmax",
+        cache_index: bool = True,
     ) -> None:
 
         # Checks
         if isinstance(dataset_folders, str):
             warnings.warn("dataset_folders should be of type List[str] but str was provided. Converting to List[str]")
             dataset_folders = [dataset_folders]
+        if index_builder not in NANOSET_INDEX_BUILDERS:
+            raise ValueError(
+                f"index_builder should be a string selected in {list(NANOSET_INDEX_BUILDERS.keys())} "
+                f"and not {index_builder}"
+            )
 
         # Init
         self.dataset_folders = dataset_folders
@@ -46,6 +63,8 @@ class Nanoset(torch.utils.data.Dataset):
         self.token_size = token_size
         self.train_split_num_samples = train_split_num_samples
         self.random_seed = random_seed
+        self.index_builder = index_builder
+        self.cache_index = cache_index
         self.datatrove_datasets = []
         for dataset_folder in self.dataset_folders:
             self.datatrove_datasets.append(
@@ -72,8 +91,9 @@ class Nanoset(torch.utils.data.Dataset):
         assert len(dataset_folders) == len(
             self.dataset_weights
         ), f"Specified {len(self.dataset_weights)} weights but {len(dataset_folders)} datasets were provided."
-        ## Build dataset index and dataset sample index
-        self.dataset_index, self.dataset_sample_index = self.build_nanoset_index()
+        ## Build dataset index and dataset sample index of 1 epoch. Epochs are generated virtually in __getitem__
+        self.samples_per_epoch = sum(self.dataset_lengths)
+        self.dataset_index, self.dataset_sample_index = self.load_or_build_nanoset_index()
 
         self.print_nanoset_info()
 
@@ -83,7 +103,7 @@ class Nanoset(torch.utils.data.Dataset):
             int: The number of samples of the Nanoset
         """
 
-        return len(self.dataset_index)
+        return self.train_split_num_samples
 
     def __getitem__(self, idx: int) -> Dict[str, np.ndarray]:
         """
@@ -95,36 +115,92 @@ class Nanoset(torch.utils.data.Dataset):
         Returns:
             Dict[str, torch.LongTensor]: The input ids wrapped in a dictionary
         """
-        dataset = self.dataset_index[idx]
-        dataset_sample = self.dataset_sample_index[idx]
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f"Index {idx} out of range for a Nanoset of {len(self)} samples")
+
+        # All the epochs share the same shuffled indexes
+        epoch_idx = idx % self.samples_per_epoch
+        dataset = self.dataset_index[epoch_idx]
+        dataset_sample = self.dataset_sample_index[epoch_idx]
 
         return self.datatrove_datasets[dataset][dataset_sample]
 
-    def build_nanoset_index(self) -> np.ndarray:
+    def build_nanoset_index(self) -> Tuple[np.ndarray, np.ndarray]:
         """
-        Build dataset index and dataset sample index
+        Build dataset index and dataset sample index of 1 epoch
         """
-        # Compute samples per epoch and number of epochs
-        samples_per_epoch = sum(self.dataset_lengths)
-        num_epochs = int(self.train_split_num_samples / samples_per_epoch) + 1
         # Build the dataset indexes for 1 epoch
-        dataset_index, dataset_sample_index = build_nanoset_index_helper(
-            n_samples=samples_per_epoch, weights=self.dataset_weights, dataset_sizes=self.dataset_lengths
+        dataset_index, dataset_sample_index = NANOSET_INDEX_BUILDERS[self.index_builder](
+            n_samples=self.samples_per_epoch, weights=self.dataset_weights, dataset_sizes=self.dataset_lengths
         )
         # Shuffle the indexes the same way
         numpy_random_state = np.random.RandomState(self.random_seed)
         numpy_random_state.shuffle(dataset_index)
         numpy_random_state = np.random.RandomState(self.random_seed)
         numpy_random_state.shuffle(dataset_sample_index)
-        # Concatenate num_epochs the shuffled indexes
-        dataset_index = np.concatenate([dataset_index for _ in range(num_epochs)])
-        dataset_sample_index = np.concatenate([dataset_sample_index for _ in range(num_epochs)])
-        # Just keep the necessary samples
-        dataset_index = dataset_index[: self.train_split_num_samples]
-        dataset_sample_index = dataset_sample_index[: self.train_split_num_samples]
 
         return dataset_index, dataset_sample_index
 
+    def load_or_build_nanoset_index(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Load the dataset index and dataset sample index from the cache if they exist, otherwise build them and store
+        them in the cache. Cached indexes are memory-mapped, so they are shared across all the ranks of a node through
+        the page cache
+        """
+        if not self.cache_index:
+            return self.build_nanoset_index()
+
+        dataset_index_path, dataset_sample_index_path = self.get_index_cache_paths()
+        if os.path.isfile(dataset_index_path) and os.path.isfile(dataset_sample_index_path):
+            log_rank(
+                f"> Loading Nanoset index from cache {dataset_index_path}", logger=logger, level=logging.INFO, rank=0
+            )
+            return np.load(dataset_index_path, mmap_mode="r"), np.load(dataset_sample_index_path, mmap_mode="r")
+
+        dataset_index, dataset_sample_index = self.build_nanoset_index()
+        try:
+            # NOTE: Ranks not synchronized by `main_rank_first` (e.g. ranks from other nodes) might build the cache
+            # concurrently, so we write to a unique temporary file and atomically move it into place
+            for path, index in [
+                (dataset_index_path, dataset_index),
+                (dataset_sample_index_path, dataset_sample_index),
+            ]:
+                tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, index)
+                os.replace(tmp_path, path)
+        except OSError as e:
+            warnings.warn(f"Couldn't write the Nanoset index cache to {dataset_index_path}: {e}")
+            return dataset_index, dataset_sample_index
+
+        log_rank(f"> Saved Nanoset index cache to {dataset_index_path}", logger=logger, level=logging.INFO, rank=0)
+        return np.load(dataset_index_path, mmap_mode="r"), np.load(dataset_sample_index_path, mmap_mode="r")
+
+    def get_index_cache_paths(self) -> Tuple[str, str]:
+        """
+        Returns the paths of the dataset index and dataset sample index caches, stored in the first dataset folder.
+        The file names contain a fingerprint of every argument that affects the indexes
+        """
+        fingerprint = {
+            "dataset_files": [
+                [
+                    (os.path.basename(path), os.path.getsize(path))
+                    for path in sorted(glob.glob(os.path.join(folder, "*.ds")))
+                ]
+                for folder in self.dataset_folders
+            ],
+            "dataset_weights": self.dataset_weights.tolist(),
+            "sequence_length": self.sequence_length,
+            "token_size": self.token_size,
+            "train_split_num_samples": self.train_split_num_samples,
+            "random_seed": self.random_seed,
+            "index_builder": self.index_builder,
+        }
+        fingerprint_hash = hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        cache_prefix = os.path.join(self.dataset_folders[0], f"nanoset_index_{fingerprint_hash}")
+
+        return f"{cache_prefix}_dataset_index.npy", f"{cache_prefix}_dataset_sample_index.npy"
+
     def print_nanoset_info(self):
 
         log_rank(f"> Total number of samples: {len(self)}", logger=logger, level=logging.INFO, rank=0)
@@ -133,7 +209,7 @@ class Nanoset(torch.utils.data.Dataset):
         )
 
         # Print samples from each dataset + weight
-        dataset_sample_count = count_dataset_indexes(self.dataset_index, len(self.dataset_folders))
+        dataset_sample_count = count_nanoset_dataset_indexes(self)
         for index, sample_count in enumerate(dataset_sample_count):
             log_rank(
                 f">   Total number of samples from the {self.dataset_folders[index]} dataset: {sample_count} ({round(normalize(dataset_sample_count).tolist()[index], 2)})",
@@ -143,6 +219,18 @@ class Nanoset(torch.utils.data.Dataset):
             )
 
 
+def count_nanoset_dataset_indexes(nanoset: Nanoset) -> List[int]:
+    """
+    Count the samples of each dataset over the whole Nanoset, including the virtual epochs
+    """
+    n_datasets = len(nanoset.dataset_folders)
+    num_full_epochs, num_remaining_samples = divmod(len(nanoset), nanoset.samples_per_epoch)
+    epoch_counts = count_dataset_indexes(nanoset.dataset_index, n_datasets)
+    remaining_counts = count_dataset_indexes(nanoset.dataset_index[:num_remaining_samples], n_datasets)
+
+    return [num_full_epochs * epoch + remaining for epoch, remaining in zip(epoch_counts, remaining_counts)]
+
+
 @jit(nopython=True, cache=True)
 def build_nanoset_index_helper(
     n_samples: int, weights: np.ndarray, dataset_sizes: List[int]
@@ -176,3 +264,54 @@ def build_nanoset_index_helper(
         current_samples[max_error_index] += 1
 
     return dataset_index, dataset_sample_index
+
+
+@jit(nopython=True, cache=True)
+def build_nanoset_index_quota_helper(
+    n_samples: int, weights: np.ndarray, dataset_sizes: List[int]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Given multiple datasets and a weighting array, build samples indexes with the number of samples of each dataset
+    following those weights, in O(n_samples + n_datasets * log(n_datasets)) instead of the
+    O(n_samples * n_datasets) of `build_nanoset_index_helper`.
+
+    Each dataset gets `weight * n_samples` samples, rounded with the largest remainders, laid out contiguously: the
+    datasets are only mixed by the shuffle of `Nanoset.build_nanoset_index`, which also shuffles the
+    `build_nanoset_index_helper` index
+    """
+    n_datasets = len(weights)
+    # Weights that don't exactly sum to 1 would give more samples than `n_samples`
+    weights = weights / np.sum(weights)
+
+    # Number of samples of each dataset: the `n_samples - sum(quotas)` datasets with the largest remainders get one
+    # more sample, ties going to the lowest dataset index
+    quotas = np.floor(weights * n_samples).astype(np.int64)
+    remainders = weights * n_samples - quotas
+    datasets_by_remainder = np.argsort(-remainders, kind="mergesort")
+    for i in range(n_samples - quotas.sum()):
+        quotas[datasets_by_remainder[i]] += 1
+    assert quotas.sum() == n_samples, "The quotas of the datasets don't add up to the number of samples"
+
+    # Create empty arrays for dataset indices and dataset sample indices
+    dataset_index = np.empty((n_samples,), dtype="uint")
+    dataset_sample_index = np.empty((n_samples,), dtype="long")  # Supports dataset with up to 2**64 samples
+
+    sample_idx = 0
+    for dataset in range(n_datasets):
+        # Go through the dataset samples, starting again from the first one once they are all used
+        dataset_sample = 0
+        for _ in range(quotas[dataset]):
+            dataset_index[sample_idx] = dataset
+            dataset_sample_index[sample_idx] = dataset_sample
+            sample_idx += 1
+            dataset_sample += 1
+            if dataset_sample == dataset_sizes[dataset]:
+                dataset_sample = 0
+
+    return dataset_index, dataset_sample_index
+
+
+NANOSET_INDEX_BUILDERS = {
+    "argmax": build_nanoset_index_helper,
+    "quota": build_nanoset_index_quota_helper,
+}
@@ -1,6 +1,9 @@
 import dataclasses
+import queue
+import threading
 import warnings
-from typing import Dict, Generator, Iterator, List, Optional, Union
+from collections import deque
+from typing import Dict, Generator, Iterable, Iterator, List, Optional, Union
 
 import numpy as np
 import torch
@@ -82,6 +85,122 @@ def sanity_check_dataloader(
         yield micro_batch
 
 
+def prefetch_dataloader(
+    dataloader: Iterable[Dict[str, Union[torch.Tensor, TensorPointer]]],
+    num_prefetch_micro_batches: int,
+    device: Optional[torch.device] = None,
+) -> Iterator[Dict[str, Union[torch.Tensor, TensorPointer]]]:
+    """Keeps `num_prefetch_micro_batches` micro-batches of `dataloader` ahead of the training loop, already on `device`.
+    `TensorPointer` entries are left untouched.
+
+    - On a CUDA device, the host to device copies of the (pinned) micro-batches run on a side stream, overlapping with the compute.
+    - Otherwise, a background thread pulls the micro-batches from `dataloader` and moves them to `device`.
+    """
+    assert num_prefetch_micro_batches > 0, "num_prefetch_micro_batches should be > 0"
+    if device is None:
+        device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+    if device.type == "cuda":
+        return _prefetch_dataloader_on_stream(dataloader, num_prefetch_micro_batches, device)
+    return _prefetch_dataloader_in_thread(dataloader, num_prefetch_micro_batches, device)
+
+
+def _prefetch_dataloader_on_stream(
+    dataloader: Iterable[Dict[str, Union[torch.Tensor, TensorPointer]]],
+    num_prefetch_micro_batches: int,
+    device: torch.device,
+) -> Iterator[Dict[str, Union[torch.Tensor, TensorPointer]]]:
+    stream = torch.cuda.Stream(device=device)
+    iterator = iter(dataloader)
+    prefetched_micro_batches = deque()
+
+    def prefetch_micro_batch() -> bool:
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return False
+
+        with torch.cuda.stream(stream):
+            micro_batch = {
+                k: v
+                if isinstance(v, TensorPointer)
+                else (v if v.is_pinned() else v.pin_memory()).to(
+                    device, memory_format=torch.contiguous_format, non_blocking=True
+                )
+                for k, v in batch.items()
+            }
+            copy_done = torch.cuda.Event()
+            copy_done.record(stream)
+        prefetched_micro_batches.append((micro_batch, copy_done))
+        return True
+
+    for _ in range(num_prefetch_micro_batches):
+        if not prefetch_micro_batch():
+            break
+
+    while len(prefetched_micro_batches) > 0:
+        micro_batch, copy_done = prefetched_micro_batches.popleft()
+        current_stream = torch.cuda.current_stream(device)
+        current_stream.wait_event(copy_done)
+        for v in micro_batch.values():
+            if not isinstance(v, TensorPointer):
+                # The tensors were allocated on the side stream: we make sure the caching allocator doesn't reuse
+                # their memory while the compute stream still uses them
+                v.record_stream(current_stream)
+
+        prefetch_micro_batch()
+        yield micro_batch
+
+
+_END_OF_DATALOADER = object()
+
+
+def _prefetch_dataloader_in_thread(
+    dataloader: Iterable[Dict[str, Union[torch.Tensor, TensorPointer]]],
+    num_prefetch_micro_batches: int,
+    device: torch.device,
+) -> Iterator[Dict[str, Union[torch.Tensor, TensorPointer]]]:
+    prefetched_micro_batches = queue.Queue(maxsize=num_prefetch_micro_batches)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                prefetched_micro_batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def prefetch_micro_batches():
+        try:
+            for batch in dataloader:
+                micro_batch = {
+                    k: v if isinstance(v, TensorPointer) else v.to(device, memory_format=torch.contiguous_format)
+                    for k, v in batch.items()
+                }
+                if not put(micro_batch):
+                    return
+            put(_END_OF_DATALOADER)
+        except Exception as e:
+            # The exception is raised in the training loop
+            put(e)
+
+    thread = threading.Thread(target=prefetch_micro_batches, name="nanotron-dataloader-prefetch", daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = prefetched_micro_batches.get()
+            if item is _END_OF_DATALOADER:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
 # Adapted from h4/src/h4/data/loading.py
 def get_datasets(
     hf_dataset_or_datasets: Union[dict, str],
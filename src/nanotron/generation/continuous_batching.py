@@ -0,0 +1,348 @@
+import dataclasses
+import time
+from itertools import islice
+from typing import TYPE_CHECKING, Generator, Iterable, List, Optional, Union
+
+import torch
+
+from nanotron import distributed as dist
+from nanotron import logging
+from nanotron.config import GenerationArgs
+from nanotron.generation.decode import (
+    GenerationInput,
+    GenerationOutput,
+    TokenizerConfig,
+    broadcast_tensors,
+    get_eos_token_id,
+    get_paged_kv_cache,
+)
+from nanotron.generation.generate_store import Store, attach_store
+from nanotron.generation.sampler import (
+    BasicSampler,
+    GreedySampler,
+    Sampler,
+    SamplerType,
+    TopKSampler,
+    TopPSampler,
+)
+from nanotron.logging import log_rank
+from nanotron.models.llama import LlamaModel
+from nanotron.parallel import ParallelContext
+from nanotron.parallel.pipeline_parallel.block import get_min_max_rank
+from nanotron.parallel.pipeline_parallel.context_manager import attach_pipeline_state_to_model
+from nanotron.parallel.pipeline_parallel.state import PipelineEvalBatchState
+from nanotron.parallel.pipeline_parallel.tensor_pointer import TensorPointer
+
+if TYPE_CHECKING:
+    try:
+        from transformers import PreTrainedTokenizer
+    except ImportError:
+        PreTrainedTokenizer = None
+
+logger = logging.get_logger(__name__)
+
+
+@dataclasses.dataclass
+class ContinuousBatchingStats:
+    """Throughput/latency counters of a `ContinuousBatchingDecoder`, times are in seconds"""
+
+    num_steps: int = 0
+    num_generated_tokens: int = 0
+    num_finished_sequences: int = 0
+    elapsed_time: float = 0.0
+    # Per finished sequence, from its admission in the batch
+    times_to_first_token: List[float] = dataclasses.field(default_factory=list)
+    latencies: List[float] = dataclasses.field(default_factory=list)
+
+    @property
+    def tokens_per_sec(self) -> float:
+        return self.num_generated_tokens / self.elapsed_time if self.elapsed_time > 0 else 0.0
+
+    @property
+    def mean_time_to_first_token(self) -> float:
+        return sum(self.times_to_first_token) / len(self.times_to_first_token) if self.times_to_first_token else 0.0
+
+    @property
+    def mean_latency(self) -> float:
+        return sum(self.latencies) / len(self.latencies) if self.latencies else 0.0
+
+
+@dataclasses.dataclass
+class RunningSequence:
+    input_ids: Union[torch.Tensor, TensorPointer]  # [prompt_length], without padding
+    admission_time: float
+    generated_ids: List[int] = dataclasses.field(default_factory=list)
+    first_token_time: Optional[float] = None
+
+
+def select_store_rows(store: Store, rows: List[int]) -> Store:
+    """Returns a store with the states of the samples `rows` of the batch of `store`"""
+    new_store = Store(paged_kv_cache=store.paged_kv_cache)
+    for module_id, module_store in store.items():
+        for key, value in module_store.items():
+            if isinstance(value, torch.Tensor):
+                value = value[torch.tensor(rows, dtype=torch.long, device=value.device)]
+            else:
+                value = [value[row] for row in rows]
+            new_store[module_id][key] = value
+    return new_store
+
+
+def concat_stores(store: Store, other_store: Store) -> Store:
+    """Returns a store with the states of the batch of `store` followed by the batch of `other_store`"""
+    assert store.paged_kv_cache is other_store.paged_kv_cache
+    assert store.keys() == other_store.keys()
+    new_store = Store(paged_kv_cache=store.paged_kv_cache)
+    for module_id, module_store in store.items():
+        for key, value in module_store.items():
+            other_value = other_store[module_id][key]
+            if isinstance(value, torch.Tensor):
+                new_store[module_id][key] = torch.cat([value, other_value], dim=0)
+            else:
+                new_store[module_id][key] = list(value) + list(other_value)
+    return new_store
+
+
+class ContinuousBatchingDecoder:
+    """Generates text with continuous batching
+
+    Instead of generating `max_new_tokens` tokens for fixed micro-batches, a single batch of at most `max_batch_size`
+    sequences is decoded one token at a time. Sequences leave the batch as soon as they generate the EOS token (or
+    `max_new_tokens` tokens), and new inputs are prefilled into the freed slots at the next step. The key/value states
+    live in a paged KV cache (`GenerationArgs.paged_kv_cache_num_blocks`), so that sequences can join and leave the
+    batch without moving their caches.
+
+    Same assumptions as `decode_text`: all ranks receive all the inputs (each DP replica generates its share), and only
+    the first pipeline rank returns the generated ids as tensors.
+    With pipeline parallelism, the single batch goes through the pipeline stages one after the other. The new tokens
+    are broadcast from the last stage, so that all stages agree on the sequences leaving the batch.
+    """
+
+    def __init__(
+        self,
+        model: LlamaModel,
+        tokenizer: "PreTrainedTokenizer",
+        parallel_context: ParallelContext,
+        generation_config: GenerationArgs,
+        tokenizer_config: TokenizerConfig,
+        max_batch_size: int,
+        max_new_tokens: int,
+        logits_are_batch_first: bool = True,
+    ):
+        if generation_config.paged_kv_cache_num_blocks is None:
+            raise ValueError("Continuous batching requires a paged KV cache, please set `paged_kv_cache_num_blocks`")
+        assert max_batch_size >= 1
+        assert max_new_tokens >= 1
+
+        self.model = model
+        self.tokenizer = tokenizer
+        self.parallel_context = parallel_context
+        self.generation_config = generation_config
+        self.tokenizer_config = tokenizer_config
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.logits_are_batch_first = logits_are_batch_first
+        self.stats = ContinuousBatchingStats()
+
+        self.decoder_input_rank, self.decoder_logit_rank = get_min_max_rank(module=model)
+        self.is_decoder_input_rank = dist.get_rank(parallel_context.pp_pg) == self.decoder_input_rank
+        self.is_decoder_logit_rank = dist.get_rank(parallel_context.pp_pg) == self.decoder_logit_rank
+
+        self.eos_token_id = get_eos_token_id(generation_config, tokenizer)
+
+    def get_sampler(self) -> Sampler:
+        sampler_type = self.generation_config.sampler or SamplerType.GREEDY
+        if isinstance(sampler_type, str):
+            sampler_type = SamplerType(sampler_type.upper())
+
+        tp_pg = self.parallel_context.tp_pg
+        if sampler_type == SamplerType.GREEDY:
+            return GreedySampler(pg=tp_pg)
+        elif sampler_type == SamplerType.TOP_K:
+            return TopKSampler(
+                pg=tp_pg, k=self.generation_config.top_k, temperature=self.generation_config.temperature
+            )
+        elif sampler_type == SamplerType.TOP_P:
+            return TopPSampler(
+                pg=tp_pg, p=self.generation_config.top_p, temperature=self.generation_config.temperature
+            )
+        elif sampler_type == SamplerType.BASIC:
+            return BasicSampler(pg=tp_pg)
+        else:
+            raise NotImplementedError(f"Sampler type {sampler_type} is not implemented")
+
+    def forward(
+        self,
+        store: Store,
+        input_ids: Union[torch.Tensor, TensorPointer],
+        input_mask: Union[torch.Tensor, TensorPointer],
+        pipeline_state: PipelineEvalBatchState,
+        sampler: Sampler,
+    ) -> Optional[torch.Tensor]:
+        """Runs the model on a batch and samples the next tokens
+        Returns: [batch_size] new tokens on the last pipeline rank, None on the others
+        """
+        with attach_store(model=self.model, store=store):
+            sharded_logits = self.model(input_ids=input_ids, input_mask=input_mask)
+
+        # There's a single batch in flight, so we send the activations to the next pipeline stage right away
+        while len(pipeline_state.microbatches_activations_to_send) > 0:
+            pipeline_state.run_communication()
+        assert len(pipeline_state.microbatches_activations_to_recv) == 0
+
+        if not self.is_decoder_logit_rank:
+            assert isinstance(sharded_logits, TensorPointer)
+            return None
+
+        assert isinstance(sharded_logits, torch.Tensor)
+        if self.logits_are_batch_first:
+            # transpose: [sequence_length, batch_size, vocab_size] -> [batch_size, sequence_length, vocab_size]
+            sharded_logits = sharded_logits.transpose(0, 1)
+        return sampler(sharded_logits=sharded_logits[:, -1, :]).view(-1)
+
+    def tokenize(self, inputs: List[GenerationInput]):
+        """Returns: left-padded input_ids and input_mask [len(inputs), max_input_length] on the first pipeline rank"""
+        if not self.is_decoder_input_rank:
+            return TensorPointer(group_rank=self.decoder_input_rank), TensorPointer(group_rank=self.decoder_input_rank)
+
+        padding = self.tokenizer_config.padding
+        if padding is None:
+            padding = "max_length" if self.tokenizer_config.max_input_length is not None else True
+        truncation = self.tokenizer_config.truncation
+        if truncation is None:
+            truncation = True if self.tokenizer_config.max_input_length is not None else None
+
+        encodings = self.tokenizer(
+            [elt.text for elt in inputs],
+            return_tensors="pt",
+            return_attention_mask=True,
+            padding=padding,
+            max_length=self.tokenizer_config.max_input_length,
+            truncation=truncation,
+        )
+        return encodings.input_ids.to("cuda"), encodings.attention_mask.to(dtype=torch.bool, device="cuda")
+
+    @torch.inference_mode()
+    def generate(self, input_iter: Iterable[GenerationInput]) -> Generator[GenerationOutput, None, None]:
+        """Yields the generations in the order in which they finish"""
+        dp_rank, dp_size = dist.get_rank(self.parallel_context.dp_pg), self.parallel_context.dp_pg.size()
+        # Each dp is responsible for its own inputs
+        inputs = (elt for i, elt in enumerate(input_iter) if i % dp_size == dp_rank)
+
+        paged_kv_cache = get_paged_kv_cache(self.generation_config)
+        sampler = self.get_sampler() if self.is_decoder_logit_rank else None
+        store = Store(paged_kv_cache=paged_kv_cache)
+        running_sequences: List[RunningSequence] = []
+
+        pipeline_state = PipelineEvalBatchState()
+        with attach_pipeline_state_to_model(model=self.model, pipeline_state=pipeline_state):
+            start_time = time.perf_counter()
+            while True:
+                new_tokens: List[Optional[torch.Tensor]] = []
+
+                # Decode the next token of the running sequences
+                if len(running_sequences) > 0:
+                    if self.is_decoder_input_rank:
+                        input_ids = torch.tensor(
+                            [[sequence.generated_ids[-1]] for sequence in running_sequences],
+                            dtype=torch.long,
+                            device="cuda",
+                        )
+                        input_mask = torch.ones_like(input_ids, dtype=torch.bool)
+                    else:
+                        input_ids = TensorPointer(group_rank=self.decoder_input_rank)
+                        input_mask = TensorPointer(group_rank=self.decoder_input_rank)
+                    new_tokens.append(self.forward(store, input_ids, input_mask, pipeline_state, sampler))
+
+                # Admit new sequences in the free slots
+                new_inputs = list(islice(inputs, self.max_batch_size - len(running_sequences)))
+                if len(new_inputs) > 0:
+                    admission_time = time.perf_counter()
+                    input_ids, input_mask = self.tokenize(new_inputs)
+                    new_store = Store(paged_kv_cache=paged_kv_cache)
+                    new_tokens.append(self.forward(new_store, input_ids, input_mask, pipeline_state, sampler))
+
+                    store = concat_stores(store, new_store) if len(running_sequences) > 0 else new_store
+                    running_sequences.extend(
+                        RunningSequence(
+                            input_ids=(
+                                input_ids[i][input_mask[i]]
+                                if self.is_decoder_input_rank
+                                else TensorPointer(group_rank=self.decoder_input_rank)
+                            ),
+                            admission_time=admission_time,
+                        )
+                        for i in range(len(new_inputs))
+                    )
+
+                if len(running_sequences) == 0:
+                    # It means we're out of element
+                    break
+
+                # All the pipeline stages need the new tokens to know which sequences leave the batch
+                (new_tokens,) = broadcast_tensors(
+                    [
+                        (
+                            torch.cat(new_tokens)
+                            if self.is_decoder_logit_rank
+                            else TensorPointer(group_rank=self.decoder_logit_rank)
+                        )
+                    ],
+                    group_src=self.decoder_logit_rank,
+                    group=self.parallel_context.pp_pg,
+                )
+                new_tokens = new_tokens.tolist()
+                assert len(new_tokens) == len(running_sequences)
+
+                now = time.perf_counter()
+                self.stats.num_steps += 1
+                self.stats.num_generated_tokens += len(new_tokens)
+                finished_rows, running_rows = [], []
+                for row, (sequence, new_token) in enumerate(zip(running_sequences, new_tokens)):
+                    sequence.generated_ids.append(new_token)
+                    if sequence.first_token_time is None:
+                        sequence.first_token_time = now
+                    if new_token == self.eos_token_id or len(sequence.generated_ids) >= self.max_new_tokens:
+                        finished_rows.append(row)
+                    else:
+                        running_rows.append(row)
+
+                if len(finished_rows) == 0:
+                    continue
+
+                # Evict the finished sequences, freeing their blocks of the KV cache
+                select_store_rows(store, finished_rows).flush()
+                store = select_store_rows(store, running_rows)
+                finished_sequences = [running_sequences[row] for row in finished_rows]
+                running_sequences = [running_sequences[row] for row in running_rows]
+
+                self.stats.elapsed_time = now - start_time
+                for sequence in finished_sequences:
+                    self.stats.num_finished_sequences += 1
+                    self.stats.times_to_first_token.append(sequence.first_token_time - sequence.admission_time)
+                    self.stats.latencies.append(now - sequence.admission_time)
+
+                    if self.is_decoder_input_rank:
+                        generated_ids = torch.tensor(
+                            sequence.generated_ids, dtype=sequence.input_ids.dtype, device=sequence.input_ids.device
+                        )
+                        yield GenerationOutput(
+                            input_ids=sequence.input_ids,
+                            generation_ids=torch.cat([sequence.input_ids, generated_ids]),
+                        )
+                    else:
+                        yield GenerationOutput(
+                            input_ids=TensorPointer(group_rank=self.decoder_input_rank),
+                            generation_ids=TensorPointer(group_rank=self.decoder_input_rank),
+                        )
+
+            self.stats.elapsed_time = time.perf_counter() - start_time
+
+        log_rank(
+            f"Generated {self.stats.num_generated_tokens} tokens for {self.stats.num_finished_sequences} sequences in"
+            f" {self.stats.num_steps} steps: {self.stats.tokens_per_sec:.2f} tokens/s, mean latency"
+            f" {self.stats.mean_latency:.2f}s, mean time to first token {self.stats.mean_time_to_first_token:.2f}s",
+            logger=logger,
+            level=logging.INFO,
+            rank=0,
+        )
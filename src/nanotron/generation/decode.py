@@ -4,15 +4,17 @@ from itertools import chain, islice
 from typing import TYPE_CHECKING, Generator, Iterable, List, Optional, Tuple, Union
 
 import torch
+from torch import nn
 
 from nanotron import distributed as dist
 from nanotron import logging
 from nanotron.config import BenchArgs, GenerationArgs
 from nanotron.distributed import ProcessGroup, get_global_rank
 from nanotron.generation.generate_store import Store, attach_store
+from nanotron.generation.paged_kv_cache import PagedKVCacheManager
 from nanotron.generation.sampler import BasicSampler, GreedySampler, SamplerType, TopKSampler, TopPSampler
 from nanotron.helpers import log_throughput
-from nanotron.models.llama import LlamaModel
+from nanotron.models.llama import CausalSelfAttention, LlamaModel
 from nanotron.parallel import ParallelContext
 from nanotron.parallel.pipeline_parallel.block import get_min_max_rank
 from nanotron.parallel.pipeline_parallel.context_manager import attach_pipeline_state_to_model
@@ -59,6 +61,11 @@ class GenerationStates:
     generation_ids: List[Union[torch.Tensor, TensorPointer]]
     generation_mask: List[Union[torch.Tensor, TensorPointer]]
 
+    # Only on the logit rank, to stop the sequences
+    finished: Optional[torch.Tensor] = None  # [B], the sequences that are done
+    sampled_mask: Optional[torch.Tensor] = None  # [B, 1], the mask of the last sampled tokens
+    recent_ids: Optional[torch.Tensor] = None  # [B, K], the last sampled tokens, to look for stop strings in
+
 
 @dataclasses.dataclass
 class TokenizerConfig:
@@ -155,6 +162,114 @@ def micro_splitter(
             )
 
 
+def get_paged_kv_cache(generation_config: Optional[GenerationArgs]) -> Optional[PagedKVCacheManager]:
+    if generation_config is None or generation_config.paged_kv_cache_num_blocks is None:
+        return None
+    return PagedKVCacheManager(
+        num_blocks=generation_config.paged_kv_cache_num_blocks,
+        block_size=generation_config.paged_kv_cache_block_size,
+    )
+
+
+def get_eos_token_id(generation_config: Optional[GenerationArgs], tokenizer: "PreTrainedTokenizer") -> Optional[int]:
+    if generation_config is not None and generation_config.eos is not None:
+        return tokenizer.convert_tokens_to_ids(generation_config.eos)
+    return tokenizer.eos_token_id
+
+
+@dataclasses.dataclass
+class StoppingCriteria:
+    """Per-sequence stop conditions, checked on the logit rank
+
+    A sequence is done once it generates `eos_token_id` or one of the `stop_strings` (those are included in the
+    output). The tokens it generates afterwards are masked: they aren't attended to, nor returned.
+    """
+
+    eos_token_id: Optional[int] = None
+    stop_strings: Optional[List[str]] = None
+    tokenizer: Optional["PreTrainedTokenizer"] = None
+
+    def __post_init__(self):
+        if self.stop_strings:
+            assert self.tokenizer is not None, "Looking for stop strings requires a tokenizer"
+
+    def update(self, state: GenerationStates, new_input_ids: torch.Tensor) -> torch.Tensor:
+        """Updates the finished sequences of `state` with the tokens that were just sampled
+        Args:
+            new_input_ids: [batch_size, 1]
+        Returns:
+            new_input_mask: [batch_size, 1], False for the sequences that were already done
+        """
+        finished = state.finished
+        if finished is None:
+            finished = torch.zeros(new_input_ids.shape[0], dtype=torch.bool, device=new_input_ids.device)
+        new_input_mask = ~finished[:, None]
+
+        if self.eos_token_id is not None:
+            finished = finished | (new_input_ids[:, -1] == self.eos_token_id)
+
+        if self.stop_strings:
+            # Tokens decode to at least one character, so a stop string ending with the new token is in the last tokens
+            max_stop_string_length = max(len(stop_string) for stop_string in self.stop_strings)
+            recent_ids = (
+                new_input_ids if state.recent_ids is None else torch.cat([state.recent_ids, new_input_ids], dim=-1)
+            )
+            state.recent_ids = recent_ids[:, -max_stop_string_length:]
+            has_stop_string = [
+                any(stop_string in text for stop_string in self.stop_strings)
+                for text in self.tokenizer.batch_decode(state.recent_ids)
+            ]
+            finished = finished | torch.tensor(has_stop_string, dtype=torch.bool, device=finished.device)
+
+        state.finished = finished
+        state.sampled_mask = new_input_mask
+        return new_input_mask
+
+
+def get_attention_layer(model: nn.Module) -> Optional[CausalSelfAttention]:
+    """Returns one of the attention layers living on the current pipeline rank, if any"""
+    return next((module for module in model.modules() if isinstance(module, CausalSelfAttention)), None)
+
+
+def can_stop_early(
+    generation_config: GenerationArgs,
+    parallel_context: ParallelContext,
+    is_decoder_input_rank: bool,
+    is_decoder_logit_rank: bool,
+    attention_layer: Optional[CausalSelfAttention],
+) -> bool:
+    """Whether every rank of the pipeline can see which sequences are done (see `get_last_input_mask`), and therefore
+    stop generating at the same iteration. Involves a collective, so all the pipeline ranks have to call it."""
+    sees_masks = generation_config.use_cache and (
+        is_decoder_input_rank or is_decoder_logit_rank or attention_layer is not None
+    )
+    sees_masks = torch.tensor([sees_masks], dtype=torch.int, device="cuda")
+    dist.all_reduce(sees_masks, op=dist.ReduceOp.MIN, group=parallel_context.pp_pg)
+    return sees_masks.item() == 1
+
+
+def get_last_input_mask(
+    state: GenerationStates, attention_layer: Optional[CausalSelfAttention]
+) -> Optional[torch.Tensor]:
+    """Returns the mask [batch_size] of the last tokens that were fed to the model, as seen by the current rank
+
+    The masks of the sampled tokens are sent to the input rank and go through the pipeline with the hidden states, so
+    every rank sees them one iteration after they're sampled: the input rank feeds them, the attention layers record
+    them in their store and the logit rank sampled them.
+    """
+    if isinstance(state.new_input_mask, torch.Tensor):
+        return state.new_input_mask[:, -1]
+    if attention_layer is not None:
+        return state.store[id(attention_layer)]["last_sequence_mask"]
+    return state.sampled_mask[:, -1] if state.sampled_mask is not None else None
+
+
+def are_all_masked(masks: List[Optional[torch.Tensor]]) -> bool:
+    if len(masks) == 0 or any(mask is None for mask in masks):
+        return False
+    return not torch.cat(masks).any().item()
+
+
 @torch.inference_mode()
 def decode_text(
     input_iter: Iterable[GenerationInput],
@@ -198,6 +313,23 @@ def decode_text(
             GenerationInput(text=input.text) for input in input_iter for _ in range(generation_config.n_samples)
         ]
 
+    # The paged KV cache is shared by all the micro-batches, their blocks are reused once they are generated
+    paged_kv_cache = get_paged_kv_cache(generation_config)
+
+    stopping_criteria = StoppingCriteria(
+        eos_token_id=get_eos_token_id(generation_config, tokenizer),
+        stop_strings=generation_config.stop_strings,
+        tokenizer=tokenizer,
+    )
+    attention_layer = get_attention_layer(model)
+    stop_early = can_stop_early(
+        generation_config,
+        parallel_context,
+        is_decoder_input_rank=is_decoder_input_rank,
+        is_decoder_logit_rank=is_decoder_logit_rank,
+        attention_layer=attention_layer,
+    )
+
     # That's annoying but I need this as soon as there's a change communication "cross"
     pipeline_state = PipelineEvalBatchState()
     with attach_pipeline_state_to_model(model=model, pipeline_state=pipeline_state):
@@ -228,7 +360,7 @@ def decode_text(
                 GenerationStates(
                     new_input_ids=batch.input_ids,
                     new_input_mask=batch.input_masks,
-                    store=Store(),
+                    store=Store(paged_kv_cache=paged_kv_cache),
                     generation_ids=[batch.input_ids],
                     generation_mask=[batch.input_masks],
                 )
@@ -248,6 +380,7 @@ def decode_text(
                     Tuple[Union[torch.LongTensor, TensorPointer], Union[torch.BoolTensor, TensorPointer]]
                 ] = []
                 new_decoder_states: List[GenerationStates] = []
+                last_input_masks: List[Optional[torch.Tensor]] = []
                 for state_id, state in enumerate(decoder_states):
                     new_decoder_states.append(state)
                     # Get the new logits
@@ -261,7 +394,13 @@ def decode_text(
                     else:
                         if isinstance(state.new_input_ids, torch.Tensor):
                             batch_generated_ids = torch.cat(state.generation_ids, dim=-1)
-                            batch_generated_mask = torch.cat(state.generation_mask, dim=-1)
+                            # The tokens generated after a sequence is done are only masked out of the output, as
+                            # the model doesn't support padding on the right
+                            batch_generated_mask = torch.cat(
+                                state.generation_mask[:1]
+                                + [torch.ones_like(mask) for mask in state.generation_mask[1:]],
+                                dim=-1,
+                            )
                         else:
                             batch_generated_ids = state.new_input_ids
                             batch_generated_mask = state.new_input_mask
@@ -272,6 +411,8 @@ def decode_text(
 
                     if isinstance(sharded_logits, torch.Tensor) and logits_are_batch_first:
                         sharded_logits = sharded_logits.transpose(0, 1)
+                    if stop_early:
+                        last_input_masks.append(get_last_input_mask(state, attention_layer))
                     # Communicate
                     # TODO @thomasw21: Make a diagram to show how this works
                     nb_send: int = 0
@@ -318,15 +459,8 @@ def decode_text(
 
                         new_decoder_input_ids = sampler(sharded_logits=sharded_logits[:, -1, :])
 
-                        # TODO @thomasw21: Handle this correctly, ie from some point after <eos> this should only generate masked tokens
-                        # TODO @thomasw21: Actually I can probably build this thing on the next device directly. Will save some communication
-                        new_decoder_input_mask = torch.ones(
-                            size=(new_decoder_input_ids.shape[0], 1),
-                            dtype=torch.bool,
-                            device=new_decoder_input_ids.device,
-                        )
-
-                        # TODO @thomasw21: We need to have stop condition.
+                        # The sequences that are done keep generating masked tokens until the whole batch is done
+                        new_decoder_input_mask = stopping_criteria.update(state, new_decoder_input_ids)
 
                         # broadcast new_tokens to everyone
                         if decoder_input_rank == decoder_logit_rank:
@@ -385,12 +519,20 @@ def decode_text(
                         store=state.store,
                         generation_ids=state.generation_ids + [new_decoder_input_ids_and_mask[0]],
                         generation_mask=state.generation_mask + [new_decoder_input_ids_and_mask[1]],
+                        finished=state.finished,
+                        sampled_mask=state.sampled_mask,
+                        recent_ids=state.recent_ids,
                     )
                     for state, new_decoder_input_ids_and_mask in zip(
                         new_decoder_states, all_new_decoder_input_ids_and_mask
                     )
                 )
 
+                # All the ranks see that the last inputs are masked at the same iteration, so they stop together and
+                # the pending communications are flushed as if it was the last iteration
+                if stop_early and are_all_masked(last_input_masks):
+                    break
+
             if is_bench:
                 # Compute throughput (tok/s/gpu). Note that the first generation is done with full seq_len, so we don't count it.
                 torch.cuda.synchronize()
@@ -398,11 +540,13 @@ def decode_text(
                 # We generate 1 token per iteration per batch (batch=microbatch)
                 # Number of tokens generated every iteration: gbs/iteration_time
                 global_batch_size = len(batches) * parallel_context.dp_pg.size()
-                tokens_per_sec = global_batch_size * max_new_tokens / total_time_sec
+                # The generation may have stopped early
+                num_new_tokens = generation_iter + 1
+                tokens_per_sec = global_batch_size * num_new_tokens / total_time_sec
 
                 model_tflops, hardware_tflops = model.get_flops_per_sec(
                     iteration_time_in_sec=total_time_sec,
-                    sequence_length=max_new_tokens,
+                    sequence_length=num_new_tokens,
                     global_batch_size=global_batch_size,
                 )
 
@@ -501,6 +645,7 @@ def decode_tokenized(
     max_micro_batch_size: int,
     max_new_tokens: int,
     returns_logits: Optional[bool] = False,
+    eos_token_id: Optional[int] = None,
 ) -> Generator[GenerationOutput, None, None]:
     """We assume the following:
     - Everyone receives ALL the input text. # TODO @thomasw21: technically only specific ranks need to receive input.
@@ -528,6 +673,19 @@ def decode_tokenized(
     # TODO @thomasw21: Fix this as we shouldn't get P2P like that
     p2p = model.p2p
 
+    # The paged KV cache is shared by all the micro-batches, their blocks are reused once they are generated
+    paged_kv_cache = get_paged_kv_cache(generation_config)
+
+    stopping_criteria = StoppingCriteria(eos_token_id=eos_token_id)
+    attention_layer = get_attention_layer(model)
+    stop_early = can_stop_early(
+        generation_config,
+        parallel_context,
+        is_decoder_input_rank=is_decoder_input_rank,
+        is_decoder_logit_rank=is_decoder_logit_rank,
+        attention_layer=attention_layer,
+    )
+
     # That's annoying but I need this as soon as there's a change communication "cross"
     pipeline_state = PipelineEvalBatchState()
     with attach_pipeline_state_to_model(model=model, pipeline_state=pipeline_state):
@@ -557,7 +715,7 @@ def decode_tokenized(
                 GenerationStates(
                     new_input_ids=batch.input_ids,
                     new_input_mask=batch.input_masks,
-                    store=Store(),
+                    store=Store(paged_kv_cache=paged_kv_cache),
                     generation_ids=[batch.input_ids],
                     generation_mask=[batch.input_masks],
                 )
@@ -569,6 +727,7 @@ def decode_tokenized(
                     Tuple[Union[torch.LongTensor, TensorPointer], Union[torch.BoolTensor, TensorPointer]]
                 ] = []
                 new_decoder_states: List[GenerationStates] = []
+                last_input_masks: List[Optional[torch.Tensor]] = []
                 for state_id, state in enumerate(decoder_states):
                     new_decoder_states.append(state)
                     # Get the new logits
@@ -580,6 +739,8 @@ def decode_tokenized(
                         )
                         if isinstance(sharded_logits, torch.Tensor):
                             sharded_logits = sharded_logits.transpose(0, 1)
+                    if stop_early:
+                        last_input_masks.append(get_last_input_mask(state, attention_layer))
 
                     # Communicate
                     # TODO @thomasw21: Make a diagram to show how this works
@@ -635,15 +796,8 @@ def decode_tokenized(
 
                         new_decoder_input_ids = sampler(sharded_logits=sharded_logits[:, -1, :])
 
-                        # TODO @thomasw21: Handle this correctly, ie from some point after <eos> this should only generate masked tokens
-                        # TODO @thomasw21: Actually I can probably build this thing on the next device directly. Will save some communication
-                        new_decoder_input_mask = torch.ones(
-                            size=(new_decoder_input_ids.shape[0], 1),
-                            dtype=torch.bool,
-                            device=new_decoder_input_ids.device,
-                        )
-
-                        # TODO @thomasw21: We need to have stop condition.
+                        # The sequences that are done keep generating masked tokens until the whole batch is done
+                        new_decoder_input_mask = stopping_criteria.update(state, new_decoder_input_ids)
 
                         # broadcast new_tokens to everyone
                         if decoder_input_rank == decoder_logit_rank:
@@ -702,12 +856,20 @@ def decode_tokenized(
                         store=state.store,
                         generation_ids=state.generation_ids + [new_decoder_input_ids_and_mask[0]],
                         generation_mask=state.generation_mask + [new_decoder_input_ids_and_mask[1]],
+                        finished=state.finished,
+                        sampled_mask=state.sampled_mask,
+                        recent_ids=state.recent_ids,
                     )
                     for state, new_decoder_input_ids_and_mask in zip(
                         new_decoder_states, all_new_decoder_input_ids_and_mask
                     )
                 )
 
+                # All the ranks see that the last inputs are masked at the same iteration, so they stop together and
+                # the pending communications are flushed as if it was the last iteration
+                if stop_early and are_all_masked(last_input_masks):
+                    break
+
             # Flush communication
             for _ in range(
                 max(
@@ -1,8 +1,11 @@
 import collections
 import contextlib
+from typing import Optional
 
 from torch import nn
 
+from nanotron.generation.paged_kv_cache import PagedKVCacheManager
+
 
 class Store(collections.defaultdict):
     """
@@ -10,10 +13,14 @@ class Store(collections.defaultdict):
     This is useful at inference if we don't want to recompute kv_cache for example, or that we don't want to communicate it through the pipeline
     """
 
-    def __init__(self):
+    def __init__(self, paged_kv_cache: Optional[PagedKVCacheManager] = None):
         super().__init__(dict)
+        # If set, the attention layers store their key/value states in a paged cache shared by all the stores
+        self.paged_kv_cache = paged_kv_cache
 
     def flush(self):
+        if self.paged_kv_cache is not None:
+            self.paged_kv_cache.free(self)
         # TODO @thomasw21: There's probably a simpler way than doing this.
         for key in list(self.keys()):
             del self[key]
@@ -35,6 +42,12 @@ class AttachableStore:
         else:
             return None
 
+    def get_paged_kv_cache(self) -> Optional[PagedKVCacheManager]:
+        if hasattr(self, "_store"):
+            return self._store.paged_kv_cache
+        else:
+            return None
+
 
 @contextlib.contextmanager
 def attach_store(model: nn.Module, store: Store):
@@ -0,0 +1,185 @@
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import torch
+
+if TYPE_CHECKING:
+    from nanotron.generation.generate_store import Store
+
+
+class PagedKVCache:
+    """Key/value cache of an attention layer, stored in fixed-size blocks
+
+    The keys/values of all the sequences live in two pools of `num_blocks` blocks of `block_size` tokens. Each sequence
+    owns a block table (the blocks holding its tokens, in order) and takes blocks from a free list as it grows, so that
+    no memory is reserved for tokens that aren't generated yet and nothing is reallocated or padded. The blocks of freed
+    sequences go back to the free list and are reused by the next sequences.
+
+    key_blocks: [num_blocks, block_size, n_kv_heads, d_qk]
+    value_blocks: [num_blocks, block_size, n_kv_heads, d_v]
+    """
+
+    def __init__(
+        self,
+        num_blocks: int,
+        block_size: int,
+        n_kv_heads: int,
+        d_qk: int,
+        d_v: int,
+        dtype: torch.dtype,
+        device: torch.device,
+    ):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.key_blocks = torch.zeros((num_blocks, block_size, n_kv_heads, d_qk), dtype=dtype, device=device)
+        self.value_blocks = torch.zeros((num_blocks, block_size, n_kv_heads, d_v), dtype=dtype, device=device)
+
+        # Popped from the end, so that the most recently freed blocks are reused first
+        self._free_blocks: List[int] = list(range(num_blocks - 1, -1, -1))
+        self._next_seq_id = 0
+        self.block_tables: Dict[int, List[int]] = {}
+        self.seq_lens: Dict[int, int] = {}
+
+    @property
+    def num_free_blocks(self) -> int:
+        return len(self._free_blocks)
+
+    def allocate_sequences(self, num_sequences: int) -> List[int]:
+        """Registers new empty sequences, returns their ids"""
+        seq_ids = list(range(self._next_seq_id, self._next_seq_id + num_sequences))
+        self._next_seq_id += num_sequences
+        for seq_id in seq_ids:
+            self.block_tables[seq_id] = []
+            self.seq_lens[seq_id] = 0
+        return seq_ids
+
+    def free_sequences(self, seq_ids: List[int]):
+        for seq_id in seq_ids:
+            self._free_blocks.extend(reversed(self.block_tables.pop(seq_id)))
+            del self.seq_lens[seq_id]
+
+    def append(self, seq_ids: List[int], key_states: torch.Tensor, value_states: torch.Tensor, num_tokens: List[int]):
+        """Writes the new tokens of the sequences at the end of their blocks, taking new blocks when needed
+        Args:
+            seq_ids: sequences to append to
+            key_states: [sum(num_tokens), n_kv_heads, d_qk], the new keys of the sequences, concatenated
+            value_states: [sum(num_tokens), n_kv_heads, d_v]
+            num_tokens: number of new tokens of each sequence
+        """
+        slots = []
+        for seq_id, seq_num_tokens in zip(seq_ids, num_tokens):
+            block_table = self.block_tables[seq_id]
+            start = self.seq_lens[seq_id]
+            end = start + seq_num_tokens
+            while len(block_table) * self.block_size < end:
+                if len(self._free_blocks) == 0:
+                    raise RuntimeError(
+                        f"The KV cache is full: all its {self.num_blocks} blocks of {self.block_size} tokens are used. "
+                        "Please increase `paged_kv_cache_num_blocks` or reduce the number of concurrent sequences."
+                    )
+                block_table.append(self._free_blocks.pop())
+            self.seq_lens[seq_id] = end
+
+            positions = torch.arange(start, end)
+            blocks = torch.tensor(block_table, dtype=torch.long)[positions // self.block_size]
+            slots.append(blocks * self.block_size + positions % self.block_size)
+
+        slots = torch.cat(slots).to(self.key_blocks.device)
+        self.key_blocks.view(-1, *self.key_blocks.shape[2:]).index_copy_(0, slots, key_states)
+        self.value_blocks.view(-1, *self.value_blocks.shape[2:]).index_copy_(0, slots, value_states)
+
+    def get_block_table(self, seq_ids: List[int]) -> torch.Tensor:
+        """Returns: [len(seq_ids), max_num_blocks] block tables of the sequences, right-padded with block 0"""
+        max_num_blocks = max(len(self.block_tables[seq_id]) for seq_id in seq_ids)
+        block_table = torch.zeros((len(seq_ids), max_num_blocks), dtype=torch.int32)
+        for i, seq_id in enumerate(seq_ids):
+            block_table[i, : len(self.block_tables[seq_id])] = torch.tensor(self.block_tables[seq_id])
+        return block_table.to(self.key_blocks.device)
+
+    def get_seq_lens(self, seq_ids: List[int]) -> torch.Tensor:
+        return torch.tensor([self.seq_lens[seq_id] for seq_id in seq_ids], dtype=torch.int32).to(
+            self.key_blocks.device
+        )
+
+    def gather(self, seq_id: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns: the keys [seq_len, n_kv_heads, d_qk] and values [seq_len, n_kv_heads, d_v] of a sequence"""
+        block_table = torch.tensor(self.block_tables[seq_id], dtype=torch.long, device=self.key_blocks.device)
+        seq_len = self.seq_lens[seq_id]
+        key_states = self.key_blocks[block_table].flatten(0, 1)[:seq_len]
+        value_states = self.value_blocks[block_table].flatten(0, 1)[:seq_len]
+        return key_states, value_states
+
+
+class PagedKVCacheManager:
+    """Gives each attention layer its `PagedKVCache`, shared by all the micro-batches being generated
+
+    Attach it to the stores of the micro-batches (`Store(paged_kv_cache=...)`): the layers allocate their sequences in
+    the cache at prefill, and flushing a store frees them.
+    """
+
+    def __init__(self, num_blocks: int, block_size: int = 256):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.layer_caches: Dict[int, PagedKVCache] = {}
+
+    def get_layer_cache(
+        self, layer_id: int, n_kv_heads: int, d_qk: int, d_v: int, dtype: torch.dtype, device: torch.device
+    ) -> PagedKVCache:
+        if layer_id not in self.layer_caches:
+            self.layer_caches[layer_id] = PagedKVCache(
+                num_blocks=self.num_blocks,
+                block_size=self.block_size,
+                n_kv_heads=n_kv_heads,
+                d_qk=d_qk,
+                d_v=d_v,
+                dtype=dtype,
+                device=device,
+            )
+        return self.layer_caches[layer_id]
+
+    def free(self, store: "Store"):
+        """Frees the sequences of a micro-batch"""
+        for layer_id, layer_cache in self.layer_caches.items():
+            seq_ids = store.get(layer_id, {}).get("seq_ids")
+            if seq_ids is not None:
+                layer_cache.free_sequences(seq_ids)
+
+
+def paged_attention(
+    query_states: torch.Tensor,
+    kv_cache: PagedKVCache,
+    seq_ids: List[int],
+    softmax_scale: Optional[float] = None,
+) -> torch.Tensor:
+    """Pure PyTorch reference of `flash_attn_with_kvcache(..., block_table=...)`: the last `q_length` tokens of each
+    sequence attend (causally) to the keys/values cached for that sequence
+    Args:
+        query_states: [batch_size, q_length, n_q_heads, d_qk]
+        kv_cache: cache holding the sequences, including their last `q_length` tokens
+        seq_ids: sequence of each sample
+    Returns:
+        attention_output: [batch_size, q_length, n_q_heads, d_v]
+    """
+    q_length = query_states.shape[1]
+    softmax_scale = softmax_scale if softmax_scale is not None else query_states.shape[-1] ** -0.5
+
+    attention_outputs = []
+    for sample_query_states, seq_id in zip(query_states, seq_ids):
+        key_states, value_states = kv_cache.gather(seq_id)
+        kv_length = key_states.shape[0]
+        # Grouped query attention: each key/value head is shared by consecutive query heads
+        n_repeats = sample_query_states.shape[1] // key_states.shape[1]
+        key_states = key_states.repeat_interleave(n_repeats, dim=1)
+        value_states = value_states.repeat_interleave(n_repeats, dim=1)
+
+        scores = torch.einsum("qhd,khd->hqk", sample_query_states.float(), key_states.float()) * softmax_scale
+        # The queries are the last tokens of the sequence
+        causal_mask = torch.arange(kv_length, device=scores.device)[None, :] > (
+            torch.arange(q_length, device=scores.device)[:, None] + kv_length - q_length
+        )
+        scores = scores.masked_fill(causal_mask, float("-inf"))
+        attention_probs = torch.softmax(scores, dim=-1)
+        attention_outputs.append(
+            torch.einsum("hqk,khd->qhd", attention_probs, value_states.float()).to(query_states.dtype)
+        )
+
+    return torch.stack(attention_outputs)
@@ -27,6 +27,7 @@ from nanotron.optim.gradient_accumulator import (
     FP32GradBucketManager,
     FP32GradientAccumulator,
     GradientAccumulator,
+    ShardedFP32GradientAccumulator,
     get_fp32_accum_hook,
 )
 from nanotron.optim.named_optimizer import NamedOptimizer
@@ -35,6 +36,7 @@ from nanotron.optim.optimizer_from_gradient_accumulator import (
 )
 from nanotron.optim.zero import ZeroDistributedOptimizer
 from nanotron.parallel import ParallelContext
+from nanotron.parallel.data_parallel.fully_sharded import FullyShardedParameters
 from nanotron.parallel.tensor_parallel.nn import TensorParallelLinearMode
 from nanotron.random import (
     RandomStates,
@@ -296,7 +298,9 @@ def init_optimizer_and_grad_accumulator(
     model: nn.Module,
     optimizer_args: OptimizerArgs,
     parallel_context: ParallelContext,
+    param_sharder: Optional[FullyShardedParameters] = None,
 ) -> Tuple[BaseOptimizer, GradientAccumulator]:
+    """`param_sharder` shards the parameters of the model with ZeRO stage 3, it's built here if not given"""
     # Unwrap DDP
     unwrapped_model: NanotronModel = model.module if isinstance(model, DistributedDataParallel) else model
 
@@ -334,7 +338,9 @@ def init_optimizer_and_grad_accumulator(
                     weight_decay=optimizer_args.weight_decay,
                     eps=optimizer_args.optimizer_factory.adam_eps,
                     betas=(optimizer_args.optimizer_factory.adam_beta1, optimizer_args.optimizer_factory.adam_beta2),
-                    fused=optimizer_args.optimizer_factory.torch_adam_is_fused,
+                    # The fused kernel only runs on GPU, offloaded weights are updated by the multi-tensor CPU kernels
+                    fused=optimizer_args.optimizer_factory.torch_adam_is_fused and not optimizer_args.cpu_offload,
+                    foreach=True if optimizer_args.cpu_offload else None,
                 )
 
         elif optimizer_args.optimizer_factory.name == "sgd":
@@ -356,16 +362,35 @@ def init_optimizer_and_grad_accumulator(
 
     optimizer_builder = basic_optimizer_builder
 
+    # ZeRO stage 3 parameter sharder
+    if optimizer_args.zero_stage == 3 and param_sharder is None:
+        param_sharder = FullyShardedParameters(
+            model=unwrapped_model, named_parameters=named_parameters, dp_pg=parallel_context.dp_pg
+        )
+
     # Gradient accumulator builder
     grad_accumulator: Optional[GradientAccumulator] = None
     if optimizer_args.accumulate_grad_in_fp32:
         # TODO @thomasw21: Make an optimizer builder system, instead of doing everything in functional manner
-        def grad_optimizer_builder(named_param_groups):
-            result = OptimizerFromGradientAccumulator(
-                gradient_accumulator_builder=lambda named_params: FP32GradientAccumulator(
+        def grad_accumulator_builder(named_params):
+            if optimizer_args.zero_stage >= 2:
+                return ShardedFP32GradientAccumulator(
                     named_parameters=named_params,
                     grad_buckets_named_params=named_parameters,
-                ),
+                    dp_pg=parallel_context.dp_pg,
+                    bucket_cap_mb=optimizer_args.zero_bucket_cap_mb,
+                    grad_buckets_names=param_sharder.get_blocks_param_names() if param_sharder is not None else None,
+                    offload_to_cpu=optimizer_args.cpu_offload,
+                )
+            return FP32GradientAccumulator(
+                named_parameters=named_params,
+                grad_buckets_named_params=named_parameters,
+                offload_to_cpu=optimizer_args.cpu_offload,
+            )
+
+        def grad_optimizer_builder(named_param_groups):
+            result = OptimizerFromGradientAccumulator(
+                gradient_accumulator_builder=grad_accumulator_builder,
                 named_params_or_groups=named_param_groups,
                 optimizer_builder=basic_optimizer_builder,
             )
@@ -385,6 +410,7 @@ def init_optimizer_and_grad_accumulator(
             # TODO @thomasw21: We need a better API for gradient accumulation/zero etc ...
             optimizer_builder=optimizer_builder,
             dp_pg=parallel_context.dp_pg,
+            param_sharder=param_sharder if optimizer_args.zero_stage == 3 else None,
         )
 
         # SANITY CHECK: assert that optimizer's named_params point to model's params (check only the first one)
@@ -413,6 +439,10 @@ def init_optimizer_and_grad_accumulator(
             param_name_to_offsets=param_name_to_dp_rank_offsets,
         )
 
+    if param_sharder is not None:
+        # The gradients of each block are reduce-scattered as soon as its backward is done
+        param_sharder.register_post_backward_hook(grad_accumulator.reduce_scatter_grads)
+
     # Register DDP hook to make fp32 grad accumulation work
     if isinstance(model, DistributedDataParallel) and grad_accumulator is not None:
         assert isinstance(grad_accumulator, FP32GradientAccumulator)
@@ -2,7 +2,6 @@ from abc import ABCMeta, abstractmethod
 from contextlib import contextmanager
 from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple
 
-import numpy as np
 import torch
 from torch import nn
 
@@ -11,7 +10,16 @@ from nanotron import logging
 from nanotron.distributed import ProcessGroup
 from nanotron.logging import log_rank
 from nanotron.parallel.context import ParallelContext
+from nanotron.parallel.data_parallel.fully_sharded import release_parameters
 from nanotron.parallel.pipeline_parallel.block import PipelineBlock
+from nanotron.parallel.pipeline_parallel.partition import (
+    BlockMemoryCost,
+    StageMemoryBudget,
+    get_imbalance,
+    get_min_max_partition,
+    get_stage_costs,
+    get_thresholds_partition,
+)
 
 if TYPE_CHECKING:
     from nanotron.config import NanotronConfigs
@@ -72,6 +80,11 @@ class NanotronModel(nn.Module, metaclass=ABCMeta):
         """
         return []
     
+    def get_block_memory_costs(self) -> Dict[Callable, BlockMemoryCost]:
+        """Returns the memory estimate of the PipelineBlocks per module builder, used to partition the model in PP stages
+        under a memory budget. Blocks without an estimate are assumed to use no memory."""
+        return {}
+
     def get_named_params_without_weight_decay(self) -> List[str]:
         """Return a list of named parameters that should not have weight decay applied to them."""
         return []
@@ -193,8 +206,24 @@ def build_model(
     dtype: torch.dtype,
     target_pp_ranks: Optional[List[int]] = None,
     device: Optional[torch.device] = torch.device("cuda"),
+    num_model_chunks: int = 1,
+    pp_partition: str = "compute",
+    memory_budget: Optional[StageMemoryBudget] = None,
+    release_params: bool = False,
 ) -> NanotronModel:
-    """Build the model and set the pp ranks for each pipeline block."""
+    """Build the model and set the pp ranks for each pipeline block.
+    With `num_model_chunks` > 1, the model is split in `num_model_chunks * pp_size` stages, and the rank `r` runs the
+    stages `r`, `r + pp_size`, ... as its model chunks (see `InterleavedOneForwardOneBackwardPipelineEngine`).
+
+    Blocks are split in contiguous stages according to `pp_partition`:
+     - "compute": a new stage starts once the cumulative compute cost of the blocks exceeds its share of the total
+     - "min_max": minimizes the compute cost of the slowest stage, such that the memory of each stage estimated with
+       `get_block_memory_costs` fits in `memory_budget`
+
+    With `release_params`, the storage of the parameters of each block is released as soon as it's built, so that the
+    parameters of the whole model are never allocated at once: they're allocated again once sharded across DP by
+    `FullyShardedParameters`.
+    """
     # TODO: classes dont take same args
     log_rank("Building model..", logger=logger, level=logging.INFO, rank=0, group=parallel_context.world_pg)
     model: NanotronModel = model_builder()
@@ -215,25 +244,89 @@ def build_model(
 
         # Balance compute across PP blocks
         block_compute_costs = model.get_block_compute_costs()
-        block_cumulative_costs = np.cumsum(
-            [
-                block_compute_costs[module.module_builder] if module.module_builder in block_compute_costs else 0
+        compute_costs = [
+            block_compute_costs[module.module_builder] if module.module_builder in block_compute_costs else 0
+            for module in pipeline_blocks
+        ]
+
+        num_stages = pp_size * num_model_chunks
+        stage_memory_costs = None
+        if pp_partition == "compute":
+            block_stages = get_thresholds_partition(compute_costs, num_stages)
+        elif pp_partition == "min_max":
+            block_memory_costs = model.get_block_memory_costs()
+            memory_costs = [
+                block_memory_costs.get(module.module_builder, BlockMemoryCost(num_params=0, activations_per_token=0))
                 for module in pipeline_blocks
             ]
-        )
-
-        thresholds = [block_cumulative_costs[-1] * ((rank + 1) / pp_size) for rank in range(pp_size)]
-        assert thresholds[-1] >= block_cumulative_costs[-1]
-        target_pp_rank_idx = 0
-        for block, cumulative_cost in zip(pipeline_blocks, block_cumulative_costs):
-            assert target_pp_rank_idx < pp_size
-            block.build_and_set_rank(target_pp_ranks[target_pp_rank_idx])
-
-            if cumulative_cost > thresholds[target_pp_rank_idx]:
-                target_pp_rank_idx += 1
+            # Without interleaving, last ranks can be left empty when there are fewer blocks than ranks
+            num_partitioned_stages = num_stages if num_model_chunks > 1 else min(num_stages, len(pipeline_blocks))
+            if memory_budget is None:
+                block_stages = get_min_max_partition(compute_costs, num_partitioned_stages)
+            else:
+                static_memory_costs = [cost.num_params * memory_budget.bytes_per_param for cost in memory_costs]
+                activation_memory_costs = [cost.activations_per_token for cost in memory_costs]
+                nb_in_flight_tokens = [
+                    memory_budget.nb_in_flight_tokens[stage % pp_size] for stage in range(num_partitioned_stages)
+                ]
+                block_stages = get_min_max_partition(
+                    compute_costs,
+                    num_partitioned_stages,
+                    static_memory_costs=static_memory_costs,
+                    activation_memory_costs=activation_memory_costs,
+                    nb_in_flight_tokens=nb_in_flight_tokens,
+                    # The model chunks of a rank share its memory
+                    max_memory=(
+                        memory_budget.max_memory / num_model_chunks if memory_budget.max_memory is not None else None
+                    ),
+                )
+                stage_memory_costs = [
+                    static_memory + activation_memory * nb_in_flight_tokens[stage]
+                    for stage, (static_memory, activation_memory) in enumerate(
+                        zip(
+                            get_stage_costs(static_memory_costs, block_stages, num_stages),
+                            get_stage_costs(activation_memory_costs, block_stages, num_stages),
+                        )
+                    )
+                ]
+        else:
+            raise ValueError(f"Unknown pp_partition {pp_partition}, expected 'compute' or 'min_max'")
+
+        for block, stage_idx in zip(pipeline_blocks, block_stages):
+            block.build_and_set_rank(target_pp_ranks[stage_idx % pp_size], model_chunk=stage_idx // pp_size)
+            if release_params:
+                release_parameters(block)
+        last_block_stage_idx = block_stages[-1]
+
+        if num_model_chunks > 1 and last_block_stage_idx < num_stages - 1:
+            # Each model chunk receives its inputs from the previous stage
+            raise ValueError(
+                f"Only {last_block_stage_idx + 1} pipeline stages have blocks, {num_stages} are needed for {num_model_chunks} model chunks per PP rank"
+            )
 
         model.input_pp_rank = target_pp_ranks[0]
-        model.output_pp_rank = target_pp_ranks[target_pp_rank_idx]
+        model.output_pp_rank = target_pp_ranks[last_block_stage_idx % pp_size]
+
+    if num_stages > 1 and sum(compute_costs) > 0:
+        stage_compute_costs = get_stage_costs(compute_costs, block_stages, num_stages)
+        total_compute_cost = sum(stage_compute_costs)
+        log_rank(
+            f"PP stage compute shares: {[f'{cost / total_compute_cost:.1%}' for cost in stage_compute_costs]}"
+            f" | imbalance: {get_imbalance(stage_compute_costs):.2f}",
+            logger=logger,
+            level=logging.INFO,
+            rank=0,
+            group=parallel_context.world_pg,
+        )
+        if stage_memory_costs is not None:
+            log_rank(
+                f"PP stage memory estimates: {[f'{memory / 1024**3:.2f}GiB' for memory in stage_memory_costs]}"
+                f" | imbalance: {get_imbalance(stage_memory_costs):.2f}",
+                logger=logger,
+                level=logging.INFO,
+                rank=0,
+                group=parallel_context.world_pg,
+            )
     return model
 
 
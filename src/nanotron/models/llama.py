@@ -30,10 +30,14 @@ from nanotron.models import NanotronModel
 from nanotron.nn.activations import ACT2FN
 from nanotron.nn.layer_norm import TritonRMSNorm
 from nanotron.parallel import ParallelContext
+from nanotron.parallel.context_parallel.ring_attention import ring_attention
+from nanotron.parallel.context_parallel.utils import get_sequence_chunk
+from nanotron.parallel.data_parallel.fully_sharded import iter_materialized_named_parameters
 from nanotron.parallel.parameters import NanotronParameter
 from nanotron.parallel.pipeline_parallel.block import PipelineBlock, TensorPointer
 from nanotron.parallel.pipeline_parallel.p2p import P2P
-from nanotron.parallel.tensor_parallel.functional import sharded_cross_entropy
+from nanotron.parallel.pipeline_parallel.partition import BlockMemoryCost, get_layer_activations_per_token
+from nanotron.parallel.tensor_parallel.functional import sharded_cross_entropy, sharded_linear_cross_entropy
 from nanotron.parallel.tensor_parallel.nn import (
     TensorParallelColumnLinear,
     TensorParallelEmbedding,
@@ -207,6 +211,7 @@ class MLP(nn.Module):
         config: LlamaConfig,
         parallel_config: Optional[ParallelismArgs],
         tp_pg: dist.ProcessGroup,
+        layer_idx: int = 0,
     ):
         super().__init__()
 
@@ -240,10 +245,16 @@ class MLP(nn.Module):
         )
         self.split_silu_mul = GLUActivation(config.hidden_act)
 
-    def forward(self, hidden_states):  # [seq_length, batch_size, hidden_dim]
+        # Only keep the input of the MLP, and recompute its intermediate activations in the backward
+        self.checkpoint_mlp = parallel_config is not None and parallel_config.should_recompute("mlp", layer_idx)
+
+    @checkpoint_method(attr_name="checkpoint_mlp")
+    def _core_forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
         merged_states = self.gate_up_proj(hidden_states)
-        hidden_states = self.down_proj(self.split_silu_mul(merged_states))
-        return {"hidden_states": hidden_states}
+        return self.down_proj(self.split_silu_mul(merged_states))
+
+    def forward(self, hidden_states):  # [seq_length, batch_size, hidden_dim]
+        return {"hidden_states": self._core_forward(hidden_states)}
 
 
 class CoreAttention(nn.Module):
@@ -267,14 +278,20 @@ class CoreAttention(nn.Module):
         value_states: torch.Tensor,  # [batch_size * kv_length, n_local_kv_heads, inner_dim]
         q_sequence_mask: torch.Tensor,  # torch.BoolTensor [batch_size, q_length] (can be broadcasted to that size)
         kv_sequence_mask: torch.Tensor,  # torch.BoolTensor [batch_size, kv_length] (can be broadcasted to that size)
+        cu_seqlens: Optional[torch.Tensor] = None,  # torch.IntTensor [n_documents + 1]
     ):
         from flash_attn.flash_attn_interface import flash_attn_varlen_func
 
-        # TODO @thomasw21: Compute once, instead of computing for each layers.
-        cu_seqlens_q = torch.zeros((q_sequence_mask.shape[0] + 1), dtype=torch.int32, device=query_states.device)
-        cu_seqlens_k = torch.zeros((kv_sequence_mask.shape[0] + 1), dtype=torch.int32, device=query_states.device)
-        torch.cumsum(q_sequence_mask.sum(-1, dtype=torch.int32), dim=0, dtype=torch.int32, out=cu_seqlens_q[1:])
-        torch.cumsum(kv_sequence_mask.sum(-1, dtype=torch.int32), dim=0, dtype=torch.int32, out=cu_seqlens_k[1:])
+        if cu_seqlens is not None:
+            # Packed documents: each document is a sequence of its own, so no token attends across a document boundary
+            cu_seqlens_q = cu_seqlens
+            cu_seqlens_k = cu_seqlens
+        else:
+            # TODO @thomasw21: Compute once, instead of computing for each layers.
+            cu_seqlens_q = torch.zeros((q_sequence_mask.shape[0] + 1), dtype=torch.int32, device=query_states.device)
+            cu_seqlens_k = torch.zeros((kv_sequence_mask.shape[0] + 1), dtype=torch.int32, device=query_states.device)
+            torch.cumsum(q_sequence_mask.sum(-1, dtype=torch.int32), dim=0, dtype=torch.int32, out=cu_seqlens_q[1:])
+            torch.cumsum(kv_sequence_mask.sum(-1, dtype=torch.int32), dim=0, dtype=torch.int32, out=cu_seqlens_k[1:])
 
         # TODO(kunhao): flash attn's causal means that the query can only attend to the keys before it. This is not
         # what we want if we are using kv cache. This is a hack as we always have q_length == 1 when using kv cache.
@@ -300,6 +317,20 @@ class CoreAttention(nn.Module):
         return attn_output
 
 
+def get_cu_seqlens_from_position_ids(position_ids: torch.Tensor) -> torch.Tensor:
+    """Cumulative sequence lengths of the documents packed in `position_ids` (batch_size, seqlen), flattened over the
+    batch. A document starts at every position id equal to 0 and at the start of every sample.
+    Returns:
+        cu_seqlens: (n_documents + 1,) torch.int32
+    """
+    position_ids = position_ids.clone()
+    position_ids[:, 0] = 0
+    position_ids = position_ids.view(-1)
+    document_starts = torch.nonzero(position_ids == 0).view(-1).to(torch.int32)
+    total_length = torch.tensor([position_ids.numel()], dtype=torch.int32, device=position_ids.device)
+    return torch.cat([document_starts, total_length])
+
+
 def pad_to_right(tensor, mask, new_tensor=None):
     """Transform a left-padded tensor into a right-padded tensor. (Useful for prefilling key/value states)
     Args:
@@ -335,6 +366,7 @@ class CausalSelfAttention(nn.Module, AttachableStore):
         parallel_config: Optional[ParallelismArgs],
         tp_pg: dist.ProcessGroup,
         layer_idx: int,
+        cp_pg: Optional[dist.ProcessGroup] = None,
     ):
         from flash_attn.layers.rotary import RotaryEmbedding as FlashRotaryEmbedding
 
@@ -367,6 +399,8 @@ class CausalSelfAttention(nn.Module, AttachableStore):
         self.d_v = config.hidden_size // config.num_attention_heads
         self.d_model = config.hidden_size
         self.is_using_mup = config.is_using_mup
+        # With context parallelism, the sequences are split across the CP ranks and attended with `ring_attention`
+        self.cp_pg = cp_pg
 
         # TODO @thomasw21: refactor so that we store that default in a single place.
         tp_mode = parallel_config.tp_mode if parallel_config is not None else TensorParallelLinearMode.ALL_REDUCE
@@ -434,6 +468,7 @@ class CausalSelfAttention(nn.Module, AttachableStore):
         self,
         hidden_states,  # [seq_length, batch_size, hidden_size]
         sequence_mask,  # [batch_size, seq_length]
+        cu_seqlens=None,  # [n_documents + 1], see `get_cu_seqlens_from_position_ids`
     ):
         from flash_attn import bert_padding
         from flash_attn.flash_attn_interface import (
@@ -478,7 +513,8 @@ class CausalSelfAttention(nn.Module, AttachableStore):
             # Double check that we use store only at inference time
             assert key_states.requires_grad is False
             assert value_states.requires_grad is False
-            if "position_offsets" in store:
+            is_prefill = "position_offsets" not in store
+            if not is_prefill:
                 old_position_offsets = store["position_offsets"]
                 position_ids = old_position_offsets[:, None] + sequence_mask
             else:
@@ -499,7 +535,21 @@ class CausalSelfAttention(nn.Module, AttachableStore):
                     query_states, key_states, cos, sin
                 )
 
-            if "key" not in store:
+            paged_kv_cache = self.get_paged_kv_cache()
+            layer_kv_cache = (
+                paged_kv_cache.get_layer_cache(
+                    id(self),
+                    n_kv_heads=self.n_local_kv_heads,
+                    d_qk=self.d_qk,
+                    d_v=self.d_v,
+                    dtype=query_states.dtype,
+                    device=query_states.device,
+                )
+                if paged_kv_cache is not None
+                else None
+            )
+
+            if is_prefill:
                 # First inference iteration (Prefill)
                 # TODO @nouamane: support custom masking
                 # assert that [ False, False, False, False,  True,  True,  True,  True,  True,  True] is accepted
@@ -508,22 +558,23 @@ class CausalSelfAttention(nn.Module, AttachableStore):
                     sequence_mask[:, :-1] & (~sequence_mask[:, 1:])  # True is never followed by False
                 ).any(), "Can't mask in the middle of sequence, please make sure that pads are at the left of the sequence if existing"
 
-                # preallocate k_cache, v_cache to self.prefill_kv_len
-                k_cache = torch.zeros(
-                    (
-                        batch_size,
-                        self.prefill_kv_len,
-                        self.n_local_kv_heads,
-                        self.d_qk,
-                    ),
-                    dtype=query_states.dtype,
-                    device=query_states.device,
-                )
-                v_cache = torch.zeros(
-                    (batch_size, self.prefill_kv_len, self.n_local_kv_heads, self.d_v),
-                    dtype=query_states.dtype,
-                    device=query_states.device,
-                )
+                if layer_kv_cache is None:
+                    # preallocate k_cache, v_cache to self.prefill_kv_len
+                    k_cache = torch.zeros(
+                        (
+                            batch_size,
+                            self.prefill_kv_len,
+                            self.n_local_kv_heads,
+                            self.d_qk,
+                        ),
+                        dtype=query_states.dtype,
+                        device=query_states.device,
+                    )
+                    v_cache = torch.zeros(
+                        (batch_size, self.prefill_kv_len, self.n_local_kv_heads, self.d_v),
+                        dtype=query_states.dtype,
+                        device=query_states.device,
+                    )
                 # Remove pad tokens from key_states and concatenate samples in key_unpad
                 # cu_seqlens_k is the cumulative sequence lengths of key_states
                 (query_unpad, indices_q, cu_seqlens_q, max_seqlen_q) = bert_padding.unpad_input(
@@ -556,8 +607,41 @@ class CausalSelfAttention(nn.Module, AttachableStore):
                     output_unpad, indices_q, batch_size, q_length
                 )  # (batch_size, q_length, n_local_q_heads, d_v)
 
-                pad_to_right(key_states, sequence_mask, new_tensor=k_cache)
-                pad_to_right(value_states, sequence_mask, new_tensor=v_cache)
+                if layer_kv_cache is not None:
+                    # The cache only holds the tokens of the sequences, in blocks taken as they grow
+                    seq_ids = layer_kv_cache.allocate_sequences(batch_size)
+                    layer_kv_cache.append(
+                        seq_ids, key_unpad, value_unpad, num_tokens=sequence_mask.sum(dim=1).tolist()
+                    )
+                else:
+                    pad_to_right(key_states, sequence_mask, new_tensor=k_cache)
+                    pad_to_right(value_states, sequence_mask, new_tensor=v_cache)
+
+            elif layer_kv_cache is not None:
+                # Subsequent inference iterations (q_length=1), with a paged cache
+                seq_ids = store["seq_ids"]
+                query_states = query_states.view(batch_size, q_length, self.n_local_q_heads, self.d_qk)
+                kv_length = key_states.shape[1]
+                # The masked tokens (generated after a sequence is done) aren't cached
+                layer_kv_cache.append(
+                    seq_ids,
+                    key_states.reshape(batch_size, kv_length, self.n_local_kv_heads, self.d_qk)[sequence_mask],
+                    value_states.reshape(batch_size, kv_length, self.n_local_kv_heads, self.d_v)[sequence_mask],
+                    num_tokens=sequence_mask.sum(dim=1).tolist(),
+                )
+
+                # NOTE: this scale is for µTransfer,
+                # in SP, we use sqrt(1/d_h)
+                softmax_scale = 1 / query_states.shape[-1] if self.is_using_mup else None
+                attention_output = flash_attn_with_kvcache(
+                    query_states,
+                    layer_kv_cache.key_blocks,
+                    layer_kv_cache.value_blocks,
+                    cache_seqlens=layer_kv_cache.get_seq_lens(seq_ids),
+                    block_table=layer_kv_cache.get_block_table(seq_ids),
+                    softmax_scale=softmax_scale,
+                    causal=True,
+                )  # (batch_size, q_length, n_local_q_heads, d_v)
 
             else:
                 # Pull pre-computed key/value states
@@ -639,50 +723,74 @@ class CausalSelfAttention(nn.Module, AttachableStore):
                     rotary_interleaved=False,  # the value is not used unless rotary_cos/sin is provided. https://github.com/Dao-AILab/flash-attention
                 )
 
-            store.update(
-                {
-                    "key": k_cache,  # flash-attn has updated with new key_states using cache_seqlens
-                    "value": v_cache,
-                    "position_offsets": position_offsets,
-                }
-            )
+            if layer_kv_cache is not None:
+                store.update({"seq_ids": seq_ids, "position_offsets": position_offsets})
+            else:
+                store.update(
+                    {
+                        "key": k_cache,  # flash-attn has updated with new key_states using cache_seqlens
+                        "value": v_cache,
+                        "position_offsets": position_offsets,
+                    }
+                )
+            # Lets the generation loop of every pipeline stage know which sequences are done
+            store["last_sequence_mask"] = sequence_mask[:, -1]
 
         else:  # Training case
             # Apply rotary embeddings to query/key states
+            # NOTE: With packed documents (`cu_seqlens`), the rotary embeddings still use the position in the sample.
+            # RoPE only depends on relative positions and tokens never attend across documents, so it's equivalent
             # NOTE: The layout is different from models/llama.py which is [batch_size, num_heads, seq_length, d_qk]
             # Here it is, [batch_size, seq_length, num_heads, d_qk]
             # [2, batch_size, seq_length, num_heads, d_qk]
             key_value_states = torch.cat([key_states.unsqueeze(0), value_states.unsqueeze(0)], dim=0)
             # [batch_size, seq_length, 2, num_heads, d_qk]
             key_value_states = key_value_states.permute(1, 2, 0, 3, 4).contiguous()
-            query_states, key_value_states = self.flash_rotary_embedding(query_states, kv=key_value_states)
+            # With context parallelism, the local chunk starts at this offset in the sequences
+            seqlen_offset = dist.get_rank(self.cp_pg) * q_length if self.cp_pg is not None else 0
+            query_states, key_value_states = self.flash_rotary_embedding(
+                query_states, kv=key_value_states, seqlen_offset=seqlen_offset
+            )
             # [batch_size, seq_length, num_heads, d_qk]
             key_states, value_states = torch.split(key_value_states, 1, dim=2)
 
-            q_sequence_mask = sequence_mask
-            kv_sequence_mask = sequence_mask
+            if self.cp_pg is not None and self.cp_pg.size() > 1:
+                # NOTE: this scale is for µTransfer,
+                # in SP, we use sqrt(1/d_h)
+                softmax_scale = 1 / self.d_qk if self.is_using_mup else None
+                attention_output = ring_attention(
+                    query_states=query_states,
+                    key_states=key_states.view(batch_size, q_length, self.n_local_kv_heads, self.d_qk),
+                    value_states=value_states.view(batch_size, q_length, self.n_local_kv_heads, self.d_v),
+                    cp_pg=self.cp_pg,
+                    softmax_scale=softmax_scale,
+                )  # [batch_size, q_length, n_local_q_heads, d_v]
+            else:
+                q_sequence_mask = sequence_mask
+                kv_sequence_mask = sequence_mask
 
-            kv_length = key_states.shape[1]
-            # [batch_size, seq_length, num_heads, d_qk]
-            # Shaping for use in `flash-attn` version of flash-attn: `flash_attn_unpadded_func`
-            query_states = query_states.view(
-                batch_size * q_length, self.n_local_q_heads, self.d_qk
-            )  # [batch_size * q_length, self.n_heads, d_qk]
-
-            key_states = key_states.view(
-                batch_size * kv_length, self.n_local_kv_heads, self.d_qk
-            )  # [batch_size * kv_length, self.n_heads, d_qk]
-            value_states = value_states.view(
-                batch_size * kv_length, self.n_local_kv_heads, self.d_v
-            )  # [batch_size * kv_length, self.n_heads, d_v]
-
-            attention_output = self.attention(
-                query_states=query_states,
-                key_states=key_states,
-                value_states=value_states,
-                q_sequence_mask=q_sequence_mask,
-                kv_sequence_mask=kv_sequence_mask,
-            )
+                kv_length = key_states.shape[1]
+                # [batch_size, seq_length, num_heads, d_qk]
+                # Shaping for use in `flash-attn` version of flash-attn: `flash_attn_unpadded_func`
+                query_states = query_states.view(
+                    batch_size * q_length, self.n_local_q_heads, self.d_qk
+                )  # [batch_size * q_length, self.n_heads, d_qk]
+
+                key_states = key_states.view(
+                    batch_size * kv_length, self.n_local_kv_heads, self.d_qk
+                )  # [batch_size * kv_length, self.n_heads, d_qk]
+                value_states = value_states.view(
+                    batch_size * kv_length, self.n_local_kv_heads, self.d_v
+                )  # [batch_size * kv_length, self.n_heads, d_v]
+
+                attention_output = self.attention(
+                    query_states=query_states,
+                    key_states=key_states,
+                    value_states=value_states,
+                    q_sequence_mask=q_sequence_mask,
+                    kv_sequence_mask=kv_sequence_mask,
+                    cu_seqlens=cu_seqlens,
+                )
 
         attention_output = (
             attention_output.contiguous().view(batch_size, q_length, self.n_local_q_heads * self.d_v).transpose(0, 1)
@@ -699,6 +807,7 @@ class LlamaDecoderLayer(nn.Module):
         parallel_config: Optional[ParallelismArgs],
         tp_pg: dist.ProcessGroup,
         layer_idx: int,
+        cp_pg: Optional[dist.ProcessGroup] = None,
     ):
         super().__init__()
         self.input_layernorm = TritonRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
@@ -707,22 +816,24 @@ class LlamaDecoderLayer(nn.Module):
             parallel_config=parallel_config,
             tp_pg=tp_pg,
             layer_idx=layer_idx,
+            cp_pg=cp_pg,
         )
 
         self.post_attention_layernorm = TritonRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
-        self.mlp = MLP(config=config, parallel_config=parallel_config, tp_pg=tp_pg)
+        self.mlp = MLP(config=config, parallel_config=parallel_config, tp_pg=tp_pg, layer_idx=layer_idx)
 
-        self.recompute_layer = parallel_config.recompute_layer
+        self.recompute_layer = parallel_config.should_recompute("full", layer_idx)
 
     def _core_forward(
         self,
         hidden_states: Union[torch.Tensor, TensorPointer],
         sequence_mask: Union[torch.Tensor, TensorPointer],
+        cu_seqlens: Optional[Union[torch.Tensor, TensorPointer]] = None,
     ) -> List[Union[torch.Tensor, TensorPointer]]:
         residual = hidden_states
         hidden_states = self.input_layernorm(hidden_states)
 
-        output = self.attn(hidden_states=hidden_states, sequence_mask=sequence_mask)
+        output = self.attn(hidden_states=hidden_states, sequence_mask=sequence_mask, cu_seqlens=cu_seqlens)
         hidden_states = output["hidden_states"]
         hidden_states = hidden_states + residual
 
@@ -737,24 +848,29 @@ class LlamaDecoderLayer(nn.Module):
         self,
         hidden_states: torch.Tensor,
         sequence_mask: torch.Tensor,
+        cu_seqlens: Optional[torch.Tensor] = None,
     ) -> List[torch.Tensor]:
-        return CheckpointFunction.apply(self._core_forward, True, hidden_states, sequence_mask)
+        return CheckpointFunction.apply(self._core_forward, True, hidden_states, sequence_mask, cu_seqlens)
 
     def forward(
         self,
         hidden_states: Union[torch.Tensor, TensorPointer],
         sequence_mask: Union[torch.Tensor, TensorPointer],
+        cu_seqlens: Optional[Union[torch.Tensor, TensorPointer]] = None,
     ) -> Dict[str, Union[torch.Tensor, TensorPointer]]:
 
         if self.recompute_layer and not isinstance(hidden_states, TensorPointer):
-            hidden_states, sequence_mask = self._checkpointed_forward(hidden_states, sequence_mask)
+            hidden_states, sequence_mask = self._checkpointed_forward(hidden_states, sequence_mask, cu_seqlens)
         else:
-            hidden_states, sequence_mask = self._core_forward(hidden_states, sequence_mask)
+            hidden_states, sequence_mask = self._core_forward(hidden_states, sequence_mask, cu_seqlens)
 
-        return {
+        output = {
             "hidden_states": hidden_states,
             "sequence_mask": sequence_mask,
         }
+        if cu_seqlens is not None:
+            output["cu_seqlens"] = cu_seqlens
+        return output
 
 
 class Embedding(nn.Module, AttachableStore):
@@ -799,7 +915,11 @@ class LlamaModel(nn.Module):
         super().__init__()
 
         # Declare all the nodes
-        self.p2p = P2P(parallel_context.pp_pg, device=torch.device("cuda"))
+        self.p2p = P2P(
+            parallel_context.pp_pg,
+            device=torch.device("cuda"),
+            cache_metadata=parallel_config.pp_cache_p2p_metadata if parallel_config is not None else False,
+        )
         self.config = config
         self.parallel_config = parallel_config
         self.parallel_context = parallel_context
@@ -807,6 +927,9 @@ class LlamaModel(nn.Module):
         tp_linear_async_communication = (
             parallel_config.tp_linear_async_communication if parallel_config is not None else False
         )
+        self.cross_entropy_chunk_size = (
+            parallel_config.tp_cross_entropy_chunk_size if parallel_config is not None else None
+        )
 
         self.token_position_embeddings = PipelineBlock(
             p2p=self.p2p,
@@ -827,6 +950,10 @@ class LlamaModel(nn.Module):
                 level=logging.INFO,
                 rank=0,
             )
+        # With doc masking, the boundaries of the packed documents go through every decoder layer
+        decoder_keys = {"hidden_states", "sequence_mask"}
+        if config.doc_masking:
+            decoder_keys.add("cu_seqlens")
         self.decoder = nn.ModuleList(
             [
                 PipelineBlock(
@@ -837,9 +964,10 @@ class LlamaModel(nn.Module):
                         "parallel_config": parallel_config,
                         "tp_pg": parallel_context.tp_pg,
                         "layer_idx": layer_idx,
+                        "cp_pg": parallel_context.cp_pg,
                     },
-                    module_input_keys={"hidden_states", "sequence_mask"},
-                    module_output_keys={"hidden_states", "sequence_mask"},
+                    module_input_keys=decoder_keys,
+                    module_output_keys=decoder_keys,
                 )
                 for layer_idx in range(config.num_hidden_layers)
             ]
@@ -853,23 +981,34 @@ class LlamaModel(nn.Module):
             module_output_keys={"hidden_states"},
         )  # TODO
 
-        self.lm_head = PipelineBlock(
-            p2p=self.p2p,
-            # Understand that this means that we return sharded logits that are going to need to be gathered
-            module_builder=TensorParallelColumnLinear,
-            module_kwargs={
-                "in_features": config.hidden_size,
-                "out_features": config.vocab_size,
-                "pg": parallel_context.tp_pg,
-                "bias": False,
-                # TODO @thomasw21: refactor so that we store that default in a single place.
-                "mode": self.tp_mode,
-                "async_communication": tp_linear_async_communication,
-                "tp_recompute_allgather": parallel_config.tp_recompute_allgather,
-            },
-            module_input_keys={"x"},
-            module_output_keys={"logits"},
-        )
+        lm_head_kwargs = {
+            "in_features": config.hidden_size,
+            "out_features": config.vocab_size,
+            "pg": parallel_context.tp_pg,
+            "bias": False,
+            # TODO @thomasw21: refactor so that we store that default in a single place.
+            "mode": self.tp_mode,
+            "async_communication": tp_linear_async_communication,
+            "tp_recompute_allgather": parallel_config.tp_recompute_allgather,
+        }
+        if self.cross_entropy_chunk_size is None:
+            self.lm_head = PipelineBlock(
+                p2p=self.p2p,
+                # Understand that this means that we return sharded logits that are going to need to be gathered
+                module_builder=TensorParallelColumnLinear,
+                module_kwargs=lm_head_kwargs,
+                module_input_keys={"x"},
+                module_output_keys={"logits"},
+            )
+        else:
+            # The lm_head computes the loss, so that the logits are never materialized
+            self.lm_head = PipelineBlock(
+                p2p=self.p2p,
+                module_builder=LMHeadWithLoss,
+                module_kwargs={**lm_head_kwargs, "chunk_size": self.cross_entropy_chunk_size},
+                module_input_keys={"x", "label_ids", "label_mask"},
+                module_output_keys={"loss"},
+            )
 
         self.cast_to_fp32 = PipelineBlock(
             p2p=self.p2p,
@@ -883,15 +1022,33 @@ class LlamaModel(nn.Module):
         self,
         input_ids: Union[torch.Tensor, TensorPointer],  # [batch_size, seq_length]
         input_mask: Union[torch.Tensor, TensorPointer],  # [batch_size, seq_length]
+        position_ids: Optional[Union[torch.Tensor, TensorPointer]] = None,  # [batch_size, seq_length]
+        label_ids: Optional[Union[torch.Tensor, TensorPointer]] = None,  # [batch_size, seq_length]
+        label_mask: Optional[Union[torch.Tensor, TensorPointer]] = None,  # [batch_size, seq_length]
     ):
-        return self.forward_with_hidden_states(input_ids=input_ids, input_mask=input_mask)[0]
+        return self.forward_with_hidden_states(
+            input_ids=input_ids,
+            input_mask=input_mask,
+            position_ids=position_ids,
+            label_ids=label_ids,
+            label_mask=label_mask,
+        )[0]
 
     def forward_with_hidden_states(
         self,
         input_ids: Union[torch.Tensor, TensorPointer],  # [batch_size, seq_length]
         input_mask: Union[torch.Tensor, TensorPointer],  # [batch_size, seq_length]
+        position_ids: Optional[Union[torch.Tensor, TensorPointer]] = None,  # [batch_size, seq_length]
+        label_ids: Optional[Union[torch.Tensor, TensorPointer]] = None,  # [batch_size, seq_length]
+        label_mask: Optional[Union[torch.Tensor, TensorPointer]] = None,  # [batch_size, seq_length]
     ):
+        """Returns the fp32 sharded logits and the hidden states, or the loss instead of the logits with
+        `tp_cross_entropy_chunk_size`, which requires the labels"""
         # all tensors are optional as most ranks don't need anything from the dataloader.
+        if self.config.doc_masking and position_ids is None:
+            raise ValueError("`position_ids` are required with `doc_masking`. Pack the documents in the data collator")
+        if self.cross_entropy_chunk_size is not None and (label_ids is None or label_mask is None):
+            raise ValueError("`label_ids` and `label_mask` are required with `tp_cross_entropy_chunk_size`")
 
         output = self.token_position_embeddings(input_ids=input_ids, input_mask=input_mask)
 
@@ -899,11 +1056,22 @@ class LlamaModel(nn.Module):
             "hidden_states": output["input_embeds"],
             "sequence_mask": input_mask,
         }
+        if self.config.doc_masking:
+            # Computed once for all the decoder layers, as it syncs with the host
+            hidden_encoder_states["cu_seqlens"] = (
+                get_cu_seqlens_from_position_ids(position_ids)
+                if isinstance(position_ids, torch.Tensor)
+                else position_ids
+            )
         for encoder_block in self.decoder:
             hidden_encoder_states = encoder_block(**hidden_encoder_states)
 
         hidden_states = self.final_layer_norm(input=hidden_encoder_states["hidden_states"])["hidden_states"]
 
+        if self.cross_entropy_chunk_size is not None:
+            loss = self.lm_head(x=hidden_states, label_ids=label_ids, label_mask=label_mask)["loss"]
+            return loss, hidden_states
+
         sharded_logits = self.lm_head(x=hidden_states)["logits"]
 
         fp32_sharded_logits = self.cast_to_fp32(x=sharded_logits)["output"]
@@ -921,9 +1089,59 @@ class LlamaModel(nn.Module):
             + 3 * d_ff * model_config.hidden_size,
             # This is the last lm_head
             TensorParallelColumnLinear: model_config.vocab_size * model_config.hidden_size,
+            # The logits are recomputed in the backward
+            LMHeadWithLoss: 4 / 3 * model_config.vocab_size * model_config.hidden_size,
         }
         return block_compute_costs
 
+    def get_block_memory_costs(self):
+        """Estimates the parameters and activations of each block on a TP rank, so that PP stages fit in memory."""
+        model_config = self.config
+        tp_size = self.parallel_context.tp_pg.size()
+        hidden_size = model_config.hidden_size
+        d_qkv = hidden_size // model_config.num_attention_heads
+        recompute_policy = self.parallel_config.recompute_policy if self.parallel_config is not None else None
+        recompute_layer_interval = (
+            self.parallel_config.recompute_layer_interval if self.parallel_config is not None else 1
+        )
+        # With sequence parallelism, the activations between the TP linears are split along the sequence
+        sequence_parallel = self.tp_mode is TensorParallelLinearMode.REDUCE_SCATTER
+        # The lm_head keeps its input gathered along the sequence unless it gathers it again in the backward
+        lm_head_input_tp_size = tp_size if sequence_parallel and self.parallel_config.tp_recompute_allgather else 1
+        decoder_layer_num_params = (
+            hidden_size * (2 * model_config.num_attention_heads + 2 * model_config.num_key_value_heads) * d_qkv
+            + 3 * model_config.intermediate_size * hidden_size
+        ) / tp_size + 2 * hidden_size
+        block_memory_costs = {
+            Embedding: BlockMemoryCost(
+                num_params=model_config.vocab_size * hidden_size / tp_size, activations_per_token=0
+            ),
+            LlamaDecoderLayer: BlockMemoryCost(
+                num_params=decoder_layer_num_params,
+                activations_per_token=get_layer_activations_per_token(
+                    hidden_size,
+                    tp_size,
+                    sequence_parallel=sequence_parallel,
+                    recompute_policy=recompute_policy,
+                    recompute_layer_interval=recompute_layer_interval,
+                ),
+            ),
+            TritonRMSNorm: BlockMemoryCost(
+                num_params=hidden_size, activations_per_token=2 * hidden_size / (tp_size if sequence_parallel else 1)
+            ),
+            # The input, the bf16 logits and their fp32 copy made by `cast_to_fp32`
+            TensorParallelColumnLinear: BlockMemoryCost(
+                num_params=model_config.vocab_size * hidden_size / tp_size,
+                activations_per_token=2 * hidden_size / lm_head_input_tp_size
+                + (2 + 4) * model_config.vocab_size / tp_size,
+            ),
+            # The gathered input and the fp32 logsumexp of each token
+            LMHeadWithLoss: BlockMemoryCost(
+                num_params=model_config.vocab_size * hidden_size / tp_size, activations_per_token=2 * hidden_size + 4
+            ),
+        }
+        return block_memory_costs
+
     def get_flops_per_sec(self, iteration_time_in_sec, sequence_length, global_batch_size):
         """Get flops per second for a given model"""
         world_size = self.parallel_context.world_pg.size()
@@ -978,6 +1196,31 @@ class Loss(nn.Module):
         return {"loss": loss}
 
 
+class LMHeadWithLoss(TensorParallelColumnLinear):
+    """lm_head computing the same loss as `Loss`, chunk by chunk, see `sharded_linear_cross_entropy`"""
+
+    def __init__(self, *args, chunk_size: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chunk_size = chunk_size
+
+    def forward(
+        self,
+        x: torch.Tensor,  # [seq_length, batch_size, hidden_size]
+        label_ids: torch.Tensor,  # [batch_size, seq_length]
+        label_mask: torch.Tensor,  # [batch_size, seq_length]
+    ) -> Dict[str, torch.Tensor]:
+        loss = sharded_linear_cross_entropy(
+            x,
+            self.weight,
+            label_ids.transpose(0, 1).contiguous(),
+            group=self.pg,
+            tp_mode=self.mode,
+            chunk_size=self.chunk_size,
+        ).transpose(0, 1)
+        loss = masked_mean(loss, label_mask, dtype=torch.float)
+        return {"loss": loss}
+
+
 class LlamaForTraining(NanotronModel):
     def __init__(
         self,
@@ -1009,10 +1252,28 @@ class LlamaForTraining(NanotronModel):
         input_mask: Union[torch.Tensor, TensorPointer],
         label_ids: Union[torch.Tensor, TensorPointer],
         label_mask: Union[torch.Tensor, TensorPointer],
+        position_ids: Optional[Union[torch.Tensor, TensorPointer]] = None,
     ) -> Dict[str, Union[torch.Tensor, TensorPointer]]:
+        # With context parallelism, each CP rank handles a contiguous chunk of the sequences, and its loss is averaged
+        # with the other ones by averaging the gradients, see `sync_gradients_across_cp`
+        input_ids, input_mask, label_ids, label_mask = (
+            get_sequence_chunk(tensor, self.parallel_context.cp_pg) if isinstance(tensor, torch.Tensor) else tensor
+            for tensor in (input_ids, input_mask, label_ids, label_mask)
+        )
+        if self.model.cross_entropy_chunk_size is not None:
+            loss = self.model(
+                input_ids=input_ids,
+                input_mask=input_mask,
+                position_ids=position_ids,
+                label_ids=label_ids,
+                label_mask=label_mask,
+            )
+            return {"loss": loss}
+
         sharded_logits = self.model(
             input_ids=input_ids,
             input_mask=input_mask,
+            position_ids=position_ids,
         )
         loss = self.loss(
             sharded_logits=sharded_logits,
@@ -1051,7 +1312,8 @@ class LlamaForTraining(NanotronModel):
         # Fix the root_model
         module_id_to_prefix[id(model)] = ""
 
-        for param_name, param in model.named_parameters():
+        # The parameters sharded across DP are allocated one block at a time
+        for param_name, param in iter_materialized_named_parameters(model):
             assert isinstance(param, NanotronParameter)
 
             module_name, param_name = param_name.rsplit(".", 1)
@@ -1092,6 +1354,15 @@ class LlamaForTraining(NanotronModel):
         """Computes the compute cost of each block in the model so that we can do a better job of load balancing."""
         return self.model.get_block_compute_costs()
 
+    def get_block_memory_costs(self):
+        """Estimates the parameters and activations of each block on a TP rank, so that PP stages fit in memory."""
+        block_memory_costs = self.model.get_block_memory_costs()
+        # The cross entropy keeps the fp32 softmax of the logits
+        block_memory_costs[Loss] = BlockMemoryCost(
+            num_params=0, activations_per_token=4 * self.config.vocab_size / self.parallel_context.tp_pg.size()
+        )
+        return block_memory_costs
+
     def get_flops_per_sec(self, iteration_time_in_sec, sequence_length, global_batch_size):
         """Get flops per second for a given model"""
         return self.model.get_flops_per_sec(iteration_time_in_sec, sequence_length, global_batch_size)
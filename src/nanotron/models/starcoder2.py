@@ -35,9 +35,11 @@ from nanotron.models import NanotronModel
 from nanotron.nn.activations import ACT2FN
 from nanotron.nn.layer_norm import TritonLayerNorm
 from nanotron.parallel import ParallelContext
+from nanotron.parallel.data_parallel.fully_sharded import iter_materialized_named_parameters
 from nanotron.parallel.parameters import NanotronParameter
 from nanotron.parallel.pipeline_parallel.block import PipelineBlock
 from nanotron.parallel.pipeline_parallel.p2p import P2P
+from nanotron.parallel.pipeline_parallel.partition import BlockMemoryCost, get_layer_activations_per_token
 from nanotron.parallel.pipeline_parallel.tensor_pointer import TensorPointer
 from nanotron.parallel.sharded_parameters import (
     SplitConfig,
@@ -1267,7 +1269,11 @@ class GPTModel(nn.Module):
         super().__init__()
 
         # Declare all the nodes
-        self.p2p = P2P(parallel_context.pp_pg, device=torch.device("cuda"))
+        self.p2p = P2P(
+            parallel_context.pp_pg,
+            device=torch.device("cuda"),
+            cache_metadata=parallel_config.pp_cache_p2p_metadata if parallel_config is not None else False,
+        )
         self.random_states = random_states
         self.tp_mode = parallel_config.tp_mode if parallel_config is not None else TensorParallelLinearMode.ALL_REDUCE
 
@@ -1491,7 +1497,8 @@ class Starcoder2ForTraining(NanotronModel):
         sigma = config.model.init_method.std
         num_layers = config.model.model_config.num_hidden_layers
 
-        for param_name, param in model.named_parameters():
+        # The parameters sharded across DP are allocated one block at a time
+        for param_name, param in iter_materialized_named_parameters(model):
             assert isinstance(param, NanotronParameter)
 
             module_name, param_name = param_name.rsplit(".", 1)
@@ -1581,6 +1588,49 @@ class Starcoder2ForTraining(NanotronModel):
         }
         return block_compute_costs
 
+    def get_block_memory_costs(self):
+        """Estimates the parameters and activations of each block on a TP rank, so that PP stages fit in memory."""
+        model_config = self.config
+        tp_size = self.parallel_context.tp_pg.size()
+        hidden_size = model_config.hidden_size
+        d_ff = model_config.intermediate_size if model_config.intermediate_size is not None else 4 * hidden_size
+        d_qkv = hidden_size // model_config.num_attention_heads
+        num_kv_heads = 1 if model_config.multi_query else model_config.num_kv_heads
+        # With sequence parallelism, the activations between the TP linears are split along the sequence, the lm_head
+        # gathering its input again in the backward
+        sequence_parallel = (
+            self.parallel_config is not None
+            and self.parallel_config.tp_mode is TensorParallelLinearMode.REDUCE_SCATTER
+        )
+        sequence_tp_size = tp_size if sequence_parallel else 1
+        block_memory_costs = {
+            Embedding: BlockMemoryCost(
+                num_params=model_config.vocab_size * hidden_size / tp_size, activations_per_token=0
+            ),
+            # The dropout mask
+            nn.Dropout: BlockMemoryCost(num_params=0, activations_per_token=hidden_size / sequence_tp_size),
+            GPTBlock: BlockMemoryCost(
+                num_params=(2 * model_config.num_attention_heads * d_qkv * hidden_size + 2 * d_ff * hidden_size)
+                / tp_size
+                + 2 * num_kv_heads * d_qkv * hidden_size
+                + 4 * hidden_size,
+                activations_per_token=get_layer_activations_per_token(
+                    hidden_size, tp_size, sequence_parallel=sequence_parallel
+                ),
+            ),
+            TritonLayerNorm: BlockMemoryCost(
+                num_params=2 * hidden_size, activations_per_token=2 * hidden_size / sequence_tp_size
+            ),
+            # The input, the bf16 logits and their fp32 copy made by `cast_to_fp32`
+            TensorParallelColumnLinear: BlockMemoryCost(
+                num_params=model_config.vocab_size * hidden_size / tp_size,
+                activations_per_token=2 * hidden_size / sequence_tp_size + (2 + 4) * model_config.vocab_size / tp_size,
+            ),
+            # The cross entropy keeps the fp32 softmax of the logits
+            Loss: BlockMemoryCost(num_params=0, activations_per_token=4 * model_config.vocab_size / tp_size),
+        }
+        return block_memory_costs
+
     def get_flops_per_sec(self, iteration_time_in_sec, sequence_length, global_batch_size):
         """Get flops per second for a given model"""
         world_size = self.parallel_context.world_pg.size()
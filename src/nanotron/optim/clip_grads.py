@@ -1,14 +1,42 @@
-from typing import Iterable, Optional, Tuple
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import torch
+from packaging import version
 
 import nanotron.distributed as dist
 from nanotron import logging
-from nanotron.optim.gradient_accumulator import GradientAccumulator
+from nanotron.optim.gradient_accumulator import GradientAccumulator, ShardedFP32GradientAccumulator
 from nanotron.parallel.parameters import NanotronParameter
 
 logger = logging.get_logger(__name__)
 
+# `torch._foreach_mul_` only accepts a tensor as scalar from torch 2.1
+torch_version_above_2_1 = version.parse(torch.__version__) >= version.parse("2.1.0")
+
+
+def _group_by_device_and_dtype(
+    grads: List[torch.Tensor],
+) -> Dict[Tuple[torch.device, torch.dtype], List[torch.Tensor]]:
+    grouped_grads = defaultdict(list)
+    for grad in grads:
+        grouped_grads[(grad.device, grad.dtype)].append(grad)
+    return grouped_grads
+
+
+def _get_grad_norms(grads: List[torch.Tensor], norm_type: float, foreach: bool) -> List[torch.Tensor]:
+    """Norm of each gradient, in fp32. With `foreach`, the p-norms of the fp32 gradients of a device are computed with
+    a single `torch._foreach_norm`, which returns the norms in the dtype of the gradients for the other dtypes."""
+    grad_norms = []
+    for (_, dtype), dtype_grads in _group_by_device_and_dtype(grads).items():
+        if foreach and dtype == torch.float and norm_type != torch.inf:
+            grad_norms.extend(torch._foreach_norm([grad.detach() for grad in dtype_grads], ord=norm_type))
+        else:
+            grad_norms.extend(
+                torch.linalg.vector_norm(grad.detach(), ord=norm_type, dtype=torch.float) for grad in dtype_grads
+            )
+    return grad_norms
+
 
 def clip_grad_norm(
     mp_pg: dist.ProcessGroup,
@@ -16,6 +44,7 @@ def clip_grad_norm(
     max_norm: float,
     grad_accumulator: Optional[GradientAccumulator],
     norm_type: float = 2.0,
+    foreach: Optional[bool] = None,
 ) -> torch.Tensor:
     """Clips gradients. Adapted from torch.nn.utils.clip_grad_norm_.
     Norms are computed in fp32 precision to retain most accuracy.
@@ -24,14 +53,19 @@ def clip_grad_norm(
         mp_pg (dist.ProcessGroup): Process group for model parallel, ie all the ranks part of the same model replica (TP x PP)
         named_parameters (Iterable[(str, Parameter)]): an iterable of named Parameters that will have gradients normalized.
         grad_accumulator (GradientAccumulator): grad accumulator. If not None, in case of Zero1, we need to clip all fp32 grads
+            In case of Zero2, each DP rank only holds a shard of the fp32 grads, so the norm is also reduced across DP
         max_norm (float or int): max norm of the gradients
         norm_type (float or int): type of the used p-norm. Can be ``'inf'`` for infinity norm.
+        foreach (bool): whether to compute the norms and scale the gradients with the multi-tensor `torch._foreach_*`
+            kernels, instead of launching kernels for each gradient. Defaults to True from torch 2.1.
 
     .. note:: In case parameters contains tied weights, we keep only a single copy of the gradient, but modify the
         gradient of all tied weights.
     """
     named_parameters = list(named_parameters)
     world_rank = dist.get_rank()
+    if foreach is None:
+        foreach = torch_version_above_2_1
 
     # assert that all params require grad
     for _, p in named_parameters:
@@ -52,24 +86,26 @@ def clip_grad_norm(
     # Calculate gradient norm
     if norm_type == torch.inf:
         if len(grads) > 0:
-            total_norm = torch.max(
-                torch.stack([torch.linalg.vector_norm(g.detach(), ord=torch.inf, dtype=torch.float) for g in grads])
-            )
+            total_norm = torch.max(torch.stack(_get_grad_norms(grads, norm_type=torch.inf, foreach=foreach)))
         else:
             total_norm = torch.zeros([], dtype=torch.float, device=torch.device("cuda"))
         dist.all_reduce(total_norm, group=mp_pg, op=dist.ReduceOp.MAX)
+        if isinstance(grad_accumulator, ShardedFP32GradientAccumulator):
+            dist.all_reduce(total_norm, group=grad_accumulator.dp_pg, op=dist.ReduceOp.MAX)
 
     else:
         if len(grads) > 0:
             # TODO @nouamanetazi: Check if we should calculate norm per parameter (remove .pow(norm_type)
             total_norm = torch.linalg.vector_norm(
-                torch.stack([torch.linalg.vector_norm(g.detach(), ord=norm_type, dtype=torch.float) for g in grads]),
+                torch.stack(_get_grad_norms(grads, norm_type=norm_type, foreach=foreach)),
                 ord=norm_type,
                 dtype=torch.float,
             ).pow(norm_type)
         else:
             total_norm = torch.zeros([], dtype=torch.float, device=torch.device("cuda"))
         dist.all_reduce(total_norm, group=mp_pg, op=dist.ReduceOp.SUM)
+        if isinstance(grad_accumulator, ShardedFP32GradientAccumulator):
+            dist.all_reduce(total_norm, group=grad_accumulator.dp_pg, op=dist.ReduceOp.SUM)
         total_norm.pow_(1.0 / norm_type)
 
     # Scale gradients
@@ -79,18 +115,19 @@ def clip_grad_norm(
     # when the gradients do not reside in CPU memory.
     clip_coef_clamped = torch.clamp(clip_coef, max=1.0)
 
-    devices = {
-        param.grad.device if grad_accumulator is None else grad_accumulator.get_grad_buffer(name).device
-        for name, param in named_parameters
-    }
-    device_to_clip_coef_clamped = {device: clip_coef_clamped.to(device) for device in devices}
+    # The gradients of all the parameters are scaled, including the copies of tied parameters left out of the norm
+    if grad_accumulator is None:
+        all_grads = [param.grad for _, param in named_parameters]
+    else:
+        all_grads = [grad_accumulator.get_grad_buffer(name) for name, _ in named_parameters]
 
-    for name, param in named_parameters:
-        if grad_accumulator is None:
-            param.grad.detach().mul_(device_to_clip_coef_clamped[param.grad.device])
-        else:
-            grad_accumulator.get_grad_buffer(name).detach().mul_(
-                device_to_clip_coef_clamped[grad_accumulator.get_grad_buffer(name).device]
-            )
+    if foreach:
+        for (device, _), dtype_grads in _group_by_device_and_dtype(all_grads).items():
+            torch._foreach_mul_([grad.detach() for grad in dtype_grads], clip_coef_clamped.to(device))
+    else:
+        devices = {grad.device for grad in all_grads}
+        device_to_clip_coef_clamped = {device: clip_coef_clamped.to(device) for device in devices}
+        for grad in all_grads:
+            grad.detach().mul_(device_to_clip_coef_clamped[grad.device])
 
     return total_norm
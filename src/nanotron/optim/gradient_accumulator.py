@@ -1,8 +1,8 @@
 import dataclasses
 from abc import ABC, abstractmethod
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from contextlib import contextmanager
-from typing import Callable, Dict, Iterator, Optional, Tuple
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 import torch
 from torch.distributed import GradBucket
@@ -23,7 +23,10 @@ class GradientAccumulator(ABC):
         ...
 
     @abstractmethod
-    def backward(self, loss: torch.Tensor):
+    def backward(self, loss: torch.Tensor, param_ids: Optional[Set[int]] = None):
+        """`param_ids` are the ids of the parameters whose gradients the backward computes, all of them if None (eg. with
+        an interleaved pipeline, a backward only computes the gradients of one model chunk)
+        """
         ...
 
     @abstractmethod
@@ -54,36 +57,45 @@ class GradientAccumulator(ABC):
     def load_state_dict(self, state_dict: torch.Tensor):
         ...
 
+    def copy_grads_to_cpu(self):
+        """Copies the gradients read by the optimizer to CPU, when it runs on CPU"""
+        pass
+
 
 class FP32GradientAccumulator(GradientAccumulator):
     def __init__(
         self,
         named_parameters: Iterator[Tuple[str, NanotronParameter]],
         grad_buckets_named_params: Optional[Iterator[Tuple[str, NanotronParameter]]] = None,
+        offload_to_cpu: bool = False,
     ):
         """Create a gradient accumulator that will accumulate gradients in fp32.
 
         Args:
             named_parameters: The parameters that will be updated by the optimizer. In case of Zero 1, this is the parameters that will be updated in this DP rank.
             grad_buckets_named_params: The parameters to accumulate gradients for. If None it defaults to `named_parameters`. In case of Zero 1, this should be all the parameters in the model.
+            offload_to_cpu: Whether to keep the fp32 weights in pinned CPU memory, so that the optimizer and its states run on CPU. The fp32 gradients are still accumulated on GPU, and copied to CPU by `copy_grads_to_cpu` before the optimizer step.
 
         Note: We use `grad_buckets_named_params` to keep grad buffers for all parameters even when Zero 1 is used. This is because we need to accumulate gradients for all parameters without having to reduce in every accumulation step.
         Note: We make a fp32 copy of parameters during initialization. Therefore parameters need to be initialized or loaded from a checkpoint before constructing this gradient accumulator
         """
+        named_parameters = list(named_parameters)
         if grad_buckets_named_params is None:
-            named_parameters = list(named_parameters)
             grad_buckets_named_params = named_parameters
+        grad_buckets_named_params = list(grad_buckets_named_params)
 
         # Initialize grad bucket
         self.fp32_grad_buffers, self._contiguous_fp32_grad_buffer = self.build_grad_buffers(
             named_parameters=grad_buckets_named_params
         )
 
-        # Assign big buffer for weights + grad in fp32
+        # Assign big buffer for weights + grad in fp32. With ZeRO, `named_parameters` are slices of the parameters, so
+        # whether they're trained is read on the full parameters
+        requires_grad_names = {name for name, param in grad_buckets_named_params if param.requires_grad}
         segment_index = {}
         length = 0
         for name, param in named_parameters:
-            if not param.requires_grad:
+            if name not in requires_grad_names:
                 continue
 
             start = length
@@ -92,7 +104,19 @@ class FP32GradientAccumulator(GradientAccumulator):
             segment_index[name] = (start, end_weight, param)
             length = end_weight
 
-        big_flat_buffer = torch.empty(length, dtype=torch.float, device="cuda")
+        if len(segment_index) == 0 and len(named_parameters) > 0:
+            raise ValueError(f"None of the {len(named_parameters)} parameters to update requires grad")
+        # Parameters live on the GPU, except when testing on CPU. Without any parameter, the buffers are empty
+        device = grad_buckets_named_params[0][1].device if len(grad_buckets_named_params) > 0 else torch.device("cpu")
+        self.offload_to_cpu = offload_to_cpu
+        if offload_to_cpu:
+            # Pinned memory allows copying asynchronously from and to the GPU
+            pin_memory = device.type == "cuda"
+            big_flat_buffer = torch.empty(length, dtype=torch.float, pin_memory=pin_memory)
+            # The optimizer reads the gradients of the fp32 weights on CPU
+            self._cpu_fp32_grad_buffer = torch.zeros(length, dtype=torch.float, pin_memory=pin_memory)
+        else:
+            big_flat_buffer = torch.empty(length, dtype=torch.float, device=device)
         self.parameters = {
             name: {
                 "fp32": big_flat_buffer[start_weight:end_weight].view_as(param),
@@ -100,6 +124,11 @@ class FP32GradientAccumulator(GradientAccumulator):
             }
             for name, (start_weight, end_weight, param) in segment_index.items()
         }
+        if offload_to_cpu:
+            for name, (start_weight, end_weight, param) in segment_index.items():
+                self.parameters[name]["cpu_fp32_grad"] = self._cpu_fp32_grad_buffer[start_weight:end_weight].view_as(
+                    param
+                )
 
         with torch.inference_mode():
             for _, elt in self.parameters.items():
@@ -201,10 +230,12 @@ class FP32GradientAccumulator(GradientAccumulator):
 
         return fp32_grad_buffers, contiguous_buffer_f32_gradients
 
-    def backward(self, loss: torch.Tensor):
+    def backward(self, loss: torch.Tensor, param_ids: Optional[Set[int]] = None):
         result = loss.backward()
 
         for name, elt in self.fp32_grad_buffers.items():
+            if param_ids is not None and id(elt["half"]) not in param_ids:
+                continue
             self._accumulate_grad(name=name, half_param=elt["half"])
 
         return result
@@ -223,7 +254,7 @@ class FP32GradientAccumulator(GradientAccumulator):
         half_param.grad = None
 
         # In the case an optimizer decides to set it to None, we need to re-assign previous buffer
-        if name in self.parameters:
+        if name in self.parameters and not self.offload_to_cpu:
             fp32_param = self.parameters[name]["fp32"]
             if hasattr(self, "param_name_to_offsets"):
                 if name not in self.param_name_to_offsets:
@@ -235,6 +266,28 @@ class FP32GradientAccumulator(GradientAccumulator):
                 grad = fp32_grad
             fp32_param.grad = grad
 
+    def _get_fp32_grad_for_optimizer(self, name: str) -> torch.Tensor:
+        """Returns the slice of the fp32 gradient of `name` the optimizer of this rank updates its weights with"""
+        fp32_grad = self.get_grad_buffer(name=name)
+        if hasattr(self, "param_name_to_offsets"):
+            start_offset, end_offset = self.param_name_to_offsets.get(name, (0, 0))
+            return fp32_grad.view(-1)[start_offset:end_offset]
+        return fp32_grad
+
+    def copy_grads_to_cpu(self):
+        """When the fp32 weights are offloaded, copies their final gradients to pinned CPU memory for the optimizer
+        step. All the copies are launched asynchronously, then waited for at once."""
+        if not self.offload_to_cpu:
+            return
+
+        for name, elt in self.parameters.items():
+            cpu_fp32_grad = elt["cpu_fp32_grad"]
+            cpu_fp32_grad.view(-1).copy_(self._get_fp32_grad_for_optimizer(name).view(-1), non_blocking=True)
+            elt["fp32"].grad = cpu_fp32_grad
+        if torch.cuda.is_available():
+            # This also makes sure the copies of the previous `step` from the fp32 weights are done
+            torch.cuda.current_stream().synchronize()
+
     @contextmanager
     def no_sync(self):
         """A context manager to disable gradient synchronizations across
@@ -259,8 +312,8 @@ class FP32GradientAccumulator(GradientAccumulator):
             fp32_param = self.parameters[name]["fp32"]
             half_param = self.parameters[name]["half"]
             # TODO @nouamane: should we use a fused kernel to copy?
-            # Copy weights from full precision to half precision
-            half_param.copy_(fp32_param)
+            # Copy weights from full precision to half precision, asynchronously from pinned memory
+            half_param.copy_(fp32_param, non_blocking=self.offload_to_cpu)
 
     def zero_grad(self):
         # Full precision gradients are reset to zero/none after the underlying `optimiser.step`, so no need to reset.
@@ -294,6 +347,229 @@ class FP32GradientAccumulator(GradientAccumulator):
                 elt["fp32"].copy_(state_dict[name])
 
 
+@dataclasses.dataclass
+class ShardedGradBucket:
+    """Parameters whose gradients are reduce-scattered together
+
+    Attributes:
+        named_params: parameters of the bucket, in the same order on all DP ranks
+        gather_index: [dp_size, chunk_size], position of each element of the reduce-scatter input in the concatenated
+            flat gradients of the bucket. Row `dp_rank` holds the slices of `dp_rank`, padded to the longest row with
+            the index of a trailing zero.
+        shard_grad: this rank's slices of the fp32 gradients of the bucket, a view of the sharded grad buffer
+    """
+
+    named_params: List[Tuple[str, NanotronParameter]]
+    gather_index: torch.Tensor
+    shard_grad: torch.Tensor
+
+
+class ShardedFP32GradientAccumulator(FP32GradientAccumulator):
+    def __init__(
+        self,
+        named_parameters: Iterator[Tuple[str, NanotronParameter]],
+        grad_buckets_named_params: Iterator[Tuple[str, NanotronParameter]],
+        dp_pg: dist.ProcessGroup,
+        bucket_cap_mb: int = 25,
+        grad_buckets_names: Optional[List[List[str]]] = None,
+        offload_to_cpu: bool = False,
+    ):
+        """Create a gradient accumulator for ZeRO stage 2: gradients are accumulated in fp32 only for the slices of
+        parameters this DP rank updates.
+
+        After each backward, the half precision gradients are reduce-scattered across DP in buckets of `bucket_cap_mb`:
+        each DP rank receives the average of its slices (`param_name_to_dp_rank_offsets` of `ZeroDistributedOptimizer`)
+        and accumulates it in its fp32 grad buffer, which is `dp_pg.size()` times smaller than the full one. Half
+        precision gradients are freed as soon as they're reduced, and the fp32 gradients are already synced across DP.
+
+        Args:
+            named_parameters: The slices of parameters that will be updated by the optimizer of this DP rank.
+            grad_buckets_named_params: All the parameters of the model.
+            dp_pg: The process group to reduce-scatter gradients across.
+            bucket_cap_mb: Size of the fp32 gradients reduce-scattered at once.
+            grad_buckets_names: Names of the parameters of each bucket. The parameters that aren't in any of them are
+                grouped in buckets of `bucket_cap_mb`. With ZeRO stage 3, these are the parameters of each block, which
+                are reduce-scattered during the backward by calling `reduce_scatter_grads`.
+            offload_to_cpu: Whether to keep the fp32 weights in pinned CPU memory, see `FP32GradientAccumulator`.
+
+        Note: The grad buffers are built by `assign_param_offsets`, once the slices of every DP rank are known.
+        """
+        self.dp_pg = dp_pg
+        self.bucket_cap_mb = bucket_cap_mb
+        self.grad_buckets_names = grad_buckets_names if grad_buckets_names is not None else []
+        super().__init__(
+            named_parameters=named_parameters,
+            grad_buckets_named_params=grad_buckets_named_params,
+            offload_to_cpu=offload_to_cpu,
+        )
+
+    def build_grad_buffers(
+        self,
+        named_parameters: Iterator[Tuple[str, NanotronParameter]],
+    ) -> Tuple[Dict[str, Dict], torch.Tensor]:
+        self.grad_buckets_named_params = [(name, param) for name, param in named_parameters if param.requires_grad]
+        for name, param in self.grad_buckets_named_params:
+            assert param.dtype != torch.float, f"Expected {name} not to be float"
+            assert param.is_contiguous(), f"Expected {name} to be contiguous"
+        return OrderedDict(), torch.empty(0)
+
+    def assign_param_offsets(self, param_name_to_offsets: Dict[str, Dict[int, Tuple[int, int]]], dp_rank: int):
+        super().assign_param_offsets(param_name_to_offsets=param_name_to_offsets, dp_rank=dp_rank)
+        dp_size = self.dp_pg.size()
+        device = self.grad_buckets_named_params[0][1].device if len(self.grad_buckets_named_params) > 0 else "cuda"
+
+        name_to_param = dict(self.grad_buckets_named_params)
+        buckets_named_params = [[(name, name_to_param[name]) for name in names] for names in self.grad_buckets_names]
+        bucketed_names = {name for names in self.grad_buckets_names for name in names}
+
+        # Group the other consecutive parameters in buckets of at most `bucket_cap_mb` of fp32 gradients
+        buckets_named_params.append([])
+        bucket_numel = 0
+        for name, param in self.grad_buckets_named_params:
+            if name in bucketed_names:
+                continue
+            if len(buckets_named_params[-1]) > 0 and (bucket_numel + param.numel()) * 4 > self.bucket_cap_mb * 2**20:
+                buckets_named_params.append([])
+                bucket_numel = 0
+            buckets_named_params[-1].append((name, param))
+            bucket_numel += param.numel()
+
+        # Only this rank's slices are kept in fp32, ordered by bucket so that a bucket's slices are contiguous
+        shard_numel = sum(end - start for start, end in self.param_name_to_offsets.values())
+        self._contiguous_fp32_grad_buffer = torch.zeros(shard_numel, dtype=torch.float, device=device)
+        self.fp32_grad_buffers = OrderedDict()
+        self.buckets: List[ShardedGradBucket] = []
+        shard_offset = 0
+        for named_params in buckets_named_params:
+            if len(named_params) == 0:
+                continue
+
+            bucket_numel = sum(param.numel() for _, param in named_params)
+            rank_indices = [[] for _ in range(dp_size)]
+            param_offset = 0
+            for name, param in named_params:
+                for rank, (start, end) in param_name_to_offsets[name].items():
+                    rank_indices[rank].append(torch.arange(param_offset + start, param_offset + end))
+                param_offset += param.numel()
+            rank_indices = [torch.cat(indices) if len(indices) > 0 else torch.empty(0) for indices in rank_indices]
+            chunk_size = max(len(indices) for indices in rank_indices)
+            # Padding points to a zero appended to the flat gradients
+            gather_index = torch.full((dp_size, chunk_size), fill_value=bucket_numel, dtype=torch.long)
+            for rank, indices in enumerate(rank_indices):
+                gather_index[rank, : len(indices)] = indices
+
+            local_numel = len(rank_indices[dp_rank])
+            shard_grad = self._contiguous_fp32_grad_buffer[shard_offset : shard_offset + local_numel]
+            for name, param in named_params:
+                start, end = self.param_name_to_offsets.get(name, (0, 0))
+                self.fp32_grad_buffers[name] = {"half": param, "fp32_grad": shard_grad[: end - start]}
+                shard_grad = shard_grad[end - start :]
+            self.buckets.append(
+                ShardedGradBucket(
+                    named_params=named_params,
+                    gather_index=gather_index.to(device),
+                    shard_grad=self._contiguous_fp32_grad_buffer[shard_offset : shard_offset + local_numel],
+                )
+            )
+            shard_offset += local_numel
+
+        self._name_to_bucket_id = {
+            name: bucket_id for bucket_id, bucket in enumerate(self.buckets) for name, _ in bucket.named_params
+        }
+        self._reduced_bucket_ids = set()
+        self._in_flight = deque()
+
+    def reduce_scatter_grads(self, names: List[str]):
+        """Reduce-scatters the gradients of the bucket of `names` without waiting for the end of the backward"""
+        self._launch_reduce_scatter(self._name_to_bucket_id[names[0]])
+
+    def _launch_reduce_scatter(self, bucket_id: int):
+        if bucket_id in self._reduced_bucket_ids:
+            return
+        self._reduced_bucket_ids.add(bucket_id)
+
+        # Keep at most two buckets in flight, to bound the memory used by the communication buffers
+        self._in_flight.append(self._reduce_scatter_bucket(self.buckets[bucket_id]))
+        if len(self._in_flight) > 1:
+            self._accumulate_reduced_bucket(*self._in_flight.popleft())
+
+    def backward(self, loss: torch.Tensor, param_ids: Optional[Set[int]] = None):
+        result = loss.backward()
+
+        for bucket_id, bucket in enumerate(self.buckets):
+            if bucket_id in self._reduced_bucket_ids:
+                # Already reduced during the backward, see `reduce_scatter_grads`
+                continue
+            missing_grad_names = [name for name, half_param in bucket.named_params if half_param.grad is None]
+            if len(missing_grad_names) > 0:
+                # With an interleaved pipeline, a backward only computes the gradients of one model chunk. The bucket
+                # is reduced once the gradients of all its parameters are computed
+                assert param_ids is not None and all(
+                    id(half_param) not in param_ids for _, half_param in bucket.named_params if half_param.grad is None
+                ), f"Expected params {missing_grad_names} to have gradient."
+                continue
+            self._launch_reduce_scatter(bucket_id)
+        while len(self._in_flight) > 0:
+            self._accumulate_reduced_bucket(*self._in_flight.popleft())
+        self._reduced_bucket_ids.clear()
+
+        # In the case an optimizer decides to set it to None, we need to re-assign previous buffer
+        if not self.offload_to_cpu:
+            for name, elt in self.parameters.items():
+                elt["fp32"].grad = self.get_grad_buffer(name).view_as(elt["fp32"])
+
+        return result
+
+    def _reduce_scatter_bucket(
+        self, bucket: ShardedGradBucket
+    ) -> Tuple[ShardedGradBucket, torch.Tensor, Optional[dist.Work]]:
+        flat_grads = []
+        for name, half_param in bucket.named_params:
+            if half_param.grad is None:
+                # The parameters of a block sharded across DP which got no gradient in its backward, eg. unused ones
+                flat_grads.append(torch.zeros(half_param.numel(), dtype=half_param.dtype, device=half_param.device))
+                continue
+            flat_grads.append(half_param.grad.view(-1))
+        flat_grads.append(torch.zeros(1, dtype=flat_grads[0].dtype, device=flat_grads[0].device))
+        # [dp_size, chunk_size], averaged across DP
+        rank_chunks = torch.cat(flat_grads)[bucket.gather_index].to(torch.float).div_(self.dp_pg.size())
+        del flat_grads
+        for _, half_param in bucket.named_params:
+            half_param.grad = None
+
+        if self.dp_pg.size() == 1:
+            return bucket, rank_chunks[0], None
+        if dist.get_backend(self.dp_pg) == dist.Backend.GLOO:
+            # Gloo doesn't support reduce-scatter
+            handle = dist.all_reduce(rank_chunks, op=dist.ReduceOp.SUM, group=self.dp_pg, async_op=True)
+            return bucket, rank_chunks[dist.get_rank(self.dp_pg)], handle
+        chunk = torch.empty(rank_chunks.shape[1], dtype=torch.float, device=rank_chunks.device)
+        handle = dist.reduce_scatter_tensor(
+            chunk, rank_chunks.view(-1), op=dist.ReduceOp.SUM, group=self.dp_pg, async_op=True
+        )
+        return bucket, chunk, handle
+
+    @staticmethod
+    def _accumulate_reduced_bucket(bucket: ShardedGradBucket, chunk: torch.Tensor, handle: Optional[dist.Work]):
+        if handle is not None:
+            handle.wait()
+        bucket.shard_grad.add_(chunk[: len(bucket.shard_grad)])
+
+    def _get_fp32_grad_for_optimizer(self, name: str) -> torch.Tensor:
+        # The grad buffer only holds the slice of this rank
+        return self.get_grad_buffer(name)
+
+    def sync_gradients_across_dp(self, dp_pg: dist.ProcessGroup, reduce_op: dist.ReduceOp, reduce_scatter: bool):
+        # Gradients are already reduce-scattered after each backward
+        assert dp_pg is self.dp_pg
+        return
+
+    def zero_grad(self):
+        for elt in self.fp32_grad_buffers.values():
+            elt["half"].grad = None
+        self._contiguous_fp32_grad_buffer.zero_()
+
+
 @dataclasses.dataclass
 class FP32GradBucketManager:
     """Manages the fp32 gradient buckets.
@@ -4,7 +4,6 @@ from collections import defaultdict
 from pathlib import Path
 from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
 
-import numpy as np
 import torch.optim
 from functorch.dim import tree_map
 from torch import nn
@@ -17,19 +16,26 @@ from nanotron.logging import human_format, log_rank, warn_once
 from nanotron.optim.base import BaseOptimizer
 from nanotron.optim.inherit_from_other_optimizer import InheritFromOtherOptimizer
 from nanotron.parallel import ParallelContext
+from nanotron.parallel.data_parallel.fully_sharded import FullyShardedParameters, get_dp_rank_offsets
 from nanotron.parallel.parameters import NanotronParameter
 
 logger = logging.get_logger(__name__)
 
 
 class ZeroDistributedOptimizer(InheritFromOtherOptimizer):
-    """Optimizer that handles partitioning of optimizer's states across DP ranks. See ZeRO Stage 1 in the paper https://arxiv.org/abs/1910.02054v3 for more details."""
+    """Optimizer that handles partitioning of optimizer's states across DP ranks. See ZeRO Stage 1 in the paper https://arxiv.org/abs/1910.02054v3 for more details.
+
+    Gradients are partitioned as well (ZeRO Stage 2) when accumulated with a `ShardedFP32GradientAccumulator`.
+    Parameters are partitioned as well (ZeRO Stage 3) when `param_sharder` is given: it shards them with the same
+    partition, this rank's optimizer then updates its shards in place.
+    """
 
     def __init__(
         self,
         named_params_or_groups: Iterable[Union[Tuple[str, NanotronParameter], Dict[str, Any]]],
         optimizer_builder: Callable[[Iterable[Dict[str, Any]]], BaseOptimizer],
         dp_pg: ProcessGroup,
+        param_sharder: Optional[FullyShardedParameters] = None,
     ):
         named_params_or_groups = list(named_params_or_groups)
         if len(named_params_or_groups) == 0 or isinstance(named_params_or_groups[0], dict):
@@ -63,19 +69,18 @@ class ZeroDistributedOptimizer(InheritFromOtherOptimizer):
         # `self.param_name_to_dp_rank_offsets` sets mapping between each param inside self.named_params and its rank
         # NOTE: some param_groups may have no params in the current rank. we still keep them in self.optimizer.param_groups
         self.param_name_to_dp_rank_offsets = self._partition_parameters()
+        self.param_sharder = param_sharder
+        if param_sharder is not None:
+            assert all(
+                self.param_name_to_dp_rank_offsets[name] == offsets
+                for name, offsets in param_sharder.param_name_to_dp_rank_offsets.items()
+            ), "The parameters have to be sharded with the same partition as the optimizer states"
 
         current_dp_rank = dist.get_rank(self.dp_pg)
         param_groups_in_rank = [
             {
                 "named_params": [
-                    (
-                        name,
-                        get_sliced_tensor(
-                            param=param,
-                            start_offset=self.param_name_to_dp_rank_offsets[name][current_dp_rank][0],
-                            end_offset=self.param_name_to_dp_rank_offsets[name][current_dp_rank][1],
-                        ),
-                    )
+                    (name, self._get_sliced_param(name=name, param=param, dp_rank=current_dp_rank))
                     for name, param in param_group["named_params"]
                     if current_dp_rank in self.param_name_to_dp_rank_offsets[name]
                 ],
@@ -115,6 +120,10 @@ class ZeroDistributedOptimizer(InheritFromOtherOptimizer):
             rank=0,
         )
 
+        if self.param_sharder is not None:
+            # Parameters still gathered are stale, they're gathered again when they're used
+            self.param_sharder.reshard()
+
         # All gather updated params
         self._all_gather_params()
         return loss
@@ -171,26 +180,7 @@ class ZeroDistributedOptimizer(InheritFromOtherOptimizer):
         for name, param in named_params:
             # We assume parameter to be contiguous in order to have an easy way of sharding it.
             assert param.is_contiguous(), f"Parameter {name} is not contiguous"
-
-            numel = param.numel()
-            padded_numel_per_dp = (numel - 1) // self.dp_pg.size() + 1
-            sizes = np.full(shape=(self.dp_pg.size()), fill_value=padded_numel_per_dp)
-            remainder = padded_numel_per_dp * self.dp_pg.size() - numel
-            # Last `remainder` indices has one less element
-            if remainder > 0:
-                # It's weird that `size[-0:]` returns the entire list instead of nothing
-                sizes[-remainder:] -= 1
-            end_offsets = np.cumsum(sizes)
-            assert len(end_offsets) == self.dp_pg.size()
-            assert end_offsets[-1] == numel, f"Somehow {end_offsets[-1]} != {numel}"
-            # We want start indices,
-            start_offsets = np.concatenate([[0], end_offsets[:-1]])
-
-            param_name_to_dp_rank_offsets[name] = {
-                dp_rank: (start_offsets[dp_rank], end_offsets[dp_rank])
-                for dp_rank in range(self.dp_pg.size())
-                if start_offsets[dp_rank] < end_offsets[dp_rank]  # Only if the slice is not empty.
-            }
+            param_name_to_dp_rank_offsets[name] = get_dp_rank_offsets(param.numel(), self.dp_pg.size())
 
         log_rank("[ZeRO sharding] Size of optimizer params per rank:", logger=logger, level=logging.INFO, rank=0)
         all_numel = sum(
@@ -214,12 +204,24 @@ class ZeroDistributedOptimizer(InheritFromOtherOptimizer):
 
         return param_name_to_dp_rank_offsets
 
+    def _get_sliced_param(self, name: str, param: NanotronParameter, dp_rank: int) -> "SlicedFlatTensor":
+        if self.param_sharder is not None and self.param_sharder.is_sharded(name):
+            shard = self.param_sharder.get_shard(name)
+            sliced_shard = get_sliced_tensor(param=shard, start_offset=0, end_offset=shard.numel())
+            # The shard is a plain tensor, the optimizer and the gradient accumulator train it like its parameter
+            sliced_shard.requires_grad_(param.requires_grad)
+            return sliced_shard
+        start_offset, end_offset = self.param_name_to_dp_rank_offsets[name][dp_rank]
+        return get_sliced_tensor(param=param, start_offset=start_offset, end_offset=end_offset)
+
     def _all_gather_params(self):
         """All gather updated params"""
+        # Parameters sharded across DP are only gathered when they're used
         all_named_tensors_to_gather = [
             (name, param.view(-1))
             for named_param_groups in self.zero_named_param_groups
             for name, param in named_param_groups["named_params"]
+            if self.param_sharder is None or not self.param_sharder.is_sharded(name)
         ]
 
         if len(all_named_tensors_to_gather) == 0:
@@ -17,9 +17,16 @@ class ParallelContext:
         data_parallel_size: int,
         expert_parallel_size: int = 1,
         backend: DistributedBackend = "nccl",
+        context_parallel_size: int = 1,
     ):
-        """Initialize parallel context."""
-        num_gpus_per_model = tensor_parallel_size * pipeline_parallel_size * expert_parallel_size
+        """Initialize parallel context.
+
+        The ranks of a context parallel (CP) group hold the same model replica and split the sequences of the same
+        samples, see `nanotron.parallel.context_parallel.ring_attention`.
+        """
+        num_gpus_per_model = (
+            tensor_parallel_size * pipeline_parallel_size * expert_parallel_size * context_parallel_size
+        )
         world_size = int(os.environ["WORLD_SIZE"])
 
         assert (
@@ -27,7 +34,7 @@ class ParallelContext:
         ), "The total number of processes must be divisible by the data parallel size."
         assert world_size % num_gpus_per_model == 0, (
             "The total number of processes must be divisible by"
-            "the number of GPUs per model (tensor_parallel_size * pipeline_parallel_size)."
+            "the number of GPUs per model (tensor_parallel_size * pipeline_parallel_size * context_parallel_size)."
         )
         if num_gpus_per_model * data_parallel_size != world_size:
             raise ValueError(
@@ -42,6 +49,7 @@ class ParallelContext:
         self.pipeline_parallel_size = pipeline_parallel_size
         self.data_parallel_size = data_parallel_size
         self.expert_parallel_size = expert_parallel_size
+        self.context_parallel_size = context_parallel_size
 
         self._groups = {}
 
@@ -66,32 +74,42 @@ class ParallelContext:
         """Initialize 3D parallelism's all process groups."""
         dist.barrier()
         world_size = int(os.environ["WORLD_SIZE"])
+        # CP ranks are next to the TP ones, so that the ring attention P2P stays within nodes when possible
         ranks = np.arange(0, world_size).reshape(
             (
                 self.expert_parallel_size,
                 self.pipeline_parallel_size,
                 self.data_parallel_size,
+                self.context_parallel_size,
                 self.tensor_parallel_size,
             )
         )
         self.world_ranks_to_pg = {}
 
         # Relevant process groups containing the current rank
-        self.tp_pg = self.create_new_group(ranks.transpose((0, 1, 2, 3)).reshape((-1, self.tensor_parallel_size)))
-        self.dp_pg = self.create_new_group(ranks.transpose((3, 0, 1, 2)).reshape((-1, self.data_parallel_size)))
-        self.pp_pg = self.create_new_group(ranks.transpose((2, 3, 0, 1)).reshape((-1, self.pipeline_parallel_size)))
-        self.expert_pg = self.create_new_group(ranks.transpose((1, 2, 3, 0)).reshape((-1, self.expert_parallel_size)))
+        self.tp_pg = self.create_new_group(ranks.transpose((0, 1, 2, 3, 4)).reshape((-1, self.tensor_parallel_size)))
+        self.cp_pg = self.create_new_group(ranks.transpose((0, 1, 2, 4, 3)).reshape((-1, self.context_parallel_size)))
+        self.dp_pg = self.create_new_group(ranks.transpose((3, 4, 0, 1, 2)).reshape((-1, self.data_parallel_size)))
+        self.pp_pg = self.create_new_group(ranks.transpose((2, 3, 4, 0, 1)).reshape((-1, self.pipeline_parallel_size)))
+        self.expert_pg = self.create_new_group(
+            ranks.transpose((1, 2, 3, 4, 0)).reshape((-1, self.expert_parallel_size))
+        )
 
-        # model parallel group = combination of tp and pp and exp for a given dp rank
+        # model parallel group = combination of tp and pp and exp for a given dp and cp rank
         self.mp_pg = self.create_new_group(
-            [ranks[:, :, dp_rank, :].reshape(-1) for dp_rank in range(self.data_parallel_size)]
+            [
+                ranks[:, :, dp_rank, cp_rank, :].reshape(-1)
+                for dp_rank in range(self.data_parallel_size)
+                for cp_rank in range(self.context_parallel_size)
+            ]
         )
 
         self.tp_and_expert_pg = self.create_new_group(
             [
-                ranks[:, pp_rank, dp_rank, :].reshape(-1)
+                ranks[:, pp_rank, dp_rank, cp_rank, :].reshape(-1)
                 for pp_rank in range(self.pipeline_parallel_size)
                 for dp_rank in range(self.data_parallel_size)
+                for cp_rank in range(self.context_parallel_size)
             ]
         )
 
@@ -125,8 +143,12 @@ class ParallelContext:
         device_id = local_rank
         torch.cuda.set_device(torch.cuda.device(device_id))
 
-    def get_local_ranks(self, world_rank: int) -> Tuple[int, int, int]:
-        return tuple(i.item() for i in np.where(self.world_rank_matrix == world_rank))
+    def get_local_ranks(self, world_rank: int) -> Tuple[int, int, int, int, int]:
+        """Returns the (ep_rank, pp_rank, dp_rank, tp_rank, cp_rank) of `world_rank`"""
+        ep_rank, pp_rank, dp_rank, cp_rank, tp_rank = (
+            i.item() for i in np.where(self.world_rank_matrix == world_rank)
+        )
+        return ep_rank, pp_rank, dp_rank, tp_rank, cp_rank
 
     def destroy(self):
         if not dist.is_initialized():
@@ -141,6 +163,7 @@ class ParallelContext:
         pp_rank: int,
         dp_rank: int,
         tp_rank: int,
+        cp_rank: int = 0,
     ) -> np.int64:
         """
         Get the global rank based on the specified ranks in different parallel groups.
@@ -149,7 +172,8 @@ class ParallelContext:
         :param pp_rank: int, Rank in the pipeline parallel group.
         :param dp_rank: int, Rank in the data parallel group.
         :param tp_rank: int, Rank in the tensor parallel group.
+        :param cp_rank: int, Rank in the context parallel group.
 
         :return: numpy.int64, The global rank.
         """
-        return self.world_rank_matrix[ep_rank, pp_rank, dp_rank, tp_rank]
\ No newline at end of file
+        return self.world_rank_matrix[ep_rank, pp_rank, dp_rank, cp_rank, tp_rank]
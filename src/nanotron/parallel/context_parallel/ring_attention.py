@@ -0,0 +1,295 @@
+"""Ring attention (https://arxiv.org/abs/2310.01889): causal attention over sequences split in contiguous chunks across
+the ranks of a context parallel (CP) process group"""
+
+import inspect
+from typing import List, Optional, Tuple
+
+import torch
+
+from nanotron import distributed as dist
+
+
+def _repeat_kv(key_value_states: torch.Tensor, n_repeats: int) -> torch.Tensor:
+    # [batch_size, kv_length, n_kv_heads, d_qk] -> [batch_size, kv_length, n_kv_heads * n_repeats, d_qk]
+    return key_value_states.repeat_interleave(n_repeats, dim=2) if n_repeats > 1 else key_value_states
+
+
+def _get_scores(
+    query_states: torch.Tensor, key_states: torch.Tensor, softmax_scale: float, causal: bool
+) -> torch.Tensor:
+    # [batch_size, n_heads, q_length, kv_length] in fp32
+    scores = torch.einsum("bqhd,bkhd->bhqk", query_states.float(), key_states.float()) * softmax_scale
+    if causal:
+        q_length, kv_length = scores.shape[-2:]
+        # Aligned on the last tokens, like flash attention
+        mask = torch.ones(q_length, kv_length, dtype=torch.bool, device=scores.device).tril(kv_length - q_length)
+        scores = scores.masked_fill(~mask, float("-inf"))
+    return scores
+
+
+def attention_reference(
+    query_states: torch.Tensor,  # [batch_size, q_length, n_heads, d_qk]
+    key_states: torch.Tensor,  # [batch_size, kv_length, n_kv_heads, d_qk]
+    value_states: torch.Tensor,  # [batch_size, kv_length, n_kv_heads, d_v]
+    softmax_scale: Optional[float] = None,
+    causal: bool = True,
+) -> torch.Tensor:
+    """Attention over the whole sequences with plain torch ops, to check `ring_attention` against on CPU"""
+    n_repeats = query_states.shape[2] // key_states.shape[2]
+    if softmax_scale is None:
+        softmax_scale = query_states.shape[-1] ** -0.5
+    scores = _get_scores(query_states, _repeat_kv(key_states, n_repeats), softmax_scale, causal)
+    attention_probs = torch.softmax(scores, dim=-1)
+    attention_output = torch.einsum("bhqk,bkhd->bqhd", attention_probs, _repeat_kv(value_states, n_repeats).float())
+    return attention_output.to(query_states.dtype)
+
+
+def attention_block_forward(
+    query_states: torch.Tensor,
+    key_states: torch.Tensor,
+    value_states: torch.Tensor,
+    softmax_scale: float,
+    causal: bool,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Attention of the queries over a block of keys and values, with flash attention on CUDA
+
+    Returns:
+        attention_output: [batch_size, q_length, n_heads, d_v]
+        softmax_lse: logsumexp of the attention scores of each query, [batch_size, n_heads, q_length] in fp32
+    """
+    if query_states.is_cuda:
+        from flash_attn.flash_attn_interface import flash_attn_func
+
+        attention_output, softmax_lse, _ = flash_attn_func(
+            query_states,
+            key_states,
+            value_states,
+            dropout_p=0.0,
+            softmax_scale=softmax_scale,
+            causal=causal,
+            return_attn_probs=True,
+        )
+        return attention_output, softmax_lse
+
+    n_repeats = query_states.shape[2] // key_states.shape[2]
+    scores = _get_scores(query_states, _repeat_kv(key_states, n_repeats), softmax_scale, causal)
+    softmax_lse = torch.logsumexp(scores, dim=-1)
+    attention_probs = torch.exp(scores - softmax_lse[..., None])
+    attention_output = torch.einsum("bhqk,bkhd->bqhd", attention_probs, _repeat_kv(value_states, n_repeats).float())
+    return attention_output.to(query_states.dtype), softmax_lse
+
+
+def attention_block_backward(
+    grad_output: torch.Tensor,
+    query_states: torch.Tensor,
+    key_states: torch.Tensor,
+    value_states: torch.Tensor,
+    attention_output: torch.Tensor,
+    softmax_lse: torch.Tensor,
+    softmax_scale: float,
+    causal: bool,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Gradients of the queries and of a block of keys and values, given the output and logsumexp of the attention
+    over all the blocks: the attention probabilities of the block are then its share of the softmax over the whole
+    sequence, so the gradients of the blocks add up to the ones of the whole attention.
+
+    Returns:
+        grad_query, grad_key, grad_value: with the shapes and dtypes of the queries, keys and values
+    """
+    if query_states.is_cuda:
+        from flash_attn.flash_attn_interface import _flash_attn_backward
+
+        grad_query = torch.empty_like(query_states)
+        grad_key = torch.empty_like(key_states)
+        grad_value = torch.empty_like(value_states)
+        kwargs = {}
+        if "softcap" in inspect.signature(_flash_attn_backward).parameters:
+            # flash-attn>=2.6
+            kwargs["softcap"] = 0.0
+        _flash_attn_backward(
+            grad_output.contiguous(),
+            query_states,
+            key_states,
+            value_states,
+            attention_output,
+            softmax_lse,
+            grad_query,
+            grad_key,
+            grad_value,
+            dropout_p=0.0,
+            softmax_scale=softmax_scale,
+            causal=causal,
+            window_size=(-1, -1),
+            alibi_slopes=None,
+            deterministic=False,
+            **kwargs,
+        )
+        return grad_query, grad_key, grad_value
+
+    batch_size, kv_length, n_kv_heads, _ = key_states.shape
+    n_repeats = query_states.shape[2] // n_kv_heads
+    repeated_key_states = _repeat_kv(key_states, n_repeats).float()
+    scores = _get_scores(query_states, repeated_key_states, softmax_scale, causal)
+    attention_probs = torch.exp(scores - softmax_lse[..., None])
+    grad_output = grad_output.float()
+
+    grad_value = torch.einsum("bhqk,bqhd->bkhd", attention_probs, grad_output)
+    grad_probs = torch.einsum("bqhd,bkhd->bhqk", grad_output, _repeat_kv(value_states, n_repeats).float())
+    # [batch_size, n_heads, q_length]
+    delta = (grad_output * attention_output.float()).sum(dim=-1).transpose(1, 2)
+    grad_scores = attention_probs * (grad_probs - delta[..., None]) * softmax_scale
+    grad_query = torch.einsum("bhqk,bkhd->bqhd", grad_scores, repeated_key_states)
+    grad_key = torch.einsum("bhqk,bqhd->bkhd", grad_scores, query_states.float())
+
+    # Sum the gradients of the query heads sharing a key/value head
+    grad_key = grad_key.view(batch_size, kv_length, n_kv_heads, n_repeats, -1).sum(dim=3)
+    grad_value = grad_value.view(batch_size, kv_length, n_kv_heads, n_repeats, -1).sum(dim=3)
+    return grad_query.to(query_states.dtype), grad_key.to(key_states.dtype), grad_value.to(value_states.dtype)
+
+
+def _ring_send_recv(
+    tensors_to_send: List[torch.Tensor], cp_pg: dist.ProcessGroup
+) -> Tuple[List[torch.Tensor], List[dist.Work]]:
+    """Sends the tensors to the next CP rank and receives the same number of tensors with the same shapes from the
+    previous one, in a single batch to avoid deadlocks around the ring"""
+    cp_rank, cp_size = dist.get_rank(cp_pg), cp_pg.size()
+    next_rank = dist.get_global_rank(group=cp_pg, group_rank=(cp_rank + 1) % cp_size)
+    prev_rank = dist.get_global_rank(group=cp_pg, group_rank=(cp_rank - 1) % cp_size)
+
+    recv_tensors = [torch.empty_like(tensor) for tensor in tensors_to_send]
+    p2p_ops = []
+    for tensor, recv_tensor in zip(tensors_to_send, recv_tensors):
+        p2p_ops.append(dist.P2POp(op=dist.isend, tensor=tensor, peer=next_rank, group=cp_pg))
+        p2p_ops.append(dist.P2POp(op=dist.irecv, tensor=recv_tensor, peer=prev_rank, group=cp_pg))
+    return recv_tensors, dist.batch_isend_irecv(p2p_ops)
+
+
+class _RingAttention(torch.autograd.Function):
+    @staticmethod
+    def forward(
+        ctx,
+        query_states: torch.Tensor,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        cp_pg: dist.ProcessGroup,
+        softmax_scale: float,
+    ):
+        cp_rank, cp_size = dist.get_rank(cp_pg), cp_pg.size()
+        # Keys and values travel together around the ring
+        key_value_states = torch.stack([key_states, value_states]).contiguous()
+
+        attention_output, softmax_lse = None, None
+        for step in range(cp_size):
+            if step < cp_size - 1:
+                # Overlapped with the attention over the current block
+                (next_key_value_states,), reqs = _ring_send_recv([key_value_states], cp_pg)
+
+            # The chunk of the CP rank `cp_rank - step`: the previous chunks are attended fully, the next ones not at all
+            if step <= cp_rank:
+                block_output, block_lse = attention_block_forward(
+                    query_states,
+                    key_value_states[0],
+                    key_value_states[1],
+                    softmax_scale=softmax_scale,
+                    causal=step == 0,
+                )
+                block_output = block_output.float()
+                if attention_output is None:
+                    attention_output, softmax_lse = block_output, block_lse
+                else:
+                    # Blockwise softmax: rescale both outputs to the logsumexp of the union of the blocks
+                    new_softmax_lse = torch.logaddexp(softmax_lse, block_lse)
+                    attention_output = (
+                        attention_output * torch.exp(softmax_lse - new_softmax_lse).transpose(1, 2)[..., None]
+                        + block_output * torch.exp(block_lse - new_softmax_lse).transpose(1, 2)[..., None]
+                    )
+                    softmax_lse = new_softmax_lse
+
+            if step < cp_size - 1:
+                for req in reqs:
+                    req.wait()
+                key_value_states = next_key_value_states
+
+        attention_output = attention_output.to(query_states.dtype)
+        ctx.save_for_backward(query_states, key_states, value_states, attention_output, softmax_lse)
+        ctx.cp_pg = cp_pg
+        ctx.softmax_scale = softmax_scale
+        return attention_output
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        query_states, key_states, value_states, attention_output, softmax_lse = ctx.saved_tensors
+        cp_pg = ctx.cp_pg
+        cp_rank, cp_size = dist.get_rank(cp_pg), cp_pg.size()
+
+        key_value_states = torch.stack([key_states, value_states]).contiguous()
+        grad_query = torch.zeros_like(query_states, dtype=torch.float)
+        # The gradients of the keys and values travel with them, and are back on their CP rank after a full turn
+        grad_key_value_states_to_send = None
+        for step in range(cp_size):
+            tensors_to_send = []
+            if step < cp_size - 1:
+                tensors_to_send.append(key_value_states)
+            if step > 0:
+                tensors_to_send.append(grad_key_value_states_to_send)
+            recv_tensors, reqs = _ring_send_recv(tensors_to_send, cp_pg) if len(tensors_to_send) > 0 else ([], [])
+
+            if step <= cp_rank:
+                block_grad_query, block_grad_key, block_grad_value = attention_block_backward(
+                    grad_output,
+                    query_states,
+                    key_value_states[0],
+                    key_value_states[1],
+                    attention_output,
+                    softmax_lse,
+                    softmax_scale=ctx.softmax_scale,
+                    causal=step == 0,
+                )
+                grad_query += block_grad_query
+                block_grad_key_value_states = torch.stack([block_grad_key, block_grad_value]).float()
+            else:
+                block_grad_key_value_states = None
+
+            for req in reqs:
+                req.wait()
+            if step > 0:
+                grad_key_value_states = recv_tensors[-1]
+                if block_grad_key_value_states is not None:
+                    grad_key_value_states += block_grad_key_value_states
+            else:
+                grad_key_value_states = block_grad_key_value_states
+            grad_key_value_states_to_send = grad_key_value_states
+            if step < cp_size - 1:
+                key_value_states = recv_tensors[0]
+
+        if cp_size > 1:
+            (grad_key_value_states,), reqs = _ring_send_recv([grad_key_value_states_to_send], cp_pg)
+            for req in reqs:
+                req.wait()
+
+        grad_key, grad_value = grad_key_value_states.to(key_states.dtype)
+        return grad_query.to(query_states.dtype), grad_key, grad_value, None, None
+
+
+def ring_attention(
+    query_states: torch.Tensor,  # [batch_size, q_length, n_heads, d_qk]
+    key_states: torch.Tensor,  # [batch_size, kv_length, n_kv_heads, d_qk]
+    value_states: torch.Tensor,  # [batch_size, kv_length, n_kv_heads, d_qk]
+    cp_pg: dist.ProcessGroup,
+    softmax_scale: Optional[float] = None,
+) -> torch.Tensor:
+    """Causal attention of the local chunk of the sequences over the chunks of this CP rank and the previous ones.
+
+    CP rank `r` holds the `r`-th contiguous chunk of the sequences. The keys and values are passed around the ring of
+    CP ranks, overlapping each send/recv with the attention over the previous block, and the blocks are merged with
+    their softmax logsumexps. In the backward, the gradients of the keys and values go around the ring with them.
+    The chunks after the local one are masked, so the last CP ranks compute more blocks than the first ones.
+    Padding and packed documents aren't masked.
+
+    Returns:
+        attention_output: [batch_size, q_length, n_heads, d_qk]
+    """
+    assert key_states.shape == value_states.shape, "Keys and values are sent around the ring together"
+    if softmax_scale is None:
+        softmax_scale = query_states.shape[-1] ** -0.5
+    return _RingAttention.apply(query_states, key_states, value_states, cp_pg, softmax_scale)
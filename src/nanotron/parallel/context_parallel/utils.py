@@ -0,0 +1,42 @@
+from typing import Optional
+
+import torch
+from torch import nn
+
+from nanotron import distributed as dist
+from nanotron.optim.gradient_accumulator import GradientAccumulator
+
+
+def get_sequence_chunk(tensor: torch.Tensor, cp_pg: dist.ProcessGroup, dim: int = 1) -> torch.Tensor:
+    """Contiguous chunk of the sequences of `tensor` along `dim` handled by this CP rank"""
+    cp_size = cp_pg.size()
+    if cp_size == 1:
+        return tensor
+    sequence_length = tensor.shape[dim]
+    assert (
+        sequence_length % cp_size == 0
+    ), f"Sequence length ({sequence_length}) must be divisible by the context parallel size ({cp_size})"
+    chunk_size = sequence_length // cp_size
+    return tensor.narrow(dim, dist.get_rank(cp_pg) * chunk_size, chunk_size)
+
+
+def sync_gradients_across_cp(
+    module: nn.Module, cp_pg: dist.ProcessGroup, grad_accumulator: Optional[GradientAccumulator]
+):
+    """Averages the gradients across CP: each CP rank only backpropagated the loss of its chunk of the sequences.
+    The ranks of a CP group hold the same parameters and the same slices of them with ZeRO, as DP groups are split
+    the same way on all of them."""
+    if cp_pg.size() == 1:
+        return
+
+    if grad_accumulator is not None:
+        grads = [grad_accumulator._contiguous_fp32_grad_buffer]
+    else:
+        grads = [param.grad for param in module.parameters() if param.grad is not None]
+    # Gloo doesn't support `ReduceOp.AVG`
+    for grad in grads:
+        grad.div_(cp_pg.size())
+    if len(grads) == 1:
+        dist.all_reduce(grads[0], op=dist.ReduceOp.SUM, group=cp_pg)
+    elif len(grads) > 1:
+        dist.all_reduce_coalesced(grads, op=dist.ReduceOp.SUM, group=cp_pg)
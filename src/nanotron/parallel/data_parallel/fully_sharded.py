@@ -0,0 +1,467 @@
+from collections import Counter
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+from nanotron import distributed as dist
+from nanotron.parallel.parameters import NanotronParameter
+from nanotron.parallel.pipeline_parallel.block import PipelineBlock
+from nanotron.utils import get_untyped_storage
+from torch import nn
+
+
+def get_dp_rank_offsets(numel: int, dp_size: int) -> Dict[int, Tuple[int, int]]:
+    """Returns: the slice (start and end offsets) of a flattened parameter of `numel` elements kept by each DP rank.
+    Ranks whose slice is empty are skipped.
+    """
+    padded_numel_per_dp = (numel - 1) // dp_size + 1
+    sizes = np.full(shape=(dp_size), fill_value=padded_numel_per_dp)
+    remainder = padded_numel_per_dp * dp_size - numel
+    # Last `remainder` indices has one less element
+    if remainder > 0:
+        # It's weird that `size[-0:]` returns the entire list instead of nothing
+        sizes[-remainder:] -= 1
+    end_offsets = np.cumsum(sizes)
+    assert len(end_offsets) == dp_size
+    assert end_offsets[-1] == numel, f"Somehow {end_offsets[-1]} != {numel}"
+    # We want start indices,
+    start_offsets = np.concatenate([[0], end_offsets[:-1]])
+
+    return {
+        dp_rank: (start_offsets[dp_rank], end_offsets[dp_rank])
+        for dp_rank in range(dp_size)
+        if start_offsets[dp_rank] < end_offsets[dp_rank]  # Only if the slice is not empty.
+    }
+
+
+def release_parameters(module: nn.Module):
+    """Frees the storage of the parameters of `module`, keeping their shapes. Their values are lost: they're allocated
+    again once sharded by `FullyShardedParameters`, before being initialized or loaded.
+    """
+    for param in module.parameters():
+        get_untyped_storage(param).resize_(0)
+
+
+class FullyShardedBlock:
+    """Parameters of a `PipelineBlock` sharded across DP (ZeRO stage 3)
+
+    The parameters are views of a flat buffer, `flat_params`, whose storage is only allocated while they're unsharded.
+    Freeing the storage (instead of the tensors) means the views autograd saved during the forward see the parameters
+    again once they're gathered for the backward.
+
+    Each DP rank keeps its slices of the parameters (`param_name_to_dp_rank_offsets`, see `get_dp_rank_offsets`) in
+    `shard`, padded to the size of the largest rank's slices so that all shards are all-gathered in a single collective.
+
+    flat_params: [total number of elements of the parameters]
+    shard: [chunk_size]
+    """
+
+    def __init__(
+        self,
+        named_params: List[Tuple[str, NanotronParameter]],
+        param_name_to_dp_rank_offsets: Dict[str, Dict[int, Tuple[int, int]]],
+        dp_pg: dist.ProcessGroup,
+    ):
+        self.named_params = named_params
+        self.dp_pg = dp_pg
+        dp_size = dp_pg.size()
+        dp_rank = dist.get_rank(dp_pg)
+        dtypes = {param.dtype for _, param in named_params}
+        assert len(dtypes) == 1, f"Expected the parameters of a block to have the same dtype, got {dtypes}"
+        dtype = named_params[0][1].dtype
+        device = named_params[0][1].device
+
+        # Position of each rank's slices in the flat parameters
+        rank_indices = [[] for _ in range(dp_size)]
+        numel = 0
+        for name, param in named_params:
+            assert param.is_contiguous(), f"Parameter {name} is not contiguous"
+            for rank, (start, end) in param_name_to_dp_rank_offsets[name].items():
+                rank_indices[rank].append(torch.arange(numel + start, numel + end))
+            numel += param.numel()
+        rank_indices = [
+            torch.cat(indices) if len(indices) > 0 else torch.empty(0, dtype=torch.long) for indices in rank_indices
+        ]
+        self.chunk_size = max(len(indices) for indices in rank_indices)
+        # Position of each element of the flat parameters in the all-gathered shards
+        unshard_index = torch.empty(numel, dtype=torch.long)
+        for rank, indices in enumerate(rank_indices):
+            unshard_index[indices] = rank * self.chunk_size + torch.arange(len(indices))
+        self.unshard_index = unshard_index.to(device)
+        self.local_index = rank_indices[dp_rank].to(device)
+
+        self.flat_params = torch.empty(numel, dtype=dtype, device=device)
+        self.shard = torch.zeros(self.chunk_size, dtype=dtype, device=device)
+        with torch.no_grad():
+            offset = 0
+            for _, param in named_params:
+                flat_param = self.flat_params[offset : offset + param.numel()].view_as(param)
+                # Parameters released once built have no values yet, see `release_parameters`
+                if get_untyped_storage(param).size() > 0:
+                    flat_param.copy_(param)
+                param.data = flat_param
+                offset += param.numel()
+            self.shard[: len(self.local_index)] = self.flat_params[self.local_index]
+
+        # This rank's slice of each parameter, a view of the shard
+        self.name_to_shard: Dict[str, torch.Tensor] = {}
+        shard = self.shard
+        for name, _ in named_params:
+            start, end = param_name_to_dp_rank_offsets[name].get(dp_rank, (0, 0))
+            self.name_to_shard[name] = shard[: end - start]
+            shard = shard[end - start :]
+
+        self.is_unsharded = True
+        self._pending_all_gather: Optional[Tuple[torch.Tensor, Optional[dist.Work]]] = None
+        # Backward bookkeeping, see `FullyShardedParameters`
+        self.is_in_backward = False
+        self.num_ready_grads = 0
+        self.num_expected_grads = 0
+        self.grad_accumulators = []
+
+    def all_gather(self):
+        """Launches the all-gather of the shards, without waiting for it (eg. to prefetch the parameters)"""
+        if self.is_unsharded or self._pending_all_gather is not None:
+            return
+
+        if self.dp_pg.size() == 1:
+            self._pending_all_gather = (self.shard, None)
+            return
+        all_shards = torch.empty(self.dp_pg.size() * self.chunk_size, dtype=self.shard.dtype, device=self.shard.device)
+        if dist.get_backend(self.dp_pg) == dist.Backend.GLOO:
+            # Gloo doesn't support all-gathering into a single tensor
+            handle = dist.all_gather(
+                list(all_shards.view(self.dp_pg.size(), self.chunk_size)), self.shard, group=self.dp_pg, async_op=True
+            )
+        else:
+            handle = dist.all_gather_into_tensor(all_shards, self.shard, group=self.dp_pg, async_op=True)
+        self._pending_all_gather = (all_shards, handle)
+
+    @torch.no_grad()
+    def unshard(self):
+        if self.is_unsharded:
+            return
+
+        self.all_gather()
+        all_shards, handle = self._pending_all_gather
+        self._pending_all_gather = None
+        if handle is not None:
+            handle.wait()
+        self.materialize()
+        torch.index_select(all_shards, 0, self.unshard_index, out=self.flat_params)
+
+    def materialize(self):
+        """Allocates the unsharded parameters without gathering their values (eg. to initialize them)"""
+        if self.is_unsharded:
+            return
+
+        get_untyped_storage(self.flat_params).resize_(self.flat_params.numel() * self.flat_params.element_size())
+        self.is_unsharded = True
+
+    def reshard(self):
+        if self._pending_all_gather is not None:
+            _, handle = self._pending_all_gather
+            self._pending_all_gather = None
+            if handle is not None:
+                handle.wait()
+
+        if not self.is_unsharded:
+            return
+        get_untyped_storage(self.flat_params).resize_(0)
+        self.is_unsharded = False
+
+    @torch.no_grad()
+    def write_back(self):
+        """Copies this rank's slices of the unsharded parameters to the shard (eg. after loading them)"""
+        assert self.is_unsharded
+        self.shard[: len(self.local_index)] = self.flat_params[self.local_index]
+
+
+class FullyShardedParameters:
+    """ZeRO stage 3: the parameters of each `PipelineBlock` are sharded across DP, and gathered only while they're used
+
+    The parameters of a block are all-gathered right before its forward, while the next block's are prefetched, and
+    released right after it. They're gathered again before its backward, while the previous block's are prefetched,
+    and released once the gradients of all its parameters that require one are computed, or at the end of the backward
+    for the parameters which didn't get any (eg. unused ones). At that point, the post backward hooks are called with
+    the names of the parameters of the block (eg. to reduce-scatter their gradients).
+
+    Parameters used by several blocks of the rank are not sharded. The model can be built with the storage of the
+    parameters of each block released (see `release_parameters`) so that its parameters are never all allocated: the
+    blocks are then initialized (see `iter_materialized_named_parameters`) or loaded once sharded.
+
+    Args:
+        model: model whose `PipelineBlock`s are sharded. The blocks are assumed to run in the order of `model.modules()`
+        named_parameters: parameters to shard, with the names used by the optimizer
+        dp_pg: process group to shard the parameters across
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        named_parameters: List[Tuple[str, NanotronParameter]],
+        dp_pg: dist.ProcessGroup,
+    ):
+        param_id_to_name = {id(param): name for name, param in named_parameters if param.requires_grad}
+        pipeline_blocks = [
+            module for module in model.modules() if isinstance(module, PipelineBlock) and hasattr(module, "pp_block")
+        ]
+        param_id_to_num_blocks = Counter(id(param) for block in pipeline_blocks for param in block.parameters())
+
+        self.blocks: List[FullyShardedBlock] = []
+        self.param_name_to_dp_rank_offsets: Dict[str, Dict[int, Tuple[int, int]]] = {}
+        self._post_backward_hooks: List[Callable[[List[str]], None]] = []
+        self._is_backward_end_queued = False
+        for pipeline_block in pipeline_blocks:
+            named_params = [
+                (param_id_to_name[id(param)], param)
+                for param in pipeline_block.parameters()
+                if id(param) in param_id_to_name and param_id_to_num_blocks[id(param)] == 1
+            ]
+            if len(named_params) == 0:
+                continue
+
+            param_name_to_dp_rank_offsets = {
+                name: get_dp_rank_offsets(param.numel(), dp_pg.size()) for name, param in named_params
+            }
+            block = FullyShardedBlock(
+                named_params=named_params, param_name_to_dp_rank_offsets=param_name_to_dp_rank_offsets, dp_pg=dp_pg
+            )
+            self._register_hooks(pipeline_block=pipeline_block, block=block, block_index=len(self.blocks))
+            pipeline_block.fully_sharded_params = block
+            self.blocks.append(block)
+            self.param_name_to_dp_rank_offsets.update(param_name_to_dp_rank_offsets)
+            block.reshard()
+
+        self.name_to_block = {name: block for block in self.blocks for name, _ in block.named_params}
+
+        # The released parameters that aren't sharded are allocated again
+        sharded_param_ids = {id(param) for block in self.blocks for _, param in block.named_params}
+        for param in model.parameters():
+            if id(param) not in sharded_param_ids and get_untyped_storage(param).size() == 0:
+                param.data = torch.empty_like(param)
+
+    def is_sharded(self, name: str) -> bool:
+        return name in self.name_to_block
+
+    def get_shard(self, name: str) -> torch.Tensor:
+        """Returns: this rank's slice of the parameter, flattened"""
+        return self.name_to_block[name].name_to_shard[name]
+
+    def get_blocks_param_names(self) -> List[List[str]]:
+        return [[name for name, _ in block.named_params] for block in self.blocks]
+
+    def register_post_backward_hook(self, hook: Callable[[List[str]], None]):
+        self._post_backward_hooks.append(hook)
+
+    def reshard(self):
+        for block in self.blocks:
+            block.reshard()
+
+    def _register_hooks(self, pipeline_block: PipelineBlock, block: FullyShardedBlock, block_index: int):
+        pipeline_block.pp_block.register_forward_pre_hook(partial(self._pre_forward, block_index))
+        pipeline_block.pp_block.register_forward_hook(partial(self._post_forward, block_index))
+        with torch.enable_grad():
+            for _, param in block.named_params:
+                # The `AccumulateGrad` node of the parameter runs once its gradient is computed
+                grad_accumulator = param.expand_as(param).grad_fn.next_functions[0][0]
+                grad_accumulator.register_hook(partial(self._post_accumulate_grad, block_index))
+                block.grad_accumulators.append(grad_accumulator)
+
+    def _pre_forward(self, block_index: int, module: nn.Module, args):
+        block = self.blocks[block_index]
+        block.unshard()
+        if not block.is_in_backward and block_index + 1 < len(self.blocks):
+            self.blocks[block_index + 1].all_gather()
+
+    def _post_forward(self, block_index: int, module: nn.Module, args, output):
+        block = self.blocks[block_index]
+        if torch.is_grad_enabled():
+            outputs = output.values() if isinstance(output, dict) else [output]
+            for tensor in outputs:
+                if isinstance(tensor, torch.Tensor) and tensor.requires_grad:
+                    tensor.register_hook(partial(self._pre_backward, block_index))
+
+        # Otherwise the forward is recomputed during the backward
+        if not block.is_in_backward:
+            block.reshard()
+
+    def _pre_backward(self, block_index: int, grad: torch.Tensor):
+        block = self.blocks[block_index]
+        if block.is_in_backward:
+            return
+
+        block.is_in_backward = True
+        block.num_ready_grads = 0
+        block.num_expected_grads = sum(param.requires_grad for _, param in block.named_params)
+        block.unshard()
+        if block_index > 0:
+            self.blocks[block_index - 1].all_gather()
+
+        if not self._is_backward_end_queued:
+            # Runs once the whole backward is done
+            torch.autograd.Variable._execution_engine.queue_callback(self._on_backward_end)
+            self._is_backward_end_queued = True
+
+    def _post_accumulate_grad(self, block_index: int, grad_inputs, grad_outputs):
+        block = self.blocks[block_index]
+        block.num_ready_grads += 1
+        if not block.is_in_backward or block.num_ready_grads < block.num_expected_grads:
+            return
+
+        self._post_backward(block_index)
+
+    def _on_backward_end(self):
+        self._is_backward_end_queued = False
+        for block_index, block in enumerate(self.blocks):
+            if block.is_in_backward:
+                # Some parameters of the block didn't get a gradient, eg. they're frozen or unused
+                self._post_backward(block_index)
+
+    def _post_backward(self, block_index: int):
+        block = self.blocks[block_index]
+        block.is_in_backward = False
+        block.reshard()
+        for hook in self._post_backward_hooks:
+            hook([name for name, _ in block.named_params])
+
+
+def get_fully_sharded_blocks(model: nn.Module) -> List[FullyShardedBlock]:
+    return [
+        module.fully_sharded_params
+        for module in model.modules()
+        if isinstance(module, PipelineBlock) and module.fully_sharded_params is not None
+    ]
+
+
+def is_fully_sharded(model: nn.Module) -> bool:
+    return len(get_fully_sharded_blocks(model)) > 0
+
+
+def _get_name_to_block(model: nn.Module, names: Iterable[str]) -> Dict[str, FullyShardedBlock]:
+    """Returns: the block of each of the `names` of `model` that is a parameter sharded across DP"""
+    param_id_to_block = {
+        id(param): block for block in get_fully_sharded_blocks(model) for _, param in block.named_params
+    }
+    name_to_block = {}
+    for name in names:
+        try:
+            param = model.get_parameter(name)
+        except AttributeError:
+            # Buffers aren't sharded
+            continue
+        if id(param) in param_id_to_block:
+            name_to_block[name] = param_id_to_block[id(param)]
+    return name_to_block
+
+
+def has_sharded_parameters(model: nn.Module, state_dict: Optional[Dict[str, torch.Tensor]] = None) -> bool:
+    """Whether some parameters of `model`, restricted to the items of `state_dict` if given, are currently sharded
+    across DP
+    """
+    if state_dict is None:
+        return any(not block.is_unsharded for block in get_fully_sharded_blocks(model))
+    return any(not block.is_unsharded for block in _get_name_to_block(model, state_dict.keys()).values())
+
+
+def get_param_id_to_shard(model: nn.Module) -> Dict[int, torch.Tensor]:
+    """Returns: this rank's slice of each parameter of `model` sharded across DP"""
+    return {
+        id(param): block.name_to_shard[name]
+        for block in get_fully_sharded_blocks(model)
+        for name, param in block.named_params
+    }
+
+
+@contextmanager
+def unshard_parameters(model: nn.Module, write_back: bool = False):
+    """Gathers all the parameters of `model` sharded across DP. All the DP ranks have to enter it.
+    If `write_back`, the shards are updated with the values of the parameters on exit (eg. after loading them).
+    """
+    blocks = get_fully_sharded_blocks(model)
+    for block in blocks:
+        block.all_gather()
+    for block in blocks:
+        block.unshard()
+
+    yield
+
+    for block in blocks:
+        if write_back:
+            block.write_back()
+        block.reshard()
+
+
+def iter_unsharded_state_dict(model: nn.Module) -> Iterator[Tuple[str, torch.Tensor]]:
+    """Iterates over `model.state_dict()`, gathering the parameters of each block sharded across DP while its items
+    are yielded. All the DP ranks have to iterate over all the items.
+    """
+    state_dict = model.state_dict()
+    name_to_block = _get_name_to_block(model, state_dict.keys())
+    unsharded_block: Optional[FullyShardedBlock] = None
+    for name, tensor in state_dict.items():
+        block = name_to_block.get(name)
+        if block is not None and block is not unsharded_block:
+            if unsharded_block is not None:
+                unsharded_block.reshard()
+            block.unshard()
+            unsharded_block = block
+
+        yield name, tensor
+
+    if unsharded_block is not None:
+        unsharded_block.reshard()
+
+
+def iter_unsharded_state_dicts_per_block(
+    model: nn.Module, state_dict: Dict[str, torch.Tensor]
+) -> Iterator[Dict[str, torch.Tensor]]:
+    """Splits `state_dict` of `model` in the items of each block sharded across DP, and the items of the parameters and
+    buffers which aren't sharded. The parameters of each block are gathered while its items are yielded, and the shards
+    are updated with their values afterwards (eg. after loading them). All the DP ranks have to iterate over all the
+    items.
+    """
+    name_to_block = _get_name_to_block(model, state_dict.keys())
+    block_id_to_state_dict = {}
+    for name, tensor in state_dict.items():
+        block_id_to_state_dict.setdefault(id(name_to_block.get(name)), {})[name] = tensor
+    block_id_to_block = {id(block): block for block in name_to_block.values()}
+
+    for block_id, block_state_dict in block_id_to_state_dict.items():
+        block = block_id_to_block.get(block_id)
+        if block is None:
+            yield block_state_dict
+            continue
+
+        block.unshard()
+        yield block_state_dict
+        block.write_back()
+        block.reshard()
+
+
+def iter_materialized_named_parameters(model: nn.Module) -> Iterator[Tuple[str, NanotronParameter]]:
+    """Iterates over `model.named_parameters()`, allocating the parameters of each block sharded across DP while they're
+    yielded, without gathering their values. The shards are updated with the values of the parameters of the block
+    once they're all yielded (eg. after initializing them), which therefore have to be the same on all the DP ranks.
+    """
+    param_id_to_block = {
+        id(param): block for block in get_fully_sharded_blocks(model) for _, param in block.named_params
+    }
+    materialized_block: Optional[FullyShardedBlock] = None
+    for name, param in model.named_parameters():
+        block = param_id_to_block.get(id(param))
+        if block is not materialized_block and materialized_block is not None:
+            materialized_block.write_back()
+            materialized_block.reshard()
+            materialized_block = None
+        if block is not None and not block.is_unsharded:
+            block.materialize()
+            materialized_block = block
+
+        yield name, param
+
+    if materialized_block is not None:
+        materialized_block.write_back()
+        materialized_block.reshard()
@@ -0,0 +1,234 @@
+import dataclasses
+from collections import OrderedDict
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import torch
+from nanotron import distributed as dist
+from nanotron.optim.gradient_accumulator import FP32GradientAccumulator, ShardedFP32GradientAccumulator
+from nanotron.parallel.parameters import NanotronParameter
+
+
+@dataclasses.dataclass
+class GradReducerBucket:
+    """Parameters whose gradients are all-reduced together
+
+    Attributes:
+        named_params: parameters of the bucket, in the same order on all the ranks of `pg`
+        pg: the process group to all-reduce the gradients across
+        reduce_op: the reduce operation
+        average: whether to divide the gradients by the size of `pg` before summing them
+        flat_grad: the gradients of the bucket when they're contiguous in the fp32 grad buffer
+        nb_pending_params: parameters whose gradients aren't final yet in the current step
+        handle: the all-reduce, once launched
+    """
+
+    named_params: List[Tuple[str, NanotronParameter]]
+    pg: dist.ProcessGroup
+    reduce_op: dist.ReduceOp = dist.ReduceOp.SUM
+    average: bool = False
+    flat_grad: Optional[torch.Tensor] = None
+    nb_pending_params: int = 0
+    is_launched: bool = False
+    handle: Optional[dist.Work] = None
+
+    def reset(self):
+        self.nb_pending_params = len(self.named_params)
+        self.is_launched = False
+        self.handle = None
+
+
+class BucketedGradReducer:
+    def __init__(
+        self,
+        named_parameters: Iterable[Tuple[str, NanotronParameter]],
+        dp_pg: dist.ProcessGroup,
+        world_ranks_to_pg: Dict[Tuple[int, ...], dist.ProcessGroup],
+        grad_accumulator: Optional[FP32GradientAccumulator],
+        bucket_cap_mb: float = 25,
+    ):
+        """Reduces the gradients across DP, and across the ranks of tied parameters, during the last backward of a
+        step, for models that aren't wrapped in DDP (eg. with ZeRO, or the interleaved and zero bubble pipelines).
+
+        A hook on the `AccumulateGrad` node of each parameter counts how many times its gradient is computed in a
+        step. Once a parameter reached the count of the first step, its gradient is final: it's accumulated in the fp32
+        grad buffer, and the all-reduce of its bucket is launched as soon as all the parameters of the bucket are final.
+        Buckets are launched in the same order on all the ranks, ie. the reverse order of the parameters for DP. The
+        first step only counts the gradients, and reduces them all in `wait`, like `sync_gradients_across_dp` and
+        `sync_tied_weights_gradients`.
+
+        The gradients of tied parameters are first summed across their ranks during the backward, then averaged across
+        DP in `wait`, once the first reduction is done. Both reductions can't run in the backward, as it would wait for
+        the other PP stages holding the tied parameters.
+
+        Args:
+            named_parameters: The parameters of the model, with the names of `get_named_params_with_correct_tied`.
+            dp_pg: The process group to average the gradients across.
+            world_ranks_to_pg: The process groups of the tied parameters, see `create_pg_for_tied_weights`.
+            grad_accumulator: The gradient accumulator keeping the fp32 gradients, if any.
+            bucket_cap_mb: Size of the gradients all-reduced at once across DP.
+        """
+        assert not isinstance(
+            grad_accumulator, ShardedFP32GradientAccumulator
+        ), "ShardedFP32GradientAccumulator already reduce-scatters its gradients after each backward"
+        self.named_params = [(name, param) for name, param in named_parameters if param.requires_grad]
+        self.dp_pg = dp_pg
+        self.grad_accumulator = grad_accumulator
+
+        # Grouped by process group and reduce operation like in `sync_tied_weights_gradients`, so that all the ranks
+        # holding a tied parameter launch the same reductions in the same order
+        group_ranks_and_reduce_op_to_named_params = OrderedDict()
+        for name, param in sorted(self.named_params, key=lambda x: x[0]):
+            # Some weights don't require any syncing, because they are by design synchronised
+            if not param.is_tied or param.get_tied_info().reduce_op is None:
+                continue
+            tied_info = param.get_tied_info()
+            key = (tied_info.global_ranks, tied_info.reduce_op)
+            group_ranks_and_reduce_op_to_named_params.setdefault(key, []).append((name, param))
+        self.tied_buckets = [
+            GradReducerBucket(named_params=named_params, pg=world_ranks_to_pg[group_ranks], reduce_op=reduce_op)
+            for (group_ranks, reduce_op), named_params in group_ranks_and_reduce_op_to_named_params.items()
+        ]
+        tied_named_params = [named_param for bucket in self.tied_buckets for named_param in bucket.named_params]
+        self.tied_dp_bucket = (
+            GradReducerBucket(named_params=tied_named_params, pg=dp_pg, average=True)
+            if len(tied_named_params) > 0
+            else None
+        )
+
+        # Group the other parameters in the order their gradients are computed, ie. the reverse of the forward. With a
+        # gradient accumulator, a bucket is a slice of the contiguous fp32 grad buffer
+        name_to_offsets: Dict[str, Tuple[int, int]] = {}
+        if grad_accumulator is not None:
+            offset = 0
+            for name, elt in grad_accumulator.fp32_grad_buffers.items():
+                name_to_offsets[name] = (offset, offset + elt["fp32_grad"].numel())
+                offset += elt["fp32_grad"].numel()
+        tied_names = {name for name, _ in tied_named_params}
+        buckets_named_params = [[]]
+        bucket_numel = 0
+        for name, param in reversed(self.named_params):
+            if name in tied_names:
+                continue
+            element_size = 4 if grad_accumulator is not None else param.element_size()
+            is_contiguous = (
+                grad_accumulator is None
+                or len(buckets_named_params[-1]) == 0
+                or name_to_offsets[name][1] == name_to_offsets[buckets_named_params[-1][-1][0]][0]
+            )
+            if len(buckets_named_params[-1]) > 0 and (
+                not is_contiguous or (bucket_numel + param.numel()) * element_size > bucket_cap_mb * 2**20
+            ):
+                buckets_named_params.append([])
+                bucket_numel = 0
+            buckets_named_params[-1].append((name, param))
+            bucket_numel += param.numel()
+        self.dp_buckets = []
+        for named_params in buckets_named_params:
+            if len(named_params) == 0:
+                continue
+            flat_grad = None
+            if grad_accumulator is not None:
+                start, end = name_to_offsets[named_params[-1][0]][0], name_to_offsets[named_params[0][0]][1]
+                flat_grad = grad_accumulator._contiguous_fp32_grad_buffer[start:end]
+            self.dp_buckets.append(
+                GradReducerBucket(named_params=named_params, pg=dp_pg, average=True, flat_grad=flat_grad)
+            )
+
+        self.name_to_buckets: Dict[str, List[GradReducerBucket]] = {name: [] for name, _ in self.named_params}
+        for bucket in self.tied_buckets + self.dp_buckets:
+            for name, _ in bucket.named_params:
+                self.name_to_buckets[name].append(bucket)
+        for bucket in self.buckets:
+            bucket.reset()
+
+        # Number of times the gradient of each parameter is computed in the current step, and in the first one
+        self.nb_grads: Dict[str, int] = {name: 0 for name, _ in self.named_params}
+        self.expected_nb_grads: Optional[Dict[str, int]] = None
+
+        self._accumulate_grad_nodes = []
+        with torch.enable_grad():
+            for name, param in self.named_params:
+                # The `AccumulateGrad` node of the parameter runs once its gradient is computed
+                accumulate_grad_node = param.expand_as(param).grad_fn.next_functions[0][0]
+                accumulate_grad_node.register_hook(partial(self._post_accumulate_grad, name, param))
+                # Otherwise the node, and its hook, would be freed
+                self._accumulate_grad_nodes.append(accumulate_grad_node)
+
+    @property
+    def buckets(self) -> List[GradReducerBucket]:
+        tied_dp_buckets = [self.tied_dp_bucket] if self.tied_dp_bucket is not None else []
+        return self.tied_buckets + self.dp_buckets + tied_dp_buckets
+
+    def _post_accumulate_grad(self, name: str, param: NanotronParameter, grad_inputs, grad_outputs):
+        self.nb_grads[name] += 1
+        if self.expected_nb_grads is None:
+            return
+        assert (
+            self.nb_grads[name] <= self.expected_nb_grads[name]
+        ), f"The gradient of {name} was computed more times than in the first step ({self.expected_nb_grads[name]})"
+        if self.nb_grads[name] < self.expected_nb_grads[name]:
+            return
+
+        if self.grad_accumulator is not None:
+            # Otherwise it's accumulated once the backward is done
+            self.grad_accumulator._accumulate_grad(name=name, half_param=param)
+        for bucket in self.name_to_buckets[name]:
+            bucket.nb_pending_params -= 1
+        self._launch_ready_buckets(self.tied_buckets)
+        self._launch_ready_buckets(self.dp_buckets)
+
+    def _launch_ready_buckets(self, buckets: List[GradReducerBucket]):
+        for bucket in buckets:
+            if bucket.is_launched:
+                continue
+            if bucket.nb_pending_params > 0:
+                # The next buckets wait for this one, to launch the collectives in the same order on all ranks
+                return
+            self._launch(bucket)
+
+    def _launch(self, bucket: GradReducerBucket):
+        bucket.is_launched = True
+        if bucket.pg.size() == 1:
+            return
+
+        if bucket.flat_grad is not None:
+            grads = [bucket.flat_grad]
+        elif self.grad_accumulator is not None:
+            grads = [self.grad_accumulator.get_grad_buffer(name=name) for name, _ in bucket.named_params]
+        else:
+            grads = [param.grad for _, param in bucket.named_params]
+        if bucket.average:
+            # Gloo doesn't support `ReduceOp.AVG`
+            for grad in grads:
+                grad.div_(bucket.pg.size())
+
+        if len(grads) == 1:
+            bucket.handle = dist.all_reduce(grads[0], op=bucket.reduce_op, group=bucket.pg, async_op=True)
+        else:
+            bucket.handle = dist.all_reduce_coalesced(grads, op=bucket.reduce_op, group=bucket.pg, async_op=True)
+
+    def wait(self):
+        """Waits for the reductions of the step, and runs the ones that couldn't start during the backward. All the
+        ranks have to call it after the pipeline, before using the gradients."""
+        if self.expected_nb_grads is None:
+            self.expected_nb_grads = dict(self.nb_grads)
+
+        # Eg. buckets with unused parameters, or all of them in the first step
+        for buckets in (self.tied_buckets, self.dp_buckets):
+            for bucket in buckets:
+                if not bucket.is_launched:
+                    self._launch(bucket)
+        for bucket in self.tied_buckets:
+            if bucket.handle is not None:
+                bucket.handle.wait()
+        if self.tied_dp_bucket is not None:
+            self._launch(self.tied_dp_bucket)
+        for bucket in self.buckets:
+            if bucket.handle is not None:
+                bucket.handle.wait()
+
+        for name in self.nb_grads:
+            self.nb_grads[name] = 0
+        for bucket in self.buckets:
+            bucket.reset()
@@ -0,0 +1,157 @@
+import collections
+import dataclasses
+from contextlib import contextmanager
+from typing import Deque, Dict, List, Optional, Tuple, Union
+
+import torch
+
+
+@dataclasses.dataclass
+class OffloadedTensor:
+    """A tensor saved for the backward, whose data was moved to host memory
+
+    Attributes:
+        cpu_tensor: the copy of the tensor in (pinned) host memory
+        device: the device the tensor is restored to
+        offload_done: recorded once the device to host copy is done, on CUDA
+        prefetched_tensor: the tensor copied back to `device`, once prefetched
+        prefetch_done: recorded once the host to device copy is done, on CUDA
+    """
+
+    cpu_tensor: torch.Tensor
+    device: torch.device
+    offload_done: Optional[torch.cuda.Event] = None
+    prefetched_tensor: Optional[torch.Tensor] = None
+    prefetch_done: Optional[torch.cuda.Event] = None
+
+
+class ActivationOffloader:
+    def __init__(self, min_offload_bytes: int = 2**20):
+        """Moves the tensors autograd saves in the forward of a micro batch to host memory, and copies them back before
+        its backward, so that a PP rank doesn't keep the activations of all its waiting micro batches on the GPU.
+
+        The micro batches are offloaded and restored in FIFO order, like `PipelineTrainBatchState` pops them. On CUDA,
+        the copies run on a side stream in pinned buffers that are reused across steps: the offload of a micro batch
+        overlaps with the rest of its forward, and the prefetch of the next micro batch with the compute following the
+        current backward. Parameters, and tensors smaller than `min_offload_bytes`, stay on the GPU.
+
+        Args:
+            min_offload_bytes: Size under which the saved tensors aren't offloaded.
+        """
+        self.min_offload_bytes = min_offload_bytes
+        # Offloaded tensors of the micro batches waiting for their backward, oldest first
+        self.micro_batches: Deque[List[OffloadedTensor]] = collections.deque()
+        self._nb_prefetched_micro_batches = 0
+        self._streams: Dict[torch.device, torch.cuda.Stream] = {}
+        self._cpu_buffers: Dict[Tuple[torch.Size, torch.dtype], List[torch.Tensor]] = {}
+
+        # Bytes copied to host memory and back since the last `reset_counters`
+        self.bytes_offloaded = 0
+        self.bytes_prefetched = 0
+
+    def reset_counters(self):
+        self.bytes_offloaded = 0
+        self.bytes_prefetched = 0
+
+    @contextmanager
+    def offload_micro_batch(self):
+        """Offloads the tensors saved for the backward in the context, as the activations of a new micro batch"""
+        self.micro_batches.append([])
+        with torch.autograd.graph.saved_tensors_hooks(self._pack, self._unpack):
+            yield
+
+    def prefetch(self):
+        """Copies the activations of the next micro batch without prefetched activations back to its device"""
+        if self._nb_prefetched_micro_batches == len(self.micro_batches):
+            return
+        for offloaded_tensor in self.micro_batches[self._nb_prefetched_micro_batches]:
+            self._prefetch_tensor(offloaded_tensor)
+        self._nb_prefetched_micro_batches += 1
+
+    def release(self):
+        """Frees the activations of the oldest micro batch once its backward is done, and starts prefetching the next
+        one"""
+        assert self._nb_prefetched_micro_batches > 0, "The activations of the micro batch were never prefetched"
+        for offloaded_tensor in self.micro_batches.popleft():
+            # The next copies to the buffer run on the side stream after the current compute, which waited for the
+            # prefetch of the micro batch
+            self._cpu_buffers.setdefault(
+                (offloaded_tensor.cpu_tensor.shape, offloaded_tensor.cpu_tensor.dtype), []
+            ).append(offloaded_tensor.cpu_tensor)
+        self._nb_prefetched_micro_batches -= 1
+        self.prefetch()
+
+    def check_buffers_empty(self):
+        assert (
+            len(self.micro_batches) == 0
+        ), f"There are still offloaded activations that require backward: {len(self.micro_batches)}"
+
+    def _should_offload(self, tensor: torch.Tensor) -> bool:
+        return (
+            not isinstance(tensor, torch.nn.Parameter)
+            and not (tensor.requires_grad and tensor.is_leaf)
+            and tensor.is_contiguous()
+            and tensor.numel() * tensor.element_size() >= self.min_offload_bytes
+        )
+
+    def _get_stream(self, device: torch.device) -> torch.cuda.Stream:
+        if device not in self._streams:
+            self._streams[device] = torch.cuda.Stream(device=device)
+        return self._streams[device]
+
+    def _get_cpu_buffer(self, tensor: torch.Tensor) -> torch.Tensor:
+        buffers = self._cpu_buffers.get((tensor.shape, tensor.dtype))
+        if buffers:
+            return buffers.pop()
+        return torch.empty(tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=tensor.is_cuda)
+
+    def _pack(self, tensor: torch.Tensor) -> Union[torch.Tensor, OffloadedTensor]:
+        if not self._should_offload(tensor):
+            return tensor
+
+        cpu_tensor = self._get_cpu_buffer(tensor)
+        offloaded_tensor = OffloadedTensor(cpu_tensor=cpu_tensor, device=tensor.device)
+        if tensor.is_cuda:
+            stream = self._get_stream(tensor.device)
+            stream.wait_stream(torch.cuda.current_stream(tensor.device))
+            with torch.cuda.stream(stream):
+                cpu_tensor.copy_(tensor, non_blocking=True)
+                offloaded_tensor.offload_done = torch.cuda.Event()
+                offloaded_tensor.offload_done.record(stream)
+            # The forward frees the tensor once autograd drops it: the caching allocator mustn't reuse its memory before
+            # the copy is done
+            tensor.record_stream(stream)
+        else:
+            cpu_tensor.copy_(tensor)
+
+        self.micro_batches[-1].append(offloaded_tensor)
+        self.bytes_offloaded += tensor.numel() * tensor.element_size()
+        return offloaded_tensor
+
+    def _prefetch_tensor(self, offloaded_tensor: OffloadedTensor):
+        cpu_tensor = offloaded_tensor.cpu_tensor
+        if offloaded_tensor.device.type == "cuda":
+            stream = self._get_stream(offloaded_tensor.device)
+            with torch.cuda.stream(stream):
+                stream.wait_event(offloaded_tensor.offload_done)
+                offloaded_tensor.prefetched_tensor = cpu_tensor.to(offloaded_tensor.device, non_blocking=True)
+                offloaded_tensor.prefetch_done = torch.cuda.Event()
+                offloaded_tensor.prefetch_done.record(stream)
+        else:
+            offloaded_tensor.prefetched_tensor = cpu_tensor.to(offloaded_tensor.device, copy=True)
+        self.bytes_prefetched += cpu_tensor.numel() * cpu_tensor.element_size()
+
+    def _unpack(self, packed: Union[torch.Tensor, OffloadedTensor]) -> torch.Tensor:
+        if isinstance(packed, torch.Tensor):
+            return packed
+
+        if packed.prefetched_tensor is None:
+            # Eg. a backward running without `prefetch`
+            self._prefetch_tensor(packed)
+        tensor = packed.prefetched_tensor
+        if packed.prefetch_done is not None:
+            current_stream = torch.cuda.current_stream(packed.device)
+            current_stream.wait_event(packed.prefetch_done)
+            # The tensor was allocated on the side stream
+            tensor.record_stream(current_stream)
+        return tensor
@@ -9,7 +9,11 @@ from nanotron.parallel.pipeline_parallel.functional import (
     send_to_pipeline_state_buffer,
 )
 from nanotron.parallel.pipeline_parallel.p2p import P2P, BatchTensorSendRecvState
-from nanotron.parallel.pipeline_parallel.state import PipelineBatchState, PipelineTrainBatchState
+from nanotron.parallel.pipeline_parallel.state import (
+    PipelineBatchState,
+    PipelineInterleavedTrainBatchState,
+    PipelineTrainBatchState,
+)
 from nanotron.parallel.pipeline_parallel.tensor_pointer import TensorPointer
 
 
@@ -42,17 +46,28 @@ class PipelineBlock(nn.Module):
         self.module_kwargs = module_kwargs
         self.module_input_keys = set(module_input_keys)
         self.module_output_keys = set(module_output_keys)
-
-    def build_and_set_rank(self, pp_rank: int):
-        """This method is used to define on which rank computation is going to happen"""
+        # Set when the parameters of the block are sharded across DP (ZeRO stage 3), see `FullyShardedParameters`
+        self.fully_sharded_params = None
+        # Model chunk (virtual stage) of the rank the block belongs to, see `InterleavedOneForwardOneBackwardPipelineEngine`
+        self.model_chunk = 0
+
+    def build_and_set_rank(self, pp_rank: int, model_chunk: int = 0):
+        """This method is used to define on which rank computation is going to happen
+        With an interleaved pipeline, `model_chunk` defines in which model chunk of the rank it happens
+        """
         assert pp_rank < self.p2p.pg.size()
         self.rank = pp_rank
+        self.model_chunk = model_chunk
         if pp_rank == dist.get_rank(self.p2p.pg):
             # Instantiate the module
             self.pp_block = self.module_builder(**self.module_kwargs)
 
     def extra_repr(self) -> str:
-        return f"pp_rank={self.rank}" if hasattr(self, "rank") else ""
+        if not hasattr(self, "rank"):
+            return ""
+        if self.model_chunk == 0:
+            return f"pp_rank={self.rank}"
+        return f"pp_rank={self.rank}, model_chunk={self.model_chunk}"
 
     def set_pipeline_state(self, pipeline_state: Optional[PipelineBatchState]):
         self.pipeline_state = pipeline_state
@@ -72,6 +87,15 @@ class PipelineBlock(nn.Module):
 
         sorted_kwargs = sorted(kwargs.items(), key=get_sort_key(dist.get_rank(self.p2p.pg)))
 
+        # With an interleaved pipeline, only the model chunk running computes, and sends activations to the next stage
+        if isinstance(self.pipeline_state, PipelineInterleavedTrainBatchState):
+            if dist.get_rank(self.p2p.pg) == self.rank:
+                is_skipped = not self.pipeline_state.is_running(self.model_chunk)
+            else:
+                is_skipped = not self.pipeline_state.is_next_stage(pp_rank=self.rank, model_chunk=self.model_chunk)
+            if is_skipped:
+                return {k: TensorPointer(group_rank=self.rank) for k in self.module_output_keys}
+
         # Is the current rank is not the one running the compute
         if dist.get_rank(self.p2p.pg) != self.rank:
             # TODO(kunhao): A better design is to pop this up for both if else branches.
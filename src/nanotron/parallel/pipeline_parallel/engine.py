@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Iterable, Optional, Union
+from functools import partial
+from typing import Any, Dict, Iterable, List, Optional, Set, Union
 
 import torch
 from nanotron import distributed as dist
@@ -7,13 +8,31 @@ from nanotron import logging
 from nanotron.distributed import ProcessGroup
 from nanotron.logging import log_rank
 from nanotron.optim.gradient_accumulator import GradientAccumulator
+from nanotron.parallel.data_parallel.fully_sharded import is_fully_sharded
 from nanotron.parallel.data_parallel.utils import ddp_trigger_sync_in_bwd
+from nanotron.parallel.pipeline_parallel.activation_offload import ActivationOffloader
+from nanotron.parallel.pipeline_parallel.block import PipelineBlock
 from nanotron.parallel.pipeline_parallel.context_manager import attach_pipeline_state_to_model
-from nanotron.parallel.pipeline_parallel.state import PipelineTrainBatchState
+from nanotron.parallel.pipeline_parallel.functional import run_on_backward
+from nanotron.parallel.pipeline_parallel.p2p import P2P, BatchTensorSendRecvState
+from nanotron.parallel.pipeline_parallel.schedule import (
+    BACKWARD_INPUT,
+    BACKWARD_WEIGHT,
+    FORWARD,
+    get_zero_bubble_schedule,
+)
+from nanotron.parallel.pipeline_parallel.state import (
+    PipelineInterleavedTrainBatchState,
+    PipelineTrainBatchState,
+    PipelineZeroBubbleTrainBatchState,
+)
 from nanotron.parallel.pipeline_parallel.tensor_pointer import TensorPointer
+from nanotron.parallel.tensor_parallel.enum import TensorParallelLinearMode
+from nanotron.parallel.tensor_parallel.nn import TensorParallelColumnLinear, TensorParallelRowLinear
 from nanotron.utils import ContextManagers
 from torch import nn as torch_nn
 from torch.nn.parallel import DistributedDataParallel
+from torch.utils.hooks import RemovableHandle
 
 logger = logging.get_logger(__name__)
 
@@ -21,7 +40,12 @@ logger = logging.get_logger(__name__)
 class PipelineEngine(ABC):
     def __init__(self):
         self.nb_microbatches: Optional[int] = None
-        pass
+        # Number of model chunks (virtual stages) each rank runs, the model has to be built accordingly
+        self.num_model_chunks = 1
+        # PP ranks moving the activations of their micro batches waiting for a backward to host memory, see
+        # `ActivationOffloader`. Only the "afab" and "1f1b" engines support it
+        self.offload_activations_pp_ranks: Optional[List[int]] = None
+        self.activation_offloader: Optional[ActivationOffloader] = None
 
     def forward(
         self,
@@ -40,6 +64,8 @@ class PipelineEngine(ABC):
 
         # IMPORTANT as it's basically the context manager storing all the intermediary activations
         state.new_micro_batch_forward()
+        if self.activation_offloader is not None and torch.is_grad_enabled():
+            context = ContextManagers([context, self.activation_offloader.offload_micro_batch()])
         with context:
             output = model(**micro_batch)
 
@@ -65,8 +91,13 @@ class PipelineEngine(ABC):
         return context
 
     def backward(
-        self, context: ContextManagers, state: PipelineTrainBatchState, grad_accumulator: Optional[GradientAccumulator]
+        self,
+        context: ContextManagers,
+        state: PipelineTrainBatchState,
+        grad_accumulator: Optional[GradientAccumulator],
+        param_ids: Optional[Set[int]] = None,
     ):
+        """`param_ids` are the ids of the parameters whose gradients the backward computes, see `GradientAccumulator`"""
         # Increment the number of backwards
         state.nb_backwards += 1
         log_rank(
@@ -76,14 +107,17 @@ class PipelineEngine(ABC):
         )
         # Go backward entirely
         activations = state.pop_last_activations_requiring_backward()
-        if len(activations) == 0:
-            return
-
-        with context:
-            if grad_accumulator is None:
-                sum(activations).backward()
-            else:
-                grad_accumulator.backward(sum(activations))
+        if self.activation_offloader is not None:
+            # No-op when it was already prefetched after the previous backward
+            self.activation_offloader.prefetch()
+        if len(activations) > 0:
+            with context:
+                if grad_accumulator is None:
+                    sum(activations).backward()
+                else:
+                    grad_accumulator.backward(sum(activations), param_ids=param_ids)
+        if self.activation_offloader is not None:
+            self.activation_offloader.release()
 
         # TODO @nouamane: this fixes interleaved afab but makes 1f1b hang
         # with context:
@@ -114,6 +148,15 @@ class PipelineEngine(ABC):
         context = ContextManagers(context_list)
         return context
 
+    def _setup_activation_offload(self, pg: ProcessGroup):
+        """Creates the activation offloader of the current PP rank if it offloads, and resets its counters"""
+        if self.offload_activations_pp_ranks is None or dist.get_rank(pg) not in self.offload_activations_pp_ranks:
+            self.activation_offloader = None
+            return
+        if self.activation_offloader is None:
+            self.activation_offloader = ActivationOffloader()
+        self.activation_offloader.reset_counters()
+
     @abstractmethod
     def train_batch_iter(
         self,
@@ -177,6 +220,7 @@ class AllForwardAllBackwardPipelineEngine(PipelineEngine):
         # Assign a new state for the current batch
         state = PipelineTrainBatchState()
         self.nb_microbatches = nb_microbatches
+        self._setup_activation_offload(pg)
 
         outputs = []
 
@@ -215,6 +259,8 @@ class AllForwardAllBackwardPipelineEngine(PipelineEngine):
                     send_grads()
             # Make sure that micro batches are all fully consumed
             state.check_buffers_empty()
+            if self.activation_offloader is not None:
+                self.activation_offloader.check_buffers_empty()
 
             return outputs
 
@@ -238,6 +284,7 @@ class OneForwardOneBackwardPipelineEngine(PipelineEngine):
         ), f"Number of microbatches ({self.nb_microbatches}) must be at least PP_SIZE-1={pg.size() - 1} when using the OneForwardOneBackwardPipelineEngine"
 
         state = PipelineTrainBatchState()
+        self._setup_activation_offload(pg)
 
         outputs = []
         batch = iter(batch)
@@ -326,5 +373,542 @@ class OneForwardOneBackwardPipelineEngine(PipelineEngine):
 
             # Make sure that micro batches are all fully consumed
             state.check_buffers_empty()
+            if self.activation_offloader is not None:
+                self.activation_offloader.check_buffers_empty()
 
         return outputs
+
+
+class InterleavedOneForwardOneBackwardPipelineEngine(PipelineEngine):
+    """1F1B where each rank runs several non contiguous model chunks (virtual stages) of the model.
+    Check https://arxiv.org/abs/2104.04473 (Section 2.2) for diagrams for the pipeline engine
+
+    With `num_model_chunks` chunks per rank, the pipeline bubble shrinks by a factor `num_model_chunks`, at the cost of
+    `num_model_chunks` times more P2P communications. Rank `r` runs the pipeline stages `r`, `r + pp`, `r + 2 * pp`...,
+    the model has to be built with the same `num_model_chunks` (see `build_model`).
+
+    After each forward or backward of a model chunk, a single batched P2P exchange with the neighbour ranks sends its
+    outputs (resp. input gradients), and receives the inputs (resp. output gradients) of a later forward (resp.
+    backward). The number of micro batches has to be a multiple of PP_SIZE.
+    """
+
+    def __init__(self, num_model_chunks: int = 2):
+        super().__init__()
+        assert num_model_chunks >= 1, f"num_model_chunks must be at least 1, got {num_model_chunks}"
+        self.num_model_chunks = num_model_chunks
+
+    def _get_model_chunk(self, virtual_micro_batch_id: int, pp_size: int, forward: bool) -> int:
+        """Model chunks run in groups of PP_SIZE micro batches, in order for the forwards and in reverse order for the backwards"""
+        model_chunk = (virtual_micro_batch_id % (pp_size * self.num_model_chunks)) // pp_size
+        return model_chunk if forward else self.num_model_chunks - model_chunk - 1
+
+    def _get_micro_batch_id(self, virtual_micro_batch_id: int, pp_size: int) -> int:
+        group_id = virtual_micro_batch_id // (pp_size * self.num_model_chunks)
+        return group_id * pp_size + virtual_micro_batch_id % pp_size
+
+    def _send_recv(
+        self,
+        p2p: P2P,
+        state: PipelineInterleavedTrainBatchState,
+        activations: Optional[List[torch.Tensor]] = None,
+        activations_micro_batch_id: Optional[int] = None,
+        grads: Optional[List[torch.Tensor]] = None,
+        grads_micro_batch_id: Optional[int] = None,
+        recv_activations_model_chunk: Optional[int] = None,
+        recv_grads_model_chunk: Optional[int] = None,
+    ):
+        """Sends `activations` to the next rank and `grads` to the previous rank, receives the activations of
+        `recv_activations_model_chunk` from the previous rank and the gradients of `recv_grads_model_chunk` from the next
+        rank, all in one batch. The neighbour ranks run the matching exchange.
+
+        The number of tensors sent per micro batch is fixed, it's only exchanged with the first micro batch.
+        """
+        next_rank = (state.pp_rank + 1) % state.pp_size
+        prev_rank = (state.pp_rank - 1) % state.pp_size
+
+        # Exchange the number of tensors of the first micro batch of each model chunk
+        num_tensors_p2p_ops = []
+        recv_num_activations = recv_num_grads = None
+        for tensors, micro_batch_id, to_rank in [
+            (activations, activations_micro_batch_id, next_rank),
+            (grads, grads_micro_batch_id, prev_rank),
+        ]:
+            if tensors is not None and micro_batch_id == 0:
+                num_tensors = torch.tensor([len(tensors)], dtype=torch.long, device=p2p.device)
+                num_tensors_p2p_ops.append(
+                    dist.P2POp(
+                        op=dist.isend,
+                        tensor=num_tensors,
+                        peer=dist.get_global_rank(group=p2p.pg, group_rank=to_rank),
+                        group=p2p.pg,
+                    )
+                )
+        if (
+            recv_activations_model_chunk is not None
+            and state.model_chunks_num_activations_to_recv[recv_activations_model_chunk] is None
+        ):
+            recv_num_activations = torch.empty(1, dtype=torch.long, device=p2p.device)
+            num_tensors_p2p_ops.append(
+                dist.P2POp(
+                    op=dist.irecv,
+                    tensor=recv_num_activations,
+                    peer=dist.get_global_rank(group=p2p.pg, group_rank=prev_rank),
+                    group=p2p.pg,
+                )
+            )
+        if recv_grads_model_chunk is not None and state.model_chunks_num_grads_to_recv[recv_grads_model_chunk] is None:
+            recv_num_grads = torch.empty(1, dtype=torch.long, device=p2p.device)
+            num_tensors_p2p_ops.append(
+                dist.P2POp(
+                    op=dist.irecv,
+                    tensor=recv_num_grads,
+                    peer=dist.get_global_rank(group=p2p.pg, group_rank=next_rank),
+                    group=p2p.pg,
+                )
+            )
+        if len(num_tensors_p2p_ops) > 0:
+            for req in dist.batch_isend_irecv(num_tensors_p2p_ops):
+                req.wait()
+        if recv_num_activations is not None:
+            state.model_chunks_num_activations_to_recv[recv_activations_model_chunk] = recv_num_activations.item()
+        if recv_num_grads is not None:
+            state.model_chunks_num_grads_to_recv[recv_grads_model_chunk] = recv_num_grads.item()
+
+        # Exchange the tensors
+        batch_send_recv = BatchTensorSendRecvState(p2p)
+        for tensor in activations if activations is not None else []:
+            batch_send_recv.add_send(tensor=tensor, to_rank=next_rank)
+        for tensor in grads if grads is not None else []:
+            batch_send_recv.add_send(tensor=tensor, to_rank=prev_rank)
+        num_activations = num_grads = 0
+        if recv_activations_model_chunk is not None:
+            num_activations = state.model_chunks_num_activations_to_recv[recv_activations_model_chunk]
+            for _ in range(num_activations):
+                batch_send_recv.add_recv(from_rank=prev_rank)
+        if recv_grads_model_chunk is not None:
+            num_grads = state.model_chunks_num_grads_to_recv[recv_grads_model_chunk]
+            for _ in range(num_grads):
+                batch_send_recv.add_recv(from_rank=next_rank)
+        recv_tensors = batch_send_recv.flush()
+        assert len(recv_tensors) == num_activations + num_grads
+
+        if recv_activations_model_chunk is not None:
+            state.model_chunks_activations_received[recv_activations_model_chunk].append(
+                recv_tensors[:num_activations]
+            )
+        if recv_grads_model_chunk is not None:
+            state.model_chunks_grads_received[recv_grads_model_chunk].append(recv_tensors[num_activations:])
+
+    def train_batch_iter(
+        self,
+        model: torch_nn.Module,
+        pg: ProcessGroup,
+        batch: Iterable[Dict[str, Union[torch.Tensor, TensorPointer]]],
+        nb_microbatches: int,
+        grad_accumulator: Optional[GradientAccumulator],
+    ) -> Iterable[Dict[str, Union[torch.Tensor, TensorPointer]]]:
+        """The schedule follows the interleaved 1F1B schedule of Megatron-LM"""
+        pp_size = pg.size()
+        current_pp_rank = dist.get_rank(pg)
+        num_model_chunks = self.num_model_chunks
+        self.nb_microbatches = nb_microbatches
+        assert (
+            self.nb_microbatches % pp_size == 0
+        ), f"Number of microbatches ({self.nb_microbatches}) must be a multiple of PP_SIZE={pp_size} when using the InterleavedOneForwardOneBackwardPipelineEngine"
+        # DDP syncs the gradients in the last backward, which only covers a single model chunk
+        assert not isinstance(
+            model, DistributedDataParallel
+        ), "InterleavedOneForwardOneBackwardPipelineEngine doesn't support DDP, gradients are synced after the pipeline"
+
+        p2p = next(module.p2p for module in model.modules() if isinstance(module, PipelineBlock))
+        # A backward only computes the gradients of the parameters of its model chunk
+        model_chunks_param_ids = [set() for _ in range(num_model_chunks)]
+        for module in model.modules():
+            if isinstance(module, PipelineBlock):
+                model_chunks_param_ids[module.model_chunk].update(id(param) for param in module.parameters())
+        state = PipelineInterleavedTrainBatchState(
+            pp_rank=current_pp_rank, pp_size=pp_size, num_model_chunks=num_model_chunks
+        )
+
+        outputs = []
+        micro_batches = []
+        batch = iter(batch)
+
+        def is_first_stage(model_chunk: int) -> bool:
+            return current_pp_rank == 0 and model_chunk == 0
+
+        def is_last_stage(model_chunk: int) -> bool:
+            return current_pp_rank == pp_size - 1 and model_chunk == num_model_chunks - 1
+
+        def forward_step(virtual_micro_batch_id: int) -> Optional[List[torch.Tensor]]:
+            """Runs a forward, returns: the activations to send to the next rank"""
+            model_chunk = self._get_model_chunk(virtual_micro_batch_id, pp_size=pp_size, forward=True)
+            micro_batch_id = self._get_micro_batch_id(virtual_micro_batch_id, pp_size=pp_size)
+            # Every model chunk needs the micro batch, eg. the first one for the inputs and the last one for the labels
+            while len(micro_batches) <= micro_batch_id:
+                micro_batches.append(next(batch))
+
+            state.model_chunk = model_chunk
+            if not is_first_stage(model_chunk):
+                state.activations_buffer.extend(state.model_chunks_activations_received[model_chunk].popleft())
+            context = self._get_fwd_context(model=model)
+            output = self.forward(context=context, state=state, micro_batch=micro_batches[micro_batch_id], model=model)
+            assert (
+                len(state.activations_buffer) == 0
+            ), f"Model chunk {model_chunk} didn't use all its received activations: {len(state.activations_buffer)}"
+
+            # We make `output` a dict
+            if not isinstance(output, dict):
+                output = {"loss": output}
+
+            # Store the loss for each microbatch
+            if model_chunk == num_model_chunks - 1:
+                if not isinstance(output["loss"], TensorPointer):
+                    output = {k: v.detach() for k, v in output.items()}
+                outputs.append(output)
+
+            activations = []
+            while len(state.microbatches_activations_to_send) > 0:
+                send_activation = state.microbatches_activations_to_send.popleft()
+                assert send_activation.to_rank == (current_pp_rank + 1) % pp_size
+                activations.append(send_activation.activation)
+            return activations if not is_last_stage(model_chunk) else None
+
+        def backward_step(virtual_micro_batch_id: int) -> Optional[List[torch.Tensor]]:
+            """Runs a backward, returns: the gradients to send to the previous rank"""
+            model_chunk = self._get_model_chunk(virtual_micro_batch_id, pp_size=pp_size, forward=False)
+
+            state.model_chunk = model_chunk
+            if not is_last_stage(model_chunk):
+                state.grads_buffer.extend(state.model_chunks_grads_received[model_chunk].popleft())
+            context = self._get_bwd_context(
+                model=model,
+                nb_backwards=state.nb_backwards,
+                grad_accumulator=grad_accumulator,
+            )
+            self.backward(
+                context=context,
+                state=state,
+                grad_accumulator=grad_accumulator,
+                param_ids=model_chunks_param_ids[model_chunk],
+            )
+            assert (
+                len(state.grads_buffer) == 0
+            ), f"Model chunk {model_chunk} didn't use all its received gradients: {len(state.grads_buffer)}"
+
+            grads = []
+            while len(state.microbatches_grads_to_send) > 0:
+                send_grad = state.microbatches_grads_to_send.popleft()
+                assert send_grad.to_rank == (current_pp_rank - 1) % pp_size
+                grads.append(send_grad.grad)
+            return grads if not is_first_stage(model_chunk) else None
+
+        total_nb_microbatches = nb_microbatches * num_model_chunks
+        # Forwards to run before the first backward: the later the rank, the sooner its first backward
+        nb_warmup_microbatches = min(
+            (pp_size - current_pp_rank - 1) * 2 + (num_model_chunks - 1) * pp_size, total_nb_microbatches
+        )
+        nb_remaining_microbatches = total_nb_microbatches - nb_warmup_microbatches
+
+        with attach_pipeline_state_to_model(model=model, pipeline_state=state):
+            # Init: receive the inputs of the first forward
+            if not is_first_stage(model_chunk=0):
+                self._send_recv(p2p, state, recv_activations_model_chunk=0)
+
+            # Warmup: forwards only
+            for k in range(nb_warmup_microbatches):
+                activations = forward_step(k)
+
+                next_forward_model_chunk = self._get_model_chunk(k + 1, pp_size=pp_size, forward=True)
+                recv_activations = not is_first_stage(next_forward_model_chunk) and k != total_nb_microbatches - 1
+                # The last warmup exchange receives the gradients of the first backward
+                recv_grads = (
+                    k == nb_warmup_microbatches - 1
+                    and nb_remaining_microbatches > 0
+                    and not is_last_stage(num_model_chunks - 1)
+                )
+                self._send_recv(
+                    p2p,
+                    state,
+                    activations=activations,
+                    activations_micro_batch_id=self._get_micro_batch_id(k, pp_size=pp_size),
+                    recv_activations_model_chunk=next_forward_model_chunk if recv_activations else None,
+                    recv_grads_model_chunk=num_model_chunks - 1 if recv_grads else None,
+                )
+
+            # Steady state: one forward, one backward
+            for k in range(nb_remaining_microbatches):
+                forward_k = k + nb_warmup_microbatches
+                activations = forward_step(forward_k)
+                backward_k = k
+                grads = backward_step(backward_k)
+
+                # The first rank receives the outputs of the last rank's forward, it's the input of its next model chunk
+                recv_activations = k != nb_remaining_microbatches - 1
+                if current_pp_rank == 0:
+                    next_forward_model_chunk = self._get_model_chunk(
+                        forward_k - (pp_size - 1), pp_size=pp_size, forward=True
+                    )
+                    recv_activations = recv_activations and next_forward_model_chunk != num_model_chunks - 1
+                    next_forward_model_chunk += 1
+                else:
+                    next_forward_model_chunk = self._get_model_chunk(forward_k + 1, pp_size=pp_size, forward=True)
+
+                # The last rank receives the input gradients of the first rank's backward, they're the output gradients of its previous model chunk
+                recv_grads = True
+                if current_pp_rank == pp_size - 1:
+                    next_backward_model_chunk = self._get_model_chunk(
+                        backward_k - (pp_size - 1), pp_size=pp_size, forward=False
+                    )
+                    recv_grads = next_backward_model_chunk != 0
+                    next_backward_model_chunk -= 1
+                else:
+                    next_backward_model_chunk = self._get_model_chunk(backward_k + 1, pp_size=pp_size, forward=False)
+
+                self._send_recv(
+                    p2p,
+                    state,
+                    activations=activations,
+                    activations_micro_batch_id=self._get_micro_batch_id(forward_k, pp_size=pp_size),
+                    grads=grads,
+                    grads_micro_batch_id=self._get_micro_batch_id(backward_k, pp_size=pp_size),
+                    recv_activations_model_chunk=next_forward_model_chunk if recv_activations else None,
+                    recv_grads_model_chunk=next_backward_model_chunk if recv_grads else None,
+                )
+
+            # Cooldown: backwards only
+            if nb_remaining_microbatches == 0 and not is_last_stage(num_model_chunks - 1):
+                self._send_recv(p2p, state, recv_grads_model_chunk=num_model_chunks - 1)
+            for k in range(nb_remaining_microbatches, total_nb_microbatches):
+                grads = backward_step(k)
+
+                next_backward_model_chunk = self._get_model_chunk(k + 1, pp_size=pp_size, forward=False)
+                recv_grads = not is_last_stage(next_backward_model_chunk) and k != total_nb_microbatches - 1
+                self._send_recv(
+                    p2p,
+                    state,
+                    grads=grads,
+                    grads_micro_batch_id=self._get_micro_batch_id(k, pp_size=pp_size),
+                    recv_grads_model_chunk=next_backward_model_chunk if recv_grads else None,
+                )
+
+            # Make sure that micro batches are all fully consumed
+            state.check_buffers_empty()
+
+        return outputs
+
+
+class ZeroBubblePipelineEngine(PipelineEngine):
+    """1F1B where the backward is split in an input gradient pass and a weight gradient pass.
+    Check https://arxiv.org/abs/2401.10241 (ZB-H1) for diagrams for the pipeline engine
+
+    Only the input gradient pass is needed by the previous rank, so the weight gradient passes are deferred to fill the
+    bubbles of the cooldown (see `get_zero_bubble_schedule`), keeping the communications of the 1F1B engine. The input
+    gradient pass backpropagates down to the outputs of the modules holding parameters, and the weight gradient pass
+    from these outputs to the parameters of their module: parameters have to be used within the forward of their
+    module only. Modules implemented with a custom `torch.autograd.Function` compute their weight gradients in both
+    passes, so the tensor parallel linears have to run in `TensorParallelLinearMode.ALL_REDUCE` without async
+    communication. Activation recompute isn't supported either: the reentrant checkpoints run their own backward.
+
+    A micro batch keeps its activations until its weight gradient pass, a rank holds up to `pp_size + 1` of them.
+    """
+
+    def __init__(self):
+        super().__init__()
+
+    def train_batch_iter(
+        self,
+        model: torch_nn.Module,
+        pg: ProcessGroup,
+        batch: Iterable[Dict[str, Union[torch.Tensor, TensorPointer]]],
+        nb_microbatches: int,
+        grad_accumulator: Optional[GradientAccumulator],
+    ) -> Iterable[Dict[str, Union[torch.Tensor, TensorPointer]]]:
+        self.nb_microbatches = nb_microbatches
+        assert (
+            self.nb_microbatches >= pg.size() - 1
+        ), f"Number of microbatches ({self.nb_microbatches}) must be at least PP_SIZE-1={pg.size() - 1} when using the ZeroBubblePipelineEngine"
+        # DDP syncs the gradients in the backward, which doesn't compute the weight gradients anymore
+        assert not isinstance(
+            model, DistributedDataParallel
+        ), "ZeroBubblePipelineEngine doesn't support DDP, gradients are synced after the pipeline"
+        assert not is_fully_sharded(model), "ZeroBubblePipelineEngine doesn't support ZeRO stage 3"
+        assert not _has_custom_autograd_linears(
+            model
+        ), "ZeroBubblePipelineEngine requires tensor parallel linears in ALL_REDUCE mode without async communication"
+        assert not _has_activation_recompute(model), "ZeroBubblePipelineEngine doesn't support activation recompute"
+
+        state = PipelineZeroBubbleTrainBatchState()
+
+        outputs = []
+        batch = iter(batch)
+
+        current_pp_rank = dist.get_rank(pg)
+        nb_warmup_microbatches = min(pg.size() - current_pp_rank - 1, nb_microbatches)
+        schedule = get_zero_bubble_schedule(
+            pp_size=pg.size(), pp_rank=current_pp_rank, nb_microbatches=self.nb_microbatches
+        )
+
+        hook_handles = self._register_weight_grad_hooks(model=model, state=state)
+        try:
+            with attach_pipeline_state_to_model(model=model, pipeline_state=state):
+                for op in schedule:
+                    if op == FORWARD:
+                        context = self._get_fwd_context(model=model)
+                        output = self.forward(context=context, state=state, micro_batch=next(batch), model=model)
+
+                        # Like in 1F1B, the activations of the warmup are sent right away, the other ones within the
+                        # communications of the next backward
+                        if state.nb_forwards <= nb_warmup_microbatches:
+                            for _ in range(len(state.microbatches_activations_to_send)):
+                                send_activation = state.microbatches_activations_to_send.popleft()
+                                # Execute
+                                send_activation()
+
+                        # We make `output` a dict
+                        if not isinstance(output, dict):
+                            output = {"loss": output}
+
+                        # Store the loss for each microbatch
+                        if not isinstance(output["loss"], TensorPointer):
+                            output = {k: v.detach() for k, v in output.items()}
+                        outputs.append(output)
+                    elif op == BACKWARD_INPUT:
+                        self.backward_input(state=state)
+
+                        # Like in 1F1B, the gradients of the cooldown are sent right away, the other ones within the
+                        # communications of the next forward
+                        if state.nb_forwards == self.nb_microbatches:
+                            for _ in range(len(state.microbatches_grads_to_send)):
+                                send_grads = state.microbatches_grads_to_send.popleft()
+                                # Execute
+                                send_grads()
+                    else:
+                        assert op == BACKWARD_WEIGHT
+                        self.backward_weight(state=state, grad_accumulator=grad_accumulator)
+
+                # Make sure that micro batches are all fully consumed
+                state.check_buffers_empty()
+        finally:
+            for hook_handle in hook_handles:
+                hook_handle.remove()
+
+        return outputs
+
+    def backward_input(self, state: PipelineZeroBubbleTrainBatchState):
+        """Computes the gradients of the outputs of the modules holding parameters, and sends the ones of the inputs"""
+        # Increment the number of backwards
+        state.nb_backwards += 1
+        log_rank(
+            f"Input gradient pass micro batch id: {state.nb_backwards}",
+            logger=logger,
+            level=logging.DEBUG,
+        )
+        activations = state.pop_last_activations_requiring_backward()
+        weight_grad_inputs, backward_leaves = state.pop_last_weight_grad_inputs()
+        state.microbatches_weight_grads_pending.append(weight_grad_inputs)
+        if len(activations) == 0:
+            return
+
+        outputs = [output for elt in weight_grad_inputs for output in elt.outputs]
+        state.is_in_backward = True
+        try:
+            if len(backward_leaves) + len(outputs) == 0:
+                sum(activations).backward()
+                return
+
+            # The graph is kept for the weight gradient pass
+            grads = torch.autograd.grad(
+                sum(activations), inputs=backward_leaves + outputs, retain_graph=True, allow_unused=True
+            )[len(backward_leaves) :]
+        finally:
+            state.is_in_backward = False
+        for elt in weight_grad_inputs:
+            elt.grads, grads = list(grads[: len(elt.outputs)]), grads[len(elt.outputs) :]
+
+    def backward_weight(
+        self, state: PipelineZeroBubbleTrainBatchState, grad_accumulator: Optional[GradientAccumulator]
+    ):
+        """Computes the gradients of the parameters of the oldest micro batch whose input gradient pass ran"""
+        log_rank(
+            f"Weight gradient pass, pending micro batches: {len(state.microbatches_weight_grads_pending)}",
+            logger=logger,
+            level=logging.DEBUG,
+        )
+        weight_grad_inputs = state.microbatches_weight_grads_pending.popleft()
+        if len(weight_grad_inputs) == 0:
+            return
+
+        def weight_grad_pass():
+            for elt in weight_grad_inputs:
+                elt()
+
+        state.is_in_backward = True
+        try:
+            if grad_accumulator is None:
+                weight_grad_pass()
+            else:
+                # The accumulator accumulates the weight gradients once its backward is done
+                grad_accumulator.backward(run_on_backward(weight_grad_pass))
+        finally:
+            state.is_in_backward = False
+
+    @staticmethod
+    def _register_weight_grad_hooks(
+        model: torch_nn.Module, state: PipelineZeroBubbleTrainBatchState
+    ) -> List[RemovableHandle]:
+        """Stores the outputs of the modules holding parameters in the state after their forward"""
+
+        def hook(params: List[torch_nn.Parameter], module: torch_nn.Module, args, output):
+            if not torch.is_grad_enabled():
+                return
+            if state.is_in_backward:
+                # A forward recomputed within the backward would register its outputs to the last micro batch
+                raise RuntimeError(
+                    f"{module.__class__.__name__} ran a forward within a backward of the ZeroBubblePipelineEngine, "
+                    "activation recompute isn't supported"
+                )
+            outputs = [tensor for tensor in _flatten_tensors(output) if tensor.requires_grad]
+            if len(outputs) > 0:
+                state.register_weight_grad_outputs(params=params, outputs=outputs)
+
+        hook_handles = []
+        for block in model.modules():
+            if not isinstance(block, PipelineBlock) or not hasattr(block, "pp_block"):
+                # Only the blocks built on this rank have a `pp_block`
+                continue
+            if not isinstance(block.pp_block, torch_nn.Module):
+                continue
+            for module in block.pp_block.modules():
+                params = [param for param in module.parameters(recurse=False) if param.requires_grad]
+                if len(params) > 0:
+                    hook_handles.append(module.register_forward_hook(partial(hook, params)))
+        return hook_handles
+
+
+def _has_custom_autograd_linears(model: torch_nn.Module) -> bool:
+    """Whether some tensor parallel linears compute their weight and input gradients in the same custom backward"""
+    for module in model.modules():
+        if isinstance(module, (TensorParallelColumnLinear, TensorParallelRowLinear)) and module.async_communication:
+            return True
+        if isinstance(module, TensorParallelColumnLinear) and module.mode is TensorParallelLinearMode.REDUCE_SCATTER:
+            return True
+    return False
+
+
+def _has_activation_recompute(model: torch_nn.Module) -> bool:
+    return any(
+        getattr(module, attr, False)
+        for module in model.modules()
+        for attr in ("recompute_layer", "checkpoint_attention", "checkpoint_mlp")
+    )
+
+
+def _flatten_tensors(output: Any) -> List[torch.Tensor]:
+    if isinstance(output, torch.Tensor):
+        return [output]
+    if isinstance(output, dict):
+        return [tensor for elt in output.values() for tensor in _flatten_tensors(elt)]
+    if isinstance(output, (list, tuple)):
+        return [tensor for elt in output for tensor in _flatten_tensors(elt)]
+    return []
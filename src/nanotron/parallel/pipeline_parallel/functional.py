@@ -1,3 +1,5 @@
+from typing import Callable
+
 import torch
 from nanotron import logging
 from nanotron.parallel.pipeline_parallel.p2p import P2P
@@ -117,3 +119,27 @@ def recv_from_pipeline_state_buffer(from_rank: int, p2p: P2P, pipeline_state: Pi
         pipeline_state.run_communication()
     activation = pipeline_state.activations_buffer.popleft()
     return RecvTensorFromPipelineBuffer.apply(activation, from_rank, p2p, pipeline_state)
+
+
+class RunOnBackward(torch.autograd.Function):
+    """Runs a function when backpropagating through it, so that it happens within `loss.backward()`"""
+
+    @staticmethod
+    def forward(ctx, dummy_input: torch.Tensor, function: Callable[[], None]):
+        assert dummy_input.requires_grad
+        ctx.function = function
+
+        # The output only serves to trigger the backward
+        return torch.tensor(1, dtype=torch.float, device="cpu", requires_grad=True)
+
+    @staticmethod
+    def backward(ctx, grad_tensor):
+        ctx.function()
+
+        return None, None
+
+
+def run_on_backward(function: Callable[[], None]) -> torch.Tensor:
+    """Returns a dummy loss whose backward runs `function`"""
+    dummy_input = torch.empty(1, dtype=torch.float, requires_grad=True, device="cpu")
+    return RunOnBackward.apply(dummy_input, function)
@@ -1,5 +1,6 @@
 import dataclasses
-from typing import List, Sequence, Tuple
+import math
+from typing import Dict, List, Sequence, Tuple
 
 import torch
 from nanotron import distributed as dist
@@ -10,6 +11,12 @@ logger = logging.get_logger(__name__)
 
 FIRST_METADATA_SIZE = 7
 SECOND_METADATA_SIZE = 1024
+# With cached metadata, the metadata of a tensor is sent in a single message with its shape and stride padded
+MAX_NUM_DIMS = 16
+METADATA_SIZE = FIRST_METADATA_SIZE + 2 * MAX_NUM_DIMS
+# Payloads are preceded by a header flagging whether new metadata follows, and their tensors are aligned on 16 bytes
+HEADER_SIZE = 1
+PAYLOAD_ALIGNMENT = 16
 ID_TO_DTYPE = [
     torch.float32,
     torch.float64,
@@ -25,6 +32,7 @@ ID_TO_DTYPE = [
     torch.bool,
 ]
 DTYPE_TO_ID = {dtype: id_ for id_, dtype in enumerate(ID_TO_DTYPE)}
+DTYPE_TO_ELEMENT_SIZE = {dtype: torch.empty((), dtype=dtype).element_size() for dtype in ID_TO_DTYPE}
 
 ID_TO_REQUIRES_GRAD = [True, False]
 REQUIRES_GRAD_TO_ID = {value: id_ for id_, value in enumerate(ID_TO_REQUIRES_GRAD)}
@@ -76,6 +84,45 @@ class P2PTensorMetaData:
 
         return buffer
 
+    @classmethod
+    def from_tensor(cls, tensor: torch.Tensor) -> "P2PTensorMetaData":
+        return cls(
+            shape=tuple(tensor.shape),
+            stride=tuple(tensor.stride()),
+            is_contiguous=tensor.is_contiguous(),
+            untyped_storage_size=get_untyped_storage(tensor).size(),
+            storage_offset=tensor.storage_offset(),
+            dtype=tensor.dtype,
+            requires_grad=tensor.requires_grad,
+        )
+
+    def to_list(self) -> List[int]:
+        """Single message metadata, with the shape and stride padded to `MAX_NUM_DIMS`"""
+        assert len(self.shape) <= MAX_NUM_DIMS, f"Can't send tensors with more than {MAX_NUM_DIMS} dimensions"
+        padding = [0] * (MAX_NUM_DIMS - len(self.shape))
+        return [
+            len(self.shape),
+            len(self.stride),
+            IS_CONTIGUOUS_TO_ID[self.is_contiguous],
+            self.untyped_storage_size,
+            self.storage_offset,
+            DTYPE_TO_ID[self.dtype],
+            REQUIRES_GRAD_TO_ID[self.requires_grad],
+            *self.shape,
+            *padding,
+            *self.stride,
+            *padding,
+        ]
+
+    @classmethod
+    def from_list(cls, metadata: List[int]) -> "P2PTensorMetaData":
+        num_shape = metadata[0]
+        shape_and_stride = metadata[FIRST_METADATA_SIZE:]
+        return cls.from_metadata(
+            first_metadata=metadata[:FIRST_METADATA_SIZE],
+            second_metadata=shape_and_stride[:num_shape] + shape_and_stride[MAX_NUM_DIMS : MAX_NUM_DIMS + num_shape],
+        )
+
     @staticmethod
     def to_first_metadata(tensor: torch.Tensor, device: torch.device) -> torch.Tensor:
         # TODO @nouamane: avoid having two metadata comms, and preallocate shape/stride instead
@@ -110,8 +157,8 @@ class P2PTensorMetaData:
             requires_grad_id,
         ) = first_metadata
         return cls(
-            shape=shape_and_stride[: len(shape_and_stride) // 2],
-            stride=shape_and_stride[len(shape_and_stride) // 2 :],
+            shape=tuple(shape_and_stride[: len(shape_and_stride) // 2]),
+            stride=tuple(shape_and_stride[len(shape_and_stride) // 2 :]),
             is_contiguous=ID_TO_IS_CONTIGUOUS[is_contiguous],
             untyped_storage_size=untyped_storage_size,
             storage_offset=storage_offset,
@@ -134,12 +181,43 @@ def view_as_contiguous(tensor: torch.Tensor):
     return buffer
 
 
+def get_payload_num_bytes(tensor_metadata: P2PTensorMetaData) -> int:
+    """Contiguous tensors are sent alone, non contiguous ones with their entire storage"""
+    if tensor_metadata.is_contiguous:
+        return math.prod(tensor_metadata.shape) * DTYPE_TO_ELEMENT_SIZE[tensor_metadata.dtype]
+    return tensor_metadata.untyped_storage_size
+
+
+def get_payload_offsets(tensor_metadatas: List[P2PTensorMetaData]) -> Tuple[List[int], int]:
+    """Byte offsets of the tensors batched in a single payload, and the size of the payload"""
+    offsets = []
+    offset = 0
+    for tensor_metadata in tensor_metadatas:
+        offsets.append(offset)
+        offset += -(-get_payload_num_bytes(tensor_metadata) // PAYLOAD_ALIGNMENT) * PAYLOAD_ALIGNMENT
+    return offsets, offset
+
+
 class P2P:
-    def __init__(self, pg: dist.ProcessGroup, device: torch.device):
+    """Point to point communication of tensors between ranks of `pg`.
+
+    With `cache_metadata`, `isend_tensors`/`irecv_tensors` cache the metadata of the tensors sent to, resp. received
+    from, each peer and tag for a given number of tensors, and the tensors are batched in a single payload message.
+    The payload is preceded by a one element header flagging whether the sender's metadata changed, in which case the
+    new metadata is sent in a single message between the header and the payload. As long as shapes don't change, the
+    receiver only waits for the header before receiving the payload asynchronously in the cached buffers, and none of
+    the sends block. Both ranks need to use the same `cache_metadata`.
+    """
+
+    def __init__(self, pg: dist.ProcessGroup, device: torch.device, cache_metadata: bool = False):
         self.pg = pg
         self.device = device
         self.first_metadata = torch.empty(FIRST_METADATA_SIZE, dtype=torch.long, device=self.device)
         self.second_metadata = torch.empty(SECOND_METADATA_SIZE, dtype=torch.long, device=self.device)
+        self.cache_metadata = cache_metadata
+        # (peer, tag, number of tensors) -> metadata of the last tensors sent/received
+        self.send_metadata_cache: Dict[Tuple[int, int, int], List[P2PTensorMetaData]] = {}
+        self.recv_metadata_cache: Dict[Tuple[int, int, int], List[P2PTensorMetaData]] = {}
 
     def _send_first_metadata_p2p_op(self, tensor: torch.Tensor, to_rank: int, tag: int = 0) -> dist.P2POp:
         first_metadata = P2PTensorMetaData.to_first_metadata(tensor=tensor, device=self.device)
@@ -286,10 +364,104 @@ class P2P:
             storage_offset=storage_offset,
         )
 
+    def _send_payload(
+        self, tensors: List[torch.Tensor], tensor_metadatas: List[P2PTensorMetaData], to_rank: int, tag: int
+    ) -> dist.Work:
+        """Sends the storages of `tensors` in a single message"""
+        offsets, payload_size = get_payload_offsets(tensor_metadatas)
+        payload = torch.empty(payload_size, dtype=torch.int8, device=self.device)
+        for tensor, offset, tensor_metadata in zip(tensors, offsets, tensor_metadatas):
+            buffer = tensor.detach().view(-1) if tensor_metadata.is_contiguous else view_as_contiguous(tensor)
+            payload[offset : offset + get_payload_num_bytes(tensor_metadata)].copy_(buffer.view(torch.int8))
+        return dist.isend(
+            payload,
+            dst=dist.get_global_rank(group=self.pg, group_rank=to_rank),
+            group=self.pg,
+            tag=tag,
+        )
+
+    def _recv_payload(
+        self, tensor_metadatas: List[P2PTensorMetaData], from_rank: int, tag: int
+    ) -> Tuple[List[torch.Tensor], dist.Work]:
+        offsets, payload_size = get_payload_offsets(tensor_metadatas)
+        payload = torch.empty(payload_size, dtype=torch.int8, device=self.device)
+        future = dist.irecv(
+            payload,
+            src=dist.get_global_rank(group=self.pg, group_rank=from_rank),
+            group=self.pg,
+            tag=tag,
+        )
+        buffers = []
+        for offset, tensor_metadata in zip(offsets, tensor_metadatas):
+            storage = payload[offset : offset + get_payload_num_bytes(tensor_metadata)].view(tensor_metadata.dtype)
+            storage_offset = storage.storage_offset()
+            if not tensor_metadata.is_contiguous:
+                storage_offset += tensor_metadata.storage_offset
+            buffer = storage.as_strided(
+                size=tuple(tensor_metadata.shape), stride=tuple(tensor_metadata.stride), storage_offset=storage_offset
+            )
+            buffer.requires_grad = tensor_metadata.requires_grad
+            buffers.append(buffer)
+        return buffers, future
+
+    def _isend_tensors_with_cached_metadata(
+        self, tensors: List[torch.Tensor], to_rank: int, tag: int
+    ) -> List[dist.Work]:
+        tensor_metadatas = []
+        for tensor in tensors:
+            tensor_metadata = P2PTensorMetaData.from_tensor(tensor)
+            if tensor_metadata.is_contiguous:
+                # Contiguous tensors are received in a storage of their own, whatever the storage they are a view of
+                tensor_metadata.untyped_storage_size = get_payload_num_bytes(tensor_metadata)
+                tensor_metadata.storage_offset = 0
+            tensor_metadatas.append(tensor_metadata)
+        key = (to_rank, tag, len(tensors))
+        is_metadata_stale = self.send_metadata_cache.get(key) != tensor_metadatas
+        dst = dist.get_global_rank(group=self.pg, group_rank=to_rank)
+
+        header = torch.tensor([int(is_metadata_stale)], dtype=torch.long, device=self.device)
+        futures = [dist.isend(header, dst=dst, group=self.pg, tag=tag)]
+        if is_metadata_stale:
+            metadata = torch.tensor(
+                [value for tensor_metadata in tensor_metadatas for value in tensor_metadata.to_list()],
+                dtype=torch.long,
+                device=self.device,
+            )
+            futures.append(dist.isend(metadata, dst=dst, group=self.pg, tag=tag))
+            self.send_metadata_cache[key] = tensor_metadatas
+        futures.append(self._send_payload(tensors, tensor_metadatas, to_rank=to_rank, tag=tag))
+        return futures
+
+    def _irecv_tensors_with_cached_metadata(
+        self, num_tensors: int, from_rank: int, tag: int
+    ) -> Tuple[List[torch.Tensor], List[dist.Work]]:
+        key = (from_rank, tag, num_tensors)
+        src = dist.get_global_rank(group=self.pg, group_rank=from_rank)
+
+        # Only the header is waited for, the payload is received asynchronously
+        header = torch.empty(HEADER_SIZE, dtype=torch.long, device=self.device)
+        dist.recv(header, src=src, group=self.pg, tag=tag)
+        if header.item() == 1:
+            metadata = torch.empty(num_tensors * METADATA_SIZE, dtype=torch.long, device=self.device)
+            dist.recv(metadata, src=src, group=self.pg, tag=tag)
+            metadata = metadata.tolist()
+            self.recv_metadata_cache[key] = [
+                P2PTensorMetaData.from_list(metadata[i * METADATA_SIZE : (i + 1) * METADATA_SIZE])
+                for i in range(num_tensors)
+            ]
+        assert key in self.recv_metadata_cache, f"No metadata was ever received from rank {from_rank} with tag {tag}"
+
+        buffers, future = self._recv_payload(self.recv_metadata_cache[key], from_rank=from_rank, tag=tag)
+        return buffers, [future]
+
     def isend_tensors(self, tensors: List[torch.Tensor], to_rank: int, tag: int = 0) -> List[dist.Work]:
         futures = []
         current_rank = dist.get_rank(self.pg)
         logger.debug(f"Current rank {current_rank} sending to rank {to_rank}. Nb_tensors: {len(tensors)}")
+        if self.cache_metadata:
+            if to_rank == current_rank:
+                raise ValueError("Tried sending tensor to itself")
+            return self._isend_tensors_with_cached_metadata(tensors, to_rank=to_rank, tag=tag)
         for tensor in tensors:
             if to_rank != current_rank:
                 self._send_meta(tensor, to_rank=to_rank, tag=tag)
@@ -321,6 +493,10 @@ class P2P:
         buffers = []
         current_rank = dist.get_rank(self.pg)
         logger.debug(f"Current rank {current_rank} receiving from rank {from_rank}. Nb_tensors: {num_tensors}")
+        if self.cache_metadata:
+            if from_rank == current_rank:
+                raise ValueError("Tried receiving tensor from itself")
+            return self._irecv_tensors_with_cached_metadata(num_tensors, from_rank=from_rank, tag=tag)
         for _ in range(num_tensors):
             if from_rank != current_rank:
                 meta = self._recv_meta(from_rank=from_rank, tag=tag)
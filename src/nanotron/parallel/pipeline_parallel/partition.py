@@ -0,0 +1,177 @@
+"""Partition of the PipelineBlocks of a model in contiguous PP stages"""
+
+import dataclasses
+import itertools
+from typing import List, Optional, Sequence, Tuple
+
+
+@dataclasses.dataclass
+class BlockMemoryCost:
+    """Memory estimate of a PipelineBlock on the rank running it
+
+    Args:
+        num_params: Number of parameters of the block held by a TP rank
+        activations_per_token: Bytes of activations the block keeps for its backward, per token of a micro batch
+    """
+
+    num_params: float
+    activations_per_token: float
+
+
+@dataclasses.dataclass
+class StageMemoryBudget:
+    """Memory available to the PP stages
+
+    Args:
+        max_memory: Bytes a PP rank can use, None for no limit
+        bytes_per_param: Bytes of a parameter along with its gradients and optimizer states
+        nb_in_flight_tokens: Tokens whose activations each PP rank holds at once, see `get_max_in_flight_microbatches`
+    """
+
+    max_memory: Optional[float]
+    bytes_per_param: float
+    nb_in_flight_tokens: List[int]
+
+
+def get_bytes_per_param(dp: int, zero_stage: int, cpu_offload: bool = False) -> float:
+    """Bytes of a parameter on a GPU: bf16 weights, bf16 gradients, fp32 accumulated gradients, fp32 master weights
+    and Adam states, the last ones being sharded across DP with ZeRO, or kept on CPU with `cpu_offload`"""
+    return (
+        2 / (dp if zero_stage >= 3 else 1)
+        + 2
+        + 4 / (dp if zero_stage >= 2 else 1)
+        + (0 if cpu_offload else (4 + 8) / (dp if zero_stage >= 1 else 1))
+    )
+
+
+def get_layer_activations_per_token(
+    hidden_size: int,
+    tp: int,
+    sequence_parallel: bool = False,
+    recompute_policy: Optional[str] = None,
+    recompute_layer_interval: int = 1,
+) -> float:
+    """Bytes of bf16 activations a Transformer layer with flash attention keeps per token on a TP rank
+    (https://arxiv.org/abs/2205.05198): the norms, residuals and dropouts keep 10 * hidden_size replicated across TP,
+    unless they run on sequence shards with sequence parallelism.
+
+    With `recompute_policy`, "full" only keeps the input of the layer and "mlp" drops the 16 * hidden_size / tp of the
+    MLP intermediate activations. Averaged over the layers when only one every `recompute_layer_interval` is
+    recomputed.
+    """
+    if sequence_parallel:
+        activations = hidden_size * 34 / tp
+    else:
+        activations = hidden_size * (10 + 24 / tp)
+
+    if recompute_policy is None:
+        recomputed_activations = activations
+    elif recompute_policy == "mlp":
+        recomputed_activations = activations - hidden_size * 16 / tp
+    elif recompute_policy == "full":
+        recomputed_activations = 2 * hidden_size / (tp if sequence_parallel else 1)
+    else:
+        raise ValueError(f"Unknown recompute policy {recompute_policy}")
+    return activations - (activations - recomputed_activations) / recompute_layer_interval
+
+
+def get_thresholds_partition(compute_costs: Sequence[float], num_stages: int) -> List[int]:
+    """Assigns a stage to each block, moving to the next stage once the cumulative compute cost exceeds the
+    stage's share of the total cost. Stages at the end can be left empty."""
+    cumulative_costs = list(itertools.accumulate(compute_costs))
+    thresholds = [cumulative_costs[-1] * ((stage + 1) / num_stages) for stage in range(num_stages)]
+    assert thresholds[-1] >= cumulative_costs[-1]
+    block_stages = []
+    stage_idx = 0
+    for cumulative_cost in cumulative_costs:
+        assert stage_idx < num_stages
+        block_stages.append(stage_idx)
+        if cumulative_cost > thresholds[stage_idx]:
+            stage_idx += 1
+    return block_stages
+
+
+def get_min_max_partition(
+    compute_costs: Sequence[float],
+    num_stages: int,
+    static_memory_costs: Optional[Sequence[float]] = None,
+    activation_memory_costs: Optional[Sequence[float]] = None,
+    nb_in_flight_tokens: Optional[Sequence[float]] = None,
+    max_memory: Optional[float] = None,
+) -> List[int]:
+    """Assigns a stage to each block, such that stages are contiguous and non-empty, and minimizing the compute cost
+    of the slowest stage, then the memory of the most loaded one.
+
+    The memory of a stage is the sum of the `static_memory_costs` of its blocks (parameters, gradients, optimizer
+    states) plus the sum of their `activation_memory_costs` times the `nb_in_flight_tokens` of the stage. Stages using
+    more than `max_memory` are not allowed.
+    """
+    num_blocks = len(compute_costs)
+    if num_blocks < num_stages:
+        raise ValueError(f"Can't split {num_blocks} blocks in {num_stages} non-empty stages")
+    if static_memory_costs is None:
+        static_memory_costs = [0.0] * num_blocks
+    if activation_memory_costs is None:
+        activation_memory_costs = [0.0] * num_blocks
+    if nb_in_flight_tokens is None:
+        nb_in_flight_tokens = [0.0] * num_stages
+    assert len(static_memory_costs) == len(activation_memory_costs) == num_blocks
+    assert len(nb_in_flight_tokens) == num_stages
+
+    cumulative_compute = list(itertools.accumulate(compute_costs, initial=0))
+    cumulative_static_memory = list(itertools.accumulate(static_memory_costs, initial=0))
+    cumulative_activation_memory = list(itertools.accumulate(activation_memory_costs, initial=0))
+
+    # `best[stage][end]` is the (max compute, max memory) of the best split of the first `end` blocks in `stage` stages
+    best: List[List[Optional[Tuple[float, float]]]] = [[None] * (num_blocks + 1) for _ in range(num_stages + 1)]
+    stage_starts = [[0] * (num_blocks + 1) for _ in range(num_stages + 1)]
+    best[0][0] = (0.0, 0.0)
+    for stage in range(1, num_stages + 1):
+        # Leave at least a block for each of the next stages
+        for end in range(stage, num_blocks - (num_stages - stage) + 1):
+            for start in range(stage - 1, end):
+                previous = best[stage - 1][start]
+                if previous is None:
+                    continue
+                memory = (
+                    cumulative_static_memory[end]
+                    - cumulative_static_memory[start]
+                    + (cumulative_activation_memory[end] - cumulative_activation_memory[start])
+                    * nb_in_flight_tokens[stage - 1]
+                )
+                if max_memory is not None and memory > max_memory:
+                    continue
+                candidate = (
+                    max(previous[0], cumulative_compute[end] - cumulative_compute[start]),
+                    max(previous[1], memory),
+                )
+                if best[stage][end] is None or candidate < best[stage][end]:
+                    best[stage][end] = candidate
+                    stage_starts[stage][end] = start
+
+    if best[num_stages][num_blocks] is None:
+        raise ValueError(
+            f"No split of the {num_blocks} blocks in {num_stages} stages fits in {max_memory / 1024**3:.2f}GiB per stage"
+        )
+
+    block_stages = [0] * num_blocks
+    end = num_blocks
+    for stage in reversed(range(num_stages)):
+        start = stage_starts[stage + 1][end]
+        block_stages[start:end] = [stage] * (end - start)
+        end = start
+    return block_stages
+
+
+def get_stage_costs(block_costs: Sequence[float], block_stages: Sequence[int], num_stages: int) -> List[float]:
+    """Sums the costs of the blocks of each stage"""
+    stage_costs = [0.0] * num_stages
+    for cost, stage in zip(block_costs, block_stages):
+        stage_costs[stage] += cost
+    return stage_costs
+
+
+def get_imbalance(stage_costs: Sequence[float]) -> float:
+    """Ratio of the cost of the most loaded stage to the mean cost, 1 being perfectly balanced"""
+    mean_cost = sum(stage_costs) / len(stage_costs)
+    return max(stage_costs) / mean_cost if mean_cost > 0 else 1.0
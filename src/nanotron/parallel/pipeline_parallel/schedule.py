@@ -0,0 +1,176 @@
+"""Per-rank order of the pipeline operations of each engine, and an offline simulator of their timeline
+
+A schedule is the list of operations a rank runs during a batch, the i-th occurrence of an operation being for the i-th
+micro batch:
+ - "F": forward
+ - "B": backward computing the gradients of the inputs only, needed by the previous rank
+ - "W": backward computing the gradients of the weights only
+ - "BW": full backward, ie "B" and "W" at once
+"""
+
+import dataclasses
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+
+FORWARD = "F"
+BACKWARD_INPUT = "B"
+BACKWARD_WEIGHT = "W"
+BACKWARD = "BW"
+
+
+def get_all_forward_all_backward_schedule(pp_size: int, pp_rank: int, nb_microbatches: int) -> List[str]:
+    return [FORWARD] * nb_microbatches + [BACKWARD] * nb_microbatches
+
+
+def get_one_forward_one_backward_schedule(pp_size: int, pp_rank: int, nb_microbatches: int) -> List[str]:
+    nb_warmup_microbatches = min(pp_size - pp_rank - 1, nb_microbatches)
+    return (
+        [FORWARD] * nb_warmup_microbatches
+        + [FORWARD, BACKWARD] * (nb_microbatches - nb_warmup_microbatches)
+        + [BACKWARD] * nb_warmup_microbatches
+    )
+
+
+def get_zero_bubble_schedule(pp_size: int, pp_rank: int, nb_microbatches: int) -> List[str]:
+    """ZB-H1 schedule of https://arxiv.org/abs/2401.10241: 1F1B with the backward split in "B" and "W".
+
+    The later the rank, the more ranks wait for its input gradient passes: rank `pp_rank` keeps up to `pp_rank` weight
+    gradient passes pending, and runs them at the end of the batch while the previous ranks run their cooldown.
+    """
+    nb_warmup_microbatches = min(pp_size - pp_rank - 1, nb_microbatches)
+
+    schedule = [FORWARD] * nb_warmup_microbatches
+    nb_pending_weight_grads = 0
+    for _ in range(nb_microbatches - nb_warmup_microbatches):
+        schedule.append(FORWARD)
+        # Run after the forward, whose communications send the gradients of the previous input gradient pass
+        if nb_pending_weight_grads > pp_rank:
+            schedule.append(BACKWARD_WEIGHT)
+            nb_pending_weight_grads -= 1
+        schedule.append(BACKWARD_INPUT)
+        nb_pending_weight_grads += 1
+
+    # While waiting for the gradients of the next rank in the cooldown, run a pending weight gradient pass
+    schedule += [BACKWARD_INPUT, BACKWARD_WEIGHT] * nb_warmup_microbatches
+    schedule += [BACKWARD_WEIGHT] * nb_pending_weight_grads
+    return schedule
+
+
+PIPELINE_SCHEDULES: Dict[str, Callable[[int, int, int], List[str]]] = {
+    "afab": get_all_forward_all_backward_schedule,
+    "1f1b": get_one_forward_one_backward_schedule,
+    "zero_bubble": get_zero_bubble_schedule,
+}
+
+
+def get_max_in_flight_microbatches(schedule: List[str]) -> int:
+    """Maximum number of micro batches whose activations a rank holds at once, ie forwarded but not fully backwarded"""
+    nb_in_flight_microbatches = max_in_flight_microbatches = 0
+    for op in schedule:
+        if op == FORWARD:
+            nb_in_flight_microbatches += 1
+            max_in_flight_microbatches = max(max_in_flight_microbatches, nb_in_flight_microbatches)
+        elif op in (BACKWARD, BACKWARD_WEIGHT):
+            nb_in_flight_microbatches -= 1
+    return max_in_flight_microbatches
+
+
+@dataclasses.dataclass
+class PipelineScheduleSimulation:
+    """Timeline of a batch: `timelines[pp_rank]` lists the (operation, micro_batch_id, start, end) of a rank"""
+
+    timelines: List[List[Tuple[str, int, float, float]]]
+
+    @property
+    def step_time(self) -> float:
+        return max(timeline[-1][3] for timeline in self.timelines if len(timeline) > 0)
+
+    @property
+    def bubble_ratio(self) -> float:
+        """Fraction of the step time the ranks spend idle"""
+        busy_time = sum(end - start for timeline in self.timelines for _, _, start, end in timeline)
+        return 1 - busy_time / (len(self.timelines) * self.step_time)
+
+
+def simulate_pipeline_schedule(
+    schedules: List[List[str]],
+    forward_time: Union[float, Sequence[float]] = 1.0,
+    backward_input_time: Union[float, Sequence[float]] = 1.0,
+    backward_weight_time: Union[float, Sequence[float]] = 1.0,
+    p2p_time: float = 0.0,
+) -> PipelineScheduleSimulation:
+    """Simulates the schedules of all the ranks of a pipeline.
+
+    Each rank runs its operations in order, as soon as the activations (resp. gradients) of the previous (resp. next)
+    rank arrived, `p2p_time` after being computed. Communications are assumed to overlap with compute. The times of
+    the operations are either the same for all the stages, or given per stage.
+    """
+    pp_size = len(schedules)
+
+    def per_stage(time: Union[float, Sequence[float]]) -> List[float]:
+        if isinstance(time, (int, float)):
+            return [time] * pp_size
+        assert len(time) == pp_size, f"Expected a time per stage, got {len(time)} times for {pp_size} stages"
+        return list(time)
+
+    forward_times, backward_input_times, backward_weight_times = (
+        per_stage(forward_time),
+        per_stage(backward_input_time),
+        per_stage(backward_weight_time),
+    )
+    durations = [
+        {
+            FORWARD: forward_times[pp_rank],
+            BACKWARD_INPUT: backward_input_times[pp_rank],
+            BACKWARD_WEIGHT: backward_weight_times[pp_rank],
+            BACKWARD: backward_input_times[pp_rank] + backward_weight_times[pp_rank],
+        }
+        for pp_rank in range(pp_size)
+    ]
+    # End time of the forward (resp. input gradient pass) of each micro batch on each rank
+    forward_ends: List[Dict[int, float]] = [{} for _ in range(pp_size)]
+    backward_ends: List[Dict[int, float]] = [{} for _ in range(pp_size)]
+    timelines: List[List[Tuple[str, int, float, float]]] = [[] for _ in range(pp_size)]
+    op_counts: List[Dict[str, int]] = [{FORWARD: 0, BACKWARD_INPUT: 0, BACKWARD_WEIGHT: 0} for _ in range(pp_size)]
+    next_op_ids = [0] * pp_size
+    rank_times = [0.0] * pp_size
+
+    nb_ops_left = sum(len(schedule) for schedule in schedules)
+    while nb_ops_left > 0:
+        has_progressed = False
+        for pp_rank, schedule in enumerate(schedules):
+            while next_op_ids[pp_rank] < len(schedule):
+                op = schedule[next_op_ids[pp_rank]]
+                # "BW" computes the input gradients as well
+                counted_op = BACKWARD_INPUT if op == BACKWARD else op
+                micro_batch_id = op_counts[pp_rank][counted_op]
+
+                # Wait for the activations, resp. gradients, of the neighbouring rank
+                ready_time = rank_times[pp_rank]
+                if op == FORWARD and pp_rank > 0:
+                    if micro_batch_id not in forward_ends[pp_rank - 1]:
+                        break
+                    ready_time = max(ready_time, forward_ends[pp_rank - 1][micro_batch_id] + p2p_time)
+                elif op in (BACKWARD_INPUT, BACKWARD) and pp_rank < pp_size - 1:
+                    if micro_batch_id not in backward_ends[pp_rank + 1]:
+                        break
+                    ready_time = max(ready_time, backward_ends[pp_rank + 1][micro_batch_id] + p2p_time)
+
+                end_time = ready_time + durations[pp_rank][op]
+                if op == FORWARD:
+                    forward_ends[pp_rank][micro_batch_id] = end_time
+                elif op == BACKWARD:
+                    # The gradients are only sent once the full backward is done
+                    backward_ends[pp_rank][micro_batch_id] = end_time
+                elif op == BACKWARD_INPUT:
+                    backward_ends[pp_rank][micro_batch_id] = end_time
+                timelines[pp_rank].append((op, micro_batch_id, ready_time, end_time))
+                op_counts[pp_rank][counted_op] += 1
+                rank_times[pp_rank] = end_time
+                next_op_ids[pp_rank] += 1
+                nb_ops_left -= 1
+                has_progressed = True
+
+        if not has_progressed:
+            raise ValueError(f"The schedules deadlock, operations left per rank: {next_op_ids}")
+
+    return PipelineScheduleSimulation(timelines=timelines)
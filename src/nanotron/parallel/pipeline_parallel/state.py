@@ -1,7 +1,7 @@
 import collections
 import dataclasses
 from abc import ABC, abstractmethod
-from typing import List
+from typing import Deque, List, Optional, Tuple
 
 import torch
 from nanotron import distributed as dist
@@ -197,6 +197,171 @@ class PipelineTrainBatchState(PipelineBatchState):
         ), f"There are gradients left for me to recv still: {len(self.microbatches_grads_to_recv)}"
 
 
+class PipelineInterleavedTrainBatchState(PipelineTrainBatchState):
+    """State of a training batch where each rank runs several model chunks (virtual stages) of the pipeline, see
+    `InterleavedOneForwardOneBackwardPipelineEngine`.
+
+    Only the `PipelineBlock`s of `model_chunk` run and communicate. The engine runs the communications itself: the
+    activations (resp. gradients) a model chunk needs are received in `activations_buffer` (resp. `grads_buffer`)
+    before its forward (resp. backward), and the ones it registers to send are collected afterwards.
+    """
+
+    def __init__(self, pp_rank: int, pp_size: int, num_model_chunks: int):
+        self.pp_rank = pp_rank
+        self.pp_size = pp_size
+        self.num_model_chunks = num_model_chunks
+        # Model chunk whose forward or backward is running
+        self.model_chunk = 0
+
+        self.microbatches_activations_to_send = collections.deque()
+        self.microbatches_activations_to_recv = collections.deque()
+        self.microbatches_grads_to_send = collections.deque()
+        self.microbatches_grads_to_recv = collections.deque()
+        self.activations_buffer = collections.deque()
+        self.grads_buffer = collections.deque()
+        self.microbatches_activations_requiring_backward = collections.deque()
+        self.nb_backwards = 0
+        self.nb_forwards = 0
+
+        # For each model chunk, first index represent micro_batch_id, second index represent activations that needs to be popped
+        self.model_chunks_activations_requiring_backward: List[Deque[Deque[torch.Tensor]]] = [
+            collections.deque() for _ in range(num_model_chunks)
+        ]
+        # For each model chunk, the activations (resp. gradients) received for its next forwards (resp. backwards)
+        self.model_chunks_activations_received: List[Deque[List[torch.Tensor]]] = [
+            collections.deque() for _ in range(num_model_chunks)
+        ]
+        self.model_chunks_grads_received: List[Deque[List[torch.Tensor]]] = [
+            collections.deque() for _ in range(num_model_chunks)
+        ]
+        # Number of tensors each model chunk receives per micro batch, known once its first micro batch is received
+        self.model_chunks_num_activations_to_recv: List[Optional[int]] = [None] * num_model_chunks
+        self.model_chunks_num_grads_to_recv: List[Optional[int]] = [None] * num_model_chunks
+
+    def is_running(self, model_chunk: int) -> bool:
+        return model_chunk == self.model_chunk
+
+    def is_next_stage(self, pp_rank: int, model_chunk: int) -> bool:
+        """Whether the pipeline stage of (`pp_rank`, `model_chunk`) comes right after the model chunk running"""
+        return model_chunk * self.pp_size + pp_rank == self.model_chunk * self.pp_size + self.pp_rank + 1
+
+    def register_recv_activation(self, from_rank: int, p2p: P2P):
+        # The engine already received the activations in `activations_buffer`
+        pass
+
+    def register_recv_grad(self, from_rank: int, p2p: P2P):
+        # The engine already received the gradients in `grads_buffer`
+        pass
+
+    def run_communication(self, send_only_activation: bool = False):
+        if send_only_activation:
+            # The activations were sent by the engine right after the forward
+            return
+        raise ValueError(
+            f"Model chunk {self.model_chunk} is missing some activations or gradients, they should have been received "
+            "by the pipeline engine before running it"
+        )
+
+    def new_micro_batch_forward(self):
+        self.model_chunks_activations_requiring_backward[self.model_chunk].append(collections.deque())
+
+    def register_activation_requiring_backward(self, activation: torch.Tensor):
+        # Register the activation to last microbatch of the running model chunk
+        self.model_chunks_activations_requiring_backward[self.model_chunk][-1].append(activation)
+
+    def pop_last_activations_requiring_backward(self) -> List[torch.Tensor]:
+        return self.model_chunks_activations_requiring_backward[self.model_chunk].popleft()
+
+    def check_buffers_empty(self):
+        super().check_buffers_empty()
+        for model_chunk in range(self.num_model_chunks):
+            assert (
+                len(self.model_chunks_activations_requiring_backward[model_chunk]) == 0
+            ), f"There are still activations that require backward in model chunk {model_chunk}: {len(self.model_chunks_activations_requiring_backward[model_chunk])}"
+            assert (
+                len(self.model_chunks_activations_received[model_chunk]) == 0
+            ), f"There are received activations left in model chunk {model_chunk}: {len(self.model_chunks_activations_received[model_chunk])}"
+            assert (
+                len(self.model_chunks_grads_received[model_chunk]) == 0
+            ), f"There are received gradients left in model chunk {model_chunk}: {len(self.model_chunks_grads_received[model_chunk])}"
+
+
+@dataclasses.dataclass
+class WeightGradInputs:
+    """Outputs of a module holding parameters, and the gradients of the loss with respect to them"""
+
+    params: List[torch.Tensor]
+    outputs: List[torch.Tensor]
+    grads: List[Optional[torch.Tensor]] = dataclasses.field(default_factory=list)
+
+    def __call__(self):
+        """Backpropagates from the outputs of the module to its parameters only"""
+        outputs_and_grads = [(output, grad) for output, grad in zip(self.outputs, self.grads) if grad is not None]
+        if len(outputs_and_grads) == 0:
+            # The outputs of the module don't contribute to the loss
+            return
+        outputs, grads = zip(*outputs_and_grads)
+        torch.autograd.backward(outputs, grad_tensors=grads, inputs=self.params, retain_graph=True)
+
+
+class PipelineZeroBubbleTrainBatchState(PipelineTrainBatchState):
+    """State of a training batch where the backward is split in two passes, see `ZeroBubblePipelineEngine`.
+
+    During the forward, the outputs of each module holding parameters and the leaves of the micro batch graph (the
+    activations received from the previous rank and the dummy inputs of `send_to_pipeline_state_buffer`) are stored
+    per micro batch. The input gradient pass only backpropagates down to them, the weight gradient pass then
+    backpropagates from each module output to the parameters of its module.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # First index represent micro_batch_id, second index represent the modules holding parameters that ran
+        self.microbatches_weight_grad_inputs: Deque[List[WeightGradInputs]] = collections.deque()
+        # First index represent micro_batch_id, second index represent the leaves the input gradient pass has to reach
+        self.microbatches_backward_leaves: Deque[List[torch.Tensor]] = collections.deque()
+        # Micro batches whose input gradient pass ran, but not the weight gradient pass yet
+        self.microbatches_weight_grads_pending: Deque[List[WeightGradInputs]] = collections.deque()
+        # Whether one of the two backward passes is running, no module holding parameters should run its forward then
+        self.is_in_backward = False
+
+    def run_communication(self, send_only_activation: bool = False):
+        nb_activations_received = len(self.activations_buffer)
+        super().run_communication(send_only_activation=send_only_activation)
+        for activation in list(self.activations_buffer)[nb_activations_received:]:
+            if activation.requires_grad:
+                # The gradient is sent to the previous rank when backpropagating to the received activation
+                self.microbatches_backward_leaves[-1].append(activation)
+
+    def new_micro_batch_forward(self):
+        super().new_micro_batch_forward()
+        self.microbatches_weight_grad_inputs.append([])
+        self.microbatches_backward_leaves.append([])
+
+    def register_activation_requiring_backward(self, activation: torch.Tensor):
+        super().register_activation_requiring_backward(activation)
+        # Activations that don't require grad are sent by backpropagating to a dummy input, see
+        # `send_to_pipeline_state_buffer`
+        if activation.grad_fn is None:
+            return
+        for next_function, _ in activation.grad_fn.next_functions:
+            leaf = getattr(next_function, "variable", None)
+            if isinstance(leaf, torch.Tensor) and not isinstance(leaf, torch.nn.Parameter):
+                self.microbatches_backward_leaves[-1].append(leaf)
+
+    def register_weight_grad_outputs(self, params: List[torch.Tensor], outputs: List[torch.Tensor]):
+        # Register the module outputs to last microbatch
+        self.microbatches_weight_grad_inputs[-1].append(WeightGradInputs(params=params, outputs=outputs))
+
+    def pop_last_weight_grad_inputs(self) -> Tuple[List[WeightGradInputs], List[torch.Tensor]]:
+        return self.microbatches_weight_grad_inputs.popleft(), self.microbatches_backward_leaves.popleft()
+
+    def check_buffers_empty(self):
+        super().check_buffers_empty()
+        assert (
+            len(self.microbatches_weight_grads_pending) == 0
+        ), f"There are weight gradients left to compute: {len(self.microbatches_weight_grads_pending)}"
+
+
 @dataclasses.dataclass
 class PipelineEvalBatchState(PipelineBatchState):
     microbatches_activations_to_send = collections.deque()
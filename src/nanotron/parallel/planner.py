@@ -0,0 +1,354 @@
+"""Offline cost model of a training step, to pick the parallelism of a run before launching it
+
+Compute times are derived from the flops of each block of a Llama model, communication times from the link bandwidths
+(assumed, or measured with `nanotron.helpers.test_all_pair_to_pair`). The pipeline is simulated with the schedule of the
+pipeline engine, see `nanotron.parallel.pipeline_parallel.schedule`.
+"""
+
+import dataclasses
+import itertools
+from typing import List, Optional, Tuple
+
+from nanotron.config import LlamaConfig
+from nanotron.config.parallelism_config import RECOMPUTE_POLICIES
+from nanotron.parallel.pipeline_parallel.partition import (
+    get_bytes_per_param,
+    get_layer_activations_per_token,
+    get_thresholds_partition,
+)
+from nanotron.parallel.pipeline_parallel.schedule import (
+    PIPELINE_SCHEDULES,
+    get_max_in_flight_microbatches,
+    simulate_pipeline_schedule,
+)
+
+GiB = 1024**3
+
+
+@dataclasses.dataclass
+class HardwareArgs:
+    """Characteristics of the cluster
+
+    Args:
+        gpus_per_node: Number of GPUs per node
+        peak_flops: Peak dense bf16 flops of a GPU
+        mfu: Fraction of the peak flops the matmuls reach
+        gpu_memory: Memory of a GPU in bytes
+        intra_node_bandwidth: Bus bandwidth between GPUs of a node in bytes/s
+        inter_node_bandwidth: Bus bandwidth between GPUs of different nodes in bytes/s
+    """
+
+    gpus_per_node: int = 8
+    peak_flops: float = 989e12
+    mfu: float = 0.5
+    gpu_memory: float = 80 * GiB
+    intra_node_bandwidth: float = 150e9
+    inter_node_bandwidth: float = 25e9
+
+
+@dataclasses.dataclass
+class ParallelismPlan:
+    """Predicted cost of a training step with a given parallelism"""
+
+    dp: int
+    tp: int
+    pp: int
+    pp_engine: str
+    sequence_parallel: bool
+    micro_batch_size: int
+    batch_accumulation_per_replica: int
+    recompute_policy: Optional[str]
+    recompute_layer_interval: int
+    num_layers_per_stage: List[int]
+    step_time: float
+    bubble_ratio: float
+    tokens_per_sec: float
+    # Peak memory of a GPU of each PP stage, in bytes
+    peak_memory_per_stage: List[float]
+
+    def fits_in_memory(self, hardware: HardwareArgs) -> bool:
+        return max(self.peak_memory_per_stage) <= hardware.gpu_memory
+
+    def __str__(self) -> str:
+        recompute = self.recompute_policy
+        if self.recompute_policy is not None and self.recompute_layer_interval > 1:
+            recompute = f"{recompute} every {self.recompute_layer_interval} layers"
+        return (
+            f"dp={self.dp} tp={self.tp} pp={self.pp} pp_engine={self.pp_engine} "
+            f"sequence_parallel={self.sequence_parallel} mbs={self.micro_batch_size} "
+            f"batch_accum={self.batch_accumulation_per_replica} recompute={recompute} | "
+            f"step time {self.step_time:.3f}s | bubble {self.bubble_ratio:.1%} | "
+            f"{self.tokens_per_sec:,.0f} tokens/s | peak memory {max(self.peak_memory_per_stage) / GiB:.1f}GiB"
+        )
+
+
+def get_decoder_layer_forward_flops(
+    model_config: LlamaConfig, sequence_length: int, micro_batch_size: int, part: str = "full"
+) -> float:
+    """Forward flops of a decoder layer for a micro batch, counted like `nanotron.models.llama.get_flops`, or of one
+    of its recompute policy `part`s"""
+    hidden_size = model_config.hidden_size
+    num_heads = model_config.num_attention_heads
+    d_qk = hidden_size // num_heads
+    nb_tokens = micro_batch_size * sequence_length
+    qkv_proj = 2 * nb_tokens * hidden_size * (num_heads + 2 * model_config.num_key_value_heads) * d_qk
+    attention = 2 * 2 * micro_batch_size * num_heads * sequence_length * sequence_length * d_qk
+    attn_out = 2 * nb_tokens * hidden_size * hidden_size
+    mlp = 2 * 3 * nb_tokens * hidden_size * model_config.intermediate_size
+    if part == "mlp":
+        return mlp
+    assert part == "full", f"Unknown decoder layer part {part}"
+    return qkv_proj + attention + attn_out + mlp
+
+
+def get_lm_head_forward_flops(model_config: LlamaConfig, sequence_length: int, micro_batch_size: int) -> float:
+    return 2 * micro_batch_size * sequence_length * model_config.hidden_size * model_config.vocab_size
+
+
+def get_decoder_layer_num_params(model_config: LlamaConfig) -> int:
+    hidden_size = model_config.hidden_size
+    d_qk = hidden_size // model_config.num_attention_heads
+    qkv_proj = hidden_size * (model_config.num_attention_heads + 2 * model_config.num_key_value_heads) * d_qk
+    return qkv_proj + hidden_size * hidden_size + 3 * hidden_size * model_config.intermediate_size + 2 * hidden_size
+
+
+def split_layers_across_stages(model_config: LlamaConfig, pp: int) -> Tuple[List[int], int]:
+    """Splits the compute costs across PP stages like `build_model` does.
+
+    Returns the number of decoder layers of each stage, and the stage of the lm_head. The embedding is on the first stage,
+    the lm_head costs like in `LlamaModel.get_block_compute_costs`.
+    """
+    d_qkv = model_config.hidden_size // model_config.num_attention_heads
+    layer_cost = (
+        4 * model_config.num_attention_heads * d_qkv * model_config.hidden_size
+        + 3 * model_config.intermediate_size * model_config.hidden_size
+    )
+    lm_head_cost = model_config.vocab_size * model_config.hidden_size
+    block_stages = get_thresholds_partition([layer_cost] * model_config.num_hidden_layers + [lm_head_cost], pp)
+    num_layers_per_stage = [block_stages[:-1].count(stage) for stage in range(pp)]
+    return num_layers_per_stage, block_stages[-1]
+
+
+def all_reduce_time(num_bytes: float, group_size: int, bandwidth: float) -> float:
+    """Ring all-reduce"""
+    return 2 * (group_size - 1) / group_size * num_bytes / bandwidth if group_size > 1 else 0.0
+
+
+def get_group_bandwidth(group_stride: int, group_size: int, hardware: HardwareArgs) -> float:
+    """Bandwidth of a process group whose ranks are `group_stride` apart, ranks being ordered as (pp, dp, tp)"""
+    return (
+        hardware.intra_node_bandwidth
+        if group_stride * group_size <= hardware.gpus_per_node
+        else hardware.inter_node_bandwidth
+    )
+
+
+def plan_parallelism(
+    model_config: LlamaConfig,
+    hardware: HardwareArgs,
+    dp: int,
+    tp: int,
+    pp: int,
+    sequence_length: int,
+    micro_batch_size: int,
+    batch_accumulation_per_replica: int,
+    pp_engine: str = "1f1b",
+    sequence_parallel: bool = False,
+    recompute_policy: Optional[str] = None,
+    recompute_layer_interval: int = 1,
+    zero_stage: int = 0,
+) -> ParallelismPlan:
+    """Predicts the step time, pipeline bubble, tokens/s and peak memory per PP stage of a parallelism.
+
+    The memory counts bf16 weights and gradients, fp32 gradient accumulation, fp32 master weights and Adam states (the
+    ones sharded by ZeRO being divided by DP) and the activations of the micro batches in flight (with flash attention,
+    see https://arxiv.org/abs/2205.05198). `sequence_parallel` is `tp_mode=REDUCE_SCATTER`: its reduce-scatters and
+    all-gathers move as many bytes as the all-reduces, but the activations are sharded across TP.
+    """
+    num_layers_per_stage, lm_head_stage = split_layers_across_stages(model_config, pp)
+    hidden_size, vocab_size = model_config.hidden_size, model_config.vocab_size
+    nb_tokens = micro_batch_size * sequence_length
+    # bf16 activations exchanged between layers
+    hidden_states_bytes = 2 * nb_tokens * hidden_size
+
+    tp_bandwidth = get_group_bandwidth(group_stride=1, group_size=tp, hardware=hardware)
+    dp_bandwidth = get_group_bandwidth(group_stride=tp, group_size=dp, hardware=hardware)
+    pp_bandwidth = get_group_bandwidth(group_stride=tp * dp, group_size=pp, hardware=hardware)
+    flops_per_sec = hardware.peak_flops * hardware.mfu
+
+    # Each layer all-reduces its attention and MLP outputs across TP in the forward, and their input gradients in the
+    # backward
+    layer_forward_time = get_decoder_layer_forward_flops(
+        model_config, sequence_length, micro_batch_size
+    ) / tp / flops_per_sec + 2 * all_reduce_time(hidden_states_bytes, tp, tp_bandwidth)
+    lm_head_forward_time = (
+        get_lm_head_forward_flops(model_config, sequence_length, micro_batch_size) / tp / flops_per_sec
+    )
+    # Forward of the recomputed part of a layer, on average over the layers
+    if recompute_policy is None:
+        layer_recompute_time = 0.0
+    elif recompute_policy == "full":
+        layer_recompute_time = layer_forward_time
+    else:
+        recompute_flops = get_decoder_layer_forward_flops(
+            model_config, sequence_length, micro_batch_size, part=recompute_policy
+        )
+        # The MLP all-reduces its output again
+        layer_recompute_time = recompute_flops / tp / flops_per_sec + all_reduce_time(
+            hidden_states_bytes, tp, tp_bandwidth
+        )
+    layer_recompute_time /= recompute_layer_interval
+
+    forward_times, backward_input_times, backward_weight_times = [], [], []
+    for stage, num_layers in enumerate(num_layers_per_stage):
+        forward_time = num_layers * layer_forward_time + (lm_head_forward_time if stage == lm_head_stage else 0.0)
+        forward_times.append(forward_time)
+        # The gradients of the inputs and of the weights each cost as much as the forward, plus the recomputation
+        backward_input_times.append(forward_time + num_layers * layer_recompute_time)
+        backward_weight_times.append(forward_time)
+
+    nb_microbatches = batch_accumulation_per_replica
+    schedules = [PIPELINE_SCHEDULES[pp_engine](pp, pp_rank, nb_microbatches) for pp_rank in range(pp)]
+    simulation = simulate_pipeline_schedule(
+        schedules,
+        forward_time=forward_times,
+        backward_input_time=backward_input_times,
+        backward_weight_time=backward_weight_times,
+        p2p_time=hidden_states_bytes / pp_bandwidth if pp > 1 else 0.0,
+    )
+
+    # Parameters of each stage on a GPU, the embedding and the lm_head being sharded across TP
+    layer_num_params = get_decoder_layer_num_params(model_config)
+    num_params_per_stage = [
+        (
+            num_layers * layer_num_params
+            + (vocab_size * hidden_size if stage == 0 else 0)
+            + (vocab_size * hidden_size + hidden_size if stage == lm_head_stage else 0)
+        )
+        / tp
+        for stage, num_layers in enumerate(num_layers_per_stage)
+    ]
+    # The gradients are synced across DP once per step, after the pipeline
+    dp_sync_time = max(all_reduce_time(4 * num_params, dp, dp_bandwidth) for num_params in num_params_per_stage)
+
+    bytes_per_param = get_bytes_per_param(dp, zero_stage)
+    layer_activation_bytes = nb_tokens * get_layer_activations_per_token(
+        hidden_size,
+        tp,
+        sequence_parallel=sequence_parallel,
+        recompute_policy=recompute_policy,
+        recompute_layer_interval=recompute_layer_interval,
+    )
+    # fp32 logits and their gradients
+    logits_bytes = 2 * 4 * nb_tokens * vocab_size / tp
+    peak_memory_per_stage = [
+        num_params * bytes_per_param
+        + get_max_in_flight_microbatches(schedule) * num_layers * layer_activation_bytes
+        + (logits_bytes if stage == lm_head_stage else 0.0)
+        for stage, (num_params, num_layers, schedule) in enumerate(
+            zip(num_params_per_stage, num_layers_per_stage, schedules)
+        )
+    ]
+
+    step_time = simulation.step_time + dp_sync_time
+    return ParallelismPlan(
+        dp=dp,
+        tp=tp,
+        pp=pp,
+        pp_engine=pp_engine,
+        sequence_parallel=sequence_parallel,
+        micro_batch_size=micro_batch_size,
+        batch_accumulation_per_replica=batch_accumulation_per_replica,
+        recompute_policy=recompute_policy,
+        recompute_layer_interval=recompute_layer_interval,
+        num_layers_per_stage=num_layers_per_stage,
+        step_time=step_time,
+        bubble_ratio=simulation.bubble_ratio,
+        tokens_per_sec=dp * batch_accumulation_per_replica * nb_tokens / step_time,
+        peak_memory_per_stage=peak_memory_per_stage,
+    )
+
+
+def recommend_parallelism(
+    model_config: LlamaConfig,
+    hardware: HardwareArgs,
+    num_gpus: int,
+    sequence_length: int,
+    global_batch_size: int,
+    pp_engines: Tuple[str, ...] = ("afab", "1f1b"),
+    recompute_policies: Tuple[Optional[str], ...] = (None, "mlp", "full"),
+    sequence_parallel_options: Tuple[bool, ...] = (False, True),
+    zero_stage: int = 0,
+    top_k: Optional[int] = None,
+) -> List[ParallelismPlan]:
+    """Plans every parallelism using `num_gpus` GPUs for `global_batch_size` sequences per step, and returns the ones
+    fitting in memory from the highest to the lowest tokens/s"""
+    plans = []
+    for tp in _divisors(num_gpus):
+        if tp > hardware.gpus_per_node or model_config.num_attention_heads % tp != 0:
+            continue
+        for pp in _divisors(num_gpus // tp):
+            if pp > model_config.num_hidden_layers:
+                continue
+            dp = num_gpus // (tp * pp)
+            if global_batch_size % dp != 0:
+                continue
+            for micro_batch_size in _divisors(global_batch_size // dp):
+                batch_accumulation_per_replica = global_batch_size // (dp * micro_batch_size)
+                for pp_engine, recompute_policy, sequence_parallel in itertools.product(
+                    pp_engines, recompute_policies, sequence_parallel_options
+                ):
+                    if pp_engine != "afab" and batch_accumulation_per_replica < pp - 1:
+                        continue
+                    if sequence_parallel and tp == 1:
+                        # Same as without sequence parallelism
+                        continue
+                    plan = plan_parallelism(
+                        model_config,
+                        hardware,
+                        dp=dp,
+                        tp=tp,
+                        pp=pp,
+                        sequence_length=sequence_length,
+                        micro_batch_size=micro_batch_size,
+                        batch_accumulation_per_replica=batch_accumulation_per_replica,
+                        pp_engine=pp_engine,
+                        sequence_parallel=sequence_parallel,
+                        recompute_policy=recompute_policy,
+                        zero_stage=zero_stage,
+                    )
+                    if plan.fits_in_memory(hardware):
+                        plans.append(plan)
+
+    plans = sorted(plans, key=lambda plan: plan.tokens_per_sec, reverse=True)
+    return plans[:top_k] if top_k is not None else plans
+
+
+def plan_recompute_policies(
+    model_config: LlamaConfig,
+    hardware: HardwareArgs,
+    recompute_layer_intervals: Tuple[int, ...] = (1, 2, 4),
+    **kwargs,
+) -> List[ParallelismPlan]:
+    """Plans a parallelism with each recompute policy, recomputing one layer every `recompute_layer_intervals`, from
+    the highest to the lowest tokens/s. The first one fitting in memory recomputes the least for the memory available.
+
+    Args:
+        kwargs: The parallelism, see `plan_parallelism`
+    """
+    plans = [plan_parallelism(model_config, hardware, recompute_policy=None, **kwargs)]
+    for recompute_policy, recompute_layer_interval in itertools.product(RECOMPUTE_POLICIES, recompute_layer_intervals):
+        plans.append(
+            plan_parallelism(
+                model_config,
+                hardware,
+                recompute_policy=recompute_policy,
+                recompute_layer_interval=recompute_layer_interval,
+                **kwargs,
+            )
+        )
+    return sorted(plans, key=lambda plan: plan.tokens_per_sec, reverse=True)
+
+
+def _divisors(n: int) -> List[int]:
+    return [d for d in range(1, n + 1) if n % d == 0]
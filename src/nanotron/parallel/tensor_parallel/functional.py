@@ -20,6 +20,7 @@ from torch.nn import functional as F
 
 import nanotron.distributed as dist
 from nanotron.parallel.tensor_parallel.distributed_differentiable_primitives import (
+    differentiable_all_gather,
     differentiable_all_reduce_sum,
     differentiable_identity,
     differentiable_reduce_scatter_sum,
@@ -115,6 +116,132 @@ def sharded_cross_entropy(sharded_logits, target, group: dist.ProcessGroup, dtyp
     return _ShardedCrossEntropy.apply(sharded_logits, target, group)
 
 
+class _ShardedLinearCrossEntropy(torch.autograd.Function):
+    """Cross entropy of the sharded logits of a column linear, computed `chunk_size` tokens at a time.
+
+    Only the fp32 logits of a chunk are materialized: the forward keeps the logsumexp of each token, and the backward
+    recomputes the logits of each chunk to get their softmax.
+    """
+
+    @staticmethod
+    def forward(
+        ctx,
+        input,  # (*, hidden_size), the same on all ranks of `group`
+        weight,  # (sharded_vocab_size, hidden_size)
+        target,  # (*)
+        group: dist.ProcessGroup,
+        chunk_size: int,
+    ):
+        input_2d = input.reshape(-1, input.shape[-1])
+        target_1d = target.reshape(-1)
+        num_tokens = input_2d.shape[0]
+
+        # Get the shard's indices
+        sharded_vocab_size = weight.shape[0]
+        start_index = dist.get_rank(group) * sharded_vocab_size
+        end_index = start_index + sharded_vocab_size
+
+        loss = torch.empty(num_tokens, dtype=torch.float, device=input.device)
+        logsumexp = torch.empty(num_tokens, dtype=torch.float, device=input.device)
+        for chunk_start in range(0, num_tokens, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, num_tokens)
+            logits = F.linear(input_2d[chunk_start:chunk_end], weight).float()
+
+            # Maximum value along last dimension across all GPUs.
+            logits_max = torch.max(logits, dim=-1)[0]
+            dist.all_reduce(logits_max, op=dist.ReduceOp.MAX, group=group)
+            logits.sub_(logits_max.unsqueeze(dim=-1))
+
+            # Get predicted-logits = logits[target], 0 if the target isn't in the shard.
+            target_chunk = target_1d[chunk_start:chunk_end]
+            target_mask = (target_chunk < start_index) | (target_chunk >= end_index)
+            masked_target = (target_chunk - start_index).masked_fill(target_mask, 0)
+            predicted_logits = logits.gather(-1, masked_target.unsqueeze(dim=-1)).squeeze(dim=-1)
+            predicted_logits.masked_fill_(target_mask, 0.0)
+
+            # Predicted-logits and sum of exponential of logits across all GPUs, in a single all reduce.
+            sum_exp_logits = logits.exp_().sum(dim=-1)
+            reduced = torch.stack([predicted_logits, sum_exp_logits])
+            dist.all_reduce(reduced, op=dist.ReduceOp.SUM, group=group)
+            predicted_logits, sum_exp_logits = reduced
+
+            # Loss = log(sum(exp(logits))) - predicted-logit.
+            log_sum_exp_logits = torch.log(sum_exp_logits)
+            loss[chunk_start:chunk_end] = log_sum_exp_logits - predicted_logits
+            logsumexp[chunk_start:chunk_end] = log_sum_exp_logits + logits_max
+
+        ctx.group = group
+        ctx.chunk_size = chunk_size
+        ctx.save_for_backward(input, weight, target_1d, logsumexp)
+
+        return loss.view_as(target)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, weight, target_1d, logsumexp = ctx.saved_tensors
+        input_2d = input.reshape(-1, input.shape[-1])
+        grad_output_1d = grad_output.reshape(-1)
+        num_tokens = input_2d.shape[0]
+
+        sharded_vocab_size = weight.shape[0]
+        start_index = dist.get_rank(ctx.group) * sharded_vocab_size
+        end_index = start_index + sharded_vocab_size
+
+        grad_input = torch.empty_like(input_2d) if ctx.needs_input_grad[0] else None
+        # Accumulated in fp32 over the chunks
+        grad_weight = (
+            torch.zeros(weight.shape, dtype=torch.float, device=weight.device) if ctx.needs_input_grad[1] else None
+        )
+        for chunk_start in range(0, num_tokens, ctx.chunk_size):
+            chunk_end = min(chunk_start + ctx.chunk_size, num_tokens)
+            input_chunk = input_2d[chunk_start:chunk_end]
+
+            # Recompute the softmax of the chunk.
+            grad_logits = F.linear(input_chunk, weight).float()
+            grad_logits.sub_(logsumexp[chunk_start:chunk_end].unsqueeze(dim=-1))
+            grad_logits.exp_()
+
+            # Add the gradient from matching classes.
+            target_chunk = target_1d[chunk_start:chunk_end]
+            target_mask = (target_chunk < start_index) | (target_chunk >= end_index)
+            masked_target = (target_chunk - start_index).masked_fill(target_mask, 0)
+            arange_1d = torch.arange(start=0, end=grad_logits.shape[0], device=grad_logits.device)
+            grad_logits[arange_1d, masked_target] -= 1.0 - target_mask.float()
+
+            grad_logits.mul_(grad_output_1d[chunk_start:chunk_end].unsqueeze(dim=-1))
+            grad_logits = grad_logits.to(input.dtype)
+
+            if grad_input is not None:
+                grad_input[chunk_start:chunk_end] = grad_logits.matmul(weight)
+            if grad_weight is not None:
+                grad_weight.add_(grad_logits.t().matmul(input_chunk))
+
+        if grad_input is not None:
+            grad_input = grad_input.view_as(input)
+        if grad_weight is not None:
+            grad_weight = grad_weight.to(weight.dtype)
+        return grad_input, grad_weight, None, None, None
+
+
+def sharded_linear_cross_entropy(
+    input: torch.Tensor,
+    weight: torch.Tensor,
+    target: torch.Tensor,
+    group: dist.ProcessGroup,
+    tp_mode: TensorParallelLinearMode,
+    chunk_size: int,
+):
+    """Same loss and gradients as `sharded_cross_entropy(column_linear(input, weight, ...), target, dtype=torch.float)`,
+    without materializing the logits of more than `chunk_size` tokens at once."""
+    if tp_mode is TensorParallelLinearMode.ALL_REDUCE:
+        input = differentiable_identity(input, group=group)
+    elif tp_mode is TensorParallelLinearMode.REDUCE_SCATTER:
+        input = differentiable_all_gather(input, group=group)
+    else:
+        raise ValueError(f"Got unexpected mode: {tp_mode}.")
+    return _ShardedLinearCrossEntropy.apply(input, weight, target, group, chunk_size)
+
+
 class _ColumnLinearAsyncCommunication(torch.autograd.Function):
     """Adapted from https://github.com/NVIDIA/Megatron-LM/blob/e6d7e09845590d0a36bc7f29eb28db974fb8da4e/megatron/core/tensor_parallel/layers.py#L215"""
 
@@ -326,13 +453,13 @@ class _ColumnLinearAsyncCommunication(torch.autograd.Function):
         else:
             raise ValueError()
 
-        grad_bias = grad_output.sum(dim=0) if use_bias else None
+        grad_bias = grad_output.sum(dim=0) if use_bias and ctx.needs_input_grad[2] else None
 
         if handle1 is not None:
             handle1.wait()
 
         # TODO @thomasw21: This sounds like we don't have the optimal physical layout
-        grad_weight = grad_output.t().matmul(total_tensor)
+        grad_weight = grad_output.t().matmul(total_tensor) if ctx.needs_input_grad[1] else None
 
         if handle2 is not None:
             handle2.wait()
@@ -411,7 +538,7 @@ class _ColumnLinearNoAsyncCommunicationReduceScatterMode(torch.autograd.Function
         total_input = total_input.view(math.prod(total_input_first_dims), total_input_last_dim)
 
         # Compute gradients.
-        grad_weight = grad_output.T @ total_input
+        grad_weight = grad_output.T @ total_input if ctx.needs_input_grad[1] else None
         grad_input = grad_output @ weight
         if group.size() == 1:
             sub_grad_input = grad_input
@@ -423,7 +550,7 @@ class _ColumnLinearNoAsyncCommunicationReduceScatterMode(torch.autograd.Function
                 input_size, dtype=total_input.dtype, device=total_input.device, requires_grad=False
             )
             dist.reduce_scatter_tensor(sub_grad_input, grad_input, group=group, op=dist.ReduceOp.SUM)
-        grad_bias = torch.sum(grad_output, dim=0) if bias is not None else None
+        grad_bias = torch.sum(grad_output, dim=0) if bias is not None and ctx.needs_input_grad[2] else None
 
         return sub_grad_input, grad_weight, grad_bias, None, None
 
@@ -575,8 +702,8 @@ class _RowLinearAsyncCommunication(torch.autograd.Function):
         total_grad_output = total_grad_output.view(math.prod(total_grad_output_first_dims), total_grad_output_last_dim)
 
         # TODO @thomasw21: This sounds like we don't have the optimal physical layout
-        grad_weight = total_grad_output.t().matmul(tensor)
-        grad_bias = total_grad_output.sum(dim=0) if use_bias else None
+        grad_weight = total_grad_output.t().matmul(tensor) if ctx.needs_input_grad[1] else None
+        grad_bias = total_grad_output.sum(dim=0) if use_bias and ctx.needs_input_grad[2] else None
 
         return total_grad_tensor, grad_weight, grad_bias, None, None
 
@@ -8,8 +8,9 @@ from nanotron import logging, optim
 from nanotron.config import Config
 from nanotron.logging import get_logger, log_rank
 from nanotron.models import NanotronModel
-from nanotron.optim.gradient_accumulator import GradientAccumulator
+from nanotron.optim.gradient_accumulator import GradientAccumulator, ShardedFP32GradientAccumulator
 from nanotron.parallel import ParallelContext
+from nanotron.parallel.data_parallel.fully_sharded import get_param_id_to_shard
 from nanotron.parallel.tied_parameters import get_tied_id_to_param
 
 logger = get_logger(__name__)
@@ -61,8 +62,13 @@ def before_tbi_sanity_checks(
     lr_scheduler: torch.optim.lr_scheduler.LRScheduler,
 ) -> None:
     if not config.general.ignore_sanity_checks:
+        # With ZeRO stage 3, each DP rank only holds its own slices of the parameters
+        param_id_to_shard = get_param_id_to_shard(unwrapped_model)
+
         # SANITY CHECK: Check that the model params are synchronized across dp
         for name, param in sorted(unwrapped_model.named_parameters(), key=lambda x: x[0]):
+            if id(param) in param_id_to_shard:
+                continue
             assert_tensor_synced_across_pg(
                 tensor=param,
                 pg=parallel_context.dp_pg,
@@ -80,7 +86,7 @@ def before_tbi_sanity_checks(
         for (name, group_ranks), param in tied_params_list:
             group = parallel_context.world_ranks_to_pg[group_ranks]
             assert_tensor_synced_across_pg(
-                tensor=param,
+                tensor=param_id_to_shard.get(id(param), param),
                 pg=group,
                 msg=lambda err: f"[Before train] Tied weights {name} are not synchronized. {err}",
             )
@@ -189,8 +195,10 @@ def before_optim_step_sanity_checks(
             )
 
         # SANITY CHECK: Test gradients are synchronized across DP
+        # With ZeRO stage 2 and 3, each DP rank only holds the reduced gradients of its own slices
+        are_grads_sharded = isinstance(grad_accumulator, ShardedFP32GradientAccumulator)
         for name, param in sorted(unwrapped_model.named_parameters(), key=lambda x: x[0]):
-            if not param.requires_grad:
+            if not param.requires_grad or are_grads_sharded:
                 continue
 
             if param.is_tied:
@@ -212,7 +220,10 @@ def before_optim_step_sanity_checks(
             )
 
         # SANITY CHECK: Check that the model params are synchronized across dp
+        param_id_to_shard = get_param_id_to_shard(unwrapped_model)
         for name, param in sorted(unwrapped_model.named_parameters(), key=lambda x: x[0]):
+            if id(param) in param_id_to_shard:
+                continue
             assert_tensor_synced_across_pg(
                 tensor=param,
                 pg=parallel_context.dp_pg,
@@ -228,7 +239,7 @@ def before_optim_step_sanity_checks(
         for (name, group_ranks), param in tied_params_list:
             group = parallel_context.world_ranks_to_pg[group_ranks]
             assert_tensor_synced_across_pg(
-                tensor=param,
+                tensor=param_id_to_shard.get(id(param), param),
                 pg=group,
                 msg=lambda err: f"[Before optimizer step] Tied weights {name} are not synchronized. {err}",
             )
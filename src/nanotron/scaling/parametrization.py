@@ -19,6 +19,11 @@ class ParametrizationMethod(Enum):
     SPECTRAL_MUP = auto()
 
 
+def _get_closest_module_class(module: nn.Module, module_classes) -> type:
+    """The closest base class of `module` in `module_classes`, eg. for subclasses of the TP linears"""
+    return next(cls for cls in type(module).__mro__ if cls in module_classes)
+
+
 class Parametrizator:
     def __init__(self, config: ModelArgs):
         self.config = config
@@ -27,7 +32,9 @@ class Parametrizator:
         if not isinstance(module, tuple(self.MODULE_TO_PARAMETRIZE.keys())):
             raise Exception(f"Parameter {param_name} was not initialized")
 
-        return self.MODULE_TO_PARAMETRIZE[type(module)](param_name, module)
+        return self.MODULE_TO_PARAMETRIZE[_get_closest_module_class(module, self.MODULE_TO_PARAMETRIZE)](
+            param_name, module
+        )
 
 
 class StandardParametrizator(Parametrizator):
@@ -199,4 +206,4 @@ class LearningRateForSpectralMup(LearningRateForParametrizator):
         # so we remove the .weight and .bias from param_name to get the module_name
         module_name = param_name.rsplit(".", 1)[0]
         module = self.names_to_modules[module_name]
-        return self.MODULE_TO_PARAMETRIZE[type(module)](param, module)
+        return self.MODULE_TO_PARAMETRIZE[_get_closest_module_class(module, self.MODULE_TO_PARAMETRIZE)](param, module)
@@ -1,4 +1,5 @@
 # flake8: noqa
+from nanotron.serialize.async_checkpoint import *
 from nanotron.serialize.main import *
 from nanotron.serialize.optimizer import *
 from nanotron.serialize.random import *
@@ -0,0 +1,196 @@
+import copy
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, cast
+
+import torch
+from torch import nn
+from torch.optim.lr_scheduler import LambdaLR
+
+from nanotron import distributed as dist
+from nanotron import logging
+from nanotron import optim as optim
+from nanotron.config import Config
+from nanotron.logging import log_rank
+from nanotron.parallel import ParallelContext
+from nanotron.parallel.data_parallel.fully_sharded import is_fully_sharded, iter_unsharded_state_dict
+from nanotron.random import RandomStates
+from nanotron.serialize.main import check_checkpoint_states_in_sync
+from nanotron.serialize.metadata import TrainingMetadata, save_meta
+from nanotron.serialize.optimizer import save_lr_scheduler, save_optimizer
+from nanotron.serialize.random import save_random_states
+from nanotron.serialize.weights import save_weights
+
+logger = logging.get_logger(__name__)
+
+
+class AsyncCheckpointWriter:
+    """Saves checkpoints without stalling the training loop
+
+    `save` snapshots the model, optimizer, lr scheduler and random states into pinned CPU memory and returns right
+    away, while a background thread writes the snapshot to disk. The pinned buffers are reused across checkpoints.
+
+    A checkpoint is complete once every rank has written its files. `poll` (non-blocking) and `wait_for_completion`
+    (blocking) detect it and run the `on_completion` callback of the checkpoint on all ranks (eg. writing `latest.txt`
+    or uploading it to S3). They involve collectives, so all ranks have to call them at the same time.
+    """
+
+    def __init__(self, parallel_context: ParallelContext):
+        self.parallel_context = parallel_context
+        self._pinned_buffers: Dict[str, torch.Tensor] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._exception: Optional[BaseException] = None
+        self._on_completion: Optional[Callable[[], None]] = None
+
+    @property
+    def is_pending(self) -> bool:
+        return self._thread is not None
+
+    def save(
+        self,
+        config: "Config",
+        model: nn.Module,
+        optimizer: optim.BaseOptimizer,
+        lr_scheduler: torch.optim.lr_scheduler.LRScheduler,
+        random_states: RandomStates,
+        training_metadata: TrainingMetadata,
+        root_folder: Path,
+        should_save_config: bool = True,
+        should_save_model: bool = True,
+        should_save_optimizer: bool = True,
+        should_save_lr_scheduler: bool = True,
+        sanity_checks: bool = True,
+        max_weights_shard_size: Optional[int] = None,
+        on_completion: Optional[Callable[[], None]] = None,
+    ) -> None:
+        # We only keep one checkpoint in flight, so that the pinned buffers can be reused
+        self.wait_for_completion()
+
+        if sanity_checks:
+            check_checkpoint_states_in_sync(model=model, optimizer=optimizer, parallel_context=self.parallel_context)
+
+        # Small files are written right away
+        if should_save_config:
+            config.save_as_yaml(root_folder / "config.yaml")
+        save_meta(root_folder=root_folder, parallel_context=self.parallel_context, training_metadata=training_metadata)
+
+        # Snapshot the states
+        model_state_dict = None
+        if should_save_model:
+            # The parameters sharded across DP (ZeRO-3) are gathered block by block
+            model_state_dict = {
+                name: self._snapshot(tensor, key=f"model.{name}") for name, tensor in iter_unsharded_state_dict(model)
+            }
+        elif is_fully_sharded(model):
+            # The other DP ranks still have to take part in gathering them
+            for _ in iter_unsharded_state_dict(model):
+                pass
+        optimizer_state_dict = (
+            self._snapshot(optimizer.state_dict(), key="optimizer") if should_save_optimizer else None
+        )
+        lr_scheduler_state_dict = None
+        if should_save_lr_scheduler:
+            lr_scheduler = cast(LambdaLR, lr_scheduler)
+            assert len(lr_scheduler.lr_lambdas) == len(
+                optimizer.param_groups
+            ), "The number of lambdas functions in the scheduler should be equal to the number of parameter groups in the optimizer."
+            lr_scheduler_state_dict = self._snapshot(lr_scheduler.state_dict(), key="lr_scheduler")
+        random_states = self._snapshot(random_states, key="random_states")
+        if torch.cuda.is_available():
+            # Wait for the device to host copies
+            torch.cuda.synchronize()
+
+        def write():
+            if model_state_dict is not None:
+                save_weights(
+                    model=model,
+                    parallel_context=self.parallel_context,
+                    root_folder=root_folder,
+                    state_dict=model_state_dict,
+                    max_shard_size=max_weights_shard_size,
+                )
+            if optimizer_state_dict is not None:
+                save_optimizer(
+                    optimizer=optimizer,
+                    parallel_context=self.parallel_context,
+                    root_folder=root_folder,
+                    state_dict=optimizer_state_dict,
+                )
+            if lr_scheduler_state_dict is not None:
+                save_lr_scheduler(
+                    lr_scheduler=lr_scheduler,
+                    is_zero=config.optimizer.zero_stage,
+                    parallel_context=self.parallel_context,
+                    root_folder=root_folder,
+                    state_dict=lr_scheduler_state_dict,
+                )
+            save_random_states(
+                random_states=random_states, parallel_context=self.parallel_context, root_folder=root_folder
+            )
+
+        def run():
+            try:
+                write()
+            except BaseException as e:
+                self._exception = e
+
+        self._on_completion = on_completion
+        self._thread = threading.Thread(target=run, name="nanotron-checkpoint-writer", daemon=True)
+        self._thread.start()
+
+    def poll(self) -> bool:
+        """Completes the pending checkpoint if all ranks have written it, without blocking
+        Returns whether there is no pending checkpoint anymore
+        """
+        if not self.is_pending:
+            return True
+
+        is_written = torch.tensor([not self._thread.is_alive()], dtype=torch.int, device="cuda")
+        dist.all_reduce(is_written, op=dist.ReduceOp.MIN, group=self.parallel_context.world_pg)
+        if is_written.item() == 0:
+            return False
+
+        self._complete()
+        return True
+
+    def wait_for_completion(self) -> None:
+        """Blocks until all ranks have written the pending checkpoint, then completes it"""
+        if not self.is_pending:
+            return
+        self._complete()
+
+    def _complete(self) -> None:
+        self._thread.join()
+        self._thread = None
+        exception, self._exception = self._exception, None
+        on_completion, self._on_completion = self._on_completion, None
+        if exception is not None:
+            log_rank(
+                f"Error while writing checkpoint: {exception}",
+                logger=logger,
+                level=logging.ERROR,
+                rank=0,
+            )
+            raise exception
+
+        dist.barrier(self.parallel_context.world_pg)
+        if on_completion is not None:
+            on_completion()
+
+    @torch.no_grad()
+    def _snapshot(self, obj: Any, key: str) -> Any:
+        """Copies `obj`, moving its tensors to pinned CPU buffers"""
+        if isinstance(obj, torch.Tensor):
+            buffer = self._pinned_buffers.get(key)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = torch.empty(obj.shape, dtype=obj.dtype, device="cpu", pin_memory=torch.cuda.is_available())
+                self._pinned_buffers[key] = buffer
+            buffer.copy_(obj, non_blocking=True)
+            return buffer
+        if isinstance(obj, dict):
+            return {k: self._snapshot(v, key=f"{key}.{k}") for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, key=f"{key}.{i}") for i, v in enumerate(obj))
+        if isinstance(obj, RandomStates):
+            return RandomStates({k: self._snapshot(v, key=f"{key}.{k}") for k, v in obj.items()})
+        return copy.deepcopy(obj)
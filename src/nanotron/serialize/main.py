@@ -14,6 +14,7 @@ from nanotron.config import Config
 from nanotron.distributed import get_global_rank
 from nanotron.logging import log_rank
 from nanotron.parallel import ParallelContext
+from nanotron.parallel.data_parallel.fully_sharded import get_param_id_to_shard, is_fully_sharded
 from nanotron.parallel.parameters import NanotronParameter
 from nanotron.s3_checkpoints import S3Mover, check_path_is_local, fs_open
 from nanotron.sanity_checks import (
@@ -59,6 +60,7 @@ def save(
     should_save_optimizer: bool = True,
     should_save_lr_scheduler: bool = True,
     sanity_checks: bool = True,
+    max_weights_shard_size: Optional[int] = None,
 ) -> None:
     assert isinstance(training_metadata, TrainingMetadata)
 
@@ -75,8 +77,14 @@ def save(
         )
         raise e
     try:
-        if should_save_model:
-            save_weights(model=model, parallel_context=parallel_context, root_folder=root_folder)
+        # With ZeRO-3, all the DP ranks take part in gathering the weights, only DP==0 writes them
+        if should_save_model or is_fully_sharded(model):
+            save_weights(
+                model=model,
+                parallel_context=parallel_context,
+                root_folder=root_folder,
+                max_shard_size=max_weights_shard_size,
+            )
     except Exception as e:
         log_rank(
             f"Error while saving weights checkpoint: {e}",
@@ -121,87 +129,101 @@ def save(
     save_meta(root_folder=root_folder, parallel_context=parallel_context, training_metadata=training_metadata)
 
     # TODO @thomas21: sanity check, not sure whether that needs to happen at testing or now (depends how much it costs)
+    if sanity_checks:
+        check_checkpoint_states_in_sync(model=model, optimizer=optimizer, parallel_context=parallel_context)
+
+    dist.barrier(parallel_context.world_pg)
+
+
+def check_checkpoint_states_in_sync(
+    model: nn.Module, optimizer: optim.BaseOptimizer, parallel_context: ParallelContext
+) -> None:
+    """Checks that the states we are about to save are synchronized across the ranks holding a copy of them"""
     ###
     # SANITY CHECK: Check that the model params are synchronized across `parallel_context.dp_pg`
-    if sanity_checks:
-        for name, param_or_buffer in sorted(model.state_dict().items(), key=lambda x: x[0]):
-            assert_tensor_synced_across_pg(
-                tensor=param_or_buffer,
-                pg=parallel_context.dp_pg,
-                msg=lambda err: f"{name} are not synced across DP {err}",
-            )
+    # With ZeRO-3, each DP rank only holds its own slices of the parameters
+    param_id_to_shard = get_param_id_to_shard(model)
+    dp_sharded_names = {name for name, param in model.named_parameters() if id(param) in param_id_to_shard}
+    for name, param_or_buffer in sorted(model.state_dict().items(), key=lambda x: x[0]):
+        if name in dp_sharded_names:
+            continue
+        assert_tensor_synced_across_pg(
+            tensor=param_or_buffer,
+            pg=parallel_context.dp_pg,
+            msg=lambda err: f"{name} are not synced across DP {err}",
+        )
+
+    # SANITY CHECK: Check that the tied parameters are synchronized
+    sorted_tied_parameters = sorted(
+        (
+            param
+            for parameters_group in optimizer.param_groups
+            for param in parameters_group["params"]
+            if param.requires_grad and isinstance(param, NanotronParameter) and param.is_tied
+        ),
+        key=lambda param: param.get_tied_info().name,
+    )
+    for tied_param in sorted_tied_parameters:
+        tied_info = tied_param.get_tied_info()
+        group_ranks = tied_info.global_ranks
+        group = parallel_context.world_ranks_to_pg[group_ranks]
 
-        # SANITY CHECK: Check that the tied parameters are synchronized
-        sorted_tied_parameters = sorted(
-            (
-                param
-                for parameters_group in optimizer.param_groups
-                for param in parameters_group["params"]
-                if param.requires_grad and isinstance(param, NanotronParameter) and param.is_tied
-            ),
-            key=lambda param: param.get_tied_info().name,
+        assert_tensor_synced_across_pg(
+            tensor=param_id_to_shard.get(id(tied_param), tied_param),
+            pg=group,
+            msg=lambda err: f"Tied {tied_info.name} are not synced {err}",
         )
-        for tied_param in sorted_tied_parameters:
-            tied_info = tied_param.get_tied_info()
-            group_ranks = tied_info.global_ranks
-            group = parallel_context.world_ranks_to_pg[group_ranks]
+    if not optimizer.inherit_from(optim.ZeroDistributedOptimizer):
+        check_optim_state_in_sync(optimizer.state_dict(), parallel_context.dp_pg)
 
-            assert_tensor_synced_across_pg(
-                tensor=tied_param, pg=group, msg=lambda err: f"Tied {tied_info.name} are not synced {err}"
-            )
-        if not optimizer.inherit_from(optim.ZeroDistributedOptimizer):
-            check_optim_state_in_sync(optimizer.state_dict(), parallel_context.dp_pg)
-
-        # SANITY CHECK: tied parameters have their optimizer states synchronized
-        # Compute a mapping from id_ to index in the optimizer sense
-        state_dict = optimizer.state_dict()
-        assert len(optimizer.param_groups) == len(state_dict["param_groups"])
-        index_to_param = {}
-        for real_param_group, index_param_group in zip(optimizer.param_groups, state_dict["param_groups"]):
-            indices = index_param_group["params"]
-            parameters = real_param_group["params"]
-            assert len(indices) == len(parameters)
-            for param, index in zip(parameters, indices):
-                assert index not in index_to_param
-                index_to_param[index] = param
-
-        current_state_dict = optimizer.state_dict()
-        for index, optim_state in sorted(current_state_dict["state"].items(), key=lambda x: x[0]):
-            param = index_to_param[index]
-            if not isinstance(param, NanotronParameter):
-                continue
-            if not param.is_tied:
-                # If it's not shared, we don't need to check it's synced
-                continue
-            tied_info = param.get_tied_info()
-            group_ranks = tied_info.global_ranks
-            group = parallel_context.world_ranks_to_pg[group_ranks]
-            reference_rank = 0
-            current_rank = dist.get_rank(group)
-
-            for name, tensor in optim_state.items():
-                # FIXME @thomasw21: Some data is actually on `cpu`, just for this test we most it to `cuda`
-                tensor = tensor.to("cuda")
-
-                if current_rank == reference_rank:
-                    reference_tensor = tensor
-                else:
-                    reference_tensor = torch.empty_like(tensor)
-                dist.broadcast(
-                    reference_tensor,
-                    src=get_global_rank(group=group, group_rank=reference_rank),
-                    group=group,
-                )
+    # SANITY CHECK: tied parameters have their optimizer states synchronized
+    # Compute a mapping from id_ to index in the optimizer sense
+    state_dict = optimizer.state_dict()
+    assert len(optimizer.param_groups) == len(state_dict["param_groups"])
+    index_to_param = {}
+    for real_param_group, index_param_group in zip(optimizer.param_groups, state_dict["param_groups"]):
+        indices = index_param_group["params"]
+        parameters = real_param_group["params"]
+        assert len(indices) == len(parameters)
+        for param, index in zip(parameters, indices):
+            assert index not in index_to_param
+            index_to_param[index] = param
 
-                torch.testing.assert_close(
-                    tensor,
-                    reference_tensor,
-                    atol=0,
-                    rtol=0,
-                    msg=lambda msg: f"tensor at {current_state_dict['names'][index]} doesn't match with our reference. Optimizer key: {name}\nCur: {tensor}\nRef: {reference_tensor}\n{msg}",
-                )
+    current_state_dict = optimizer.state_dict()
+    for index, optim_state in sorted(current_state_dict["state"].items(), key=lambda x: x[0]):
+        param = index_to_param[index]
+        if not isinstance(param, NanotronParameter):
+            continue
+        if not param.is_tied:
+            # If it's not shared, we don't need to check it's synced
+            continue
+        tied_info = param.get_tied_info()
+        group_ranks = tied_info.global_ranks
+        group = parallel_context.world_ranks_to_pg[group_ranks]
+        reference_rank = 0
+        current_rank = dist.get_rank(group)
 
-    dist.barrier(parallel_context.world_pg)
+        for name, tensor in optim_state.items():
+            # FIXME @thomasw21: Some data is actually on `cpu`, just for this test we most it to `cuda`
+            tensor = tensor.to("cuda")
+
+            if current_rank == reference_rank:
+                reference_tensor = tensor
+            else:
+                reference_tensor = torch.empty_like(tensor)
+            dist.broadcast(
+                reference_tensor,
+                src=get_global_rank(group=group, group_rank=reference_rank),
+                group=group,
+            )
+
+            torch.testing.assert_close(
+                tensor,
+                reference_tensor,
+                atol=0,
+                rtol=0,
+                msg=lambda msg: f"tensor at {current_state_dict['names'][index]} doesn't match with our reference. Optimizer key: {name}\nCur: {tensor}\nRef: {reference_tensor}\n{msg}",
+            )
 
 
 def parse_ckpt_path(config: Config, parallel_context: ParallelContext) -> Optional[Path]:
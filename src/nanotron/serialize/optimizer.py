@@ -42,10 +42,13 @@ def save_optimizer(
     optimizer: optim.BaseOptimizer,
     parallel_context: ParallelContext,
     root_folder: Path,
+    state_dict: Optional[Dict] = None,
 ):
     """Saves optimizer states
     - If Zero-0 is used, optimizer states are replicated across all DPs. Only DP-0 saves the states
     - If Zero-1 is used, optimizer states are sharded across all DPs. Each DP saves its own states
+
+    If `state_dict` is provided (eg. a CPU snapshot of `optimizer.state_dict()`), it's saved instead
     """
     if (not optimizer.inherit_from(optim.ZeroDistributedOptimizer)) and dist.get_rank(parallel_context.dp_pg) > 0:
         # this is Zero-0, so only DP-0 saves the optimizer states
@@ -100,7 +103,7 @@ def save_optimizer(
 
     # We dump the optimizer state using `torch.save`
     torch.save(
-        optimizer.state_dict(),
+        optimizer.state_dict() if state_dict is None else state_dict,
         root_folder
         / optimizer_filename(parallel_context, is_zero=optimizer.inherit_from(optim.ZeroDistributedOptimizer)),
     )
@@ -111,8 +114,9 @@ def save_lr_scheduler(
     is_zero,
     parallel_context: ParallelContext,
     root_folder: Path,
+    state_dict: Optional[Dict] = None,
 ):
-    """Saves lr scheduler states"""
+    """Saves lr scheduler states. If `state_dict` is provided, it's saved instead of `lr_scheduler.state_dict()`"""
     if not is_zero and dist.get_rank(parallel_context.dp_pg) > 0:
         # this is Zero-0, so only DP-0 saves the optimizer states
         return
@@ -122,7 +126,7 @@ def save_lr_scheduler(
 
     # We dump the optimizer state using `torch.save`
     torch.save(
-        lr_scheduler.state_dict(),
+        lr_scheduler.state_dict() if state_dict is None else state_dict,
         root_folder / lr_scheduler_filename(parallel_context, is_zero),
     )
 
@@ -13,6 +13,10 @@ def save_random_states(
     root_folder: Path,
 ):
     """All processes save their own random state"""
+    if dist.get_rank(parallel_context.cp_pg) > 0:
+        # The CP ranks of a model replica share their random states, only CP==0 saves them
+        return
+
     filename = (
         root_folder
         / "random"
@@ -1,7 +1,7 @@
 import re
 from enum import Enum
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Any, List, Optional, Tuple
 
 import torch
 
@@ -82,3 +82,70 @@ def merge_and_shard_tp_tensors(
         buffer[local_slices] = unsharded_buffer[global_slices]
 
     return buffer
+
+
+def has_unit_steps(slices_pairs: Tuple[SlicesPair, ...]) -> bool:
+    return all(
+        s.step in (None, 1)
+        for slices_pair in slices_pairs
+        for s in (*slices_pair.local_slices, *slices_pair.global_slices)
+    )
+
+
+def get_overlapping_slices(
+    source_slices_pair: SlicesPair,
+    source_shape: Tuple[int, ...],
+    target_slices_pair: SlicesPair,
+    target_shape: Tuple[int, ...],
+    unsharded_shape: Tuple[int, ...],
+) -> Optional[Tuple[Tuple[slice, ...], Tuple[slice, ...]]]:
+    """Intersects the global slices of two shards of the same unsharded tensor
+    Returns: the slices of the intersection in the source shard and in the target shard, None if they don't overlap
+    """
+    source_slices, target_slices = [], []
+    for dim, size in enumerate(unsharded_shape):
+        source_global_start, source_global_stop, _ = source_slices_pair.global_slices[dim].indices(size)
+        target_global_start, target_global_stop, _ = target_slices_pair.global_slices[dim].indices(size)
+        start = max(source_global_start, target_global_start)
+        stop = min(source_global_stop, target_global_stop)
+        if start >= stop:
+            return None
+
+        source_local_start, _, _ = source_slices_pair.local_slices[dim].indices(source_shape[dim])
+        target_local_start, _, _ = target_slices_pair.local_slices[dim].indices(target_shape[dim])
+        source_offset = source_local_start - source_global_start
+        target_offset = target_local_start - target_global_start
+        source_slices.append(slice(start + source_offset, stop + source_offset))
+        target_slices.append(slice(start + target_offset, stop + target_offset))
+
+    return tuple(source_slices), tuple(target_slices)
+
+
+def load_tp_shard_from_tp_shards(
+    buffer: torch.Tensor,
+    shards_and_slices_maps: List[Tuple[Any, Tuple[int, ...], Tuple[SlicesPair, ...]]],
+    unsharded_shape: Tuple[int, ...],
+    shard_metadata: TensorMetadata,
+) -> torch.Tensor:
+    """Same as `merge_and_shard_tp_tensors`, without materializing the unsharded tensor
+
+    Only the parts of the checkpoint shards that overlap the local shard are read. Shards are given with their shape
+    and can be anything that supports slicing, eg. a `safe_open(...).get_slice(...)`, which only reads these parts
+    from the memory-mapped file.
+    """
+    for shard, shard_shape, shard_slices_pairs in shards_and_slices_maps:
+        for shard_slices_pair in shard_slices_pairs:
+            for slices_pair in shard_metadata.local_global_slices_pairs:
+                overlapping_slices = get_overlapping_slices(
+                    source_slices_pair=shard_slices_pair,
+                    source_shape=shard_shape,
+                    target_slices_pair=slices_pair,
+                    target_shape=tuple(buffer.shape),
+                    unsharded_shape=unsharded_shape,
+                )
+                if overlapping_slices is None:
+                    continue
+                source_slices, target_slices = overlapping_slices
+                buffer[target_slices] = shard[source_slices]
+
+    return buffer
@@ -1,5 +1,11 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from functools import partial
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import dacite
 import torch
@@ -10,10 +16,16 @@ from tqdm import tqdm
 
 from nanotron import distributed as dist
 from nanotron import logging
-from nanotron.constants import CHECKPOINT_VERSION
+from nanotron.constants import CHECKPOINT_VERSION, CONSOLIDATED_WEIGHTS_INDEX_SUFFIX
 from nanotron.distributed import get_global_rank
 from nanotron.logging import log_rank
 from nanotron.parallel import ParallelContext
+from nanotron.parallel.data_parallel.fully_sharded import (
+    has_sharded_parameters,
+    is_fully_sharded,
+    iter_unsharded_state_dict,
+    iter_unsharded_state_dicts_per_block,
+)
 from nanotron.parallel.parameters import NanotronParameter, ShardedInfo, SlicesPair
 from nanotron.serialize.metadata import CheckpointMetadata, TensorMetadata, load_meta
 from nanotron.serialize.utils import (
@@ -21,18 +33,42 @@ from nanotron.serialize.utils import (
     extract_tp_pp_rank_from_shard_path,
     get_exp_tp_pp_rank_and_size_from,
     get_path,
+    has_unit_steps,
+    load_tp_shard_from_tp_shards,
     merge_and_shard_tp_tensors,
 )
 
 logger = logging.get_logger(__name__)
 
 
-def save_weights(model: nn.Module, parallel_context: ParallelContext, root_folder: Path):
+def save_weights(
+    model: nn.Module,
+    parallel_context: ParallelContext,
+    root_folder: Path,
+    state_dict: Optional[Dict[str, torch.Tensor]] = None,
+    max_shard_size: Optional[int] = None,
+):
+    """Saves the weights of `model`
+    If `state_dict` is provided (eg. a CPU snapshot of `model.state_dict()`), its tensors are saved instead
+    If `max_shard_size` is provided, the weights of each rank are packed in safetensors shards of at most
+    `max_shard_size` bytes (see `save_consolidated_weights`), instead of one file per parameter
+    """
+    if max_shard_size is not None:
+        return save_consolidated_weights(
+            model=model,
+            parallel_context=parallel_context,
+            root_folder=root_folder,
+            state_dict=state_dict,
+            max_shard_size=max_shard_size,
+        )
+
     root_folder = root_folder / "model"
 
     # We save only `dist.get_rank(parallel_context.dp_pg) == 0`
-    # TODO @thomasw21: Figure how this works with Zero-3
-    if dist.get_rank(parallel_context.dp_pg) != 0:
+    # With ZeRO-3, the other DP ranks still have to take part in gathering the parameters
+    gather_sharded_params = state_dict is None and is_fully_sharded(model)
+    is_saving_rank = dist.get_rank(parallel_context.dp_pg) == 0
+    if not is_saving_rank and not gather_sharded_params:
         return
 
     module_id_to_prefix = {id(module): f"{module_name}." for module_name, module in model.named_modules()}
@@ -40,7 +76,10 @@ def save_weights(model: nn.Module, parallel_context: ParallelContext, root_folde
     module_id_to_prefix[id(model)] = ""
 
     # We chunk everything by `tp_world_size` in order to make sure that we gather all the weights into a single device before saving it
-    for name, param_or_buffer in tqdm(model.state_dict().items(), desc="Saving weights"):
+    named_tensors = state_dict.items() if state_dict is not None else iter_unsharded_state_dict(model)
+    for name, param_or_buffer in tqdm(named_tensors, desc="Saving weights", disable=not is_saving_rank):
+        if not is_saving_rank:
+            continue
 
         # exp_rank=0 saves all weights whereas exp_rank>0 save only MLP weights
         if dist.get_rank(parallel_context.expert_pg) != 0:
@@ -109,6 +148,148 @@ def save_weights(model: nn.Module, parallel_context: ParallelContext, root_folde
             raise NotImplementedError("Parameters are required to be NanotronParameter")
 
 
+def get_consolidated_weights_prefix(parallel_context: ParallelContext) -> str:
+    """Prefix of the shards and index files written by the current rank in the consolidated format"""
+    (exp_rank, exp_size), (tp_rank, tp_size), (pp_rank, pp_size) = get_exp_tp_pp_rank_and_size_from(
+        world_rank=dist.get_rank(parallel_context.world_pg), parallel_context=parallel_context
+    )
+    return f"{ObjectType.MODEL.value}_pp-rank-{pp_rank}-of-{pp_size}_tp-rank-{tp_rank}-of-{tp_size}_exp-rank-{exp_rank}-of-{exp_size}"
+
+
+def is_consolidated_checkpoint(root_folder: Path) -> bool:
+    return any((root_folder / "model").glob(f"*{CONSOLIDATED_WEIGHTS_INDEX_SUFFIX}"))
+
+
+def save_consolidated_weights(
+    model: nn.Module,
+    parallel_context: ParallelContext,
+    root_folder: Path,
+    max_shard_size: int,
+    state_dict: Optional[Dict[str, torch.Tensor]] = None,
+):
+    """Saves the weights of the current rank in a few safetensors shards of at most `max_shard_size` bytes
+    (a tensor bigger than `max_shard_size` gets a shard of its own), along with a JSON index:
+    {
+        "version": checkpoint version,
+        "weight_map": {
+            parameter name: {
+                "shard": shard file name,
+                "exp_tp_pp_rank_and_size": ranks and sizes of the rank that saved it (None if it isn't sharded),
+                "metadata": `TensorMetadata` of the parameter (None if it isn't sharded),
+            }
+        }
+    }
+    Tensors are stored in the shards under their parameter name. The rank saving a parameter is the same as in the
+    one file per parameter layout.
+    """
+    root_folder = root_folder / "model"
+
+    # We save only `dist.get_rank(parallel_context.dp_pg) == 0`
+    # With ZeRO-3, the other DP ranks still have to take part in gathering the parameters
+    gather_sharded_params = state_dict is None and is_fully_sharded(model)
+    is_saving_rank = dist.get_rank(parallel_context.dp_pg) == 0
+    if not is_saving_rank and not gather_sharded_params:
+        return
+
+    module_id_to_prefix = {id(module): f"{module_name}." for module_name, module in model.named_modules()}
+    # Fix the root_model
+    module_id_to_prefix[id(model)] = ""
+
+    shards: List[Dict[str, torch.Tensor]] = [{}]
+    shard_sizes = [0]
+    weight_map: Dict[str, Dict[str, Any]] = {}
+    named_tensors = state_dict.items() if state_dict is not None else iter_unsharded_state_dict(model)
+    for name, param_or_buffer in named_tensors:
+        if not is_saving_rank:
+            continue
+
+        # exp_rank=0 saves all weights whereas exp_rank>0 save only MLP weights
+        if dist.get_rank(parallel_context.expert_pg) != 0:
+            if "experts" not in name:
+                continue
+
+        # `state_dict` doesn't return a Param or a buffer, just a tensors which loses some metadata
+        try:
+            param = model.get_parameter(name)
+        except AttributeError:
+            # TODO @nouamanetazi: Handle buffers
+            param = None
+
+        if not isinstance(param, NanotronParameter):
+            raise NotImplementedError("Parameters are required to be NanotronParameter")
+
+        if param.is_tied:
+            tied_info = param.get_tied_info()
+            base_name = tied_info.get_full_name_from_module_id_to_prefix(module_id_to_prefix=module_id_to_prefix)
+            group = parallel_context.world_ranks_to_pg[tied_info.global_ranks]
+            # Only the first rank of the group of the tied weights saves weights
+            if dist.get_rank(group) != 0:
+                continue
+        else:
+            base_name = name
+
+        if base_name in weight_map:
+            # Tied parameters appear several times in the `state_dict`
+            continue
+
+        if param.is_sharded:
+            sharded_info: ShardedInfo = param.get_sharded_info()
+            group = parallel_context.world_ranks_to_pg[sharded_info.global_ranks]
+            exp_tp_pp_rank_and_size = get_exp_tp_pp_rank_and_size_from(
+                world_rank=get_global_rank(group=group, group_rank=dist.get_rank(group)),
+                parallel_context=parallel_context,
+            )
+            metadata = TensorMetadata(
+                version=CHECKPOINT_VERSION,
+                local_global_slices_pairs=sharded_info.local_global_slices_pairs,
+                unsharded_shape=sharded_info.unsharded_shape,
+            ).to_str_dict()
+        else:
+            exp_tp_pp_rank_and_size = None
+            metadata = None
+
+        tensor_size = param_or_buffer.numel() * param_or_buffer.element_size()
+        if shard_sizes[-1] > 0 and shard_sizes[-1] + tensor_size > max_shard_size:
+            shards.append({})
+            shard_sizes.append(0)
+        # Gathered parameters are released once their block is resharded, we keep a copy until the shards are written
+        shards[-1][base_name] = param_or_buffer.clone() if gather_sharded_params else param_or_buffer.contiguous()
+        shard_sizes[-1] += tensor_size
+        weight_map[base_name] = {
+            "shard": len(shards) - 1,
+            "exp_tp_pp_rank_and_size": exp_tp_pp_rank_and_size,
+            "metadata": metadata,
+        }
+
+    if len(weight_map) == 0:
+        return
+
+    prefix = get_consolidated_weights_prefix(parallel_context)
+    shard_file_names = [
+        f"{prefix}_shard-{shard_idx + 1:05d}-of-{len(shards):05d}.safetensors" for shard_idx in range(len(shards))
+    ]
+    for entry in weight_map.values():
+        entry["shard"] = shard_file_names[entry["shard"]]
+
+    root_folder.mkdir(exist_ok=True, parents=True)
+    for shard, shard_file_name in zip(shards, shard_file_names):
+        try:
+            save_file(
+                tensors=shard, filename=root_folder / shard_file_name, metadata={"version": str(CHECKPOINT_VERSION)}
+            )
+        except Exception as e:
+            log_rank(
+                f"Error saving {root_folder / shard_file_name}",
+                logger=logger,
+                level=logging.ERROR,
+                rank=0,
+            )
+            raise e
+
+    with open(root_folder / f"{prefix}{CONSOLIDATED_WEIGHTS_INDEX_SUFFIX}", mode="w") as fo:
+        json.dump({"version": str(CHECKPOINT_VERSION), "weight_map": weight_map}, fo, indent=2, sort_keys=True)
+
+
 class CheckpointVersionFromShardFileException(Exception):
     """Raise when loading checkpoint version from shard file fails"""
 
@@ -124,6 +305,11 @@ def read_checkpoint_version_from_shard_file(param_save_path: Path) -> Version:
     return checkpoint_version
 
 
+def read_checkpoint_version_from_index_file(index_path: Path) -> Version:
+    with open(index_path, mode="r") as fi:
+        return Version(json.load(fi)["version"])
+
+
 def read_checkpoint_version_from_meta(parallel_context: ParallelContext, root_folder: Path) -> Version:
     checkpoint_metadata: CheckpointMetadata = load_meta(parallel_context=parallel_context, root_folder=root_folder)
     checkpoint_version = checkpoint_metadata.version
@@ -131,6 +317,8 @@ def read_checkpoint_version_from_meta(parallel_context: ParallelContext, root_fo
 
 
 def get_checkpoint_version(parallel_context, root_folder, param_save_path: Path) -> Version:
+    if param_save_path.name.endswith(CONSOLIDATED_WEIGHTS_INDEX_SUFFIX):
+        return read_checkpoint_version_from_index_file(index_path=param_save_path)
     try:
         checkpoint_version = read_checkpoint_version_from_shard_file(param_save_path=param_save_path)
     except CheckpointVersionFromShardFileException:
@@ -146,6 +334,37 @@ def get_checkpoint_version(parallel_context, root_folder, param_save_path: Path)
     return checkpoint_version
 
 
+def load_tp_shard(
+    buffer: torch.Tensor,
+    shards_and_slices_maps: List[Tuple[Any, Tuple[int, ...], Tuple[SlicesPair, ...]]],
+    unsharded_shape: Tuple[int, ...],
+    sharded_info: ShardedInfo,
+):
+    """Loads the local shard of a parameter from the checkpoint shards of another TP topology"""
+    if has_unit_steps(sharded_info.local_global_slices_pairs) and all(
+        has_unit_steps(slices_pairs) for _, _, slices_pairs in shards_and_slices_maps
+    ):
+        load_tp_shard_from_tp_shards(
+            buffer=buffer,
+            shards_and_slices_maps=shards_and_slices_maps,
+            unsharded_shape=unsharded_shape,
+            shard_metadata=sharded_info,
+        )
+        return
+
+    # Strided slices can't be intersected, we materialize the unsharded tensor
+    unsharded_tensor = torch.empty(unsharded_shape, dtype=buffer.dtype, device=buffer.device)
+    merge_and_shard_tp_tensors(
+        buffer=buffer,
+        unsharded_buffer=unsharded_tensor,
+        shards_and_slices_maps=[
+            (shard[tuple(slice(None) for _ in shard_shape)], slices_pairs)
+            for shard, shard_shape, slices_pairs in shards_and_slices_maps
+        ],
+        shard_metadata=sharded_info,
+    )
+
+
 def load_sharded_param_latest(
     param_or_buffer: torch.Tensor,
     sharded_info: ShardedInfo,
@@ -153,14 +372,16 @@ def load_sharded_param_latest(
     param_shard_metadata: Optional[Dict] = None,
 ):
     checkpoint_unsharded_shape = None
-    shards_and_slices_maps: List[Tuple[torch.Tensor, Tuple[SlicesPair, ...]]] = []
+    shards_and_slices_maps: List[Tuple[Any, Tuple[int, ...], Tuple[SlicesPair, ...]]] = []
 
-    for shard_path in shards_path:
-        with safe_open(shard_path, framework="pt", device=str(param_or_buffer.device)) as fi:
-            # TODO @thomasw21: Choose only a slice if we switch the TP topology
+    with ExitStack() as stack:
+        for shard_path in shards_path:
+            fi = stack.enter_context(safe_open(shard_path, framework="pt", device=str(param_or_buffer.device)))
             param_metadata = fi.metadata()
             param_metadata = TensorMetadata.from_str_dict(param_metadata)
-            shards_and_slices_maps.append((fi.get_tensor("data"), param_metadata.local_global_slices_pairs))
+            # Memory-mapped slice, only the parts overlapping the local shard are read from the file
+            shard = fi.get_slice("data")
+            shards_and_slices_maps.append((shard, tuple(shard.get_shape()), param_metadata.local_global_slices_pairs))
 
             if checkpoint_unsharded_shape is None:
                 checkpoint_unsharded_shape = param_metadata.unsharded_shape
@@ -173,25 +394,71 @@ def load_sharded_param_latest(
                 pp_rank, tp_rank = extract_tp_pp_rank_from_shard_path(shard_path)
                 param_shard_metadata[(pp_rank, tp_rank)] = param_metadata
 
-    assert checkpoint_unsharded_shape is not None
-    # TODO @thomasw21: Interestingly enough we don't actually need to instantiate the entire model at all.
-    unsharded_tensor = torch.empty(checkpoint_unsharded_shape, device=param_or_buffer.device)
-
-    merge_and_shard_tp_tensors(
-        buffer=param_or_buffer,
-        unsharded_buffer=unsharded_tensor,
-        shards_and_slices_maps=shards_and_slices_maps,
-        shard_metadata=sharded_info,
-    )
+        assert checkpoint_unsharded_shape is not None
+        load_tp_shard(
+            buffer=param_or_buffer,
+            shards_and_slices_maps=shards_and_slices_maps,
+            unsharded_shape=checkpoint_unsharded_shape,
+            sharded_info=sharded_info,
+        )
 
     return param_shard_metadata
 
 
+def load_param(param_or_buffer: torch.Tensor, path: Path):
+    with safe_open(path, framework="pt", device=str(param_or_buffer.device)) as fi:
+        param_or_buffer[:] = fi.get_tensor("data")
+
+
+def run_load_tasks(
+    load_tasks: List[Callable[[], Any]],
+    parallel_context: ParallelContext,
+    root_folder: Path,
+    planning_time: float,
+    num_workers: int = 1,
+):
+    """Runs the tasks reading the checkpoint files on a pool of `num_workers` threads, and logs the time spent
+    planning (resolving the files to read) and reading them
+    """
+    start_time = time.perf_counter()
+    progress_bar = tqdm(
+        total=len(load_tasks), disable=dist.get_rank(parallel_context.world_pg) != 0, desc="Loading weights"
+    )
+    if num_workers <= 1:
+        for load_task in load_tasks:
+            load_task()
+            progress_bar.update()
+    else:
+        # The files are memory-mapped, reads release the GIL
+        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="nanotron-weights-loader") as executor:
+            futures = [executor.submit(load_task) for load_task in load_tasks]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    progress_bar.update()
+            except BaseException:
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+    progress_bar.close()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    reading_time = time.perf_counter() - start_time
+
+    log_rank(
+        f"Loaded {len(load_tasks)} tensors from {root_folder} in {planning_time + reading_time:.2f}s"
+        f" (planning: {planning_time:.2f}s, reading: {reading_time:.2f}s, {max(num_workers, 1)} workers)",
+        logger=logger,
+        level=logging.INFO,
+        rank=0,
+    )
+
+
 def load_weights(
     model: nn.Module,
     parallel_context: ParallelContext,
     root_folder: Path,
     filtered_state_dict: Optional[Dict[str, Any]] = None,
+    num_workers: int = 1,
 ):
     """Load weights from a checkpoint
 
@@ -200,7 +467,35 @@ def load_weights(
         parallel_context: distributed process groups
         root_folder: root folder of the checkpoint
         filtered_state_dict: state dict to load from (overrides model.state_dict()). if None, load from model.state_dict()
+        num_workers: number of threads reading the checkpoint files
     """
+    if has_sharded_parameters(model, state_dict=filtered_state_dict):
+        # With ZeRO-3, the parameters are loaded unsharded one block at a time, and each DP rank keeps its own slices
+        param_shard_metadata = {}
+        for block_state_dict in iter_unsharded_state_dicts_per_block(
+            model, state_dict=filtered_state_dict if filtered_state_dict is not None else model.state_dict()
+        ):
+            param_shard_metadata.update(
+                load_weights(
+                    model=model,
+                    parallel_context=parallel_context,
+                    root_folder=root_folder,
+                    filtered_state_dict=block_state_dict,
+                    num_workers=num_workers,
+                )
+            )
+        return param_shard_metadata
+
+    if is_consolidated_checkpoint(root_folder):
+        return load_consolidated_weights(
+            model=model,
+            parallel_context=parallel_context,
+            root_folder=root_folder,
+            filtered_state_dict=filtered_state_dict,
+            num_workers=num_workers,
+        )
+
+    start_time = time.perf_counter()
     param_root_folder = root_folder / "model"
 
     module_id_to_prefix = {id(module): f"{module_name}." for module_name, module in model.named_modules()}
@@ -211,9 +506,9 @@ def load_weights(
 
     filtered_state_dict = filtered_state_dict if filtered_state_dict is not None else model.state_dict()
     param_shard_metadata = {}
-    for name, param_or_buffer in tqdm(
-        filtered_state_dict.items(), disable=dist.get_rank(parallel_context.world_pg) != 0, desc="Loading weights"
-    ):
+    # We first resolve the files of each parameter, then read them all in parallel
+    load_tasks: List[Callable[[], Any]] = []
+    for name, param_or_buffer in filtered_state_dict.items():
         # NOTE: extract how does the current model parameter are sharded
         # so that we can load optimizer checkpoints in this way
         param_shard_metadata[name] = {}
@@ -259,9 +554,7 @@ def load_weights(
             )
 
             if path.exists():
-                with safe_open(path, framework="pt", device=str(param.device)) as fi:
-                    # TODO @thomasw21: Choose only a slice if we switch the TP topology
-                    param_or_buffer[:] = fi.get_tensor("data")
+                load_tasks.append(partial(load_param, param_or_buffer=param_or_buffer, path=path))
 
             elif not path.parent.exists():
                 raise ValueError(
@@ -305,11 +598,14 @@ def load_weights(
                         ), f"Checkpoint version mismatch at {shards_path[0]}."
 
                 if checkpoint_version <= CHECKPOINT_VERSION:
-                    load_sharded_param_latest(
-                        param_or_buffer=param_or_buffer,
-                        sharded_info=sharded_info,
-                        shards_path=shards_path,
-                        param_shard_metadata=param_shard_metadata[name],
+                    load_tasks.append(
+                        partial(
+                            load_sharded_param_latest,
+                            param_or_buffer=param_or_buffer,
+                            sharded_info=sharded_info,
+                            shards_path=shards_path,
+                            param_shard_metadata=param_shard_metadata[name],
+                        )
                     )
                 else:
                     raise ValueError(f"Unsupported checkpoint version {checkpoint_version}")
@@ -317,6 +613,205 @@ def load_weights(
         else:
             raise NotImplementedError(f"Parameters {param} should be a NanotronParameter")
 
+    run_load_tasks(
+        load_tasks=load_tasks,
+        parallel_context=parallel_context,
+        root_folder=root_folder,
+        planning_time=time.perf_counter() - start_time,
+        num_workers=num_workers,
+    )
+
+    return param_shard_metadata
+
+
+def load_consolidated_weights_index(parallel_context: ParallelContext, root_folder: Path) -> Dict[str, List[Dict]]:
+    """Merges the indexes of all the ranks of a consolidated checkpoint
+    Returns: parameter name -> index entries of the ranks that saved it
+    """
+    weight_map: Dict[str, List[Dict]] = {}
+    index_paths = sorted((root_folder / "model").glob(f"*{CONSOLIDATED_WEIGHTS_INDEX_SUFFIX}"))
+    for index_path in index_paths:
+        checkpoint_version = get_checkpoint_version(parallel_context, root_folder, param_save_path=index_path)
+        if checkpoint_version > CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version {checkpoint_version}")
+        with open(index_path, mode="r") as fi:
+            for name, entry in json.load(fi)["weight_map"].items():
+                weight_map.setdefault(name, []).append(entry)
+    return weight_map
+
+
+def load_consolidated_weights(
+    model: nn.Module,
+    parallel_context: ParallelContext,
+    root_folder: Path,
+    filtered_state_dict: Optional[Dict[str, Any]] = None,
+    num_workers: int = 1,
+):
+    """Load weights from a checkpoint saved with `save_consolidated_weights`
+    Same arguments and outputs as `load_weights`
+    """
+    if has_sharded_parameters(model, state_dict=filtered_state_dict):
+        param_shard_metadata = {}
+        for block_state_dict in iter_unsharded_state_dicts_per_block(
+            model, state_dict=filtered_state_dict if filtered_state_dict is not None else model.state_dict()
+        ):
+            param_shard_metadata.update(
+                load_consolidated_weights(
+                    model=model,
+                    parallel_context=parallel_context,
+                    root_folder=root_folder,
+                    filtered_state_dict=block_state_dict,
+                    num_workers=num_workers,
+                )
+            )
+        return param_shard_metadata
+
+    start_time = time.perf_counter()
+    param_root_folder = root_folder / "model"
+    weight_map = load_consolidated_weights_index(parallel_context=parallel_context, root_folder=root_folder)
+
+    module_id_to_prefix = {id(module): f"{module_name}." for module_name, module in model.named_modules()}
+    # Fix the root_model
+    module_id_to_prefix[id(model)] = ""
+
+    filtered_state_dict = filtered_state_dict if filtered_state_dict is not None else model.state_dict()
+    param_shard_metadata = {}
+    with ExitStack() as stack:
+        # The shards are memory-mapped, and opened only once per loading thread
+        opened_shards_lock = threading.Lock()
+        thread_local = threading.local()
+
+        def get_shard(shard_file_name: str, device: torch.device):
+            opened_shards = thread_local.__dict__.setdefault("opened_shards", {})
+            key = (shard_file_name, str(device))
+            if key not in opened_shards:
+                with opened_shards_lock:
+                    opened_shards[key] = stack.enter_context(
+                        safe_open(param_root_folder / shard_file_name, framework="pt", device=str(device))
+                    )
+            return opened_shards[key]
+
+        def load_param_from_shard(param_or_buffer: torch.Tensor, shard_file_name: str, name: str):
+            param_or_buffer[:] = get_shard(shard_file_name, param_or_buffer.device).get_tensor(name)
+
+        def load_sharded_param_from_shards(
+            param_or_buffer: torch.Tensor,
+            name: str,
+            entries: List[Dict],
+            unsharded_shape: Tuple[int, ...],
+            sharded_info: ShardedInfo,
+        ):
+            shards_and_slices_maps = []
+            for entry in entries:
+                # Memory-mapped slice, only the parts overlapping the local shard are read from the file
+                shard = get_shard(entry["shard"], param_or_buffer.device).get_slice(name)
+                local_global_slices_pairs = TensorMetadata.from_str_dict(entry["metadata"]).local_global_slices_pairs
+                shards_and_slices_maps.append((shard, tuple(shard.get_shape()), local_global_slices_pairs))
+            load_tp_shard(
+                buffer=param_or_buffer,
+                shards_and_slices_maps=shards_and_slices_maps,
+                unsharded_shape=unsharded_shape,
+                sharded_info=sharded_info,
+            )
+
+        # We first resolve the shards of each parameter, then read them all in parallel
+        load_tasks: List[Callable[[], Any]] = []
+        for name, param_or_buffer in filtered_state_dict.items():
+            # NOTE: extract how does the current model parameter are sharded
+            # so that we can load optimizer checkpoints in this way
+            param_shard_metadata[name] = {}
+            # `state_dict` doesn't return a Param or a buffer, just a tensors which loses some metadata
+            try:
+                param = model.get_parameter(name)
+            except AttributeError:
+                param = None
+
+            if not isinstance(param, NanotronParameter):
+                raise NotImplementedError(f"Parameters {param} should be a NanotronParameter")
+
+            if param.is_tied:
+                tied_info = param.get_tied_info()
+                base_name = tied_info.get_full_name_from_module_id_to_prefix(module_id_to_prefix=module_id_to_prefix)
+            else:
+                base_name = name
+
+            if param.is_sharded:
+                sharded_info = param.get_sharded_info()
+
+                if param.is_tied:
+                    # When params are tied only the first rank of tied param group stores weights (see save_weights)
+                    group = parallel_context.world_ranks_to_pg[tied_info.global_ranks]
+                    group_rank = 0
+                else:
+                    group = parallel_context.world_ranks_to_pg[sharded_info.global_ranks]
+                    group_rank = dist.get_rank(group)
+
+                exp_tp_pp_rank_and_size = get_exp_tp_pp_rank_and_size_from(
+                    world_rank=get_global_rank(group=group, group_rank=group_rank), parallel_context=parallel_context
+                )
+                # JSON stores tuples as lists
+                exp_tp_pp_rank_and_size = [list(rank_and_size) for rank_and_size in exp_tp_pp_rank_and_size]
+            else:
+                exp_tp_pp_rank_and_size = None
+
+            if base_name not in weight_map:
+                raise ValueError(
+                    f"Checkpoint is empty or checkpoint structure is not matching the model architecture."
+                    f"Couldn't find {base_name} in the consolidated checkpoint at {root_folder}"
+                )
+            entries = weight_map[base_name]
+
+            entry = next((e for e in entries if e["exp_tp_pp_rank_and_size"] == exp_tp_pp_rank_and_size), None)
+            if entry is not None:
+                load_tasks.append(
+                    partial(
+                        load_param_from_shard,
+                        param_or_buffer=param_or_buffer,
+                        shard_file_name=entry["shard"],
+                        name=base_name,
+                    )
+                )
+                continue
+
+            # Let's assume that the topology changed and the param is sharded.
+            # We read the parts of the shards that overlap the specific shard we're interested in
+            if not param.is_sharded:
+                raise ValueError(
+                    f"`{name}` is not a sharded parameter. It's possible you were expecting it to be saved unsharded."
+                )
+
+            checkpoint_unsharded_shape = None
+            for entry in entries:
+                param_metadata = TensorMetadata.from_str_dict(entry["metadata"])
+                if checkpoint_unsharded_shape is None:
+                    checkpoint_unsharded_shape = param_metadata.unsharded_shape
+                else:
+                    assert checkpoint_unsharded_shape == param_metadata.unsharded_shape
+
+                # NOTE: store how does model parameter are sharded
+                # so that we can shard optimizer checkpoints in this way
+                _, (tp_rank, _), (pp_rank, _) = entry["exp_tp_pp_rank_and_size"]
+                param_shard_metadata[name][(str(pp_rank), str(tp_rank))] = param_metadata
+
+            load_tasks.append(
+                partial(
+                    load_sharded_param_from_shards,
+                    param_or_buffer=param_or_buffer,
+                    name=base_name,
+                    entries=entries,
+                    unsharded_shape=checkpoint_unsharded_shape,
+                    sharded_info=sharded_info,
+                )
+            )
+
+        run_load_tasks(
+            load_tasks=load_tasks,
+            parallel_context=parallel_context,
+            root_folder=root_folder,
+            planning_time=time.perf_counter() - start_time,
+            num_workers=num_workers,
+        )
+
     return param_shard_metadata
 
 
@@ -33,10 +33,11 @@ from nanotron.config import (
     ParallelismArgs,
     RandomInit,
     SpectralMupInit,
+    cast_pipeline_engine_to_str,
     get_config_from_file,
 )
 from nanotron.constants import MODEL_CONFIG_FILE_NAME
-from nanotron.dataloader import sanity_check_dataloader
+from nanotron.dataloader import prefetch_dataloader, sanity_check_dataloader
 from nanotron.helpers import (
     _vocab_size_with_padding,
     compute_remain_train_steps_of_a_data_stage_from_ckp,
@@ -60,13 +61,20 @@ from nanotron.models.base import check_model_has_grad
 from nanotron.models.llama import LlamaForTraining, RotaryEmbedding
 from nanotron.models.starcoder2 import Starcoder2ForTraining
 from nanotron.optim.clip_grads import clip_grad_norm
+from nanotron.optim.gradient_accumulator import ShardedFP32GradientAccumulator
 from nanotron.parallel import ParallelContext
+from nanotron.parallel.context_parallel.utils import sync_gradients_across_cp
+from nanotron.parallel.data_parallel.fully_sharded import FullyShardedParameters, get_param_id_to_shard
+from nanotron.parallel.data_parallel.grad_reducer import BucketedGradReducer
 from nanotron.parallel.data_parallel.utils import sync_gradients_across_dp
 from nanotron.parallel.parameters import NanotronParameter, sanity_check
 from nanotron.parallel.pipeline_parallel.engine import (
     PipelineEngine,
     TensorPointer,
+    ZeroBubblePipelineEngine,
 )
+from nanotron.parallel.pipeline_parallel.partition import StageMemoryBudget, get_bytes_per_param
+from nanotron.parallel.pipeline_parallel.schedule import PIPELINE_SCHEDULES, get_max_in_flight_microbatches
 from nanotron.parallel.pipeline_parallel.utils import get_pp_rank_of
 from nanotron.parallel.tensor_parallel.enum import TensorParallelLinearMode
 from nanotron.parallel.tensor_parallel.nn import TensorParallelRowLinear
@@ -93,6 +101,7 @@ from nanotron.serialize import (
     save,
     save_random_states,
 )
+from nanotron.serialize.async_checkpoint import AsyncCheckpointWriter
 from nanotron.serialize.metadata import DataStageMetadata, TrainingMetadata
 from nanotron.serialize.optimizer import load_optimizer, state_dict_to_device
 
@@ -149,6 +158,7 @@ class DistributedTrainer:
             pipeline_parallel_size=self.config.parallelism.pp,
             data_parallel_size=self.config.parallelism.dp,
             expert_parallel_size=self.config.parallelism.expert_parallel_size,
+            context_parallel_size=self.config.parallelism.cp,
         )
 
         self.pre_init()
@@ -189,6 +199,7 @@ class DistributedTrainer:
             model=self.model,
             optimizer_args=self.config.optimizer,
             parallel_context=self.parallel_context,
+            param_sharder=self.param_sharder,
         )
         if self.init_checkpoint_path is not None and self.config.checkpoints.load_optimizer:
             load_optimizer(
@@ -200,6 +211,21 @@ class DistributedTrainer:
                 map_location="cpu",
             )
 
+        # Reduce the gradients during the backward when DDP doesn't
+        self.grad_reducer: Optional[BucketedGradReducer] = None
+        if (
+            self.config.parallelism.dp_overlap_grad_reduce
+            and not isinstance(self.model, DistributedDataParallel)
+            and not isinstance(self.grad_accumulator, ShardedFP32GradientAccumulator)
+        ):
+            self.grad_reducer = BucketedGradReducer(
+                named_parameters=self.unwrapped_model.get_named_params_with_correct_tied(),
+                dp_pg=self.parallel_context.dp_pg,
+                world_ranks_to_pg=self.parallel_context.world_ranks_to_pg,
+                grad_accumulator=self.grad_accumulator,
+                bucket_cap_mb=self.config.model.ddp_bucket_cap_mb,
+            )
+
         # Init learning rate scheduler
         self.lr_scheduler = lr_scheduler_builder(
             optimizer=self.optimizer,
@@ -279,6 +305,11 @@ class DistributedTrainer:
         else:
             self.s3_mover = None
 
+        if self.config.checkpoints.async_save:
+            self.checkpoint_writer = AsyncCheckpointWriter(parallel_context=self.parallel_context)
+        else:
+            self.checkpoint_writer = None
+
     def pre_training(self, *args, **kwargs):
         self._print_training_plan()
 
@@ -300,12 +331,17 @@ class DistributedTrainer:
             )
 
     def post_train_step(self):
+        # Complete the checkpoint written in the background, if all ranks are done
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.poll()
 
         # Update our background upload/removal of checkpoints
         if self.s3_mover is not None:
             self.s3_mover.update()
 
     def post_training(self):
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.wait_for_completion()
         if self.s3_mover is not None:
             self.s3_mover.distributed_wait_for_completion(group=self.parallel_context.world_pg)
 
@@ -404,6 +440,10 @@ class DistributedTrainer:
                 dataloader = dataloaders[stage.name]
                 # NOTE: if a dataloader is lazy initialized, we need to call it to initialize it
                 dataloader = dataloader() if callable(dataloader) else dataloader
+                if stage.data.num_prefetch_micro_batches > 0:
+                    dataloader = prefetch_dataloader(
+                        dataloader, num_prefetch_micro_batches=stage.data.num_prefetch_micro_batches
+                    )
                 break
 
         if dataloader is not None:
@@ -497,6 +537,10 @@ class DistributedTrainer:
         if self.iteration_step < self.initial_iter_step + 5:
             log_memory(logger=logger)
 
+        if self.grad_reducer is not None:
+            # Most gradients are already reduced across DP and tied ranks during the last backwards
+            self.grad_reducer.wait()
+
         after_tbi_sanity_checks(self.config, self.parallel_context, self.unwrapped_model, self.grad_accumulator)
 
         if isinstance(self.model, DistributedDataParallel) and self.grad_accumulator is not None:
@@ -507,7 +551,7 @@ class DistributedTrainer:
             self.grad_accumulator.fp32_grads_allreduce_handle.wait()
 
         # Sync tied weights
-        if not isinstance(self.model, DistributedDataParallel):
+        if not isinstance(self.model, DistributedDataParallel) and self.grad_reducer is None:
             # Manually sync across DP if it's not handled by DDP
             sync_gradients_across_dp(
                 module=self.model,
@@ -518,11 +562,17 @@ class DistributedTrainer:
                 grad_accumulator=self.grad_accumulator,
             )
 
-        # TODO @nouamane: Put this in hooks so we can overlap communication with gradient computation on the last backward pass.
-        sync_tied_weights_gradients(
-            module=self.unwrapped_model,
-            parallel_context=self.parallel_context,
-            grad_accumulator=self.grad_accumulator,
+        if self.grad_reducer is None:
+            # See `BucketedGradReducer` to overlap it with the last backwards
+            sync_tied_weights_gradients(
+                module=self.unwrapped_model,
+                parallel_context=self.parallel_context,
+                grad_accumulator=self.grad_accumulator,
+            )
+
+        # Each CP rank only backpropagated the loss of its chunk of the sequences
+        sync_gradients_across_cp(
+            module=self.model, cp_pg=self.parallel_context.cp_pg, grad_accumulator=self.grad_accumulator
         )
 
         # Clip gradients
@@ -546,6 +596,9 @@ class DistributedTrainer:
             loss_avg = torch.stack(
                 [output["loss"] for output in outputs]
             ).sum()  # already divided by n_micro_batches_per_batch
+            if self.parallel_context.cp_pg.size() > 1:
+                # The loss of a CP rank only covers its chunk of the sequences
+                dist.all_reduce(loss_avg, group=self.parallel_context.cp_pg, op=dist.ReduceOp.AVG)
             # sync loss across DP
             handle = dist.all_reduce(loss_avg, group=self.parallel_context.dp_pg, async_op=True, op=dist.ReduceOp.AVG)
         else:
@@ -557,6 +610,7 @@ class DistributedTrainer:
             self.init_checkpoint_path is not None
             and self.config.checkpoints.load_optimizer
             and self.iteration_step == self.initial_iter_step
+            and not self.config.optimizer.cpu_offload
         ):
             state_dict_to_device(self.optimizer.state_dict(), "cuda")
 
@@ -606,6 +660,26 @@ class DistributedTrainer:
             global_batch_size=self.global_batch_size,
         )
 
+        if self.config.parallelism.pp_offload_activations:
+            # Only the offloading PP ranks have an offloader, and the logger ranks may not be one of them
+            activation_offloader = self.pipeline_engine.activation_offloader
+            if activation_offloader is None:
+                activation_offload_bytes = torch.zeros(2, dtype=torch.int64, device="cuda")
+            else:
+                activation_offload_bytes = torch.tensor(
+                    [activation_offloader.bytes_offloaded, activation_offloader.bytes_prefetched],
+                    dtype=torch.int64,
+                    device="cuda",
+                )
+            activation_offload_bytes_per_pp_rank = torch.empty(
+                (self.parallel_context.pp_pg.size(), 2), dtype=torch.int64, device="cuda"
+            )
+            dist.all_gather_into_tensor(
+                activation_offload_bytes_per_pp_rank, activation_offload_bytes, group=self.parallel_context.pp_pg
+            )
+        else:
+            activation_offload_bytes_per_pp_rank = None
+
         if dist.get_rank(self.parallel_context.world_pg) in self.logger_ranks:
             assert self.loggerwriter is not None, "loggerwriter should be defined on logger ranks"
 
@@ -633,6 +707,19 @@ class DistributedTrainer:
             if self.config.optimizer.clip_grad is not None:
                 log_entries.append(LogItem("grad_norm", self.grad_norm_unclipped.item(), "human_format"))  # , ".3f"))
 
+            if activation_offload_bytes_per_pp_rank is not None:
+                for pp_rank, (bytes_offloaded, bytes_prefetched) in enumerate(
+                    activation_offload_bytes_per_pp_rank.tolist()
+                ):
+                    if pp_rank not in self.config.parallelism.pp_offload_activations_ranks:
+                        continue
+                    log_entries.append(
+                        LogItem(f"activations_offloaded_bytes_pp_rank_{pp_rank}", bytes_offloaded, "human_format")
+                    )
+                    log_entries.append(
+                        LogItem(f"activations_prefetched_bytes_pp_rank_{pp_rank}", bytes_prefetched, "human_format")
+                    )
+
             # Log not too often the memory
             if self.iteration_step < 5 or (self.iteration_step - 1) % self.config.checkpoints.checkpoint_interval == 0:
                 total, used, free = shutil.disk_usage("/")
@@ -740,6 +827,7 @@ class DistributedTrainer:
                     model=unwrapped_model,
                     parallel_context=self.parallel_context,
                     root_folder=self.init_checkpoint_path,
+                    num_workers=self.config.checkpoints.load_weights_num_workers or 1,
                 )
             reloaded_from_checkpoint = True
         if not reloaded_from_checkpoint:
@@ -750,13 +838,18 @@ class DistributedTrainer:
                     model=unwrapped_model,
                     parallel_context=self.parallel_context,
                     root_folder=self.config.model.init_method.path,
+                    num_workers=self.config.checkpoints.load_weights_num_workers or 1,
                 )
             elif isinstance(self.config.model.init_method, (RandomInit, SpectralMupInit)):
                 unwrapped_model.init_model_randomly(config=self.config)
 
                 # Synchronize parameters so that the model is consistent
                 # sync all params across dp
+                param_id_to_shard = get_param_id_to_shard(unwrapped_model)
                 for _, param in sorted(model.named_parameters(), key=lambda x: x[0]):
+                    if id(param) in param_id_to_shard:
+                        # Each DP rank keeps its own slices of the parameters sharded across DP
+                        continue
                     dist.all_reduce(param, op=dist.ReduceOp.AVG, group=self.parallel_context.dp_pg)
 
                 # sync tied params across tied groups
@@ -768,12 +861,50 @@ class DistributedTrainer:
                     key=lambda x: x[0],
                 ):
                     group = self.parallel_context.world_ranks_to_pg[group_ranks]
-                    dist.all_reduce(param, op=dist.ReduceOp.AVG, group=group)
+                    # The tied ranks of a parameter sharded across DP keep the same slices of it
+                    dist.all_reduce(param_id_to_shard.get(id(param), param), op=dist.ReduceOp.AVG, group=group)
             else:
                 raise ValueError(f"Unsupported {self.config.model.init_method}")
 
         return model
 
+    def _get_stage_memory_budget(self) -> StageMemoryBudget:
+        """Memory budget of the PP ranks, to partition the model with `pp_partition="min_max"`"""
+        config = self.config
+        parallel_config = config.parallelism
+        pp_size = self.parallel_context.pp_pg.size()
+        nb_microbatches = config.tokens.batch_accumulation_per_replica
+        pp_engine = cast_pipeline_engine_to_str(parallel_config.pp_engine)
+        if pp_engine in PIPELINE_SCHEDULES:
+            nb_in_flight_microbatches = [
+                get_max_in_flight_microbatches(PIPELINE_SCHEDULES[pp_engine](pp_size, pp_rank, nb_microbatches))
+                for pp_rank in range(pp_size)
+            ]
+        else:
+            # Upper bound for the interleaved pipeline, each model chunk holds at most all the micro batches
+            nb_in_flight_microbatches = [nb_microbatches] * pp_size
+        if parallel_config.pp_offload_activations:
+            # Offloading ranks only keep the micro batch running its backward and the prefetched one on the GPU
+            for pp_rank in parallel_config.pp_offload_activations_ranks:
+                nb_in_flight_microbatches[pp_rank] = min(nb_in_flight_microbatches[pp_rank], 2)
+        return StageMemoryBudget(
+            max_memory=(
+                parallel_config.pp_max_memory_per_rank * 1024**3
+                if parallel_config.pp_max_memory_per_rank is not None
+                else None
+            ),
+            bytes_per_param=get_bytes_per_param(
+                dp=self.parallel_context.data_parallel_size,
+                zero_stage=config.optimizer.zero_stage,
+                cpu_offload=config.optimizer.cpu_offload,
+            ),
+            # With context parallelism, each rank only keeps the activations of its chunk of the sequences
+            nb_in_flight_tokens=[
+                nb * config.tokens.micro_batch_size * config.tokens.sequence_length // parallel_config.cp
+                for nb in nb_in_flight_microbatches
+            ],
+        )
+
     def _init_model(
         self,
         model_builder: Callable[[], NanotronModel],
@@ -783,8 +914,13 @@ class DistributedTrainer:
         parallel_context = self.parallel_context
 
         parallel_config = config.parallelism
-        make_ddp = parallel_context.data_parallel_size > 1 and not (
-            config.optimizer.accumulate_grad_in_fp32 and config.optimizer.zero_stage > 0
+        # DDP syncs the gradients in the last backward, which only covers one model chunk with an interleaved pipeline,
+        # and no weight gradients with a zero bubble pipeline
+        make_ddp = (
+            parallel_context.data_parallel_size > 1
+            and not (config.optimizer.accumulate_grad_in_fp32 and config.optimizer.zero_stage > 0)
+            and parallel_config.pp_engine.num_model_chunks == 1
+            and not isinstance(parallel_config.pp_engine, ZeroBubblePipelineEngine)
         )
 
         # Build model and set pp ranks
@@ -793,6 +929,11 @@ class DistributedTrainer:
             dtype=config.model.dtype,
             target_pp_ranks=target_pp_ranks,
             model_builder=model_builder,
+            num_model_chunks=parallel_config.pp_engine.num_model_chunks,
+            pp_partition=parallel_config.pp_partition,
+            memory_budget=self._get_stage_memory_budget() if parallel_config.pp_partition == "min_max" else None,
+            # With ZeRO-3, the parameters of each block are only allocated again once sharded
+            release_params=config.optimizer.zero_stage == 3,
         )
 
         # Initialize rotary embeddings
@@ -804,6 +945,15 @@ class DistributedTrainer:
         # Mark some parameters as tied
         self._mark_tied_parameters(model=model, parallel_context=parallel_context, parallel_config=parallel_config)
 
+        # Shard the parameters across DP before they're initialized or loaded
+        self.param_sharder: Optional[FullyShardedParameters] = None
+        if config.optimizer.zero_stage == 3:
+            self.param_sharder = FullyShardedParameters(
+                model=model,
+                named_parameters=list(model.get_named_params_with_correct_tied()),
+                dp_pg=parallel_context.dp_pg,
+            )
+
         # count number of parameters
         num_params = sum(p.numel() for p in model.parameters())
         size_params = sum(p.numel() * p.element_size() for p in model.parameters())
@@ -874,6 +1024,8 @@ class DistributedTrainer:
         return loggerwriter
 
     def pre_save_checkpoint(self) -> Path:
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.wait_for_completion()
         if self.s3_mover is not None:
             self.s3_mover.distributed_wait_for_completion(self.parallel_context.world_pg)
             if self.s3_mover.post_upload_callback_outputs is not None:
@@ -904,36 +1056,65 @@ class DistributedTrainer:
         self.config.general.step = self.metadata.last_train_step
         self.config.general.consumed_train_samples = self.metadata.consumed_train_samples
 
+        if hasattr(self.model_config, "to_json_file"):
+            self.model_config.to_json_file(checkpoint_path / MODEL_CONFIG_FILE_NAME)
+        else:
+            with open(checkpoint_path / MODEL_CONFIG_FILE_NAME, mode="w") as fo:
+                fo.write(json.dumps(asdict(self.model_config)))
+
+        iteration_step = self.iteration_step
+
+        def on_checkpoint_written():
+            with open(checkpoints_path / "latest.txt", mode="w") as fo:
+                fo.write(f"{iteration_step}")
+
+            self.post_save_checkpoint()
+
+        # The CP ranks of a model replica hold the same states, only CP==0 saves them
+        is_cp_zero = bool(dist.get_rank(self.parallel_context.cp_pg) == 0)
+        should_save_model = (
+            bool(dist.get_rank(self.parallel_context.dp_pg) == 0) and is_cp_zero
+        )  # We only save the weights on DP==0
+        should_save_config = bool(
+            dist.get_rank(self.parallel_context.world_pg) == 0
+        )  # We only save the config on world_rank==0
+        if self.checkpoint_writer is not None:
+            # `latest.txt` and the S3 upload wait for all the ranks to write the checkpoint
+            self.checkpoint_writer.save(
+                config=self.config,
+                model=self.unwrapped_model,
+                optimizer=self.optimizer,
+                lr_scheduler=self.lr_scheduler,
+                random_states=self.random_states,
+                training_metadata=self.metadata,
+                root_folder=checkpoint_path,
+                should_save_config=should_save_config,
+                should_save_model=should_save_model,
+                should_save_optimizer=is_cp_zero,
+                should_save_lr_scheduler=is_cp_zero,
+                max_weights_shard_size=self.config.checkpoints.max_weights_shard_size,
+                on_completion=on_checkpoint_written,
+            )
+            return checkpoint_path
+
         save(
             model=self.unwrapped_model,
             optimizer=self.optimizer,
             lr_scheduler=self.lr_scheduler,
-            should_save_model=bool(
-                dist.get_rank(self.parallel_context.dp_pg) == 0
-            ),  # We only save the weights on DP==0
-            should_save_optimizer=True,
-            should_save_lr_scheduler=True,
-            should_save_config=bool(
-                dist.get_rank(self.parallel_context.world_pg) == 0
-            ),  # We only save the config on world_rank==0
+            should_save_model=should_save_model,
+            should_save_optimizer=is_cp_zero,
+            should_save_lr_scheduler=is_cp_zero,
+            should_save_config=should_save_config,
             parallel_context=self.parallel_context,
             root_folder=checkpoint_path,
             training_metadata=self.metadata,
             config=self.config,
+            max_weights_shard_size=self.config.checkpoints.max_weights_shard_size,
         )
         save_random_states(
             random_states=self.random_states, parallel_context=self.parallel_context, root_folder=checkpoint_path
         )
-        with open(checkpoints_path / "latest.txt", mode="w") as fo:
-            fo.write(f"{self.iteration_step}")
-
-        if hasattr(self.model_config, "to_json_file"):
-            self.model_config.to_json_file(checkpoint_path / MODEL_CONFIG_FILE_NAME)
-        else:
-            with open(checkpoint_path / MODEL_CONFIG_FILE_NAME, mode="w") as fo:
-                fo.write(json.dumps(asdict(self.model_config)))
-
-        self.post_save_checkpoint()
+        on_checkpoint_written()
 
         return checkpoint_path
 
@@ -961,6 +1142,7 @@ def mark_tied_parameters(
                         pp_rank=get_pp_rank_of(target, module=model),
                         dp_rank=dist.get_rank(parallel_context.dp_pg),
                         tp_rank=dist.get_rank(parallel_context.tp_pg),
+                        cp_rank=dist.get_rank(parallel_context.cp_pg),
                     ),
                 ),
             )
@@ -1,5 +1,5 @@
 from math import ceil
-from typing import Union
+from typing import Optional, Union
 
 import torch
 from nanotron import distributed as dist
@@ -21,9 +21,13 @@ class DummyModel(nn.Module):
     def __init__(
         self,
         p2p: P2P,
+        num_layers: Optional[int] = None,
     ):
         super().__init__()
         self.p2p = p2p
+        # By default, one layer per PP rank
+        if num_layers is None:
+            num_layers = p2p.pg.size()
         self.mlp = nn.Sequential(
             *(
                 nn.ModuleDict(
@@ -37,14 +41,14 @@ class DummyModel(nn.Module):
                         ),
                         "activation": PipelineBlock(
                             p2p=p2p,
-                            module_builder=nn.Sigmoid if pp_rank < p2p.pg.size() - 1 else nn.Identity,
+                            module_builder=nn.Sigmoid if layer_idx < num_layers - 1 else nn.Identity,
                             module_kwargs={},
                             module_input_keys={"input"},
                             module_output_keys={"output"},
                         ),
                     }
                 )
-                for pp_rank in range(p2p.pg.size())
+                for layer_idx in range(num_layers)
             )
         )
 
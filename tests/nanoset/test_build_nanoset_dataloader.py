@@ -120,6 +120,10 @@ def _test_build_nanoset_dataloader(
 
         # Assert we have the same Nanoset in all ranks
         assert_nanoset_sync_across_all_ranks(train_dataset, parallel_context)
+        # Assert the cached Nanoset index is the same as the built one
+        uncached_train_dataset = Nanoset(**config, cache_index=False)
+        assert np.array_equal(train_dataset.dataset_index, uncached_train_dataset.dataset_index)
+        assert np.array_equal(train_dataset.dataset_sample_index, uncached_train_dataset.dataset_sample_index)
         dataset_sample_count = count_dataset_indexes(train_dataset.dataset_index, len(train_dataset.dataset_folders))
         for idx, ds_length in enumerate(train_dataset.dataset_lengths):
             # Assert Nanoset doesn't sample indexes greater than the datasets
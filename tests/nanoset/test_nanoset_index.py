@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from nanotron.data.nanoset import build_nanoset_index_helper, build_nanoset_index_quota_helper
+from nanotron.data.utils import normalize
+
+
+@pytest.mark.parametrize("n_datasets", [1, 2, 7, 64])
+@pytest.mark.parametrize("weights_type", ["uniform", "integer", "random"])
+def test_nanoset_index_quota_builder_follows_weights(n_datasets: int, weights_type: str):
+    rng = np.random.default_rng(n_datasets)
+    if weights_type == "uniform":
+        dataset_weights = normalize([1] * n_datasets)
+    elif weights_type == "integer":
+        # Integer weights produce exact ties between the remainders of the datasets
+        dataset_weights = normalize(rng.integers(1, 10, n_datasets).tolist())
+    else:
+        dataset_weights = normalize(rng.random(n_datasets).tolist())
+    dataset_sizes = rng.integers(1, 5000, n_datasets)
+    n_samples = int(dataset_sizes.sum())
+
+    dataset_index, dataset_sample_index = build_nanoset_index_helper(
+        n_samples=n_samples, weights=dataset_weights, dataset_sizes=dataset_sizes
+    )
+    quota_dataset_index, quota_dataset_sample_index = build_nanoset_index_quota_helper(
+        n_samples=n_samples, weights=dataset_weights, dataset_sizes=dataset_sizes
+    )
+
+    assert quota_dataset_index.dtype == dataset_index.dtype
+    assert quota_dataset_sample_index.dtype == dataset_sample_index.dtype
+    assert len(quota_dataset_index) == len(quota_dataset_sample_index) == n_samples
+
+    # Like the argmax builder, each dataset gets its share of the samples up to the rounding
+    dataset_counts = np.bincount(quota_dataset_index.astype(np.int64), minlength=n_datasets)
+    assert np.all(np.abs(dataset_counts - dataset_weights * n_samples) < 1)
+    assert np.all(np.abs(dataset_counts - np.bincount(dataset_index.astype(np.int64), minlength=n_datasets)) <= 1)
+
+    # The samples of each dataset are used in order, starting again from the first one once they are all used
+    for dataset in range(n_datasets):
+        np.testing.assert_array_equal(
+            quota_dataset_sample_index[quota_dataset_index == dataset],
+            np.arange(dataset_counts[dataset]) % dataset_sizes[dataset],
+        )
+
+
+@pytest.mark.parametrize("scale", [1 - 1e-3, 1 + 1e-9, 1 + 1e-3])
+def test_nanoset_index_quota_builder_normalizes_weights(scale: float):
+    # Weights not exactly summing to 1 still give exactly `n_samples` samples, with the shares of the normalized weights
+    rng = np.random.default_rng(0)
+    dataset_weights = normalize(rng.random(5).tolist())
+    dataset_sizes = rng.integers(1, 5000, 5)
+    n_samples = int(dataset_sizes.sum())
+
+    quota_dataset_index, quota_dataset_sample_index = build_nanoset_index_quota_helper(
+        n_samples=n_samples, weights=dataset_weights * scale, dataset_sizes=dataset_sizes
+    )
+
+    assert len(quota_dataset_index) == len(quota_dataset_sample_index) == n_samples
+    dataset_counts = np.bincount(quota_dataset_index.astype(np.int64), minlength=5)
+    assert dataset_counts.sum() == n_samples
+    assert np.all(np.abs(dataset_counts - dataset_weights * n_samples) < 1)
@@ -0,0 +1,25 @@
+import torch
+from nanotron.data.collator import get_document_position_ids
+from nanotron.models.llama import get_cu_seqlens_from_position_ids
+
+
+def test_get_document_position_ids():
+    eos_token_id = 0
+    input_ids = torch.tensor(
+        [
+            [5, 6, 0, 7, 8, 9, 0, 4],
+            [5, 6, 7, 8, 9, 4, 3, 2],
+            [0, 0, 5, 6, 0, 7, 8, 0],
+        ]
+    )
+
+    position_ids = get_document_position_ids(input_ids, eos_token_id)
+
+    assert position_ids.dtype == torch.int32
+    assert position_ids.tolist() == [
+        [0, 1, 2, 0, 1, 2, 3, 0],
+        [0, 1, 2, 3, 4, 5, 6, 7],
+        [0, 0, 0, 1, 2, 0, 1, 2],
+    ]
+    # Documents don't span across samples
+    assert get_cu_seqlens_from_position_ids(position_ids).tolist() == [0, 3, 7, 8, 16, 17, 18, 21, 24]
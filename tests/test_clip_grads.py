@@ -27,6 +27,8 @@ from nanotron.parallel.tied_parameters import (
 )
 from nanotron.parallel.utils import initial_sync
 from nanotron.sanity_checks import assert_tensor_synced_across_pg
+from nanotron.utils import find_free_port
+from torch import multiprocessing as mp
 from torch import nn
 
 
@@ -620,3 +622,56 @@ def _test_clip_grads_fp32_accumulator(
         )
 
     parallel_context.destroy()
+
+
+@pytest.mark.parametrize("norm_type", [math.inf, 1.0, 2.0])
+@rerun_if_address_is_in_use()
+def test_clip_grads_foreach_on_cpu(norm_type: float):
+    mp.spawn(_test_clip_grads_foreach_on_cpu, args=(norm_type, find_free_port()), nprocs=2)
+
+
+def _test_clip_grads_foreach_on_cpu(rank: int, norm_type: float, port: int):
+    dist.init_process_group(backend="gloo", init_method=f"tcp://localhost:{port}", rank=rank, world_size=2)
+    root_module = nn.Module()
+
+    def get_named_parameters():
+        generator = torch.Generator().manual_seed(rank)
+        named_parameters = []
+        for i, (shape, dtype) in enumerate([((3, 5), torch.float), ((7,), torch.bfloat16), ((2, 2), torch.float)]):
+            param = NanotronParameter(torch.empty(shape, dtype=dtype))
+            param.grad = torch.randn(shape, generator=generator).to(dtype)
+            named_parameters.append((f"param_{i}", param))
+        # Only the gradient of the first rank is part of the norm
+        named_parameters[-1][1].mark_as_tied(
+            name="param_2", global_ranks=(0, 1), reduce_op=dist.ReduceOp.SUM, root_module=root_module
+        )
+        return named_parameters
+
+    ref_named_parameters = get_named_parameters()
+    ref_total_norm = clip_grad_norm(
+        mp_pg=dist.group.WORLD,
+        named_parameters=ref_named_parameters,
+        max_norm=1.0,
+        grad_accumulator=None,
+        norm_type=norm_type,
+        foreach=False,
+    )
+    named_parameters = get_named_parameters()
+    total_norm = clip_grad_norm(
+        mp_pg=dist.group.WORLD,
+        named_parameters=named_parameters,
+        max_norm=1.0,
+        grad_accumulator=None,
+        norm_type=norm_type,
+        foreach=True,
+    )
+
+    torch.testing.assert_close(total_norm, ref_total_norm)
+    clip_coef = torch.clamp(1.0 / (ref_total_norm + 1.0e-6), max=1.0)
+    for (_, param), (_, ref_param), (_, unclipped_param) in zip(
+        named_parameters, ref_named_parameters, get_named_parameters()
+    ):
+        torch.testing.assert_close(param.grad, ref_param.grad)
+        torch.testing.assert_close(param.grad, unclipped_param.grad * clip_coef)
+
+    dist.destroy_process_group()
@@ -0,0 +1,51 @@
+import torch
+from nanotron.generation.continuous_batching import ContinuousBatchingStats, concat_stores, select_store_rows
+from nanotron.generation.generate_store import Store
+from nanotron.generation.paged_kv_cache import PagedKVCacheManager
+
+
+def prefill_store(kv_cache_manager: PagedKVCacheManager, seq_lens):
+    """Mimics the states stored by an embedding (module 0) and an attention layer (module 1) at prefill"""
+    store = Store(paged_kv_cache=kv_cache_manager)
+    store[0]["past_length"] = torch.tensor(seq_lens)
+    kv_cache = kv_cache_manager.get_layer_cache(
+        1, n_kv_heads=2, d_qk=8, d_v=8, dtype=torch.float, device=torch.device("cpu")
+    )
+    seq_ids = kv_cache.allocate_sequences(len(seq_lens))
+    kv_cache.append(seq_ids, torch.randn(sum(seq_lens), 2, 8), torch.randn(sum(seq_lens), 2, 8), num_tokens=seq_lens)
+    store[1]["seq_ids"] = seq_ids
+    store[1]["position_offsets"] = torch.tensor(seq_lens) - 1
+    return store
+
+
+def test_concat_and_select_store_rows():
+    kv_cache_manager = PagedKVCacheManager(num_blocks=16, block_size=4)
+    store = concat_stores(
+        prefill_store(kv_cache_manager, seq_lens=[3, 5]), prefill_store(kv_cache_manager, seq_lens=[9])
+    )
+    kv_cache = kv_cache_manager.layer_caches[1]
+    assert store[0]["past_length"].tolist() == [3, 5, 9]
+    assert store[1]["position_offsets"].tolist() == [2, 4, 8]
+    assert [kv_cache.seq_lens[seq_id] for seq_id in store[1]["seq_ids"]] == [3, 5, 9]
+    assert kv_cache.num_free_blocks == 16 - 1 - 2 - 3
+
+    # Evict the second sequence, its blocks are freed
+    select_store_rows(store, [1]).flush()
+    store = select_store_rows(store, [0, 2])
+    assert store[0]["past_length"].tolist() == [3, 9]
+    assert store[1]["position_offsets"].tolist() == [2, 8]
+    assert [kv_cache.seq_lens[seq_id] for seq_id in store[1]["seq_ids"]] == [3, 9]
+    assert kv_cache.num_free_blocks == 16 - 1 - 3
+
+    store.flush()
+    assert kv_cache.num_free_blocks == 16
+
+
+def test_continuous_batching_stats():
+    stats = ContinuousBatchingStats(
+        num_generated_tokens=30, elapsed_time=2.0, times_to_first_token=[0.1, 0.3], latencies=[1.0, 2.0]
+    )
+    assert stats.tokens_per_sec == 15.0
+    assert abs(stats.mean_time_to_first_token - 0.2) < 1e-9
+    assert stats.mean_latency == 1.5
+    assert ContinuousBatchingStats().tokens_per_sec == 0.0
@@ -6,9 +6,12 @@ from helpers.exception import assert_fail_except_rank_with
 from helpers.utils import available_gpus, init_distributed, rerun_if_address_is_in_use
 from nanotron import distributed as dist
 from nanotron.parallel import ParallelContext
+from nanotron.parallel.data_parallel.grad_reducer import BucketedGradReducer
 from nanotron.parallel.data_parallel.utils import ddp_trigger_sync_in_bwd
 from nanotron.parallel.parameters import NanotronParameter
 from nanotron.sanity_checks import assert_tensor_synced_across_pg
+from nanotron.utils import find_free_port
+from torch import multiprocessing as mp
 from torch import nn
 from torch.distributed import GradBucket
 
@@ -77,3 +80,72 @@ def _test_ddp_with_afab(parallel_context: ParallelContext, accumulation_steps: i
                 assert_tensor_synced_across_pg(grad_hook, parallel_context.dp_pg)
 
     parallel_context.destroy()
+
+
+@rerun_if_address_is_in_use()
+def test_bucketed_grad_reducer_on_cpu():
+    mp.spawn(_test_bucketed_grad_reducer_on_cpu, args=(find_free_port(),), nprocs=4)
+
+
+def _test_bucketed_grad_reducer_on_cpu(rank: int, port: int):
+    dist.init_process_group(backend="gloo", init_method=f"tcp://localhost:{port}", rank=rank, world_size=4)
+    # Ranks 0 and 1 (resp. 2 and 3) are DP replicas, ranks 0 and 2 (resp. 1 and 3) hold the two PP stages of a model
+    dp_pgs = [dist.new_group(ranks=[0, 1]), dist.new_group(ranks=[2, 3])]
+    world_ranks_to_pg = {(0, 2): dist.new_group(ranks=[0, 2]), (1, 3): dist.new_group(ranks=[1, 3])}
+    dp_pg = dp_pgs[rank // 2]
+    tied_ranks = (rank % 2, rank % 2 + 2)
+
+    def build_model():
+        model = nn.Sequential(*(nn.Linear(4, 4) for _ in range(3)))
+        with torch.no_grad():
+            for i, param in enumerate(model.parameters()):
+                param.copy_(torch.arange(param.numel()).view_as(param) / (i + 1))
+        for module in model:
+            module.weight = NanotronParameter(module.weight)
+            module.bias = NanotronParameter(module.bias)
+        # The first weight is used twice, and tied with the other PP stage
+        model[2].weight = model[0].weight
+        model[0].weight.mark_as_tied(
+            name="0.weight", global_ranks=tied_ranks, reduce_op=dist.ReduceOp.SUM, root_module=model
+        )
+        return model
+
+    def run_backwards(model: nn.Module, step: int):
+        generator = torch.Generator().manual_seed(10 * step + rank)
+        losses = [model(torch.randn(2, 4, generator=generator)).pow(2).sum() for _ in range(3)]
+        for loss in losses:
+            loss.backward()
+
+    model = build_model()
+    ref_model = build_model()
+    # A bucket per parameter
+    reducer = BucketedGradReducer(
+        named_parameters=model.named_parameters(),
+        dp_pg=dp_pg,
+        world_ranks_to_pg=world_ranks_to_pg,
+        grad_accumulator=None,
+        bucket_cap_mb=0,
+    )
+    assert len(reducer.dp_buckets) == 4
+    assert len(reducer.tied_buckets) == 1
+
+    for step in range(3):
+        run_backwards(model, step=step)
+        # The first step only counts the gradients of each parameter
+        assert all(bucket.is_launched is (step > 0) for bucket in reducer.dp_buckets + reducer.tied_buckets)
+        assert not reducer.tied_dp_bucket.is_launched
+        reducer.wait()
+
+        run_backwards(ref_model, step=step)
+        for name, ref_param in ref_model.named_parameters():
+            dist.all_reduce(ref_param.grad, op=dist.ReduceOp.SUM, group=dp_pg)
+            ref_param.grad.div_(dp_pg.size())
+            if name == "0.weight":
+                dist.all_reduce(ref_param.grad, op=dist.ReduceOp.SUM, group=world_ranks_to_pg[tied_ranks])
+
+        for (name, param), ref_param in zip(model.named_parameters(), ref_model.parameters()):
+            torch.testing.assert_close(param.grad, ref_param.grad, msg=lambda msg: f"{name} at step {step}: {msg}")
+            param.grad = None
+            ref_param.grad = None
+
+    dist.destroy_process_group()
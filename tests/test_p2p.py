@@ -7,6 +7,8 @@ from helpers.utils import available_gpus, init_distributed, rerun_if_address_is_
 from nanotron import distributed as dist
 from nanotron.parallel import ParallelContext
 from nanotron.parallel.pipeline_parallel.p2p import P2P
+from nanotron.utils import find_free_port
+from torch import multiprocessing as mp
 
 
 @pytest.mark.skipif(available_gpus() < 2, reason="Testing test_ddp_with_afab requires at least 2 gpus")
@@ -79,3 +81,50 @@ def _test_check_send_recv_tensor(parallel_context: ParallelContext, send_contigu
             )
 
     parallel_context.destroy()
+
+
+@rerun_if_address_is_in_use()
+def test_send_recv_tensors_with_cached_metadata_on_cpu():
+    mp.spawn(_test_send_recv_tensors_with_cached_metadata_on_cpu, args=(find_free_port(),), nprocs=2)
+
+
+def _test_send_recv_tensors_with_cached_metadata_on_cpu(rank: int, port: int):
+    dist.init_process_group(backend="gloo", init_method=f"tcp://localhost:{port}", rank=rank, world_size=2)
+    p2p = P2P(pg=dist.new_group(ranks=[0, 1], backend="gloo"), device=torch.device("cpu"), cache_metadata=True)
+
+    def get_tensors(step: int):
+        generator = torch.Generator().manual_seed(step)
+        # The last step changes shapes
+        seq_length = 5 if step < 2 else 7
+        return [
+            torch.randn(3, seq_length, generator=generator).requires_grad_(),
+            # Non contiguous tensors are sent with their entire storage
+            torch.randn(seq_length, 3, generator=generator).transpose(0, 1),
+            # Contiguous slices are sent alone
+            torch.randn(4, seq_length, generator=generator).to(torch.bfloat16)[1:3],
+            torch.randint(0, 10, (seq_length,), generator=generator),
+        ]
+
+    for step in range(4):
+        tensors = get_tensors(step)
+        if rank == 0:
+            for future in p2p.isend_tensors(tensors, to_rank=1):
+                future.wait()
+        else:
+            recv_tensors, futures = p2p.irecv_tensors(len(tensors), from_rank=0)
+            # The payload is always received asynchronously, even when the metadata is cached
+            assert len(futures) == 1
+            futures[0].wait()
+            for tensor, recv_tensor in zip(tensors, recv_tensors):
+                assert recv_tensor.dtype == tensor.dtype
+                assert recv_tensor.requires_grad == tensor.requires_grad
+                torch.testing.assert_close(recv_tensor, tensor.detach(), atol=0, rtol=0)
+
+    # The metadata is cached on both ranks, for the last shapes
+    cache = p2p.send_metadata_cache if rank == 0 else p2p.recv_metadata_cache
+    assert len(cache) == 1
+    assert [tensor_metadata.shape for tensor_metadata in next(iter(cache.values()))] == [
+        tuple(tensor.shape) for tensor in get_tensors(step=3)
+    ]
+
+    dist.destroy_process_group()
@@ -0,0 +1,106 @@
+import pytest
+import torch
+from nanotron.generation.generate_store import Store
+from nanotron.generation.paged_kv_cache import PagedKVCache, PagedKVCacheManager, paged_attention
+
+
+def get_kv_cache(num_blocks: int = 8, block_size: int = 4, n_kv_heads: int = 2, d_qk: int = 8, d_v: int = 6):
+    return PagedKVCache(
+        num_blocks=num_blocks,
+        block_size=block_size,
+        n_kv_heads=n_kv_heads,
+        d_qk=d_qk,
+        d_v=d_v,
+        dtype=torch.float,
+        device=torch.device("cpu"),
+    )
+
+
+def test_paged_kv_cache_append_and_gather():
+    kv_cache = get_kv_cache()
+    seq_ids = kv_cache.allocate_sequences(2)
+    expected_keys = {seq_id: [] for seq_id in seq_ids}
+    expected_values = {seq_id: [] for seq_id in seq_ids}
+
+    # Prefill with different lengths, then decode one token at a time across block boundaries
+    for num_tokens in [[3, 6], [1, 1], [1, 1], [1, 1]]:
+        key_states = torch.randn(sum(num_tokens), 2, 8)
+        value_states = torch.randn(sum(num_tokens), 2, 6)
+        kv_cache.append(seq_ids, key_states, value_states, num_tokens=num_tokens)
+        for seq_id, keys, values in zip(
+            seq_ids, torch.split(key_states, num_tokens), torch.split(value_states, num_tokens)
+        ):
+            expected_keys[seq_id].append(keys)
+            expected_values[seq_id].append(values)
+
+    for seq_id in seq_ids:
+        key_states, value_states = kv_cache.gather(seq_id)
+        assert torch.equal(key_states, torch.cat(expected_keys[seq_id]))
+        assert torch.equal(value_states, torch.cat(expected_values[seq_id]))
+
+    # Only the blocks holding tokens are used: ceil(6 / 4) + ceil(9 / 4)
+    assert kv_cache.num_free_blocks == 8 - 2 - 3
+    assert kv_cache.get_seq_lens(seq_ids).tolist() == [6, 9]
+    assert kv_cache.get_block_table(seq_ids).shape == (2, 3)
+
+
+def test_paged_kv_cache_reuses_freed_blocks():
+    kv_cache = get_kv_cache(num_blocks=4)
+    seq_ids = kv_cache.allocate_sequences(2)
+    kv_cache.append(seq_ids, torch.randn(16, 2, 8), torch.randn(16, 2, 6), num_tokens=[8, 8])
+    assert kv_cache.num_free_blocks == 0
+
+    with pytest.raises(RuntimeError, match="The KV cache is full"):
+        kv_cache.append(seq_ids[:1], torch.randn(1, 2, 8), torch.randn(1, 2, 6), num_tokens=[1])
+
+    used_blocks = set(kv_cache.block_tables[seq_ids[0]])
+    kv_cache.free_sequences(seq_ids[:1])
+    assert kv_cache.num_free_blocks == 2
+
+    (new_seq_id,) = kv_cache.allocate_sequences(1)
+    kv_cache.append([new_seq_id], torch.randn(5, 2, 8), torch.randn(5, 2, 6), num_tokens=[5])
+    assert set(kv_cache.block_tables[new_seq_id]) == used_blocks
+
+
+def test_paged_kv_cache_manager_frees_store_sequences():
+    kv_cache_manager = PagedKVCacheManager(num_blocks=4, block_size=4)
+    store = Store(paged_kv_cache=kv_cache_manager)
+    layer_ids = [0, 1]
+    for layer_id in layer_ids:
+        kv_cache = kv_cache_manager.get_layer_cache(
+            layer_id, n_kv_heads=2, d_qk=8, d_v=6, dtype=torch.float, device=torch.device("cpu")
+        )
+        seq_ids = kv_cache.allocate_sequences(2)
+        kv_cache.append(seq_ids, torch.randn(10, 2, 8), torch.randn(10, 2, 6), num_tokens=[5, 5])
+        store[layer_id]["seq_ids"] = seq_ids
+        assert kv_cache.num_free_blocks == 0
+
+    store.flush()
+    assert len(store) == 0
+    for layer_id in layer_ids:
+        assert kv_cache_manager.layer_caches[layer_id].num_free_blocks == 4
+
+
+@pytest.mark.parametrize("n_q_heads,n_kv_heads", [(4, 4), (4, 2)])
+@pytest.mark.parametrize("q_length", [1, 3])
+def test_paged_attention_matches_dense_attention(n_q_heads: int, n_kv_heads: int, q_length: int):
+    kv_cache = get_kv_cache(num_blocks=16, n_kv_heads=n_kv_heads)
+    seq_lens = [5, 11]
+    seq_ids = kv_cache.allocate_sequences(len(seq_lens))
+    key_states = torch.randn(sum(seq_lens), n_kv_heads, 8)
+    value_states = torch.randn(sum(seq_lens), n_kv_heads, 6)
+    kv_cache.append(seq_ids, key_states, value_states, num_tokens=seq_lens)
+    query_states = torch.randn(len(seq_lens), q_length, n_q_heads, 8)
+
+    attention_output = paged_attention(query_states, kv_cache, seq_ids)
+
+    for i, (keys, values) in enumerate(zip(torch.split(key_states, seq_lens), torch.split(value_states, seq_lens))):
+        # [n_q_heads, seq_len, d]
+        keys = keys.repeat_interleave(n_q_heads // n_kv_heads, dim=1).transpose(0, 1)
+        values = values.repeat_interleave(n_q_heads // n_kv_heads, dim=1).transpose(0, 1)
+        # The queries are the last `q_length` tokens of the sequence
+        attention_mask = torch.ones(q_length, keys.shape[1], dtype=torch.bool).tril(diagonal=keys.shape[1] - q_length)
+        expected_output = torch.nn.functional.scaled_dot_product_attention(
+            query_states[i].transpose(0, 1), keys, values, attn_mask=attention_mask
+        ).transpose(0, 1)
+        torch.testing.assert_close(attention_output[i], expected_output)
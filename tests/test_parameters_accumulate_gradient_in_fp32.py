@@ -137,6 +137,54 @@ def test_optimizer_can_step_gradient_in_fp32(half_precision: torch.dtype):
     assert not torch.allclose(original_weight, model.weight)
 
 
+@pytest.mark.parametrize("half_precision", [torch.float16, torch.bfloat16])
+def test_optimizer_step_with_cpu_offload(half_precision: torch.dtype):
+    model = nn.Linear(3, 2, dtype=half_precision, device="cuda")
+    ref_model = copy.deepcopy(model)
+
+    def build_optimizer(model: nn.Module, offload_to_cpu: bool) -> OptimizerFromGradientAccumulator:
+        for module in model.modules():
+            for name, param in list(module.named_parameters(recurse=False)):
+                setattr(module, name, NanotronParameter(param))
+        return OptimizerFromGradientAccumulator(
+            gradient_accumulator_builder=lambda named_params: FP32GradientAccumulator(
+                named_parameters=named_params, offload_to_cpu=offload_to_cpu
+            ),
+            named_params_or_groups=model.named_parameters(),
+            optimizer_builder=lambda named_param_groups: NamedOptimizer(
+                named_params_or_groups=named_param_groups,
+                optimizer_builder=lambda param_groups: torch.optim.AdamW(param_groups, foreach=True),
+            ),
+        )
+
+    optimizer = build_optimizer(model, offload_to_cpu=True)
+    ref_optimizer = build_optimizer(ref_model, offload_to_cpu=False)
+
+    for _ in range(3):
+        input = torch.randn(5, 3, dtype=half_precision, device="cuda")
+        optimizer.gradient_accumulator.backward(model(input).sum())
+        ref_optimizer.gradient_accumulator.backward(ref_model(input).sum())
+        optimizer.step()
+        ref_optimizer.step()
+        optimizer.zero_grad()
+        ref_optimizer.zero_grad()
+
+    for name, param in model.named_parameters():
+        # The fp32 weights and the optimizer states are on CPU, the model's weights stay on GPU
+        fp32_param = optimizer.gradient_accumulator.parameters[name]["fp32"]
+        assert fp32_param.device.type == "cpu" and fp32_param.is_pinned()
+        assert all(
+            state.device.type == "cpu"
+            for state in optimizer.get_base_optimizer().state[fp32_param].values()
+            if state.dim() > 0
+        )
+        assert param.device.type == "cuda"
+
+        ref_fp32_param = ref_optimizer.gradient_accumulator.parameters[name]["fp32"]
+        torch.testing.assert_close(fp32_param, ref_fp32_param.cpu())
+        torch.testing.assert_close(param, ref_model.get_parameter(name), atol=0, rtol=0)
+
+
 @pytest.mark.skipif(available_gpus() < 2, reason="Testing ddp_hook_allreduce requires at least 2 gpus")
 @pytest.mark.parametrize("half_precision", [torch.float16, torch.bfloat16])
 @pytest.mark.parametrize("accumulation_steps", [1, 10])
@@ -7,11 +7,14 @@ from helpers.utils import available_gpus, init_distributed, rerun_if_address_is_
 from nanotron import distributed as dist
 from nanotron.models import init_on_device_and_dtype
 from nanotron.parallel import ParallelContext
+from nanotron.parallel.pipeline_parallel.activation_offload import ActivationOffloader, OffloadedTensor
 from nanotron.parallel.pipeline_parallel.block import PipelineBlock
 from nanotron.parallel.pipeline_parallel.engine import (
     AllForwardAllBackwardPipelineEngine,
+    InterleavedOneForwardOneBackwardPipelineEngine,
     OneForwardOneBackwardPipelineEngine,
     PipelineEngine,
+    ZeroBubblePipelineEngine,
 )
 from nanotron.parallel.pipeline_parallel.p2p import P2P
 from nanotron.parallel.pipeline_parallel.tensor_pointer import TensorPointer
@@ -55,6 +58,127 @@ def _test_build_and_set_rank(parallel_context: ParallelContext):
     parallel_context.destroy()
 
 
+@pytest.mark.skipif(available_gpus() < 2, reason="Testing interleaved 1F1B requires at least 2 gpus")
+@pytest.mark.parametrize("num_model_chunks", [2, 3])
+@pytest.mark.parametrize("pp", list(range(2, min(4, available_gpus()) + 1)))
+@rerun_if_address_is_in_use()
+def test_interleaved_pipeline_engine(num_model_chunks: int, pp: int):
+    init_distributed(tp=1, dp=1, pp=pp)(_test_interleaved_pipeline_engine)(num_model_chunks=num_model_chunks)
+
+
+def _test_interleaved_pipeline_engine(parallel_context: ParallelContext, num_model_chunks: int):
+    device = torch.device("cuda")
+    p2p = P2P(parallel_context.pp_pg, device=device)
+    pp_size = parallel_context.pp_pg.size()
+    reference_rank = 0
+    has_reference_model = dist.get_rank(parallel_context.pp_pg) == reference_rank
+    current_pp_rank = dist.get_rank(parallel_context.pp_pg)
+    pipeline_engine = InterleavedOneForwardOneBackwardPipelineEngine(num_model_chunks=num_model_chunks)
+
+    # spawn model, stage `stage_idx` runs on rank `stage_idx % pp_size` in model chunk `stage_idx // pp_size`
+    num_stages = pp_size * num_model_chunks
+    model = DummyModel(p2p=p2p, num_layers=num_stages)
+    if has_reference_model:
+        reference_model = DummyModel(p2p=p2p, num_layers=num_stages)
+
+    # Set the ranks
+    with init_on_device_and_dtype(device):
+        for stage_idx, non_linear in enumerate(model.mlp):
+            non_linear.linear.build_and_set_rank(pp_rank=stage_idx % pp_size, model_chunk=stage_idx // pp_size)
+            non_linear.activation.build_and_set_rank(pp_rank=stage_idx % pp_size, model_chunk=stage_idx // pp_size)
+        model.loss.build_and_set_rank(pp_rank=pp_size - 1, model_chunk=num_model_chunks - 1)
+
+        # build reference model
+        if has_reference_model:
+            for non_linear in reference_model.mlp:
+                non_linear.linear.build_and_set_rank(pp_rank=reference_rank)
+                non_linear.activation.build_and_set_rank(pp_rank=reference_rank)
+            reference_model.loss.build_and_set_rank(pp_rank=reference_rank)
+
+    # synchronize weights
+    for stage_idx, non_linear in enumerate(model.mlp):
+        stage_pp_rank = stage_idx % pp_size
+        if has_reference_model:
+            reference_linear = reference_model.mlp[stage_idx].linear.pp_block
+            with torch.inference_mode():
+                if stage_pp_rank == current_pp_rank:
+                    reference_linear.weight.data.copy_(non_linear.linear.pp_block.weight.data)
+                    reference_linear.bias.data.copy_(non_linear.linear.pp_block.bias.data)
+                else:
+                    weight, bias = p2p.recv_tensors(num_tensors=2, from_rank=stage_pp_rank)
+                    reference_linear.weight.data.copy_(weight.data)
+                    reference_linear.bias.data.copy_(bias.data)
+        elif stage_pp_rank == current_pp_rank:
+            p2p.send_tensors(
+                [non_linear.linear.pp_block.weight, non_linear.linear.pp_block.bias], to_rank=reference_rank
+            )
+
+    # Get infinite dummy data iterator
+    data_iterator = dummy_infinite_data_loader(pp_pg=parallel_context.pp_pg)  # First rank receives data
+
+    # The number of microbatches has to be a multiple of PP size.
+    n_micro_batches_per_batch = 2 * pp_size
+
+    batch = [next(data_iterator) for _ in range(n_micro_batches_per_batch)]
+    losses = pipeline_engine.train_batch_iter(
+        model, pg=parallel_context.pp_pg, batch=batch, nb_microbatches=n_micro_batches_per_batch, grad_accumulator=None
+    )
+
+    # Equivalent on the reference model
+    if has_reference_model:
+        reference_losses = []
+        for micro_batch in batch:
+            loss = reference_model(**micro_batch)
+            loss /= n_micro_batches_per_batch
+            loss.backward()
+            reference_losses.append(loss.detach())
+
+    # Gather loss in reference_rank
+    if has_reference_model:
+        _losses = []
+    for loss in losses:
+        if isinstance(loss["loss"], torch.Tensor):
+            if has_reference_model:
+                _losses.append(loss["loss"])
+            else:
+                p2p.send_tensors([loss["loss"]], to_rank=reference_rank)
+        else:
+            assert isinstance(loss["loss"], TensorPointer)
+            if not has_reference_model:
+                continue
+            _losses.append(p2p.recv_tensors(num_tensors=1, from_rank=loss["loss"].group_rank)[0])
+    if has_reference_model:
+        losses = _losses
+
+    # Check loss are the same as reference
+    if has_reference_model:
+        assert len(losses) == n_micro_batches_per_batch
+        for loss, ref_loss in zip(losses, reference_losses):
+            torch.testing.assert_close(loss, ref_loss, atol=1e-6, rtol=1e-7)
+
+    # Check that gradient flows through every model chunk
+    for param in model.parameters():
+        assert param.grad is not None
+
+    # Check that gradient are the same as reference
+    for stage_idx, non_linear in enumerate(model.mlp):
+        stage_pp_rank = stage_idx % pp_size
+        if has_reference_model:
+            reference_linear = reference_model.mlp[stage_idx].linear.pp_block
+            if stage_pp_rank == current_pp_rank:
+                weight_grad, bias_grad = non_linear.linear.pp_block.weight.grad, non_linear.linear.pp_block.bias.grad
+            else:
+                weight_grad, bias_grad = p2p.recv_tensors(num_tensors=2, from_rank=stage_pp_rank)
+            torch.testing.assert_close(weight_grad, reference_linear.weight.grad, atol=1e-6, rtol=1e-7)
+            torch.testing.assert_close(bias_grad, reference_linear.bias.grad, atol=1e-6, rtol=1e-7)
+        elif stage_pp_rank == current_pp_rank:
+            p2p.send_tensors(
+                [non_linear.linear.pp_block.weight.grad, non_linear.linear.pp_block.bias.grad], to_rank=reference_rank
+            )
+
+    parallel_context.destroy()
+
+
 @pytest.mark.skipif(available_gpus() < 1, reason="Testing test_init_on_device_and_dtype requires at least 1 gpus")
 def test_init_on_device_and_dtype():
     device = torch.device(type="cuda", index=0)
@@ -67,7 +191,8 @@ def test_init_on_device_and_dtype():
 
 @pytest.mark.skipif(available_gpus() < 2, reason="Testing AFAB requires at least 2 gpus")
 @pytest.mark.parametrize(
-    "pipeline_engine", [AllForwardAllBackwardPipelineEngine(), OneForwardOneBackwardPipelineEngine()]
+    "pipeline_engine",
+    [AllForwardAllBackwardPipelineEngine(), OneForwardOneBackwardPipelineEngine(), ZeroBubblePipelineEngine()],
 )
 @pytest.mark.parametrize("pp", list(range(2, min(4, available_gpus()) + 1)))
 @rerun_if_address_is_in_use()
@@ -207,12 +332,87 @@ def _test_pipeline_engine(parallel_context: ParallelContext, pipeline_engine: Pi
     parallel_context.destroy()
 
 
+@pytest.mark.skipif(available_gpus() < 2, reason="Testing activation offload requires at least 2 gpus")
+@pytest.mark.parametrize(
+    "pipeline_engine", [AllForwardAllBackwardPipelineEngine(), OneForwardOneBackwardPipelineEngine()]
+)
+@pytest.mark.parametrize("pp", list(range(2, min(4, available_gpus()) + 1)))
+@rerun_if_address_is_in_use()
+def test_pipeline_engine_with_activation_offload(pipeline_engine: PipelineEngine, pp: int):
+    init_distributed(tp=1, dp=1, pp=pp)(_test_pipeline_engine_with_activation_offload)(pipeline_engine=pipeline_engine)
+
+
+def _test_pipeline_engine_with_activation_offload(parallel_context: ParallelContext, pipeline_engine: PipelineEngine):
+    pipeline_engine.offload_activations_pp_ranks = list(range(parallel_context.pp_pg.size()))
+    # The activations of the dummy model are tiny
+    activation_offloader = ActivationOffloader(min_offload_bytes=0)
+    pipeline_engine.activation_offloader = activation_offloader
+
+    # Same losses and gradients as the reference model
+    _test_pipeline_engine(parallel_context=parallel_context, pipeline_engine=pipeline_engine)
+
+    assert activation_offloader.bytes_offloaded > 0
+    assert activation_offloader.bytes_prefetched == activation_offloader.bytes_offloaded
+
+
+def test_activation_offloader_on_cpu():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(16, 32), nn.GELU(), nn.Linear(32, 16))
+    micro_batches = [torch.randn(4, 16) for _ in range(3)]
+
+    for micro_batch in micro_batches:
+        model(micro_batch).sum().backward()
+    reference_grads = [param.grad.clone() for param in model.parameters()]
+    model.zero_grad()
+
+    activation_offloader = ActivationOffloader(min_offload_bytes=0)
+    # Record the tensors autograd saves that get offloaded
+    offloaded_saved_tensors = []
+    pack = activation_offloader._pack
+
+    def record_pack(tensor: torch.Tensor):
+        packed = pack(tensor)
+        if isinstance(packed, OffloadedTensor):
+            offloaded_saved_tensors.append(tensor)
+        return packed
+
+    activation_offloader._pack = record_pack
+    losses = []
+    for micro_batch in micro_batches:
+        with activation_offloader.offload_micro_batch():
+            losses.append(model(micro_batch).sum())
+    assert len(activation_offloader.micro_batches) == len(micro_batches)
+    assert activation_offloader.bytes_offloaded > 0
+    # Parameters, and the other leaves requiring grad, aren't offloaded
+    assert len(offloaded_saved_tensors) > 0
+    for tensor in offloaded_saved_tensors:
+        assert not isinstance(tensor, nn.Parameter)
+        assert not (tensor.requires_grad and tensor.is_leaf)
+    offloaded_bytes = sum(
+        offloaded_tensor.cpu_tensor.numel() * offloaded_tensor.cpu_tensor.element_size()
+        for offloaded_tensors in activation_offloader.micro_batches
+        for offloaded_tensor in offloaded_tensors
+    )
+    assert offloaded_bytes == activation_offloader.bytes_offloaded
+
+    for loss in losses:
+        activation_offloader.prefetch()
+        loss.backward()
+        activation_offloader.release()
+    activation_offloader.check_buffers_empty()
+    assert activation_offloader.bytes_prefetched == activation_offloader.bytes_offloaded
+
+    for param, reference_grad in zip(model.parameters(), reference_grads):
+        torch.testing.assert_close(param.grad, reference_grad)
+
+
 @pytest.mark.skipif(
     available_gpus() < 2,
     reason="Testing `test_pipeline_engine_with_tensor_that_does_not_require_grad` requires at least 2 gpus",
 )
 @pytest.mark.parametrize(
-    "pipeline_engine", [AllForwardAllBackwardPipelineEngine(), OneForwardOneBackwardPipelineEngine()]
+    "pipeline_engine",
+    [AllForwardAllBackwardPipelineEngine(), OneForwardOneBackwardPipelineEngine(), ZeroBubblePipelineEngine()],
 )
 @pytest.mark.parametrize("pp", list(range(2, min(4, available_gpus()) + 1)))
 @rerun_if_address_is_in_use()
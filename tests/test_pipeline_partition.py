@@ -0,0 +1,114 @@
+import pytest
+from nanotron.parallel.pipeline_parallel.partition import (
+    get_imbalance,
+    get_layer_activations_per_token,
+    get_min_max_partition,
+    get_stage_costs,
+    get_thresholds_partition,
+)
+
+
+def test_thresholds_partition():
+    # The block crossing the threshold of a stage stays in that stage, so the first stage gets one more block
+    assert get_thresholds_partition([1] * 8, num_stages=4) == [0, 0, 0, 1, 1, 2, 2, 3]
+    assert get_min_max_partition([1] * 8, num_stages=4) == [0, 0, 1, 1, 2, 2, 3, 3]
+
+
+@pytest.mark.parametrize(
+    "compute_costs,num_stages",
+    [([1] * 8, 4), ([1, 1, 1, 1, 1, 1, 4], 3), ([0, 1, 1, 1, 1, 1, 1, 3, 0], 4), ([5, 1, 1, 1, 1, 1], 2)],
+)
+def test_min_max_partition_is_optimal(compute_costs, num_stages):
+    block_stages = get_min_max_partition(compute_costs, num_stages)
+
+    # Stages are contiguous and non-empty
+    assert block_stages == sorted(block_stages)
+    assert set(block_stages) == set(range(num_stages))
+
+    # The slowest stage is at least as fast as with any contiguous split, computed by brute force
+    def best_max_cost(costs, num_stages):
+        if num_stages == 1:
+            return sum(costs)
+        return min(
+            max(sum(costs[:end]), best_max_cost(costs[end:], num_stages - 1))
+            for end in range(1, len(costs) - num_stages + 2)
+        )
+
+    stage_costs = get_stage_costs(compute_costs, block_stages, num_stages)
+    assert max(stage_costs) == best_max_cost(compute_costs, num_stages)
+    assert max(stage_costs) <= max(
+        get_stage_costs(compute_costs, get_thresholds_partition(compute_costs, num_stages), num_stages)
+    )
+
+
+def test_min_max_partition_memory():
+    compute_costs = [1] * 8
+    # The first block is an embedding with a lot of parameters
+    static_memory_costs = [6, 1, 1, 1, 1, 1, 1, 1]
+    activation_memory_costs = [0, 1, 1, 1, 1, 1, 1, 1]
+    # The first stage holds more micro batches in flight, like with 1F1B
+    nb_in_flight_tokens = [2, 1]
+
+    block_stages = get_min_max_partition(
+        compute_costs,
+        num_stages=2,
+        static_memory_costs=static_memory_costs,
+        activation_memory_costs=activation_memory_costs,
+        nb_in_flight_tokens=nb_in_flight_tokens,
+        max_memory=12,
+    )
+    assert block_stages == [0, 0, 0, 1, 1, 1, 1, 1]
+
+    # Without a memory cap, the compute is balanced, and the memory of the most loaded stage minimized
+    assert get_min_max_partition(
+        compute_costs,
+        num_stages=2,
+        static_memory_costs=static_memory_costs,
+        activation_memory_costs=activation_memory_costs,
+        nb_in_flight_tokens=nb_in_flight_tokens,
+    ) == [0, 0, 0, 0, 1, 1, 1, 1]
+
+    with pytest.raises(ValueError):
+        get_min_max_partition(
+            compute_costs,
+            num_stages=2,
+            static_memory_costs=static_memory_costs,
+            activation_memory_costs=activation_memory_costs,
+            nb_in_flight_tokens=nb_in_flight_tokens,
+            max_memory=5,
+        )
+
+
+def test_imbalance():
+    assert get_imbalance([1, 1, 1, 1]) == 1
+    assert get_imbalance([2, 1, 1, 0]) == 2
+
+
+def test_layer_activations_with_sequence_parallel():
+    hidden_size, tp = 4096, 8
+    # Everything is split across TP with sequence parallelism, the recomputed input included
+    assert get_layer_activations_per_token(hidden_size, tp=1) == get_layer_activations_per_token(
+        hidden_size, tp=1, sequence_parallel=True
+    )
+    assert get_layer_activations_per_token(hidden_size, tp, sequence_parallel=True) == pytest.approx(
+        get_layer_activations_per_token(hidden_size, tp=1) / tp
+    )
+    assert get_layer_activations_per_token(
+        hidden_size, tp, sequence_parallel=True, recompute_policy="full"
+    ) == pytest.approx(get_layer_activations_per_token(hidden_size, tp, recompute_policy="full") / tp)
+    assert get_layer_activations_per_token(hidden_size, tp, sequence_parallel=True) < get_layer_activations_per_token(
+        hidden_size, tp
+    )
+
+
+def test_layer_activations_with_recompute_policies():
+    hidden_size, tp = 4096, 8
+    activations = {
+        policy: get_layer_activations_per_token(hidden_size, tp, recompute_policy=policy)
+        for policy in (None, "mlp", "full")
+    }
+    assert activations[None] > activations["mlp"] > activations["full"]
+    # Recomputing every other layer keeps half of the activations saved by recomputing them all
+    assert get_layer_activations_per_token(
+        hidden_size, tp, recompute_policy="full", recompute_layer_interval=2
+    ) == pytest.approx((activations[None] + activations["full"]) / 2)
@@ -0,0 +1,59 @@
+import pytest
+from nanotron.parallel.pipeline_parallel.schedule import (
+    BACKWARD,
+    BACKWARD_INPUT,
+    BACKWARD_WEIGHT,
+    FORWARD,
+    PIPELINE_SCHEDULES,
+    get_one_forward_one_backward_schedule,
+    get_zero_bubble_schedule,
+    simulate_pipeline_schedule,
+)
+
+
+@pytest.mark.parametrize("pp_engine", list(PIPELINE_SCHEDULES.keys()))
+@pytest.mark.parametrize("pp_size,nb_microbatches", [(1, 4), (2, 2), (4, 3), (4, 8), (8, 32)])
+def test_schedules_run_every_micro_batch_once(pp_engine: str, pp_size: int, nb_microbatches: int):
+    schedules = [PIPELINE_SCHEDULES[pp_engine](pp_size, pp_rank, nb_microbatches) for pp_rank in range(pp_size)]
+    for schedule in schedules:
+        assert schedule.count(FORWARD) == nb_microbatches
+        assert schedule.count(BACKWARD) + schedule.count(BACKWARD_INPUT) == nb_microbatches
+        if BACKWARD_WEIGHT in schedule:
+            assert schedule.count(BACKWARD_WEIGHT) == nb_microbatches
+            # A weight gradient pass always comes after the input gradient pass of its micro batch
+            for i, op in enumerate(schedule):
+                if op == BACKWARD_WEIGHT:
+                    assert schedule[:i].count(BACKWARD_INPUT) > schedule[:i].count(BACKWARD_WEIGHT)
+
+    # Doesn't deadlock
+    simulate_pipeline_schedule(schedules)
+
+
+def test_one_forward_one_backward_bubble_ratio():
+    pp_size, nb_microbatches = 4, 8
+    simulation = simulate_pipeline_schedule(
+        [get_one_forward_one_backward_schedule(pp_size, pp_rank, nb_microbatches) for pp_rank in range(pp_size)],
+        forward_time=1.0,
+        backward_input_time=1.0,
+        backward_weight_time=1.0,
+    )
+    assert simulation.step_time == (nb_microbatches + pp_size - 1) * 3.0
+    assert simulation.bubble_ratio == pytest.approx((pp_size - 1) / (nb_microbatches + pp_size - 1))
+
+
+@pytest.mark.parametrize("pp_size,nb_microbatches", [(2, 2), (4, 8), (8, 32)])
+def test_zero_bubble_schedule_reduces_bubble(pp_size: int, nb_microbatches: int):
+    one_forward_one_backward = simulate_pipeline_schedule(
+        [get_one_forward_one_backward_schedule(pp_size, pp_rank, nb_microbatches) for pp_rank in range(pp_size)]
+    )
+    zero_bubble = simulate_pipeline_schedule(
+        [get_zero_bubble_schedule(pp_size, pp_rank, nb_microbatches) for pp_rank in range(pp_size)]
+    )
+    assert zero_bubble.bubble_ratio < one_forward_one_backward.bubble_ratio
+    assert zero_bubble.step_time < one_forward_one_backward.step_time
+
+
+def test_simulate_deadlock():
+    # The first rank waits for the gradients of the second rank, which waits for its activations
+    with pytest.raises(ValueError):
+        simulate_pipeline_schedule([[BACKWARD, FORWARD], [FORWARD, BACKWARD]])
@@ -0,0 +1,115 @@
+from nanotron.config import LlamaConfig
+from nanotron.parallel.pipeline_parallel.schedule import (
+    get_all_forward_all_backward_schedule,
+    get_max_in_flight_microbatches,
+    get_one_forward_one_backward_schedule,
+)
+from nanotron.parallel.planner import (
+    HardwareArgs,
+    plan_parallelism,
+    plan_recompute_policies,
+    recommend_parallelism,
+    split_layers_across_stages,
+)
+
+
+def get_model_config() -> LlamaConfig:
+    return LlamaConfig(
+        hidden_size=2048, intermediate_size=5632, num_attention_heads=16, num_hidden_layers=24, vocab_size=32000
+    )
+
+
+def test_split_layers_across_stages():
+    model_config = get_model_config()
+    num_layers_per_stage, lm_head_stage = split_layers_across_stages(model_config, pp=4)
+    assert sum(num_layers_per_stage) == model_config.num_hidden_layers
+    assert lm_head_stage == 3
+    # The lm_head costs as much as a few layers, the last stage gets less layers
+    assert num_layers_per_stage[-1] < num_layers_per_stage[0]
+
+
+def test_max_in_flight_microbatches():
+    assert get_max_in_flight_microbatches(get_all_forward_all_backward_schedule(4, 0, 8)) == 8
+    assert [get_max_in_flight_microbatches(get_one_forward_one_backward_schedule(4, r, 8)) for r in range(4)] == [
+        4,
+        3,
+        2,
+        1,
+    ]
+
+
+def test_plan_parallelism():
+    model_config = get_model_config()
+    hardware = HardwareArgs()
+    kwargs = {
+        "dp": 2,
+        "tp": 2,
+        "pp": 4,
+        "sequence_length": 2048,
+        "micro_batch_size": 1,
+        "batch_accumulation_per_replica": 16,
+    }
+
+    afab = plan_parallelism(model_config, hardware, pp_engine="afab", **kwargs)
+    one_forward_one_backward = plan_parallelism(model_config, hardware, pp_engine="1f1b", **kwargs)
+    recompute = plan_parallelism(model_config, hardware, pp_engine="1f1b", recompute_policy="full", **kwargs)
+    zero = plan_parallelism(model_config, hardware, pp_engine="1f1b", zero_stage=1, **kwargs)
+    sequence_parallel = plan_parallelism(model_config, hardware, pp_engine="1f1b", sequence_parallel=True, **kwargs)
+
+    # Less activations in flight, and no slower
+    assert one_forward_one_backward.step_time <= afab.step_time
+    assert max(one_forward_one_backward.peak_memory_per_stage) < max(afab.peak_memory_per_stage)
+    # Recomputing trades compute for memory
+    assert recompute.step_time > one_forward_one_backward.step_time
+    assert max(recompute.peak_memory_per_stage) < max(one_forward_one_backward.peak_memory_per_stage)
+    assert max(zero.peak_memory_per_stage) < max(one_forward_one_backward.peak_memory_per_stage)
+    # Sequence parallelism shards the activations across TP, for the same communications
+    assert sequence_parallel.step_time == one_forward_one_backward.step_time
+    assert max(sequence_parallel.peak_memory_per_stage) < max(one_forward_one_backward.peak_memory_per_stage)
+    assert 0 < one_forward_one_backward.bubble_ratio < 1
+    assert one_forward_one_backward.tokens_per_sec == 2 * 16 * 2048 / one_forward_one_backward.step_time
+
+
+def test_recommend_parallelism():
+    model_config = get_model_config()
+    hardware = HardwareArgs(gpu_memory=40 * 1024**3)
+    plans = recommend_parallelism(model_config, hardware, num_gpus=16, sequence_length=2048, global_batch_size=64)
+    assert len(plans) > 0
+    for plan in plans:
+        assert plan.dp * plan.tp * plan.pp == 16
+        assert plan.dp * plan.micro_batch_size * plan.batch_accumulation_per_replica == 64
+        assert plan.fits_in_memory(hardware)
+    assert [plan.tokens_per_sec for plan in plans] == sorted([plan.tokens_per_sec for plan in plans], reverse=True)
+
+
+def test_plan_recompute_policies():
+    model_config = get_model_config()
+    hardware = HardwareArgs()
+    kwargs = {
+        "dp": 2,
+        "tp": 2,
+        "pp": 4,
+        "sequence_length": 2048,
+        "micro_batch_size": 1,
+        "batch_accumulation_per_replica": 16,
+    }
+
+    plans = plan_recompute_policies(model_config, hardware, recompute_layer_intervals=(1, 2), **kwargs)
+    assert len(plans) == 1 + 2 * 2
+    assert [plan.tokens_per_sec for plan in plans] == sorted([plan.tokens_per_sec for plan in plans], reverse=True)
+    # Not recomputing is the fastest, and the MLP saves memory for less compute than the full layer
+    assert plans[0].recompute_policy is None
+    policy_to_plan = {
+        (plan.recompute_policy, plan.recompute_layer_interval): plan for plan in plans if plan.recompute_policy
+    }
+    no_recompute, mlp, full = plans[0], policy_to_plan[("mlp", 1)], policy_to_plan[("full", 1)]
+    assert no_recompute.step_time < mlp.step_time < full.step_time
+    assert max(no_recompute.peak_memory_per_stage) > max(mlp.peak_memory_per_stage) > max(full.peak_memory_per_stage)
+    # Recomputing half of the layers is in between
+    full_every_other_layer = policy_to_plan[("full", 2)]
+    assert no_recompute.step_time < full_every_other_layer.step_time < full.step_time
+    assert (
+        max(no_recompute.peak_memory_per_stage)
+        > max(full_every_other_layer.peak_memory_per_stage)
+        > max(full.peak_memory_per_stage)
+    )
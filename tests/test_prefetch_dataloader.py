@@ -0,0 +1,52 @@
+import pytest
+import torch
+from nanotron.dataloader import prefetch_dataloader
+from nanotron.parallel.pipeline_parallel.tensor_pointer import TensorPointer
+
+
+def dummy_dataloader(n_micro_batches: int):
+    for i in range(n_micro_batches):
+        yield {
+            "input_ids": torch.full((2, 8), i, dtype=torch.long),
+            "input_mask": torch.ones((2, 8), dtype=torch.bool),
+            "label_ids": TensorPointer(group_rank=1),
+        }
+
+
+@pytest.mark.parametrize("num_prefetch_micro_batches", [1, 3, 10])
+def test_prefetch_dataloader_in_thread(num_prefetch_micro_batches: int):
+    micro_batches = list(
+        prefetch_dataloader(
+            dummy_dataloader(5), num_prefetch_micro_batches=num_prefetch_micro_batches, device=torch.device("cpu")
+        )
+    )
+
+    assert len(micro_batches) == 5
+    for i, micro_batch in enumerate(micro_batches):
+        assert torch.equal(micro_batch["input_ids"], torch.full((2, 8), i, dtype=torch.long))
+        assert micro_batch["input_mask"].all()
+        assert isinstance(micro_batch["label_ids"], TensorPointer)
+        assert micro_batch["label_ids"].group_rank == 1
+
+
+def test_prefetch_dataloader_in_thread_raises_dataloader_exception():
+    def failing_dataloader():
+        yield from dummy_dataloader(2)
+        raise RuntimeError("Dataloader failed")
+
+    micro_batches = prefetch_dataloader(failing_dataloader(), num_prefetch_micro_batches=2, device=torch.device("cpu"))
+    next(micro_batches)
+    next(micro_batches)
+    with pytest.raises(RuntimeError, match="Dataloader failed"):
+        next(micro_batches)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="Requires CUDA")
+def test_prefetch_dataloader_on_stream():
+    micro_batches = list(prefetch_dataloader(dummy_dataloader(5), num_prefetch_micro_batches=2))
+
+    assert len(micro_batches) == 5
+    for i, micro_batch in enumerate(micro_batches):
+        assert micro_batch["input_ids"].is_cuda
+        assert torch.equal(micro_batch["input_ids"].cpu(), torch.full((2, 8), i, dtype=torch.long))
+        assert isinstance(micro_batch["label_ids"], TensorPointer)
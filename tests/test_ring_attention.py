@@ -0,0 +1,48 @@
+import pytest
+import torch
+from helpers.utils import rerun_if_address_is_in_use
+from nanotron import distributed as dist
+from nanotron.parallel.context_parallel.ring_attention import attention_reference, ring_attention
+from nanotron.parallel.context_parallel.utils import get_sequence_chunk
+from nanotron.utils import find_free_port
+from torch import multiprocessing as mp
+
+
+@pytest.mark.parametrize("cp_size", [2, 4])
+@pytest.mark.parametrize("n_kv_heads", [4, 2])
+@rerun_if_address_is_in_use()
+def test_ring_attention_matches_reference_on_cpu(cp_size: int, n_kv_heads: int):
+    mp.spawn(
+        _test_ring_attention_matches_reference_on_cpu, args=(find_free_port(), cp_size, n_kv_heads), nprocs=cp_size
+    )
+
+
+def _test_ring_attention_matches_reference_on_cpu(rank: int, port: int, cp_size: int, n_kv_heads: int):
+    dist.init_process_group(backend="gloo", init_method=f"tcp://localhost:{port}", rank=rank, world_size=cp_size)
+    cp_pg = dist.new_group(ranks=list(range(cp_size)), backend="gloo")
+
+    batch_size, seq_length, n_heads, d_qk = 2, 4 * cp_size, 4, 8
+    generator = torch.Generator().manual_seed(42)
+    query_states = torch.randn(batch_size, seq_length, n_heads, d_qk, generator=generator)
+    key_states = torch.randn(batch_size, seq_length, n_kv_heads, d_qk, generator=generator)
+    value_states = torch.randn(batch_size, seq_length, n_kv_heads, d_qk, generator=generator)
+    grad_output = torch.randn(batch_size, seq_length, n_heads, d_qk, generator=generator)
+
+    # Attention over the whole sequences
+    reference_inputs = [tensor.clone().requires_grad_() for tensor in (query_states, key_states, value_states)]
+    reference_output = attention_reference(*reference_inputs)
+    reference_output.backward(grad_output)
+
+    # Each CP rank attends its chunk of the sequences
+    local_inputs = [
+        get_sequence_chunk(tensor, cp_pg).clone().requires_grad_()
+        for tensor in (query_states, key_states, value_states)
+    ]
+    local_output = ring_attention(*local_inputs, cp_pg=cp_pg)
+    local_output.backward(get_sequence_chunk(grad_output, cp_pg))
+
+    torch.testing.assert_close(local_output, get_sequence_chunk(reference_output.detach(), cp_pg))
+    for local_input, reference_input in zip(local_inputs, reference_inputs):
+        torch.testing.assert_close(local_input.grad, get_sequence_chunk(reference_input.grad, cp_pg))
+
+    dist.destroy_process_group()
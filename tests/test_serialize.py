@@ -1,3 +1,6 @@
+import time
+
+import nanotron.serialize.weights
 import pytest
 import torch
 from helpers.context import TestContext
@@ -18,6 +21,7 @@ from nanotron.optim.optimizer_from_gradient_accumulator import (
 )
 from nanotron.optim.zero import ZeroDistributedOptimizer
 from nanotron.parallel import ParallelContext
+from nanotron.parallel.parameters import SlicesPair
 from nanotron.parallel.pipeline_parallel.engine import (
     AllForwardAllBackwardPipelineEngine,
 )
@@ -25,6 +29,7 @@ from nanotron.parallel.sharded_parameters import SplitConfig, create_sharded_par
 from nanotron.parallel.tied_parameters import sync_tied_weights_gradients
 from nanotron.random import RandomStates, get_current_random_state, get_synced_random_state
 from nanotron.serialize import (
+    AsyncCheckpointWriter,
     load_optimizer,
     load_random_states,
     load_weights,
@@ -32,7 +37,8 @@ from nanotron.serialize import (
     save_random_states,
     save_weights,
 )
-from nanotron.serialize.metadata import TensorMetadata
+from nanotron.serialize.metadata import TensorMetadata, TrainingMetadata
+from nanotron.serialize.utils import load_tp_shard_from_tp_shards
 from torch.nn.parallel import DistributedDataParallel
 
 
@@ -49,14 +55,17 @@ def test_save_and_load_with_changed_topolgy():
         for all_3d_configs in get_all_3d_configurations(gpus)
     ],
 )
+@pytest.mark.parametrize("num_workers", [1, 4])
 @rerun_if_address_is_in_use()
-def test_save_and_load_model(tp: int, dp: int, pp: int):
+def test_save_and_load_model(tp: int, dp: int, pp: int, num_workers: int):
     test_context = TestContext()
     # We use DP=2 as we're interested in testing that one
-    init_distributed(tp=tp, dp=dp, pp=pp)(_test_save_and_load_model)(test_context=test_context)
+    init_distributed(tp=tp, dp=dp, pp=pp)(_test_save_and_load_model)(
+        test_context=test_context, num_workers=num_workers
+    )
 
 
-def _test_save_and_load_model(parallel_context: ParallelContext, test_context: TestContext):
+def _test_save_and_load_model(parallel_context: ParallelContext, test_context: TestContext, num_workers: int):
     model = init_dummy_model(parallel_context=parallel_context)
     store_folder = test_context.get_auto_remove_tmp_dir()
 
@@ -74,6 +83,97 @@ def _test_save_and_load_model(parallel_context: ParallelContext, test_context: T
     else:
         assert not match, "Newly initialised model should not match."
 
+    load_weights(model=new_model, parallel_context=parallel_context, root_folder=store_folder, num_workers=num_workers)
+
+    # Assert the weights are exactly the same after loading
+    match, msg = is_dict_equal(new_model.state_dict(), model.state_dict())
+    assert match, msg
+
+    parallel_context.destroy()
+
+
+@pytest.mark.parametrize("saved_tp,loaded_tp", [(1, 2), (2, 1), (2, 4), (4, 3)])
+@pytest.mark.parametrize("split_dim", [0, 1])
+def test_load_tp_shard_from_tp_shards(saved_tp: int, loaded_tp: int, split_dim: int):
+    unsharded_tensor = torch.randn(12, 24)
+
+    def get_shards(tp: int):
+        shard_length = unsharded_tensor.shape[split_dim] // tp
+        shards = []
+        for tp_rank in range(tp):
+            global_slices = tuple(
+                slice(tp_rank * shard_length, (tp_rank + 1) * shard_length) if dim == split_dim else slice(None)
+                for dim in range(unsharded_tensor.ndim)
+            )
+            local_slices = tuple(slice(None) for _ in range(unsharded_tensor.ndim))
+            shards.append(
+                (
+                    unsharded_tensor[global_slices].clone(),
+                    (SlicesPair(local_slices=local_slices, global_slices=global_slices),),
+                )
+            )
+        return shards
+
+    # Only the overlapping parts of the saved shards are read, without materializing the unsharded tensor
+    shards_and_slices_maps = [
+        (shard, tuple(shard.shape), slices_pairs) for shard, slices_pairs in get_shards(saved_tp)
+    ]
+    for expected_shard, slices_pairs in get_shards(loaded_tp):
+        buffer = torch.empty_like(expected_shard)
+        load_tp_shard_from_tp_shards(
+            buffer=buffer,
+            shards_and_slices_maps=shards_and_slices_maps,
+            unsharded_shape=tuple(unsharded_tensor.shape),
+            shard_metadata=TensorMetadata(
+                version=CHECKPOINT_VERSION,
+                local_global_slices_pairs=slices_pairs,
+                unsharded_shape=tuple(unsharded_tensor.shape),
+            ),
+        )
+        torch.testing.assert_close(buffer, expected_shard, atol=0, rtol=0)
+
+
+@pytest.mark.parametrize(
+    "tp,dp,pp",
+    [
+        pytest.param(*all_3d_configs)
+        for gpus in range(1, min(available_gpus(), 4) + 1)
+        for all_3d_configs in get_all_3d_configurations(gpus)
+    ],
+)
+@pytest.mark.parametrize("max_shard_size", [1, 2**30])
+@rerun_if_address_is_in_use()
+def test_save_and_load_consolidated_model(tp: int, dp: int, pp: int, max_shard_size: int):
+    test_context = TestContext()
+    init_distributed(tp=tp, dp=dp, pp=pp)(_test_save_and_load_consolidated_model)(
+        test_context=test_context, max_shard_size=max_shard_size
+    )
+
+
+def _test_save_and_load_consolidated_model(
+    parallel_context: ParallelContext, test_context: TestContext, max_shard_size: int
+):
+    model = init_dummy_model(parallel_context=parallel_context)
+    store_folder = test_context.get_auto_remove_tmp_dir()
+
+    # Save
+    save_weights(
+        model=model, parallel_context=parallel_context, root_folder=store_folder, max_shard_size=max_shard_size
+    )
+    dist.barrier(parallel_context.world_pg)
+
+    # The weights of each rank are packed in shards, with one index per rank
+    model_folder = store_folder / "model"
+    assert all(path.is_file() for path in model_folder.iterdir())
+    index_paths = list(model_folder.glob("*_index.json"))
+    shard_paths = list(model_folder.glob("*.safetensors"))
+    if len(model.state_dict()) > 0:
+        assert len(index_paths) > 0
+        if max_shard_size == 2**30:
+            assert len(shard_paths) == len(index_paths)
+
+    # Load
+    new_model = init_dummy_model(parallel_context=parallel_context)
     load_weights(model=new_model, parallel_context=parallel_context, root_folder=store_folder)
 
     # Assert the weights are exactly the same after loading
@@ -576,3 +676,81 @@ def _test_serialize_deserialize_tensormetadata(parallel_context: ParallelContext
     assert metadata == metadata_from_str_dict
 
     parallel_context.destroy()
+
+
+@rerun_if_address_is_in_use()
+def test_async_save_stall_time():
+    test_context = TestContext()
+    init_distributed(tp=1, dp=1, pp=1)(_test_async_save_stall_time)(test_context=test_context)
+
+
+def _test_async_save_stall_time(parallel_context: ParallelContext, test_context: TestContext):
+    model = init_dummy_model(parallel_context=parallel_context)
+    optimizer = NamedOptimizer(
+        named_params_or_groups=model.named_parameters(),
+        optimizer_builder=lambda params: torch.optim.AdamW(params),
+    )
+    random_states = RandomStates({"my_own_random_state": get_current_random_state()})
+    training_metadata = TrainingMetadata(consumed_train_samples=0, last_train_step=0)
+
+    # Simulate a slow file system so that writing the weights dominates the time spent in the training loop
+    write_delay = 0.1
+    save_file = nanotron.serialize.weights.save_file
+
+    def slow_save_file(*args, **kwargs):
+        time.sleep(write_delay)
+        return save_file(*args, **kwargs)
+
+    nanotron.serialize.weights.save_file = slow_save_file
+    try:
+        # Synchronous save: the training loop is stalled until all the files are written
+        sync_store_folder = test_context.get_auto_remove_tmp_dir()
+        start_time = time.perf_counter()
+        save_weights(model=model, parallel_context=parallel_context, root_folder=sync_store_folder)
+        save_optimizer(optimizer=optimizer, parallel_context=parallel_context, root_folder=sync_store_folder)
+        save_random_states(
+            random_states=random_states, parallel_context=parallel_context, root_folder=sync_store_folder
+        )
+        sync_stall_time = time.perf_counter() - start_time
+
+        # Asynchronous save: the training loop is only stalled while snapshotting the states
+        async_store_folder = test_context.get_auto_remove_tmp_dir()
+        checkpoint_writer = AsyncCheckpointWriter(parallel_context=parallel_context)
+        start_time = time.perf_counter()
+        checkpoint_writer.save(
+            config=None,
+            model=model,
+            optimizer=optimizer,
+            lr_scheduler=None,
+            random_states=random_states,
+            training_metadata=training_metadata,
+            root_folder=async_store_folder,
+            should_save_config=False,
+            should_save_lr_scheduler=False,
+        )
+        async_stall_time = time.perf_counter() - start_time
+
+        # Training goes on while the checkpoint is written: the snapshot must not change
+        with torch.no_grad():
+            for param in model.parameters():
+                param.add_(1)
+
+        checkpoint_writer.wait_for_completion()
+    finally:
+        nanotron.serialize.weights.save_file = save_file
+
+    n_weight_files = len(model.state_dict())
+    assert sync_stall_time >= n_weight_files * write_delay
+    assert (
+        async_stall_time < sync_stall_time / 2
+    ), f"Async save stalled the training loop for {async_stall_time:.3f}s vs {sync_stall_time:.3f}s for the sync save"
+
+    # The async checkpoint matches the states at the time of the save
+    for store_folder in [sync_store_folder, async_store_folder]:
+        new_model = init_dummy_model(parallel_context=parallel_context)
+        load_weights(model=new_model, parallel_context=parallel_context, root_folder=store_folder)
+        for (name, param), new_param in zip(model.state_dict().items(), new_model.state_dict().values()):
+            torch.testing.assert_close(new_param, param - 1, atol=0, rtol=0, msg=lambda msg: f"{name}\n{msg}")
+    assert load_random_states(parallel_context=parallel_context, root_folder=async_store_folder) == random_states
+
+    parallel_context.destroy()
@@ -0,0 +1,53 @@
+import torch
+from nanotron.generation.decode import GenerationStates, StoppingCriteria, are_all_masked
+from nanotron.generation.generate_store import Store
+
+
+class CharTokenizer:
+    """Each token id is the code point of a character"""
+
+    def batch_decode(self, sequences):
+        return ["".join(chr(token_id) for token_id in sequence.tolist()) for sequence in sequences]
+
+
+def get_state(batch_size: int) -> GenerationStates:
+    input_ids = torch.zeros(batch_size, 1, dtype=torch.long)
+    input_mask = torch.ones(batch_size, 1, dtype=torch.bool)
+    return GenerationStates(
+        new_input_ids=input_ids,
+        new_input_mask=input_mask,
+        store=Store(),
+        generation_ids=[input_ids],
+        generation_mask=[input_mask],
+    )
+
+
+def test_stopping_criteria_masks_tokens_after_eos():
+    eos_token_id = 0
+    stopping_criteria = StoppingCriteria(eos_token_id=eos_token_id)
+    state = get_state(batch_size=3)
+
+    masks = []
+    for new_input_ids in [[5, 0, 7], [0, 3, 8], [4, 2, 9]]:
+        masks.append(stopping_criteria.update(state, torch.tensor(new_input_ids)[:, None]))
+
+    # The EOS token is kept, the tokens generated afterwards are masked
+    assert torch.cat(masks, dim=-1).tolist() == [[True, True, False], [True, False, False], [True, True, True]]
+    assert state.finished.tolist() == [True, True, False]
+    assert not are_all_masked([masks[-1][:, -1]])
+    assert are_all_masked([torch.zeros(2, dtype=torch.bool), ~state.finished[:2]])
+    assert not are_all_masked([None])
+
+
+def test_stopping_criteria_stop_strings():
+    stopping_criteria = StoppingCriteria(stop_strings=["\n\n", "###"], tokenizer=CharTokenizer())
+    state = get_state(batch_size=2)
+
+    # The new token of each sequence
+    stopping_criteria.update(state, torch.tensor([[ord("\n")], [ord("#")]]))
+    stopping_criteria.update(state, torch.tensor([[ord("\n")], [ord("#")]]))
+    assert state.finished.tolist() == [True, False]
+    stopping_criteria.update(state, torch.tensor([[ord("a")], [ord("#")]]))
+    assert state.finished.tolist() == [True, True]
+    # Only the last tokens are kept to look for the stop strings
+    assert state.recent_ids.shape == (2, 3)
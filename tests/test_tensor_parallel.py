@@ -7,11 +7,18 @@ from nanotron import distributed as dist
 from nanotron.distributed import get_global_rank
 from nanotron.parallel import ParallelContext
 from nanotron.parallel.tensor_parallel.enum import TensorParallelLinearMode
+from nanotron.parallel.tensor_parallel.functional import (
+    column_linear,
+    sharded_cross_entropy,
+    sharded_linear_cross_entropy,
+)
 from nanotron.parallel.tensor_parallel.nn import (
     TensorParallelColumnLinear,
     TensorParallelEmbedding,
     TensorParallelRowLinear,
 )
+from nanotron.utils import find_free_port
+from torch import multiprocessing as mp
 from torch import nn as torch_nn
 
 
@@ -400,3 +407,54 @@ def _test_tensor_parallel_embedding(parallel_context: ParallelContext, tp_mode:
     )
 
     parallel_context.destroy()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 64])
+@rerun_if_address_is_in_use()
+def test_sharded_linear_cross_entropy_on_cpu(chunk_size: int):
+    mp.spawn(_test_sharded_linear_cross_entropy_on_cpu, args=(chunk_size, find_free_port()), nprocs=2)
+
+
+def _test_sharded_linear_cross_entropy_on_cpu(rank: int, chunk_size: int, port: int):
+    dist.init_process_group(backend="gloo", init_method=f"tcp://localhost:{port}", rank=rank, world_size=2)
+    group = dist.group.WORLD
+    seq_length, batch_size, hidden_size, vocab_size = 7, 3, 16, 10
+
+    # Same inputs on both ranks, each one holding half of the vocabulary
+    generator = torch.Generator().manual_seed(0)
+    input = torch.randn(seq_length, batch_size, hidden_size, generator=generator)
+    weight = torch.randn(vocab_size, hidden_size, generator=generator)
+    target = torch.randint(0, vocab_size, (seq_length, batch_size), generator=generator)
+    grad_output = torch.randn(seq_length, batch_size, generator=generator)
+    sharded_weight = weight.chunk(2)[rank]
+
+    reference_input = input.clone().requires_grad_()
+    reference_weight = sharded_weight.clone().requires_grad_()
+    reference_logits = column_linear(
+        reference_input,
+        reference_weight,
+        None,
+        group=group,
+        tp_mode=TensorParallelLinearMode.ALL_REDUCE,
+        async_communication=False,
+    )
+    reference_loss = sharded_cross_entropy(reference_logits, target, group=group, dtype=torch.float)
+    reference_loss.backward(grad_output)
+
+    chunked_input = input.clone().requires_grad_()
+    chunked_weight = sharded_weight.clone().requires_grad_()
+    loss = sharded_linear_cross_entropy(
+        chunked_input,
+        chunked_weight,
+        target,
+        group=group,
+        tp_mode=TensorParallelLinearMode.ALL_REDUCE,
+        chunk_size=chunk_size,
+    )
+    loss.backward(grad_output)
+
+    torch.testing.assert_close(loss, reference_loss)
+    torch.testing.assert_close(chunked_input.grad, reference_input.grad)
+    torch.testing.assert_close(chunked_weight.grad, reference_weight.grad)
+
+    dist.destroy_process_group()
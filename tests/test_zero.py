@@ -7,17 +7,32 @@ from helpers.dummy import dummy_infinite_data_loader, init_dummy_model
 from helpers.exception import assert_fail_with
 from helpers.utils import available_gpus, init_distributed, rerun_if_address_is_in_use
 from nanotron import distributed as dist
-from nanotron.optim import NamedOptimizer, ZeroDistributedOptimizer
+from nanotron.optim import NamedOptimizer, OptimizerFromGradientAccumulator, ZeroDistributedOptimizer
+from nanotron.optim.gradient_accumulator import ShardedFP32GradientAccumulator
 from nanotron.optim.zero import SlicedFlatTensor
 from nanotron.parallel import ParallelContext
+from nanotron.parallel.data_parallel.fully_sharded import (
+    FullyShardedParameters,
+    has_sharded_parameters,
+    is_fully_sharded,
+    iter_materialized_named_parameters,
+    iter_unsharded_state_dict,
+    iter_unsharded_state_dicts_per_block,
+    release_parameters,
+    unshard_parameters,
+)
 from nanotron.parallel.data_parallel.utils import sync_gradients_across_dp
 from nanotron.parallel.parameters import NanotronParameter
+from nanotron.parallel.pipeline_parallel.block import PipelineBlock
 from nanotron.parallel.pipeline_parallel.engine import AllForwardAllBackwardPipelineEngine
+from nanotron.parallel.pipeline_parallel.p2p import P2P
 from nanotron.parallel.pipeline_parallel.tensor_pointer import TensorPointer
 from nanotron.parallel.tensor_parallel import nn
 from nanotron.parallel.tensor_parallel.enum import TensorParallelLinearMode
 from nanotron.parallel.tied_parameters import sync_tied_weights_gradients
 from nanotron.random import RandomStates, branch_random_state, get_current_random_state, get_synced_random_state
+from nanotron.utils import find_free_port, get_untyped_storage
+from torch import multiprocessing as mp
 from torch import nn as torch_nn
 from torch.nn.parallel import DistributedDataParallel
 
@@ -543,3 +558,279 @@ def _test_sliced_flat_tensor(parallel_context: ParallelContext):
     assert not isinstance(c, SlicedFlatTensor)
 
     parallel_context.destroy()
+
+
+@pytest.mark.parametrize("dp", [2, 3])
+@pytest.mark.parametrize("bucket_cap_mb", [0, 25])
+@rerun_if_address_is_in_use()
+def test_sharded_fp32_gradient_accumulator_on_cpu(dp: int, bucket_cap_mb: int):
+    # ZeRO stage 2 only relies on collectives that are available on CPU with gloo
+    mp.spawn(_test_sharded_fp32_gradient_accumulator_on_cpu, args=(dp, find_free_port(), bucket_cap_mb), nprocs=dp)
+
+
+def _test_sharded_fp32_gradient_accumulator_on_cpu(rank: int, dp: int, port: int, bucket_cap_mb: int):
+    dist.init_process_group(backend="gloo", init_method=f"tcp://localhost:{port}", rank=rank, world_size=dp)
+    dp_pg = dist.new_group(ranks=list(range(dp)), backend="gloo")
+
+    # Same parameters and inputs on all ranks, `scale` is too small to be split across all ranks
+    torch.manual_seed(42)
+    named_params = [
+        ("weight", NanotronParameter(torch.randn(7, 5, dtype=torch.bfloat16))),
+        ("bias", NanotronParameter(torch.randn(5, dtype=torch.bfloat16))),
+        ("scale", NanotronParameter(torch.randn(2, dtype=torch.bfloat16))),
+    ]
+    nb_microbatches = 2
+    inputs = torch.randn(dp, nb_microbatches, 3, 7)
+
+    def loss_fn(params, input):
+        weight, bias, scale = [param.float() for param in params]
+        return ((input @ weight + bias) * scale.sum()).pow(2).sum()
+
+    # The reference gradients are averaged across DP and accumulated across micro batches
+    reference_params = [param.detach().float().requires_grad_() for _, param in named_params]
+    for dp_rank in range(dp):
+        for input in inputs[dp_rank]:
+            (loss_fn(reference_params, input) / dp).backward()
+
+    optimizer = ZeroDistributedOptimizer(
+        named_params_or_groups=named_params,
+        optimizer_builder=lambda named_param_groups: OptimizerFromGradientAccumulator(
+            gradient_accumulator_builder=lambda named_params_in_rank: ShardedFP32GradientAccumulator(
+                named_parameters=named_params_in_rank,
+                grad_buckets_named_params=named_params,
+                dp_pg=dp_pg,
+                bucket_cap_mb=bucket_cap_mb,
+            ),
+            named_params_or_groups=named_param_groups,
+            optimizer_builder=lambda named_param_groups: NamedOptimizer(
+                named_params_or_groups=named_param_groups,
+                optimizer_builder=lambda param_groups: torch.optim.SGD(param_groups, lr=1.0),
+            ),
+        ),
+        dp_pg=dp_pg,
+    )
+    grad_accumulator = optimizer.optimizer.gradient_accumulator
+    grad_accumulator.assign_param_offsets(
+        param_name_to_offsets=optimizer.param_name_to_dp_rank_offsets, dp_rank=dist.get_rank(dp_pg)
+    )
+    assert len(grad_accumulator.buckets) == (len(named_params) if bucket_cap_mb == 0 else 1)
+
+    for _ in range(2):
+        optimizer.zero_grad()
+        for input in inputs[rank]:
+            grad_accumulator.backward(loss_fn([param for _, param in named_params], input))
+            # Half precision gradients are freed once reduced
+            assert all(param.grad is None for _, param in named_params)
+
+        # Only this rank's slices of the gradients are kept in fp32
+        assert grad_accumulator._contiguous_fp32_grad_buffer.numel() == sum(
+            end - start for start, end in grad_accumulator.param_name_to_offsets.values()
+        )
+        for (name, _), reference_param in zip(named_params, reference_params):
+            start, end = grad_accumulator.param_name_to_offsets.get(name, (0, 0))
+            expected_grad = reference_param.grad.view(-1)[start:end]
+            torch.testing.assert_close(grad_accumulator.get_grad_buffer(name), expected_grad, rtol=1e-2, atol=1e-2)
+            if name in grad_accumulator.parameters:
+                fp32_param = grad_accumulator.parameters[name]["fp32"]
+                torch.testing.assert_close(fp32_param.grad.view(-1), expected_grad, rtol=1e-2, atol=1e-2)
+
+    dist.destroy_process_group()
+
+
+class ShardedTestBlock(torch_nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.weight = NanotronParameter(torch.randn(5, 7, dtype=torch.bfloat16))
+        self.bias = NanotronParameter(torch.randn(7, dtype=torch.bfloat16))
+
+    def forward(self, x: torch.Tensor):
+        return torch.tanh(x @ self.weight.float() + self.bias.float())[:, :5]
+
+
+@pytest.mark.parametrize("dp", [2, 3])
+@rerun_if_address_is_in_use()
+def test_fully_sharded_parameters_on_cpu(dp: int):
+    # ZeRO stage 3 only relies on collectives that are available on CPU with gloo
+    mp.spawn(_test_fully_sharded_parameters_on_cpu, args=(dp, find_free_port()), nprocs=dp)
+
+
+def _test_fully_sharded_parameters_on_cpu(rank: int, dp: int, port: int):
+    dist.init_process_group(backend="gloo", init_method=f"tcp://localhost:{port}", rank=rank, world_size=dp)
+    dp_pg = dist.new_group(ranks=list(range(dp)), backend="gloo")
+    # No pipeline parallelism, each rank runs all the blocks
+    pp_pgs = [dist.new_group(ranks=[dp_rank], backend="gloo") for dp_rank in range(dp)]
+    p2p = P2P(pp_pgs[rank], device=torch.device("cpu"))
+
+    torch.manual_seed(42)
+    model = torch_nn.ModuleList(
+        [
+            PipelineBlock(
+                p2p=p2p,
+                module_builder=ShardedTestBlock,
+                module_kwargs={},
+                module_input_keys={"x"},
+                module_output_keys={"x"},
+            )
+            for _ in range(2)
+        ]
+    )
+    for block in model:
+        block.build_and_set_rank(0)
+    named_params = list(model.named_parameters())
+    nb_microbatches = 2
+    inputs = torch.randn(dp, nb_microbatches, 3, 5)
+
+    def loss_fn(x):
+        for block in model:
+            x = block(x=x)["x"]
+        return x.pow(2).sum()
+
+    # The reference gradients are averaged across DP and accumulated across micro batches
+    reference_model = [ShardedTestBlock(), ShardedTestBlock()]
+    for reference_block, block in zip(reference_model, model):
+        for name, reference_param in reference_block.named_parameters():
+            reference_param.data = getattr(block.pp_block, name).detach().float()
+    for dp_rank in range(dp):
+        for input in inputs[dp_rank]:
+            x = input
+            for reference_block in reference_model:
+                x = reference_block(x)
+            (x.pow(2).sum() / dp).backward()
+
+    param_sharder = FullyShardedParameters(model=model, named_parameters=named_params, dp_pg=dp_pg)
+    optimizer = ZeroDistributedOptimizer(
+        named_params_or_groups=named_params,
+        optimizer_builder=lambda named_param_groups: OptimizerFromGradientAccumulator(
+            gradient_accumulator_builder=lambda named_params_in_rank: ShardedFP32GradientAccumulator(
+                named_parameters=named_params_in_rank,
+                grad_buckets_named_params=named_params,
+                dp_pg=dp_pg,
+                grad_buckets_names=param_sharder.get_blocks_param_names(),
+            ),
+            named_params_or_groups=named_param_groups,
+            optimizer_builder=lambda named_param_groups: NamedOptimizer(
+                named_params_or_groups=named_param_groups,
+                optimizer_builder=lambda param_groups: torch.optim.SGD(param_groups, lr=1.0),
+            ),
+        ),
+        dp_pg=dp_pg,
+        param_sharder=param_sharder,
+    )
+    grad_accumulator = optimizer.optimizer.gradient_accumulator
+    grad_accumulator.assign_param_offsets(
+        param_name_to_offsets=optimizer.param_name_to_dp_rank_offsets, dp_rank=dist.get_rank(dp_pg)
+    )
+    param_sharder.register_post_backward_hook(grad_accumulator.reduce_scatter_grads)
+    # One gradient bucket per block
+    assert len(param_sharder.blocks) == len(grad_accumulator.buckets) == 2
+    assert is_fully_sharded(model) and has_sharded_parameters(model)
+
+    optimizer.zero_grad()
+    for input in inputs[rank]:
+        grad_accumulator.backward(loss_fn(input))
+        # The parameters are released once their gradients are reduce-scattered
+        assert all(get_untyped_storage(param).size() == 0 for _, param in named_params)
+        assert all(param.grad is None for _, param in named_params)
+
+    reference_params = {
+        f"{block_idx}.pp_block.{name}": param
+        for block_idx, reference_block in enumerate(reference_model)
+        for name, param in reference_block.named_parameters()
+    }
+    for name, _ in named_params:
+        start, end = grad_accumulator.param_name_to_offsets.get(name, (0, 0))
+        expected_grad = reference_params[name].grad.view(-1)[start:end]
+        torch.testing.assert_close(grad_accumulator.get_grad_buffer(name), expected_grad, rtol=1e-2, atol=1e-2)
+
+    # Each rank updates its shards
+    optimizer.step()
+    with torch.no_grad():
+        for reference_param in reference_params.values():
+            reference_param -= reference_param.grad
+    with unshard_parameters(model):
+        for name, param in named_params:
+            torch.testing.assert_close(param.float(), reference_params[name], rtol=1e-2, atol=1e-2)
+            assert_tensor_equal_over_group(param, group=dp_pg)
+    assert has_sharded_parameters(model)
+
+    # Loaded weights are written back to the shards
+    with unshard_parameters(model, write_back=True):
+        for _, param in named_params:
+            param.data.fill_(1.0)
+    unsharded_state_dict = {name: tensor.clone() for name, tensor in iter_unsharded_state_dict(model)}
+    assert set(unsharded_state_dict) == {name for name, _ in named_params}
+    assert all((tensor == 1.0).all() for tensor in unsharded_state_dict.values())
+    assert has_sharded_parameters(model)
+
+    dist.destroy_process_group()
+
+
+class UnusedParamTestBlock(ShardedTestBlock):
+    def __init__(self):
+        super().__init__()
+        self.unused = NanotronParameter(torch.randn(3, dtype=torch.bfloat16))
+
+
+@pytest.mark.parametrize("dp", [2, 3])
+@rerun_if_address_is_in_use()
+def test_fully_sharded_parameters_released_on_build_on_cpu(dp: int):
+    mp.spawn(_test_fully_sharded_parameters_released_on_build_on_cpu, args=(dp, find_free_port()), nprocs=dp)
+
+
+def _test_fully_sharded_parameters_released_on_build_on_cpu(rank: int, dp: int, port: int):
+    dist.init_process_group(backend="gloo", init_method=f"tcp://localhost:{port}", rank=rank, world_size=dp)
+    dp_pg = dist.new_group(ranks=list(range(dp)), backend="gloo")
+    pp_pgs = [dist.new_group(ranks=[dp_rank], backend="gloo") for dp_rank in range(dp)]
+    p2p = P2P(pp_pgs[rank], device=torch.device("cpu"))
+
+    model = torch_nn.ModuleList(
+        [
+            PipelineBlock(
+                p2p=p2p,
+                module_builder=UnusedParamTestBlock,
+                module_kwargs={},
+                module_input_keys={"x"},
+                module_output_keys={"x"},
+            )
+            for _ in range(2)
+        ]
+    )
+    for block in model:
+        block.build_and_set_rank(0)
+        release_parameters(block)
+    named_params = list(model.named_parameters())
+    assert all(get_untyped_storage(param).size() == 0 for _, param in named_params)
+
+    param_sharder = FullyShardedParameters(model=model, named_parameters=named_params, dp_pg=dp_pg)
+    assert has_sharded_parameters(model)
+
+    # Each block is initialized unsharded, with the same values on all the DP ranks
+    with torch.no_grad():
+        for name, param in iter_materialized_named_parameters(model):
+            assert get_untyped_storage(param).size() > 0
+            param.fill_(len(name))
+    assert all(get_untyped_storage(param).size() == 0 for _, param in named_params)
+    with unshard_parameters(model):
+        assert all((param == len(name)).all() for name, param in named_params)
+
+    # Each block is loaded unsharded
+    for block_state_dict in iter_unsharded_state_dicts_per_block(model, state_dict=model.state_dict()):
+        assert not has_sharded_parameters(model, state_dict=block_state_dict)
+        assert has_sharded_parameters(model)
+        for tensor in block_state_dict.values():
+            tensor.fill_(1.0)
+    with unshard_parameters(model):
+        assert all((param == 1.0).all() for _, param in named_params)
+
+    # The blocks whose parameters don't all get a gradient are released at the end of the backward
+    post_backward_names = []
+    param_sharder.register_post_backward_hook(post_backward_names.append)
+    x = torch.randn(3, 5)
+    for block in model:
+        x = block(x=x)["x"]
+    x.sum().backward()
+    assert post_backward_names == param_sharder.get_blocks_param_names()
+    assert all(get_untyped_storage(param).size() == 0 for _, param in named_params)
+    assert not any(block.is_in_backward for block in param_sharder.blocks)
+
+    dist.destroy_process_group()